@@ -0,0 +1,4 @@
+# THIS FILE IS GENERATED BY RTMPY SETUP.PY
+from pyamf.versions import Version
+
+version = Version(0, 2, 'dev')
@@ -16,55 +16,662 @@
 """
 RTMP client implementation.
 
+Example usage::
+
+    def play(stream):
+        return stream.play('livestream', subscriber)
+
+    d = client.connect('rtmp://localhost/live')
+    d.addCallback(lambda nc: nc.openStream())
+    d.addCallback(play)
+
+See L{rtmpy.scripts.load} for opening a large number of connections.
+
 @since: 0.1.0
 """
 
-from twisted.internet import protocol as twisted_protocol
+import urlparse
+
+from twisted.internet import protocol, defer
+import pyamf
+
+from rtmpy import exc, message, rpc, core, versions
+from rtmpy.protocol import rtmp
+from rtmpy.protocol.rtmp import handshake
+from rtmpy.status import codes
+
+
+#: The port used when the url does not supply one.
+DEFAULT_PORT = 1935
+
+
+def getStatusCode(info):
+    """
+    Returns the C{code} of a status object received from the peer.
+    """
+    try:
+        return info['code']
+    except (KeyError, TypeError):
+        return getattr(info, 'code', None)
+
+
+def getStatusError(info, default=exc.CallFailed):
+    """
+    Returns an exception instance for an error status received from the
+    peer, based on its C{code}.
+    """
+    cls = exc.classByCode(getStatusCode(info)) or default
+
+    try:
+        description = info['description']
+    except (KeyError, TypeError):
+        description = getattr(info, 'description', '')
 
-from rtmpy import protocol, versions
-from rtmpy.protocol import handshake
+    return cls(description or getStatusCode(info))
 
 
-class ClientProtocol(protocol.BaseProtocol):
+def getRedirect(info):
     """
-    Client RTMP Protocol.
+    Returns the url a status object received from the peer redirects to, if
+    any.
     """
+    try:
+        ex = info['ex']
+    except (KeyError, TypeError):
+        ex = getattr(info, 'ex', None)
+
+    try:
+        return ex['redirect']
+    except (KeyError, TypeError):
+        return getattr(ex, 'redirect', None)
+
+
+def isError(info):
+    """
+    Whether the status object received from the peer is an error.
+    """
+    try:
+        return info['level'] == 'error'
+    except (KeyError, TypeError):
+        return getattr(info, 'level', None) == 'error'
+
+
+
+class NetStream(core.NetStream):
+    """
+    A client side NetStream, see L{NetConnection.openStream}.
+
+    @ivar state: The state of the stream. Right now the only valid values are
+        C{None}, C{'playing'}, C{'publishing'} and C{'closing'} (waiting for
+        the peer to confirm that publishing has stopped).
+    @ivar name: The name of the stream being played or published.
+    @ivar subscriber: Receives the audio/video/meta data while playing.
+    @type subscriber: L{rtmpy.server.IPublishingStream}
+    """
+
+
+    def __init__(self, nc, streamId):
+        core.NetStream.__init__(self, nc, streamId)
+
+        self.state = None
+        self.name = None
+        self.subscriber = None
+
+        self._starting = None
+        self._audioChannel = None
+        self._videoChannel = None
+
+
+    def play(self, name, subscriber, start=None):
+        """
+        Asks the peer to play the stream C{name}. The audio/video/meta data is
+        passed to C{subscriber}.
+
+        @param start: Where to start playing a recorded stream, in seconds.
+            C{-1} only plays a live stream. By default a live stream is
+            played if there is one, the recorded stream otherwise.
+
+        @return: A L{defer.Deferred} that fires with this stream once the peer
+            has started playing.
+        """
+        if self.state is not None:
+            raise exc.PlayError('Stream is already %s' % (self.state,))
+
+        self.state = 'playing'
+        self.name = name
+        self.subscriber = subscriber
+
+        d = self._starting = defer.Deferred()
+
+        if start is None:
+            self.call('play', name)
+        else:
+            self.call('play', name, start)
+
+        return d
+
+
+    def publish(self, name, type_='live'):
+        """
+        Asks the peer to accept the audio/video/meta data for the stream
+        C{name}, see L{sendVideo}, L{sendAudio} and L{sendMetaData}.
+
+        @return: A L{defer.Deferred} that fires with this stream once the peer
+            has started accepting the data.
+        """
+        if self.state is not None:
+            raise exc.PublishError('Stream is already %s' % (self.state,))
+
+        self.state = 'publishing'
+        self.name = name
+
+        d = self._starting = defer.Deferred()
+
+        self.call('publish', name, type_)
+
+        return d
+
+
+    def seek(self, offset):
+        """
+        Moves the playback of a recorded stream to C{offset} milliseconds.
+        """
+        self.call('seek', offset)
+
+
+    def close(self):
+        """
+        Stops playing (or publishing) and asks the peer to delete this stream.
+        """
+        self.call('closeStream')
+        self.nc.call('deleteStream', self.streamId)
+
+        if self.state == 'publishing':
+            # the peer confirms with a status on this stream, which is
+            # forgotten once that has arrived
+            self.state = 'closing'
+
+            return
+
+        self.nc.deleteStream(self.streamId)
+
+
+    def sendVideo(self, data, timestamp):
+        """
+        Sends a video packet to the peer while publishing. C{data} is written
+        as is.
+        """
+        self._videoChannel.sendData(data, timestamp)
+
+
+    def sendAudio(self, data, timestamp):
+        """
+        Sends an audio packet to the peer while publishing.
+        """
+        self._audioChannel.sendData(data, timestamp)
+
+
+    def sendMetaData(self, data):
+        """
+        Sets the meta data of the stream being published.
+        """
+        self.sendMessage(message.Notify('@setDataFrame', 'onMetaData', data))
+
+
+    def _publishingStarted(self):
+        self._audioChannel = self.nc.getStreamingChannel(self)
+        self._audioChannel.setType(message.AUDIO_DATA)
+
+        self._videoChannel = self.nc.getStreamingChannel(self)
+        self._videoChannel.setType(message.VIDEO_DATA)
+
+        self._fireStarted(self)
+
+
+    def _fireStarted(self, result):
+        d, self._starting = self._starting, None
+
+        if d is None:
+            return
+
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+    @rpc.expose
+    def closeStream(self):
+        """
+        Called when the stream has been deleted (or the connection lost).
+        """
+        subscriber = self.subscriber
+
+        if self.nc.redirect is not None:
+            error = exc.Redirect(self.nc.redirect)
+        elif self.state in ('publishing', 'closing'):
+            error = exc.PublishError('Stream closed')
+        else:
+            error = exc.PlayError('Stream closed')
+
+        self.state = None
+        self.subscriber = None
+        self._audioChannel = self._videoChannel = None
+
+        self._fireStarted(error)
+
+        if subscriber is not None:
+            subscriber.unpublish()
+
+
+    @rpc.expose
+    def onStatus(self, info):
+        """
+        Called when the status of the stream has changed.
+        """
+        code = getStatusCode(info)
+
+        if code == codes.NS_PLAY_START:
+            self._fireStarted(self)
+        elif code == codes.NS_PUBLISH_START:
+            self._publishingStarted()
+        elif code == codes.NS_UNPUBLISHED_SUCCESS:
+            self.nc.deleteStream(self.streamId)
+        elif code == codes.NS_PLAY_UNPUBLISHNOTIFY or isError(info):
+            if isError(info):
+                if self.state == 'publishing':
+                    default = exc.PublishError
+                else:
+                    default = exc.PlayError
+
+                self._fireStarted(getStatusError(info, default))
+
+            self.closeStream()
+
+
+    @rpc.expose
+    def onMetaData(self, data):
+        if self.subscriber is not None:
+            self.subscriber.onMetaData(data)
+
+
+    def onVideoData(self, data, timestamp):
+        """
+        Called when a video packet has been received from the peer.
+        """
+        if self.subscriber is not None:
+            self.subscriber.videoDataReceived(data, timestamp)
+
+
+    def onAudioData(self, data, timestamp):
+        """
+        Called when an audio packet has been received from the peer.
+        """
+        if self.subscriber is not None:
+            self.subscriber.audioDataReceived(data, timestamp)
+
+
+    def onControlMessage(self, *args):
+        """
+        """
+
+
+
+class MediaCounter(object):
+    """
+    A subscriber (see L{NetStream.play}) that counts the audio/video played to
+    it without looking at the payloads. Useful for load testing.
+
+    @ivar bytes: The number of audio/video bytes received.
+    @ivar packets: The number of audio/video packets received.
+    @ivar firstPacket: When the first packet was received (see
+        C{clock.seconds}), C{None} until then.
+    @ivar unpublished: Whether the stream has stopped playing.
+    """
+
+
+    def __init__(self, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.clock = clock
+
+        self.bytes = 0
+        self.packets = 0
+        self.firstPacket = None
+        self.unpublished = False
+
+
+    def _count(self, data):
+        if self.firstPacket is None:
+            self.firstPacket = self.clock.seconds()
+
+        self.bytes += len(data)
+        self.packets += 1
+
+
+    def videoDataReceived(self, data, timestamp):
+        self._count(data)
+
+
+    def audioDataReceived(self, data, timestamp):
+        self._count(data)
+
+
+    def onMetaData(self, data):
+        pass
+
+
+    def unpublish(self):
+        self.unpublished = True
+
+
+
+class NetConnection(core.NetConnection):
+    """
+    Client side NetConnection implementation.
+
+    @ivar connected: Whether the peer has accepted the connect request.
+    @ivar info: The status object the peer accepted the connection with.
+    @ivar redirect: The url the peer has redirected us to, if any. The peer
+        closes the connection afterwards and the streams fail with
+        L{exc.Redirect}.
+    """
+
+    objectEncoding = pyamf.AMF0
+
+
+    def __init__(self, protocol):
+        core.NetConnection.__init__(self, protocol)
+
+        self.connected = False
+        self.info = None
+        self.redirect = None
+
+
+    def buildStream(self, streamId):
+        """
+        """
+        return NetStream(self, streamId)
+
+
+    def connect(self, params, *args):
+        """
+        Asks the peer to connect this C{NetConnection} to an application.
+
+        @param params: The connection parameters, e.g. C{app} and C{tcUrl}.
+        @type params: C{dict}
+        @param args: Passed to the application along with C{params}.
+        @return: A L{defer.Deferred} that fires with this C{NetConnection}
+            once the peer has accepted the connection.
+        """
+        d = self.call('connect', params, *args, notify=True)
+
+        def cb(result):
+            info = result[-1]
+
+            if getStatusCode(info) != codes.NC_CONNECT_SUCCESS:
+                raise getStatusError(info, exc.ConnectFailed)
+
+            self.connected = True
+            self.info = info
+
+            return self
+
+        d.addCallback(cb)
+
+        return d
+
+
+    def openStream(self):
+        """
+        Asks the peer to create a new stream.
+
+        @return: A L{defer.Deferred} that fires with the new L{NetStream}.
+        """
+        d = self.call('createStream', notify=True)
+
+        def cb(result):
+            streamId = int(result[-1])
+            stream = self.streams[streamId] = self.buildStream(streamId)
+
+            return stream
+
+        d.addCallback(cb)
+
+        return d
+
+
+    @rpc.expose
+    def onStatus(self, info):
+        """
+        Called when the status of the connection has changed.
+        """
+        if getStatusCode(info) == codes.NC_CONNECT_REJECTED:
+            self.redirect = getRedirect(info)
+
+
+    @rpc.expose
+    def onBWDone(self, *args):
+        """
+        Sent by some servers once bandwidth detection has finished.
+        """
+
+
+    def closeStream(self):
+        """
+        Called when the connection has been lost. Any calls still waiting for
+        a response are failed.
+        """
+        self.connected = False
+
+        for callId, context in self._activeCalls.items():
+            if not context or not isinstance(context[0], defer.Deferred):
+                continue
+
+            self.discardCall(callId)
+
+            context[0].errback(exc.ConnectError('Connection lost (%s)' % (
+                context[1],)))
+
+
+    def sendMessage(self, msg, stream=None):
+        """
+        """
+        self.protocol.sendMessage(msg, stream or self)
+
+
+    def getStreamingChannel(self, stream):
+        return self.protocol.getStreamingChannel(stream)
+
+
+
+class ClientProtocol(rtmp.RTMPProtocol):
+    """
+    Client side RTMP protocol implementation. Once the handshake has
+    completed, the connect request is made using the factory's C{params}.
+    """
+
+    netconnection = NetConnection
 
     version = versions.FLASH_MIN_H264
-    protocolVersion = protocol.RTMP_PROTOCOL_VERSION
+    protocolVersion = 3
+
+
+    def buildStreamManager(self):
+        return self.nc
+
 
     def connectionMade(self):
         """
-        Called when a connection has been made to this protocol instance. Used
-        to do general setup and protocol initialisation.
+        Sends the protocol version and starts the handshake straight away, the
+        server waits for the client to go first.
+        """
+        rtmp.RTMPProtocol.connectionMade(self)
+
+        self.transport.write(chr(self.protocolVersion))
+
+        self.handshaker = self.buildHandshakeNegotiator()
+        self.handshaker.start(0, 0)
+
+
+    def startHandshaking(self):
+        """
+        The handshake was started when the connection was made.
         """
-        rtmp.BaseProtocol.connectionMade(self)
 
-        self.negotiator = self.factory.getHandshakeNegotiator(self, self.protocolVersion)
 
-        self.negotiator.start(0, self.version)
+    def handshakeSuccess(self, data):
+        """
+        Starts streaming and asks the peer to connect to the application.
+        """
+        rtmp.RTMPProtocol.handshakeSuccess(self, data)
+
+        f = self.factory
+
+        d = self.nc.connect(f.params, *f.args)
+
+        d.addErrback(self.connectFailed)
+        d.addCallbacks(f.connected, f.failed)
+
+
+    def connectFailed(self, fail):
+        """
+        The peer did not accept the connect request, there is no point in
+        staying connected.
+        """
+        self.transport.loseConnection()
+
+        return fail
+
+
+    def connectionLost(self, reason):
+        rtmp.RTMPProtocol.connectionLost(self, reason)
+
+        self.factory.failed(reason)
+
+
+    def startStreaming(self):
+        """
+        """
+        self.nc = self.netconnection(self)
 
-    def connectionLost(self, *args):
-        print args
+        rtmp.RTMPProtocol.startStreaming(self)
 
 
-class ClientFactory(twisted_protocol.ClientFactory):
+    def onUpstreamBandwidth(self, bandwidth, extra, timestamp):
+        """
+        The peer has set the bandwidth of this connection, which is
+        acknowledged with our bytes interval. The server waits for this
+        before accepting the connection.
+        """
+        self.nc.sendMessage(message.DownstreamBandwidth(bandwidth))
+
+
+    def closeStream(self):
+        """
+        Called when the connection has been lost.
+        """
+        self.nc.closeStream()
+
+
+    def onInvoke(self, name, callId, args, timestamp):
+        """
+        """
+        self.nc.onInvoke(name, callId, args, timestamp)
+
+
+    def onNotify(self, name, args, timestamp):
+        """
+        """
+        self.nc.onNotify(name, args, timestamp)
+
+
+    def onControlMessage(self, *args):
+        """
+        """
+
+
+    def onBytesRead(self, *args):
+        """
+        """
+
+
+
+class ClientFactory(protocol.ClientFactory):
     """
-    RTMP client protocol factory.
+    RTMP client protocol factory. Makes one connection to the application at
+    C{url}.
+
+    @ivar params: The connection parameters sent with the connect request.
+    @ivar args: Passed to the application along with C{params}.
+    @ivar deferred: Fires with the connected L{NetConnection}.
     """
 
     protocol = ClientProtocol
+    handshake = handshake.ClientNegotiator
+
+
+    def __init__(self, url, *args):
+        scheme, netloc, path = urlparse.urlparse(url)[:3]
+
+        if scheme != 'rtmp':
+            raise ValueError('Unsupported url %r' % (url,))
+
+        host, _, port = netloc.partition(':')
+
+        self.host = host
+        self.port = int(port or DEFAULT_PORT)
+
+        self.params = {
+            'app': path.strip('/'),
+            'tcUrl': url,
+            'flashVer': 'LNX %s' % (self.protocol.version,),
+            'objectEncoding': NetConnection.objectEncoding,
+        }
+        self.args = args
+
+        self.deferred = defer.Deferred()
 
-    def getHandshakeNegotiator(self, protocol, version):
-        """
-        Returns an implementation of L{handshake.IHandshakeNegotiator} based on
-        the version supplied.
 
-        @param protocol: The client protocol instance.
-        @type protocol: L{ClientProtocol}
-        @param version: The RTMP version request.
-        @type version: C{int}
+    def buildHandshakeNegotiator(self, observer, output):
         """
-        imp = handshake.get_implementation(version)
+        Returns a negotiator that will handshake with the server.
+        """
+        return self.handshake(observer, output)
+
+
+    def connected(self, nc):
+        if not self.deferred.called:
+            self.deferred.callback(nc)
+
+
+    def failed(self, reason):
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed(reason)
+
+
+
+def connect(url, *args, **kwargs):
+    """
+    Connects to the application at C{url}, e.g. C{rtmp://localhost/live}.
+
+    @param args: Passed to the application with the connect request.
+    @param kwargs: C{reactor} - defaults to the global reactor.
+    @return: A L{defer.Deferred} that fires with the connected
+        L{NetConnection}.
+    """
+    reactor = kwargs.get('reactor', None)
+
+    if reactor is None:
+        from twisted.internet import reactor
+
+    f = ClientFactory(url, *args)
+
+    reactor.connectTCP(f.host, f.port, f)
 
-        return imp.ClientNegotiator(imp.HandshakeObserver(protocol))
+    return f.deferred
@@ -0,0 +1,29 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Support for running RTMPy across a number of processes.
+
+A L{launcher<worker.run>} forks a number of workers that all accept
+connections on the same port. Published streams are recorded in a shared
+L{directory<directory.FileDirectory>} so that a worker can L{relay<relay>} a
+stream that is published on another worker to its own subscribers. Nodes on
+different hosts can share a L{directory.SQLiteDirectory} instead.
+
+Independent servers can split the streams between them with a
+L{placement<placement.Placement>}.
+
+@since: 0.2
+"""
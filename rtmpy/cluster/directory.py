@@ -0,0 +1,692 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stream directories map the names of published streams to the node (worker
+process or server) that owns them, so that a stream published on one node
+can be played on another.
+
+A directory provides L{IStreamDirectory}. L{MemoryDirectory} is shared by
+the applications in one process, L{FileDirectory} by the processes on one
+host and L{SQLiteDirectory} by the nodes that share a disk. The shared
+directories do their I/O in a thread of their own, so that a slow disk or a
+busy lock never blocks the reactor.
+
+@since: 0.2
+"""
+
+import os
+import fcntl
+import urllib
+
+from zope.interface import Interface, implements
+from twisted.internet import task, defer, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+
+#: The number of seconds an entry lives for without a heartbeat, see
+#: L{BaseDirectory.ttl}.
+DEFAULT_TTL = 30
+
+
+
+class IStreamDirectory(Interface):
+    """
+    Records which node owns each published stream.
+    """
+
+
+    def register(key, owner):
+        """
+        Claims the stream C{key} for C{owner}. The claim is atomic, it fails
+        if another owner has a live entry for C{key} (even one registered at
+        the same time by another process). The entry is kept alive by
+        heartbeats for as long as the owner is running.
+
+        @return: A L{defer.Deferred} that fires with whether C{owner} now owns
+            C{key}.
+        """
+
+
+    def unregister(key, owner):
+        """
+        Removes the entry for C{key}, if it is still owned by C{owner}.
+
+        @return: A L{defer.Deferred} that fires once the entry is removed.
+        """
+
+
+    def lookup(key):
+        """
+        Finds the owner of the stream C{key}.
+
+        @return: A L{defer.Deferred} that fires with the owner or C{None} if
+            the stream is not published (or its owner has stopped sending
+            heartbeats).
+        """
+
+
+    def refresh(owner):
+        """
+        Extends the life of all the entries owned by C{owner}.
+
+        @return: A L{defer.Deferred} that fires once they are extended.
+        """
+
+
+    def watch(key, cb):
+        """
+        Calls C{cb(key, owner)} once, when the stream C{key} has been
+        published.
+        """
+
+
+    def unwatch(key, cb):
+        """
+        Cancels a L{watch}.
+        """
+
+
+
+class BaseDirectory(object):
+    """
+    The heartbeat and watch logic shared by the directories. Subclasses store
+    the entries, see L{claim}, L{load}, L{remove} and L{touch}. These are
+    called through L{run}, in the directory's thread.
+
+    @ivar ttl: The number of seconds an entry lives for unless it is
+        refreshed. C{None} means that entries never expire. Once a stream
+        has been registered, its owner is refreshed every third of C{ttl}.
+    @ivar clock: Provides C{seconds} (which must be the same for all the
+        nodes sharing the directory) and C{callLater}.
+    @ivar watchers: A C{dict} of key -> list of callbacks, see L{watch}.
+    @ivar owned: A C{dict} of owner -> set of keys that were registered
+        through this instance.
+    @ivar pool: The thread the entries are stored and loaded in, started on
+        first use.
+    """
+
+    implements(IStreamDirectory)
+
+    #: Whether other processes can register entries, which are found by
+    #: polling the watched keys every C{pollInterval} seconds.
+    shared = True
+    pollInterval = 1.0
+
+
+    def __init__(self, ttl=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.ttl = ttl
+        self.clock = clock
+
+        self.watchers = {}
+        self.owned = {}
+        self.pool = None
+
+        self._heartbeats = {}
+        self._poller = None
+
+
+    def run(self, func, *args):
+        """
+        Calls C{func} (see L{claim}, L{load}, L{remove} and L{touch}) in the
+        directory's thread. The calls are made one at a time, in order.
+
+        @return: A L{defer.Deferred} that fires with the result of the call.
+        """
+        if self.pool is None:
+            self.startPool()
+
+        return threads.deferToThreadPool(self.reactor, self.pool, func, *args)
+
+
+    def startPool(self):
+        from twisted.internet import reactor
+
+        self.reactor = reactor
+
+        self.pool = ThreadPool(1, 1, name='rtmpy-directory')
+        self.pool.start()
+
+        self._shutdownTrigger = reactor.addSystemEventTrigger('during',
+            'shutdown', self.stopPool)
+
+
+    def stopPool(self):
+        """
+        Stops the thread, once the calls waiting for it have been made.
+        """
+        if self.pool is None:
+            return
+
+        pool, self.pool = self.pool, None
+        pool.stop()
+
+        try:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+        except (KeyError, ValueError, TypeError):
+            pass
+
+
+    def getExpiry(self):
+        """
+        Returns when an entry registered (or refreshed) now expires, C{None}
+        if it does not.
+        """
+        if self.ttl is None:
+            return None
+
+        return self.clock.seconds() + self.ttl
+
+
+    def isLive(self, expires):
+        return expires is None or expires > self.clock.seconds()
+
+
+    def register(self, key, owner):
+        def claimed(result):
+            if not result:
+                return False
+
+            self.owned.setdefault(owner, set()).add(key)
+            self.startHeartbeat(owner)
+
+            self.notify(key, owner)
+
+            return True
+
+        d = self.run(self.claim, key, owner, self.getExpiry())
+
+        return d.addCallback(claimed)
+
+
+    def unregister(self, key, owner):
+        keys = self.owned.get(owner, None)
+
+        if keys is not None:
+            keys.discard(key)
+
+            if not keys:
+                del self.owned[owner]
+                self.stopHeartbeat(owner)
+
+        return self.run(self.remove, key, owner)
+
+
+    def lookup(self, key):
+        def loaded(entry):
+            if entry is None:
+                return None
+
+            owner, expires = entry
+
+            if not self.isLive(expires):
+                return None
+
+            return owner
+
+        return self.run(self.load, key).addCallback(loaded)
+
+
+    def refresh(self, owner):
+        return self.run(self.touch, owner, self.getExpiry())
+
+
+    def startHeartbeat(self, owner):
+        """
+        Starts refreshing the entries of C{owner}, if they expire.
+        """
+        if self.ttl is None or owner in self._heartbeats:
+            return
+
+        def beat():
+            # the next beat waits for this one to finish
+            return self.refresh(owner).addErrback(log.err)
+
+        loop = self._heartbeats[owner] = task.LoopingCall(beat)
+        loop.clock = self.clock
+        loop.start(self.ttl / 3.0, now=False)
+
+
+    def stopHeartbeat(self, owner):
+        loop = self._heartbeats.pop(owner, None)
+
+        if loop is not None and loop.running:
+            loop.stop()
+
+
+    def watch(self, key, cb):
+        self.watchers.setdefault(key, []).append(cb)
+
+        if self.shared and self._poller is None:
+            self._poller = task.LoopingCall(self.poll)
+            self._poller.clock = self.clock
+            self._poller.start(self.pollInterval, now=False)
+
+
+    def unwatch(self, key, cb):
+        cbs = self.watchers.get(key, None)
+
+        if cbs is None or cb not in cbs:
+            return
+
+        cbs.remove(cb)
+
+        if not cbs:
+            del self.watchers[key]
+
+        self._checkPoller()
+
+
+    def notify(self, key, owner):
+        """
+        Calls the callbacks watching C{key}.
+        """
+        cbs = self.watchers.pop(key, None)
+
+        self._checkPoller()
+
+        if not cbs:
+            return
+
+        for cb in cbs:
+            try:
+                cb(key, owner)
+            except:
+                log.err()
+
+
+    def poll(self):
+        """
+        Looks for watched streams that have been registered by other
+        processes.
+
+        @return: A L{defer.Deferred} that fires once all the watched streams
+            have been looked up.
+        """
+        def found(owner, key):
+            if owner is not None and key in self.watchers:
+                self.notify(key, owner)
+
+        dl = []
+
+        for key in self.watchers.keys():
+            d = self.lookup(key)
+
+            d.addCallback(found, key)
+            d.addErrback(log.err)
+
+            dl.append(d)
+
+        return defer.gatherResults(dl)
+
+
+    def _checkPoller(self):
+        if self.watchers or self._poller is None:
+            return
+
+        poller, self._poller = self._poller, None
+
+        if poller.running:
+            poller.stop()
+
+
+    def close(self):
+        """
+        Stops the heartbeats, polling and the directory's thread.
+        """
+        for owner in self._heartbeats.keys():
+            self.stopHeartbeat(owner)
+
+        self.watchers = {}
+        self._checkPoller()
+
+        self.stopPool()
+
+
+    def claim(self, key, owner, expires):
+        """
+        Stores the entry for C{key}, unless another owner has a live entry for
+        it. Must be atomic across all the users of the directory.
+
+        @return: Whether the entry was stored.
+        """
+        raise NotImplementedError
+
+
+    def load(self, key):
+        """
+        Returns the C{(owner, expires)} entry for C{key} or C{None}.
+        """
+        raise NotImplementedError
+
+
+    def remove(self, key, owner):
+        """
+        Removes the entry for C{key} if it belongs to C{owner}.
+        """
+        raise NotImplementedError
+
+
+    def touch(self, owner, expires):
+        """
+        Sets the expiry of all the entries of C{owner}.
+        """
+        raise NotImplementedError
+
+
+
+class MemoryDirectory(BaseDirectory):
+    """
+    A stream directory kept in memory, for nodes (applications) that run in
+    the same process.
+
+    @ivar entries: A C{dict} of key -> C{(owner, expires)}.
+    """
+
+    shared = False
+
+
+    def __init__(self, ttl=None, clock=None):
+        BaseDirectory.__init__(self, ttl, clock)
+
+        self.entries = {}
+
+
+    def run(self, func, *args):
+        """
+        The entries are in memory, so C{func} is called straight away.
+        """
+        return defer.maybeDeferred(func, *args)
+
+
+    def claim(self, key, owner, expires):
+        entry = self.entries.get(key, None)
+
+        if entry is not None and entry[0] != owner and self.isLive(entry[1]):
+            return False
+
+        self.entries[key] = (owner, expires)
+
+        return True
+
+
+    def load(self, key):
+        return self.entries.get(key, None)
+
+
+    def remove(self, key, owner):
+        entry = self.entries.get(key, None)
+
+        if entry is not None and entry[0] == owner:
+            del self.entries[key]
+
+
+    def touch(self, owner, expires):
+        for key, entry in self.entries.items():
+            if entry[0] == owner:
+                self.entries[key] = (owner, expires)
+
+
+
+class FileDirectory(BaseDirectory):
+    """
+    A stream directory kept in a directory on the local filesystem, shared by
+    all the workers on one host.
+
+    Each published stream is a file (named after the quoted stream key) that
+    contains the id of the owning node and, if entries expire, the expiry
+    time on a second line. Files are replaced atomically so readers never see
+    a partial entry. Entries are only changed whilst holding the C{flock} on
+    the C{+lock} file, which is released by the system if the process holding
+    it dies.
+
+    @ivar path: The directory that holds the entries.
+    """
+
+
+    def __init__(self, path, ttl=None, clock=None):
+        BaseDirectory.__init__(self, ttl, clock)
+
+        self.path = path
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+
+    def _getPath(self, key):
+        return os.path.join(self.path, urllib.quote(key, safe=''))
+
+
+    def _lock(self):
+        """
+        Takes the lock on the directory, waiting for any other process that
+        holds it.
+
+        @return: The locked file descriptor, see L{_unlock}.
+        """
+        # '+' is always quoted in the entry names, so it marks the lock (and
+        # temporary) files
+        fd = os.open(os.path.join(self.path, '+lock'),
+            os.O_WRONLY | os.O_CREAT, 0644)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except:
+            os.close(fd)
+
+            raise
+
+        return fd
+
+
+    def _unlock(self, fd):
+        # closing the file releases the lock
+        os.close(fd)
+
+
+    def _store(self, key, owner, expires):
+        path = self._getPath(key)
+        tmp = '%s+%d.tmp' % (path, os.getpid())
+
+        data = owner
+
+        if expires is not None:
+            data = '%s\n%r' % (owner, expires)
+
+        f = open(tmp, 'wb')
+
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        os.rename(tmp, path)
+
+
+    def claim(self, key, owner, expires):
+        lock = self._lock()
+
+        try:
+            entry = self.load(key)
+
+            if entry is not None and entry[0] != owner and \
+                    self.isLive(entry[1]):
+                return False
+
+            self._store(key, owner, expires)
+        finally:
+            self._unlock(lock)
+
+        return True
+
+
+    def load(self, key):
+        try:
+            f = open(self._getPath(key), 'rb')
+        except IOError:
+            return None
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        if not data:
+            return None
+
+        owner, _, expires = data.partition('\n')
+
+        if expires:
+            expires = float(expires)
+        else:
+            expires = None
+
+        return owner, expires
+
+
+    def remove(self, key, owner):
+        entry = self.load(key)
+
+        if entry is None or entry[0] != owner:
+            return
+
+        lock = self._lock()
+
+        try:
+            entry = self.load(key)
+
+            if entry is not None and entry[0] == owner:
+                os.unlink(self._getPath(key))
+        finally:
+            self._unlock(lock)
+
+
+    def touch(self, owner, expires):
+        lock = self._lock()
+
+        try:
+            for name in os.listdir(self.path):
+                if '+' in name:
+                    continue
+
+                key = urllib.unquote(name)
+                entry = self.load(key)
+
+                # it may have expired and been claimed by another owner
+                if entry is not None and entry[0] == owner:
+                    self._store(key, owner, expires)
+        finally:
+            self._unlock(lock)
+
+
+
+class SQLiteDirectory(BaseDirectory):
+    """
+    A stream directory kept in an SQLite database. With the database on a
+    shared disk, any number of nodes can use it.
+
+    @ivar path: The path of the database file.
+    """
+
+
+    def __init__(self, path, ttl=None, clock=None):
+        import sqlite3
+
+        BaseDirectory.__init__(self, ttl, clock)
+
+        self.path = path
+        self.db = None
+
+
+    def _getDB(self):
+        """
+        Returns the connection to the database, connecting on first use (in
+        the directory's thread).
+        """
+        if self.db is None:
+            import sqlite3
+
+            # autocommit, every statement stands on its own. The connection
+            # is only used by the directory's thread, one call at a time
+            self.db = sqlite3.connect(self.path, timeout=5,
+                isolation_level=None, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS streams ('
+                'key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL)')
+
+        return self.db
+
+
+    def _disconnect(self):
+        db, self.db = self.db, None
+
+        if db is not None:
+            db.close()
+
+
+    def claim(self, key, owner, expires):
+        # one statement, so no other node can claim the key in between
+        cursor = self._getDB().execute('INSERT OR REPLACE INTO streams '
+            '(key, owner, expires) SELECT ?, ?, ? WHERE NOT EXISTS ('
+            'SELECT 1 FROM streams WHERE key = ? AND owner != ? AND '
+            '(expires IS NULL OR expires > ?))',
+            (key, owner, expires, key, owner, self.clock.seconds()))
+
+        return cursor.rowcount == 1
+
+
+    def load(self, key):
+        row = self._getDB().execute('SELECT owner, expires FROM streams '
+            'WHERE key = ?', (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        return str(row[0]), row[1]
+
+
+    def remove(self, key, owner):
+        self._getDB().execute('DELETE FROM streams WHERE key = ? AND '
+            'owner = ?', (key, owner))
+
+
+    def touch(self, owner, expires):
+        self._getDB().execute('UPDATE streams SET expires = ? WHERE '
+            'owner = ?', (expires, owner))
+
+
+    def purge(self):
+        """
+        Removes the expired entries.
+
+        @return: A L{defer.Deferred} that fires with the number of entries
+            removed.
+        """
+        return self.run(self._purge)
+
+
+    def _purge(self):
+        return self._getDB().execute('DELETE FROM streams WHERE '
+            'expires <= ?', (self.clock.seconds(),)).rowcount
+
+
+    def close(self):
+        if self.pool is not None:
+            self.run(self._disconnect)
+
+        BaseDirectory.close(self)
@@ -0,0 +1,454 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Hands RTMP connections over to the worker process that serves the requested
+application.
+
+The front process completes the handshake and reads the C{connect} request.
+If the application is owned by another worker (decided by a consistent hash
+of the application name, see L{hashring}) the socket is passed to the owner
+over a UNIX socket (C{SCM_RIGHTS}) together with the decoder state and the
+connect request. The owner adopts the socket and carries on as if it had
+accepted the connection itself, see L{server.ServerProtocol.resume}.
+
+The state is sent as JSON (binary data base64 encoded) and the handoff
+socket is only accessible by the user the workers run as.
+
+Example usage::
+
+    h = handoff.Handoff('worker-0', ['worker-0', 'worker-1'], path)
+    h.listen(serverFactory)
+
+@since: 0.2
+"""
+
+import os
+import json
+import base64
+
+from zope.interface import implements
+from twisted.internet import protocol, defer, interfaces
+from twisted.protocols import basic
+from twisted.python import log, failure
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.protocol import rtmp
+from rtmpy.protocol.rtmp import codec
+from rtmpy.cluster import hashring
+
+
+
+#: The largest handoff frame that will be accepted.
+MAX_FRAME_LENGTH = 1024 * 1024
+
+#: The permissions of the handoff socket.
+SOCKET_MODE = 0600
+
+
+
+def getConnectApp(data):
+    """
+    Returns the C{app} requested by an encoded C{connect} invoke or C{None}.
+    """
+    msg = message.Invoke()
+    msg.decode(BufferedByteStream(data))
+
+    if msg.name != 'connect' or not msg.argv:
+        return None
+
+    params = msg.argv[0]
+
+    try:
+        return params.get('app', None)
+    except AttributeError:
+        return None
+
+
+
+def encodeState(state):
+    """
+    Encodes the handoff C{state} (see L{Handoff.handOff}) for sending to
+    another worker.
+    """
+    decoder = dict(state['decoder'])
+
+    decoder['buffer'] = base64.b64encode(decoder['buffer'])
+    decoder['bucket'] = [(channelId, base64.b64encode(data))
+        for channelId, data in decoder['bucket']]
+
+    datatype, timestamp, data = state['connect']
+
+    return json.dumps({
+        'family': state['family'],
+        'decoder': decoder,
+        'connect': (datatype, timestamp, base64.b64encode(data)),
+    })
+
+
+
+def decodeState(frame):
+    """
+    Decodes a handoff state that was encoded by L{encodeState}.
+    """
+    state = json.loads(frame)
+    decoder = state['decoder']
+
+    decoder['buffer'] = base64.b64decode(decoder['buffer'])
+    decoder['bucket'] = [(channelId, base64.b64decode(data))
+        for channelId, data in decoder['bucket']]
+
+    datatype, timestamp, data = state['connect']
+    state['connect'] = (datatype, timestamp, base64.b64decode(data))
+
+    return state
+
+
+
+class HandoffDispatcher(rtmp.ProtocolMessageDispatcher):
+    """
+    Checks the first invoke on a connection (the C{connect} request) and
+    hands the connection over to the owning worker when required.
+    """
+
+
+    def __init__(self, streamer, handoff):
+        rtmp.ProtocolMessageDispatcher.__init__(self, streamer)
+
+        self.handoff = handoff
+        self.checked = False
+
+
+    def dispatchMessage(self, stream, datatype, timestamp, data):
+        if self.checked or datatype != message.INVOKE:
+            return rtmp.ProtocolMessageDispatcher.dispatchMessage(self, stream,
+                datatype, timestamp, data)
+
+        self.checked = True
+
+        if not self.streamer.resumed:
+            try:
+                owner = self.handoff.getOwner(getConnectApp(data))
+            except:
+                log.err(failure.Failure(), 'Unable to read connect request')
+                owner = None
+
+            if owner is not None and owner != self.handoff.nodeId:
+                if self.handoff.handOff(self.streamer, owner, datatype,
+                        timestamp, data):
+                    return
+
+        rtmp.ProtocolMessageDispatcher.dispatchMessage(self, stream, datatype,
+            timestamp, data)
+
+
+
+class HandoffServerProtocol(basic.Int32StringReceiver):
+    """
+    Receives connections from another worker. The file descriptor arrives
+    first and is followed by the encoded state, see L{encodeState}.
+    """
+
+    implements(interfaces.IFileDescriptorReceiver)
+
+    MAX_LENGTH = MAX_FRAME_LENGTH
+
+
+    def connectionMade(self):
+        self.descriptors = []
+
+
+    def fileDescriptorReceived(self, fd):
+        self.descriptors.append(fd)
+
+
+    def stringReceived(self, frame):
+        if not self.descriptors:
+            self.sendString('E' + 'No descriptor received')
+            self.transport.loseConnection()
+
+            return
+
+        fd = self.descriptors.pop(0)
+
+        try:
+            self.factory.handoff.adopt(fd, decodeState(frame))
+        except:
+            log.err(failure.Failure(), 'Unable to adopt connection')
+            os.close(fd)
+
+            self.sendString('E' + 'Unable to adopt connection')
+        else:
+            self.sendString('K')
+
+
+    def connectionLost(self, reason):
+        # descriptors that were never claimed
+        for fd in self.descriptors:
+            os.close(fd)
+
+        self.descriptors = []
+
+
+
+class HandoffServerFactory(protocol.ServerFactory):
+    """
+    @ivar handoff: The L{Handoff} that adopts the received connections.
+    """
+
+    protocol = HandoffServerProtocol
+
+
+    def __init__(self, handoff):
+        self.handoff = handoff
+
+
+
+class HandoffClientProtocol(basic.Int32StringReceiver):
+    """
+    Passes one connection to another worker.
+    """
+
+    MAX_LENGTH = MAX_FRAME_LENGTH
+
+
+    def connectionMade(self):
+        f = self.factory
+
+        self.transport.sendFileDescriptor(f.fd)
+        self.sendString(f.state)
+
+
+    def stringReceived(self, frame):
+        if frame == 'K':
+            self.factory.succeeded()
+        else:
+            self.factory.failed(failure.Failure(
+                RuntimeError('Handoff failed: %s' % (frame[1:],))))
+
+        self.transport.loseConnection()
+
+
+    def connectionLost(self, reason):
+        self.factory.failed(reason)
+
+
+
+class HandoffClientFactory(protocol.ClientFactory):
+    """
+    @ivar deferred: Fires when the other worker has adopted the connection.
+    """
+
+    protocol = HandoffClientProtocol
+
+
+    def __init__(self, fd, state):
+        self.fd = fd
+        self.state = state
+        self.deferred = defer.Deferred()
+
+
+    def succeeded(self):
+        d, self.deferred = self.deferred, None
+
+        if d is not None:
+            d.callback(None)
+
+
+    def failed(self, reason):
+        d, self.deferred = self.deferred, None
+
+        if d is not None:
+            d.errback(reason)
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed(reason)
+
+
+
+class _AdoptingFactory(protocol.ServerFactory):
+    """
+    Builds the protocol for an adopted connection.
+    """
+
+
+    def __init__(self, serverFactory, state):
+        self.serverFactory = serverFactory
+        self.state = state
+
+
+    def buildProtocol(self, addr):
+        p = self.serverFactory.buildProtocol(addr)
+
+        if p is not None:
+            p.resumeState = self.state
+
+        return p
+
+
+
+class Handoff(object):
+    """
+    Decides which worker serves an application and moves connections
+    between the workers.
+
+    @ivar nodeId: The id of this worker.
+    @ivar ring: The consistent hash of the worker ids.
+    @type ring: L{hashring.HashRing}
+    @ivar path: The directory that holds the handoff sockets.
+    @ivar serverFactory: The factory that adopted connections are given to,
+        set by L{listen}.
+    @ivar stats: Counts the connections that were C{handedOff}, C{adopted}
+        or that C{failed} to be handed off (and were served locally).
+    """
+
+
+    def __init__(self, nodeId, nodes, path, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.nodeId = nodeId
+        self.ring = hashring.HashRing(nodes)
+        self.path = path
+        self.reactor = reactor
+
+        self.serverFactory = None
+        self.stats = {'handedOff': 0, 'adopted': 0, 'failed': 0}
+
+
+    def getAddress(self, nodeId):
+        """
+        Returns the path of the handoff socket for C{nodeId}.
+        """
+        return os.path.join(self.path, '%s.handoff' % (nodeId,))
+
+
+    def getOwner(self, appName):
+        """
+        Returns the id of the worker that serves C{appName}.
+        """
+        if appName is None:
+            return None
+
+        return self.ring.getNode(appName)
+
+
+    def buildDispatcher(self, protocol):
+        """
+        Returns the message dispatcher for C{protocol}, see
+        L{server.ServerProtocol.getDispatcher}.
+        """
+        return HandoffDispatcher(protocol, self)
+
+
+    def listen(self, serverFactory):
+        """
+        Starts accepting connections from the other workers. They are handed
+        to C{serverFactory}.
+
+        @return: The listening port.
+        """
+        self.serverFactory = serverFactory
+        serverFactory.handoff = self
+
+        address = self.getAddress(self.nodeId)
+
+        if os.path.exists(address):
+            os.unlink(address)
+
+        return self.reactor.listenUNIX(address, HandoffServerFactory(self),
+            mode=SOCKET_MODE)
+
+
+    def adopt(self, fd, state):
+        """
+        Takes over the connected socket C{fd} from another worker. C{fd} is
+        closed, the reactor keeps its own copy.
+
+        @param state: As built by L{handOff}, the C{family} of the socket is
+            taken from it.
+        """
+        try:
+            self.reactor.adoptStreamConnection(fd, state['family'],
+                _AdoptingFactory(self.serverFactory, state))
+        finally:
+            os.close(fd)
+
+        self.stats['adopted'] += 1
+
+
+    def handOff(self, protocol, owner, datatype, timestamp, data):
+        """
+        Passes the connection for C{protocol} to the worker C{owner}. Must be
+        called while the decoder is dispatching the connect request.
+
+        If the handoff fails the connect request is dispatched locally.
+
+        @return: Whether the handoff was started.
+        """
+        transport = protocol.transport
+
+        if getattr(transport, 'dataBuffer', None) or \
+                getattr(transport, '_tempDataBuffer', None):
+            # the peer would miss what is still to be written
+            return False
+
+        try:
+            decoderState = protocol.decoder.getState()
+        except codec.DecodeError:
+            return False
+
+        # anything that is still buffered goes with the connection
+        protocol.decoder.stream.seek(0, 2)
+        transport.pauseProducing()
+
+        state = {
+            'family': transport.getHandle().family,
+            'decoder': decoderState,
+            'connect': (datatype, timestamp, data),
+        }
+
+        f = HandoffClientFactory(transport.fileno(), encodeState(state))
+
+        def cb(result):
+            self.stats['handedOff'] += 1
+
+            # the socket lives on in the other worker
+            protocol.detach()
+
+        def eb(reason):
+            log.err(reason, 'Unable to hand connection to %r' % (owner,))
+
+            self.stats['failed'] += 1
+
+            if not transport.connected:
+                return
+
+            protocol.decoder.dispatcher.dispatchMessage(
+                protocol.streamManager.getStream(0), datatype, timestamp,
+                data)
+
+            if decoderState['buffer']:
+                protocol.dataReceived(decoderState['buffer'])
+
+            transport.resumeProducing()
+
+        f.deferred.addCallbacks(cb, eb)
+
+        self.reactor.connectUNIX(self.getAddress(owner), f)
+
+        return True
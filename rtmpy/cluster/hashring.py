@@ -0,0 +1,119 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Consistent hashing, used to decide which node owns a key (an application or
+a stream name) so that adding or removing a node only moves the keys that
+node owned.
+
+@since: 0.2
+"""
+
+import bisect
+import struct
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+
+
+def hashKey(key):
+    """
+    Returns a 32 bit hash of C{key} that is the same in every process.
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    return struct.unpack('!I', md5(key).digest()[:4])[0]
+
+
+
+class HashRing(object):
+    """
+    A consistent hash ring of nodes.
+
+    Each node is placed on the ring C{replicas} times so that the keys are
+    spread evenly.
+
+    @ivar nodes: The nodes on the ring.
+    """
+
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = []
+
+        self._hashes = []
+        self._owners = {}
+
+        for node in nodes:
+            self.addNode(node)
+
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+    def addNode(self, node):
+        """
+        Adds C{node} to the ring.
+        """
+        if node in self.nodes:
+            return
+
+        self.nodes.append(node)
+
+        for i in xrange(self.replicas):
+            h = hashKey('%s-%d' % (node, i))
+
+            if h in self._owners:
+                # collision, first come first served
+                continue
+
+            self._owners[h] = node
+            bisect.insort(self._hashes, h)
+
+
+    def removeNode(self, node):
+        """
+        Removes C{node} from the ring.
+        """
+        if node not in self.nodes:
+            return
+
+        self.nodes.remove(node)
+
+        self._hashes = [h for h in self._hashes if self._owners[h] != node]
+
+        for h in self._owners.keys():
+            if self._owners[h] == node:
+                del self._owners[h]
+
+
+    def getNode(self, key):
+        """
+        Returns the node that owns C{key} or C{None} if the ring is empty.
+        """
+        if not self._hashes:
+            return None
+
+        i = bisect.bisect(self._hashes, hashKey(key))
+
+        if i == len(self._hashes):
+            i = 0
+
+        return self._owners[self._hashes[i]]
@@ -0,0 +1,183 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stream placement across a number of RTMP servers (nodes) without a central
+router. The node that owns a stream is picked from a consistent hash of its
+name, so every node agrees on the owner and adding or removing a node only
+moves the streams that node owned.
+
+A publish or play that lands on the wrong node is either redirected (the
+peer is sent C{NetConnection.Connect.Rejected} with C{ex.redirect} set to the
+owner's url) or proxied, in which case published streams are pushed to the
+owner and played streams are pulled from it.
+
+Example usage::
+
+    app = server.Application()
+    app.placement = placement.Placement('node-1', {
+        'node-1': 'rtmp://node1.example.com/live',
+        'node-2': 'rtmp://node2.example.com/live',
+    }, mode='proxy')
+
+@since: 0.2
+"""
+
+from rtmpy import exc, push, edge
+from rtmpy.cluster import hashring
+
+
+#: Sends peers to the node that owns the stream.
+REDIRECT = 'redirect'
+#: Relays the stream to or from the node that owns it.
+PROXY = 'proxy'
+
+
+
+class Placement(object):
+    """
+    Decides which node owns each stream of an L{server.Application}, see
+    L{server.Application.placement}.
+
+    @ivar nodeId: The id of this node.
+    @ivar urls: A C{dict} of node id -> the url of the application on that
+        node.
+    @ivar mode: L{REDIRECT} or L{PROXY}.
+    @ivar ring: The nodes, see L{hashring.HashRing}.
+    @ivar stats: Counters for the streams C{redirected}, C{pushed} to and
+        C{pulled} from other nodes.
+    """
+
+
+    def __init__(self, nodeId, urls, mode=REDIRECT, replicas=100,
+            reactor=None):
+        if mode not in (REDIRECT, PROXY):
+            raise ValueError('Unknown placement mode %r' % (mode,))
+
+        self.nodeId = nodeId
+        self.urls = {}
+        self.mode = mode
+        self.reactor = reactor
+        self.ring = hashring.HashRing(replicas=replicas)
+
+        self._origins = {}
+
+        self.stats = {
+            'redirected': 0,
+            'pushed': 0,
+            'pulled': 0,
+        }
+
+        for node, url in urls.items():
+            self.addNode(node, url)
+
+
+    def addNode(self, nodeId, url):
+        """
+        Adds the node C{nodeId}, serving the application at C{url}. It takes
+        over roughly a share of the streams of the other nodes.
+        """
+        self.urls[nodeId] = url
+        self.ring.addNode(nodeId)
+
+
+    def removeNode(self, nodeId):
+        """
+        Removes the node C{nodeId}. Its streams are shared between the
+        remaining nodes.
+        """
+        self.ring.removeNode(nodeId)
+        self.urls.pop(nodeId, None)
+        self._origins.pop(nodeId, None)
+
+
+    def getOwner(self, name):
+        """
+        Returns the id of the node that owns the stream C{name}, or C{None}
+        if it is this one (or there are no nodes).
+        """
+        # any parameters (e.g. credentials) are not part of the name
+        owner = self.ring.getNode(unicode(name).split(u'?', 1)[0])
+
+        if owner == self.nodeId:
+            return None
+
+        return owner
+
+
+    def getRedirect(self, name):
+        """
+        Returns the L{exc.Redirect} to send a peer asking for the stream
+        C{name} on, or C{None} if the stream is handled here.
+        """
+        if self.mode != REDIRECT:
+            return None
+
+        owner = self.getOwner(name)
+
+        if owner is None:
+            return None
+
+        self.stats['redirected'] += 1
+
+        return exc.Redirect(self.urls[owner])
+
+
+    def publish(self, publisher, name):
+        """
+        Forwards the newly published stream C{name} to its owner, when
+        proxying.
+
+        @type publisher: L{server.StreamPublisher}
+        """
+        if self.mode != PROXY:
+            return
+
+        owner = self.getOwner(name)
+
+        if owner is None:
+            return
+
+        self.stats['pushed'] += 1
+
+        publisher.addPushTarget(push.PushTarget(self.urls[owner],
+            unicode(name), self.reactor))
+
+
+    def fetch(self, name):
+        """
+        Plays the stream C{name} from its owner, when proxying.
+
+        @return: A L{defer.Deferred} that fires with the relayed publisher,
+            see L{edge.Origin.fetch}, or C{None} if the stream is not
+            available elsewhere.
+        """
+        if self.mode != PROXY:
+            return None
+
+        owner = self.getOwner(name)
+
+        if owner is None:
+            return None
+
+        origin = self._origins.get(owner, None)
+
+        if origin is None:
+            origin = self._origins[owner] = edge.Origin(self.urls[owner],
+                reactor=self.reactor)
+
+        self.stats['pulled'] += 1
+
+        return origin.fetch(name)
@@ -0,0 +1,486 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Relays published streams between worker processes over UNIX sockets.
+
+A subscriber on one worker can play a stream that is published on another.
+The playing worker connects to the owner's relay socket, asks for the
+stream and republishes the audio/video/meta data it receives to its own
+subscribers through a L{RelayedPublisher}.
+
+Each relay frame is length prefixed (see C{Int32StringReceiver}) and starts
+with a single byte kind:
+
+ - C{P}: play request, followed by the stream key.
+ - C{R}: play request for the audio/video to be passed through a shared
+   memory ring (see L{ring}), followed by the stream key.
+ - C{S}: the play request succeeded, followed by the path of the ring for
+   C{R} requests (if the worker has rings enabled).
+ - C{E}: the play request failed, followed by a description.
+ - C{A}/C{V}: audio/video data, followed by a 4 byte timestamp and the data.
+ - C{M}: AMF0 encoded meta data.
+ - C{U}: the stream was unpublished.
+
+@since: 0.2
+"""
+
+import os
+import struct
+import urllib
+
+from zope.interface import implements
+from twisted.internet import protocol, defer
+from twisted.protocols import basic
+import pyamf
+
+from rtmpy import server, exc
+from rtmpy.cluster import ring
+
+
+
+#: The largest relay frame that will be accepted.
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+
+_data_header = struct.Struct('!IcI')
+
+
+
+class RelaySubscriber(object):
+    """
+    Subscribes to a local L{server.StreamPublisher} on behalf of a remote
+    worker and writes the data to the relay connection.
+
+    @ivar media: Whether to write the audio/video data, C{False} when it is
+        passed through a ring instead.
+    """
+
+    implements(server.IPublishingStream)
+
+
+    def __init__(self, transport, media=True):
+        self.transport = transport
+        self.media = media
+
+
+    def _writeData(self, kind, data, timestamp):
+        # avoid copying the payload, the transport takes care of joining
+        self.transport.writeSequence([
+            _data_header.pack(len(data) + 5, kind, timestamp & 0xffffffff),
+            data])
+
+
+    def started(self):
+        pass
+
+
+    def stopped(self):
+        pass
+
+
+    def videoDataReceived(self, data, timestamp):
+        if self.media:
+            self._writeData('V', data, timestamp)
+
+
+    def audioDataReceived(self, data, timestamp):
+        if self.media:
+            self._writeData('A', data, timestamp)
+
+
+    def onMetaData(self, data):
+        meta = pyamf.encode(data, encoding=pyamf.AMF0).getvalue()
+
+        self.transport.write(struct.pack('!I', len(meta) + 1) + 'M' + meta)
+
+
+    def unpublish(self):
+        self.transport.write(struct.pack('!I', 1) + 'U')
+        self.transport.loseConnection()
+
+
+
+class RelayServerProtocol(basic.Int32StringReceiver):
+    """
+    Serves a single play request from another worker.
+    """
+
+    MAX_LENGTH = MAX_FRAME_LENGTH
+
+    publisher = None
+    subscriber = None
+    ring = None
+
+
+    def stringReceived(self, frame):
+        kind = frame[:1]
+
+        if kind not in ('P', 'R') or self.publisher is not None:
+            self.transport.loseConnection()
+
+            return
+
+        key = frame[1:]
+        publisher = self.factory.getPublisher(key)
+
+        if publisher is None:
+            self.sendString('E' + 'Unknown stream %r' % (key,))
+            self.transport.loseConnection()
+
+            return
+
+        path = None
+
+        if kind == 'R':
+            path = self.factory.getRing(key, publisher)
+
+            if path is not None:
+                self.ring = self.factory.rings[key][0]
+
+        self.publisher = publisher
+        self.subscriber = RelaySubscriber(self.transport, media=path is None)
+
+        self.sendString('S' + (path or ''))
+        publisher.addSubscriber(self.subscriber)
+
+
+    def connectionLost(self, reason):
+        if self.publisher is None:
+            return
+
+        if self.subscriber in self.publisher.subscribers:
+            self.publisher.removeSubscriber(self.subscriber)
+
+        if self.ring is not None:
+            self.factory.releaseRing(self.publisher, self.ring)
+
+        self.publisher = self.subscriber = self.ring = None
+
+
+
+class RelayServerFactory(protocol.ServerFactory):
+    """
+    Listens for play requests from other workers.
+
+    @ivar serverFactory: The L{server.ServerFactory} whose applications hold
+        the published streams.
+    @ivar ringPath: The directory for the ring buffers, C{None} if the
+        audio/video is always written to the relay connections.
+    @ivar rings: A C{[subscriber, readers]} pair for each stream key that
+        is written to a ring, where C{subscriber} is the
+        L{ring.RingSubscriber} and C{readers} the number of relay
+        connections using it.
+    """
+
+    protocol = RelayServerProtocol
+
+    #: The capacity of each ring buffer, in bytes.
+    ringCapacity = ring.DEFAULT_CAPACITY
+
+
+    def __init__(self, serverFactory, ringPath=None):
+        self.serverFactory = serverFactory
+        self.ringPath = ringPath
+        self.rings = {}
+
+
+    def getPublisher(self, key):
+        """
+        Returns the local publisher for the stream C{key} or C{None}.
+
+        @see: L{server.Application.getStreamKey}
+        """
+        try:
+            appName, name = key.split('/', 1)
+        except ValueError:
+            return None
+
+        app = self.serverFactory.applications.get(appName, None)
+
+        if app is None:
+            return None
+
+        return app.streams.get(name, None)
+
+
+    def getRing(self, key, publisher):
+        """
+        Returns the path of the ring buffer that C{publisher} writes to,
+        creating it if necessary. All the workers playing the stream share
+        the ring.
+
+        @return: The path or C{None} if rings are not enabled.
+        """
+        if self.ringPath is None:
+            return None
+
+        entry = self.rings.get(key, None)
+
+        if entry is not None:
+            subscriber = entry[0]
+
+            if not subscriber.writer.closed and \
+                    subscriber in publisher.subscribers:
+                entry[1] += 1
+
+                return subscriber.writer.path
+
+        path = os.path.join(self.ringPath, urllib.quote(key, safe=''))
+        subscriber = ring.RingSubscriber(
+            ring.RingWriter(path, self.ringCapacity))
+
+        self.rings[key] = [subscriber, 1]
+        publisher.addSubscriber(subscriber)
+
+        return path
+
+
+    def releaseRing(self, publisher, subscriber):
+        """
+        Called when a relay connection that used the ring written by
+        C{subscriber} has gone away. The ring is closed when it has no
+        readers left.
+        """
+        for key, entry in self.rings.items():
+            if entry[0] is subscriber:
+                break
+        else:
+            # replaced by a newer ring
+            return
+
+        entry[1] -= 1
+
+        if entry[1] > 0:
+            return
+
+        del self.rings[key]
+
+        if subscriber in publisher.subscribers:
+            publisher.removeSubscriber(subscriber)
+
+        subscriber.writer.close()
+
+
+
+class RelayedPublisher(server.StreamPublisher):
+    """
+    Republishes a stream received over a relay connection to local
+    subscribers.
+
+    @ivar key: The stream key.
+    @ivar finished: A L{defer.Deferred} that fires when the stream has been
+        unpublished (or the relay connection was lost).
+    @ivar feeder: Reads the audio/video from a shared memory ring, C{None}
+        if it arrives over the relay connection.
+    @type feeder: L{ring.RingFeeder}
+    """
+
+
+    def __init__(self, key):
+        server.StreamPublisher.__init__(self, None, None)
+
+        self.key = key
+        self.transport = None
+        self.feeder = None
+        self.finished = defer.Deferred()
+
+
+    def stop(self):
+        """
+        Stops relaying the stream.
+        """
+        if self.feeder is not None:
+            self.feeder.stop()
+
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+
+    def unpublish(self):
+        server.StreamPublisher.unpublish(self)
+
+        self.stop()
+        self.transport = None
+
+        if not self.finished.called:
+            self.finished.callback(self)
+
+
+
+class RelayClientProtocol(basic.Int32StringReceiver):
+    """
+    Plays a stream from another worker.
+    """
+
+    MAX_LENGTH = MAX_FRAME_LENGTH
+
+
+    def connectionMade(self):
+        f = self.factory
+
+        self.publisher = f.publisher
+        self.publisher.transport = self.transport
+
+        if f.rings:
+            self.sendString('R' + f.key)
+        else:
+            self.sendString('P' + f.key)
+
+
+    def stringReceived(self, frame):
+        kind = frame[:1]
+        publisher = self.publisher
+
+        if kind == 'V':
+            timestamp, = struct.unpack_from('!I', frame, 1)
+            publisher.videoDataReceived(frame[5:], timestamp)
+        elif kind == 'A':
+            timestamp, = struct.unpack_from('!I', frame, 1)
+            publisher.audioDataReceived(frame[5:], timestamp)
+        elif kind == 'M':
+            publisher.onMetaData(
+                pyamf.decode(frame[1:], encoding=pyamf.AMF0).next())
+        elif kind == 'S':
+            if len(frame) > 1:
+                self.startFeeding(frame[1:])
+
+            self.factory.started()
+        elif kind == 'E':
+            self.factory.failed(exc.StreamNotFound(frame[1:]))
+        elif kind == 'U':
+            publisher.unpublish()
+        else:
+            self.transport.loseConnection()
+
+
+    def startFeeding(self, path):
+        """
+        Reads the audio/video from the ring at C{path}.
+        """
+        f = self.factory
+
+        feeder = self.publisher.feeder = ring.RingFeeder(ring.RingReader(path),
+            self.publisher, clock=f.clock)
+        feeder.start()
+
+
+    def connectionLost(self, reason):
+        self.factory.failed(exc.StreamNotFound('Relay connection lost'))
+
+        self.publisher.unpublish()
+
+
+
+class RelayClientFactory(protocol.ClientFactory):
+    """
+    @ivar deferred: Fires with the L{RelayedPublisher} once the owner has
+        accepted the play request.
+    @ivar rings: Whether to ask for the audio/video to be passed through a
+        shared memory ring.
+    """
+
+    protocol = RelayClientProtocol
+
+
+    def __init__(self, key, rings=False, clock=None):
+        self.key = key
+        self.rings = rings
+        self.clock = clock
+        self.publisher = RelayedPublisher(key)
+        self.deferred = defer.Deferred()
+
+
+    def started(self):
+        if not self.deferred.called:
+            self.deferred.callback(self.publisher)
+
+
+    def failed(self, reason):
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self.failed(reason)
+
+
+
+class RelayClient(object):
+    """
+    Fetches streams from the other workers that share C{path}.
+
+    @ivar path: The directory that contains the relay sockets, one per worker
+        named after the worker id.
+    @ivar rings: Whether the audio/video is passed between the workers
+        through shared memory rings (in C{path}/rings) rather than copied
+        to each relay connection.
+    """
+
+
+    def __init__(self, path, reactor=None, rings=False):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.path = path
+        self.reactor = reactor
+        self.rings = rings
+
+
+    def getAddress(self, nodeId):
+        """
+        Returns the path of the relay socket for C{nodeId}.
+        """
+        return os.path.join(self.path, '%s.sock' % (nodeId,))
+
+
+    def listen(self, nodeId, serverFactory):
+        """
+        Starts serving the streams published to C{serverFactory} to the other
+        workers.
+
+        @return: The listening port.
+        """
+        address = self.getAddress(nodeId)
+
+        if os.path.exists(address):
+            os.unlink(address)
+
+        ringPath = None
+
+        if self.rings:
+            ringPath = os.path.join(self.path, 'rings')
+
+            try:
+                os.makedirs(ringPath)
+            except OSError:
+                # another worker got there first
+                if not os.path.isdir(ringPath):
+                    raise
+
+        return self.reactor.listenUNIX(address,
+            RelayServerFactory(serverFactory, ringPath))
+
+
+    def fetch(self, owner, key):
+        """
+        Plays the stream C{key} from the worker C{owner}.
+
+        @return: A L{defer.Deferred} that fires with a L{RelayedPublisher}.
+        """
+        factory = RelayClientFactory(key, self.rings, self.reactor)
+
+        self.reactor.connectUNIX(self.getAddress(owner), factory)
+
+        return factory.deferred
@@ -0,0 +1,419 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A memory mapped ring buffer for passing a published stream's audio/video to
+the other worker processes on the same host.
+
+There is a single writer per stream (the worker that owns the publisher)
+and any number of readers. The payload is copied once into the ring by the
+writer and once out of it by each reader, no locks are taken and the writer
+never waits for the readers. A reader that falls more than the capacity of
+the ring behind is overrun, it skips to the most recent record and counts
+the records that it lost.
+
+The file starts with a header::
+
+    magic (8), capacity (Q), committed (Q), next sequence (Q), reserved (Q),
+    last (Q), closed (I)
+
+All offsets are byte positions in the (endless) stream of records, the
+position in the ring is the offset modulo the capacity. The writer moves
+C{reserved} past a record before writing it and C{last}, C{committed} and
+the next sequence (the latter two with a single write) once it has been
+written. A reader checks C{reserved} after copying a
+record to make sure that it was not overwritten in the meantime.
+
+Each record is a C{sequence (Q), kind (c), timestamp (I), length (I)}
+header followed by the data. A record never wraps around the end of the
+ring, the writer skips to the start instead, leaving a C{W} record behind
+if there is room for one.
+
+@since: 0.2
+"""
+
+import os
+import mmap
+import struct
+
+from zope.interface import implements
+from twisted.internet import task
+
+from rtmpy import server
+
+
+
+#: The default capacity of a ring, in bytes.
+DEFAULT_CAPACITY = 4 * 1024 * 1024
+
+MAGIC = 'RTMPYRB1'
+
+HEADER_SIZE = 64
+
+_header = struct.Struct('!8sQQQQQI')
+_record = struct.Struct('!QcII')
+_offset = struct.Struct('!Q')
+_progress = struct.Struct('!QQ')
+_closed = struct.Struct('!I')
+
+# positions of the header fields
+_COMMITTED = 16
+_RESERVED = 32
+_LAST = 40
+_CLOSED = 48
+
+WRAP = 'W'
+
+
+
+class RingWriter(object):
+    """
+    Writes records to a new ring buffer at C{path}.
+
+    @ivar capacity: The size of the ring in bytes. A record (plus its 17 byte
+        header) cannot be larger than this.
+    @ivar seq: The sequence number of the next record.
+    @ivar offset: The offset of the next record.
+    """
+
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.seq = 0
+        self.offset = 0
+        self.closed = False
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            self.map = mmap.mmap(fd, HEADER_SIZE + capacity)
+        finally:
+            os.close(fd)
+
+        _header.pack_into(self.map, 0, MAGIC, capacity, 0, 0, 0, 0, 0)
+
+
+    def write(self, kind, timestamp, data):
+        """
+        Appends a record to the ring.
+
+        @param kind: A single character.
+        @return: The sequence number of the record.
+        """
+        size = _record.size + len(data)
+        capacity = self.capacity
+
+        if size > capacity:
+            raise ValueError('Record of %d bytes is larger than the ring '
+                '(%d bytes)' % (size, capacity))
+
+        m = self.map
+        offset = self.offset
+        pos = offset % capacity
+
+        skip = 0
+
+        if capacity - pos < size:
+            # skip to the start of the ring
+            skip = capacity - pos
+
+        # readers must see that these bytes are about to be overwritten
+        _offset.pack_into(m, _RESERVED, offset + skip + size)
+
+        if skip:
+            if skip >= _record.size:
+                _record.pack_into(m, HEADER_SIZE + pos, self.seq, WRAP, 0, 0)
+
+            offset += skip
+            pos = 0
+
+        start = HEADER_SIZE + pos
+        seq = self.seq
+
+        _record.pack_into(m, start, seq, kind, timestamp & 0xffffffff,
+            len(data))
+
+        start += _record.size
+        m[start:start + len(data)] = data
+
+        self.seq = seq + 1
+        self.offset = offset + size
+
+        _offset.pack_into(m, _LAST, offset)
+        _progress.pack_into(m, _COMMITTED, self.offset, self.seq)
+
+        return seq
+
+
+    def close(self, unlink=True):
+        """
+        Marks the ring as closed, readers see this once they have read the
+        remaining records. The mapped readers keep working if the file is
+        unlinked.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+
+        _closed.pack_into(self.map, _CLOSED, 1)
+        self.map.close()
+
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+
+class RingReader(object):
+    """
+    Reads the records written to the ring buffer at C{path} from the point
+    at which the reader was opened.
+
+    @ivar seq: The sequence number of the next record expected.
+    @ivar lost: The number of records that were overwritten before they
+        could be read.
+    @ivar overruns: The number of times the reader was overrun.
+    """
+
+
+    def __init__(self, path):
+        self.path = path
+
+        f = open(path, 'rb')
+
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic, capacity = _header.unpack_from(self.map, 0)[:2]
+
+        if magic != MAGIC:
+            self.map.close()
+
+            raise IOError('%r is not a ring buffer' % (path,))
+
+        self.capacity = capacity
+        self.offset, self.seq = self._readProgress()
+        self.lost = 0
+        self.overruns = 0
+
+
+    @property
+    def closed(self):
+        """
+        Whether the writer has closed the ring and all the records have been
+        read.
+        """
+        m = self.map
+
+        return bool(_closed.unpack_from(m, _CLOSED)[0]) and \
+            _offset.unpack_from(m, _COMMITTED)[0] == self.offset
+
+
+    def _readProgress(self):
+        """
+        Returns the committed offset and the next sequence number, read until
+        they are consistent.
+        """
+        m = self.map
+        progress = _progress.unpack_from(m, _COMMITTED)
+
+        while True:
+            again = _progress.unpack_from(m, _COMMITTED)
+
+            if again == progress:
+                return progress
+
+            progress = again
+
+
+    def _resync(self):
+        """
+        Skips to the most recent record.
+        """
+        self.overruns += 1
+        self.offset = _offset.unpack_from(self.map, _LAST)[0]
+
+
+    def read(self, limit=None):
+        """
+        Returns a C{list} of C{(seq, kind, timestamp, data)} tuples for the
+        records that have been written since the last read.
+
+        @param limit: The maximum number of records to return.
+        """
+        m = self.map
+        capacity = self.capacity
+        records = []
+
+        committed = _offset.unpack_from(m, _COMMITTED)[0]
+
+        while self.offset < committed:
+            if limit is not None and len(records) >= limit:
+                break
+
+            offset = self.offset
+
+            if committed - offset > capacity:
+                self._resync()
+
+                continue
+
+            pos = offset % capacity
+
+            if capacity - pos < _record.size:
+                self.offset += capacity - pos
+
+                continue
+
+            start = HEADER_SIZE + pos
+            seq, kind, timestamp, length = _record.unpack_from(m, start)
+
+            if kind == WRAP:
+                data = None
+                size = capacity - pos
+            else:
+                size = _record.size + length
+
+                if size > capacity - pos:
+                    # overwritten while the header was being read
+                    data = None
+                else:
+                    start += _record.size
+                    data = m[start:start + length]
+
+            # the record is intact if the writer has not got round to it
+            if _offset.unpack_from(m, _RESERVED)[0] > offset + capacity:
+                self._resync()
+                committed = _offset.unpack_from(m, _COMMITTED)[0]
+
+                continue
+
+            self.offset += size
+
+            if kind == WRAP:
+                continue
+
+            if seq != self.seq:
+                self.lost += seq - self.seq
+
+            self.seq = seq + 1
+
+            records.append((seq, kind, timestamp, data))
+
+        return records
+
+
+    def close(self):
+        self.map.close()
+
+
+
+class RingSubscriber(object):
+    """
+    Subscribes to a L{server.StreamPublisher} and writes the audio/video
+    data to a L{RingWriter}. The ring is closed when the stream is
+    unpublished.
+    """
+
+    implements(server.IPublishingStream)
+
+
+    def __init__(self, writer):
+        self.writer = writer
+
+
+    def started(self):
+        pass
+
+
+    def stopped(self):
+        pass
+
+
+    def videoDataReceived(self, data, timestamp):
+        self.writer.write('V', timestamp, data)
+
+
+    def audioDataReceived(self, data, timestamp):
+        self.writer.write('A', timestamp, data)
+
+
+    def onMetaData(self, data):
+        # meta data is rare and a reader that joins late needs the current
+        # meta data, so it is sent with the control messages instead. See
+        # L{relay.RelayServerProtocol}.
+        pass
+
+
+    def unpublish(self):
+        self.writer.close()
+
+
+
+class RingFeeder(object):
+    """
+    Polls a L{RingReader} and passes the records to a publisher.
+
+    @ivar interval: Seconds between polls.
+    """
+
+
+    def __init__(self, reader, publisher, interval=0.01, clock=None):
+        self.reader = reader
+        self.publisher = publisher
+        self.interval = interval
+
+        self._loop = task.LoopingCall(self.poll)
+
+        if clock is not None:
+            self._loop.clock = clock
+
+
+    def start(self):
+        self._loop.start(self.interval, now=True)
+
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+    def poll(self):
+        """
+        Passes the records written since the last poll to the publisher.
+        """
+        publisher = self.publisher
+        reader = self.reader
+
+        for seq, kind, timestamp, data in reader.read():
+            if kind == 'V':
+                publisher.videoDataReceived(data, timestamp)
+            elif kind == 'A':
+                publisher.audioDataReceived(data, timestamp)
+
+        if self.reader is reader and reader.closed:
+            self.stop()
+            publisher.unpublish()
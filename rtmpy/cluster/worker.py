@@ -0,0 +1,278 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Forks a number of worker processes that share one listening port.
+
+Each worker runs its own reactor and L{server.ServerFactory} and accepts
+connections on the RTMP port via C{SO_REUSEPORT}, so the kernel spreads the
+connections across the workers (and cores). Published streams are recorded
+in a L{directory.FileDirectory} and relayed between the workers over UNIX
+sockets, see L{relay}.
+
+With C{handoff} enabled each application is served by one worker (chosen by
+a consistent hash of its name) and connections that arrive at another worker
+are passed to it after the C{connect} request, see L{handoff}.
+
+With C{rings} enabled the audio/video of a relayed stream is passed through
+a shared memory ring per stream (see L{ring}) instead of being copied to
+each relay connection.
+
+Example usage::
+
+    from rtmpy import server
+    from rtmpy.cluster import worker
+
+    def buildFactory():
+        return server.ServerFactory({'live': server.Application()})
+
+    worker.run(buildFactory, 1935, workers=4)
+
+@since: 0.2
+"""
+
+import os
+import sys
+import errno
+import random
+import signal
+import socket
+import shutil
+import tempfile
+
+from rtmpy.cluster import directory, relay, handoff
+
+
+#: Linux value of C{SO_REUSEPORT}, older Pythons do not export it.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+
+def getCPUCount():
+    """
+    Returns the number of processors, or 1 if that cannot be determined.
+    """
+    try:
+        import multiprocessing
+
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+
+def listenReusePort(port, factory, interface='', backlog=50, reactor=None):
+    """
+    Like C{reactor.listenTCP} but sets C{SO_REUSEPORT} on the socket, so
+    that a number of processes can listen on the same port.
+
+    @return: The listening port.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        s.bind((interface, port))
+        s.listen(backlog)
+        s.setblocking(False)
+
+        return reactor.adoptStreamPort(s.fileno(), socket.AF_INET, factory)
+    finally:
+        # the reactor has its own copy of the file descriptor
+        s.close()
+
+
+
+class Worker(object):
+    """
+    The cluster state for one worker process.
+
+    @ivar nodeId: The id of this worker, unique within C{path}.
+    @ivar path: The directory shared by all the workers. Holds the stream
+        directory and the relay sockets.
+    @ivar handoff: Passes connections to the worker that serves the
+        requested application, C{None} if every worker serves every
+        application.
+    @type handoff: L{handoff.Handoff}
+    """
+
+
+    def __init__(self, nodeId, path, reactor=None, nodes=None, rings=False):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.nodeId = nodeId
+        self.path = path
+        self.reactor = reactor
+
+        self.directory = directory.FileDirectory(os.path.join(path, 'streams'),
+            ttl=directory.DEFAULT_TTL, clock=reactor)
+        self.relay = relay.RelayClient(path, reactor=reactor, rings=rings)
+        self.handoff = None
+
+        if nodes:
+            self.handoff = handoff.Handoff(nodeId, nodes, path,
+                reactor=reactor)
+
+
+    def attach(self, factory):
+        """
+        Sets up the applications registered with C{factory} to use this
+        worker's directory and relay.
+        """
+        for app in factory.applications.values():
+            app.nodeId = self.nodeId
+            app.directory = self.directory
+            app.relay = self.relay
+
+
+    def listen(self, factory, port, interface=''):
+        """
+        Starts accepting RTMP connections on the shared C{port} and relay
+        requests from the other workers.
+
+        @return: A C{list} of the listening ports.
+        """
+        self.attach(factory)
+
+        ports = [
+            listenReusePort(port, factory, interface, reactor=self.reactor),
+            self.relay.listen(self.nodeId, factory),
+        ]
+
+        if self.handoff is not None:
+            ports.append(self.handoff.listen(factory))
+
+        return ports
+
+
+
+def _runWorker(nodeId, path, buildFactory, port, interface, nodes, rings):
+    from twisted.internet import reactor
+
+    w = Worker(nodeId, path, reactor=reactor, nodes=nodes, rings=rings)
+    w.listen(buildFactory(), port, interface)
+
+    reactor.run()
+
+
+
+def run(buildFactory, port, workers=None, path=None, interface='',
+        handoff=False, rings=False):
+    """
+    Forks C{workers} processes (defaults to one per processor) that serve
+    RTMP on C{port}. Blocks until all the workers have exited, restarting any
+    that are killed by a signal. Sending C{SIGINT} or C{SIGTERM} stops the
+    workers.
+
+    @param buildFactory: Called in each worker to build the
+        L{server.ServerFactory}. Register applications before returning.
+    @param path: The directory shared by the workers. A temporary directory
+        is used (and removed afterwards) if not supplied.
+    @param handoff: Serve each application from a single worker, see
+        L{handoff.Handoff}.
+    @param rings: Relay the audio/video between the workers through shared
+        memory, see L{ring}.
+    """
+    if workers is None:
+        workers = getCPUCount()
+
+    cleanup = path is None
+
+    if cleanup:
+        path = tempfile.mkdtemp(prefix='rtmpy-')
+
+    nodeIds = ['worker-%d' % (i,) for i in xrange(workers)]
+    nodes = None
+
+    if handoff:
+        nodes = nodeIds
+
+    children = {}
+    state = {'stopping': False}
+
+    def spawn(nodeId):
+        pid = os.fork()
+
+        if pid == 0:
+            code = 0
+
+            # otherwise every worker generates the same "random" client ids
+            # and handshake payloads, see util.generateBytes
+            random.seed()
+
+            try:
+                try:
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+                    _runWorker(nodeId, path, buildFactory, port, interface,
+                        nodes, rings)
+                except:
+                    import traceback
+
+                    traceback.print_exc()
+                    code = 1
+            finally:
+                os._exit(code)
+
+        children[pid] = nodeId
+
+    def stop(signum, frame):
+        state['stopping'] = True
+
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        for nodeId in nodeIds:
+            spawn(nodeId)
+
+        while children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+
+                raise
+
+            nodeId = children.pop(pid, None)
+
+            if nodeId is None or state['stopping']:
+                continue
+
+            if not os.WIFSIGNALED(status):
+                sys.stderr.write('%s (pid %d) exited with status %d\n' % (
+                    nodeId, pid, os.WEXITSTATUS(status)))
+
+                continue
+
+            sys.stderr.write('%s (pid %d) killed by signal %d, '
+                'restarting\n' % (nodeId, pid, os.WTERMSIG(status)))
+            spawn(nodeId)
+    finally:
+        if cleanup:
+            shutil.rmtree(path, ignore_errors=True)
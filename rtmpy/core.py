@@ -223,7 +223,9 @@ class BaseStream(rpc.AbstractCallHandler):
         """
         command = None
 
-        if len(args) > 0 and args[0] is None:
+        # only the first argument is needed to check for a command object, the
+        # rest are decoded on demand (see L{message.Arguments})
+        if args and args[0] is None:
             command = args[0]
             args = args[1:]
 
@@ -0,0 +1,197 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Edge mode. Streams that are not published locally are played from an origin
+server over one client connection each and republished to the local
+subscribers.
+
+Example usage::
+
+    app = server.Application()
+    app.origin = edge.Origin('rtmp://origin.example.com/live')
+
+@since: 0.2
+"""
+
+from twisted.internet import defer
+from twisted.python import log
+
+from rtmpy import server, client
+
+
+
+class OriginPublisher(server.StreamPublisher):
+    """
+    Republishes a stream played from the origin to the local subscribers.
+
+    Once the last subscriber has left, the stream is played for another
+    C{gracePeriod} seconds (in case someone else turns up) before the origin
+    connection is closed.
+
+    @ivar name: The name of the stream.
+    @ivar nc: The L{client.NetConnection} to the origin.
+    @ivar finished: A L{defer.Deferred} that fires when the stream has been
+        unpublished (or the origin connection was lost).
+    """
+
+
+    def __init__(self, name, gracePeriod, clock):
+        server.StreamPublisher.__init__(self, None, None)
+
+        self.name = name
+        self.gracePeriod = gracePeriod
+        self.clock = clock
+        self.nc = None
+        self.finished = defer.Deferred()
+
+        self.idleTimer = None
+
+
+    def addSubscriber(self, subscriber):
+        self._cancelIdleTimer()
+
+        server.StreamPublisher.addSubscriber(self, subscriber)
+
+
+    def removeSubscriber(self, subscriber):
+        server.StreamPublisher.removeSubscriber(self, subscriber)
+
+        self.checkSubscribers()
+
+
+    def checkSubscribers(self):
+        """
+        Starts the grace period if there is no one subscribed.
+        """
+        if self.subscribers or self.idleTimer is not None:
+            return
+
+        if self.finished.called:
+            return
+
+        self.idleTimer = self.clock.callLater(self.gracePeriod,
+            self.idleTimedOut)
+
+
+    def idleTimedOut(self):
+        """
+        No one has subscribed for C{gracePeriod} seconds.
+        """
+        self.idleTimer = None
+
+        log.msg('No subscribers for %r, closing the origin connection' % (
+            self.name,))
+
+        self.stop()
+
+
+    def _cancelIdleTimer(self):
+        timer, self.idleTimer = self.idleTimer, None
+
+        if timer is not None and timer.active():
+            timer.cancel()
+
+
+    def stop(self):
+        """
+        Stops playing the stream from the origin.
+        """
+        if self.nc is not None:
+            self.nc.protocol.transport.loseConnection()
+
+
+    def unpublish(self):
+        self._cancelIdleTimer()
+
+        server.StreamPublisher.unpublish(self)
+
+        self.stop()
+        self.nc = None
+
+        if not self.finished.called:
+            self.finished.callback(self)
+
+
+
+class Origin(object):
+    """
+    Plays streams from the application at C{url} for an edge
+    L{server.Application}, see L{server.Application.origin}.
+
+    @ivar url: The url of the application on the origin server, e.g.
+        C{rtmp://origin.example.com/live}.
+    @ivar gracePeriod: The number of seconds a stream is played for after its
+        last subscriber has left.
+    @ivar stats: Counters for the streams C{fetched} from the origin and
+        the fetches that C{failed}.
+    """
+
+
+    def __init__(self, url, gracePeriod=30, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.url = url
+        self.gracePeriod = gracePeriod
+        self.reactor = reactor
+        self.clock = reactor
+
+        self.stats = {
+            'fetched': 0,
+            'failed': 0,
+        }
+
+
+    def fetch(self, name):
+        """
+        Plays the stream C{name} from the origin.
+
+        @return: A L{defer.Deferred} that fires with an L{OriginPublisher}
+            once the origin has started playing the stream.
+        """
+        publisher = OriginPublisher(name, self.gracePeriod, self.clock)
+
+        def play(nc):
+            publisher.nc = nc
+
+            d = nc.openStream()
+
+            d.addCallback(lambda stream: stream.play(name, publisher))
+
+            return d
+
+        def started(stream):
+            self.stats['fetched'] += 1
+
+            # the callbacks run after this one subscribe to the publisher,
+            # cancelling the grace period again.
+            publisher.checkSubscribers()
+
+            return publisher
+
+        def failed(fail):
+            self.stats['failed'] += 1
+
+            publisher.stop()
+
+            return fail
+
+        d = client.connect(self.url, reactor=self.reactor)
+
+        d.addCallback(play)
+        d.addCallbacks(started, failed)
+
+        return d
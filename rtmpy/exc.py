@@ -58,6 +58,20 @@ class CallFailed(NetConnectionError):
 
 
 
+class CallTimedOut(CallFailed):
+    """
+    Raised when the peer does not respond to an RPC call in time.
+    """
+
+
+
+class CallRateLimited(CallFailed):
+    """
+    Raised when the peer makes calls faster than the application allows.
+    """
+
+
+
 class ConnectError(NetConnectionError):
     """
     Base error class for all connection related errors.
@@ -84,6 +98,22 @@ class ConnectRejected(ConnectError):
 
 
 
+class Redirect(ConnectRejected):
+    """
+    Raised when the peer should connect to the application at C{url} instead,
+    e.g. because the stream it asked for is placed on another server.
+
+    @ivar url: The url of the application to connect to.
+    """
+
+    def __init__(self, url, description=None):
+        ConnectRejected.__init__(self, description or 'Redirected to %s' % (
+            url,))
+
+        self.url = url
+
+
+
 class InvalidApplication(NetConnectionError):
     """
     Raised when the peer attempts to connect to an invalid or unknown
@@ -168,7 +198,10 @@ for k, v in globals().items():
 
     code = v.__status_code__
 
-    CLASS_CODES[code] = v
+    # subclasses share the code of their base but are not its error class
+    if '__status_code__' in v.__dict__:
+        CLASS_CODES[code] = v
+
     CLASS_CODES[v.__name__] = code
 
 del k, v
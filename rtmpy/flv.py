@@ -0,0 +1,199 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The U{FLV<http://osflash.org/flv>} file format.
+
+An FLV file is a header followed by tags, each of which holds an audio or
+video packet (exactly as sent over RTMP) or a script data object such as
+C{onMetaData}. Every tag is followed by its total size so that the file can
+be read backwards.
+
+@since: 0.2
+"""
+
+import struct
+
+import pyamf
+
+from rtmpy import message
+
+
+#: The tag types, the same as the RTMP message types.
+AUDIO = message.AUDIO_DATA
+VIDEO = message.VIDEO_DATA
+SCRIPT = message.NOTIFY
+
+HEADER_SIZE = 9
+TAG_HEADER_SIZE = 11
+
+#: The audio/video codecs that need a sequence header, see
+#: L{isSequenceHeader}.
+CODEC_AVC = 7
+SOUND_AAC = 10
+
+
+_tagHeader = struct.Struct('>IIHB')
+_tagSize = struct.Struct('>I')
+
+
+class FLVError(Exception):
+    """
+    Raised when reading a file that is not a valid FLV file.
+    """
+
+
+
+def encodeHeader(audio=True, video=True):
+    """
+    Returns the file header, along with the (zero) size of the previous tag
+    that precedes the first tag.
+    """
+    flags = (audio and 0x04 or 0) | (video and 0x01 or 0)
+
+    return 'FLV\x01' + chr(flags) + _tagSize.pack(HEADER_SIZE) + \
+        _tagSize.pack(0)
+
+
+def decodeHeader(data):
+    """
+    Checks the file header in C{data}.
+
+    @return: The offset of the first tag.
+    """
+    if data[:3] != 'FLV' or len(data) < HEADER_SIZE + 4:
+        raise FLVError('Not an FLV file')
+
+    return _tagSize.unpack(data[5:9])[0] + 4
+
+
+def encodeTagHeader(tagType, size, timestamp):
+    """
+    Returns the header of a tag holding C{size} bytes of data.
+    """
+    timestamp &= 0xffffffff
+
+    return _tagHeader.pack((tagType << 24) | size,
+        ((timestamp & 0xffffff) << 8) | (timestamp >> 24), 0, 0)
+
+
+def decodeTagHeader(data, offset=0):
+    """
+    Reads the header of the tag at C{offset} in C{data}.
+
+    @return: A C{(tagType, size, timestamp)} tuple.
+    """
+    a, b, _, _ = _tagHeader.unpack_from(data, offset)
+
+    return a >> 24, a & 0xffffff, (b >> 8) | ((b & 0xff) << 24)
+
+
+def encodeTagSize(size):
+    """
+    Returns the trailer of a tag holding C{size} bytes of data.
+    """
+    return _tagSize.pack(TAG_HEADER_SIZE + size)
+
+
+def encodeTag(tagType, data, timestamp):
+    """
+    Returns a complete tag.
+    """
+    return encodeTagHeader(tagType, len(data), timestamp) + data + \
+        encodeTagSize(len(data))
+
+
+def encodeMetaData(meta):
+    """
+    Returns the body of the C{onMetaData} script tag.
+    """
+    return pyamf.encode('onMetaData', meta, encoding=pyamf.AMF0).getvalue()
+
+
+def decodeMetaData(data):
+    """
+    Returns the meta data in the body of an C{onMetaData} script tag, or
+    C{None} if it is some other script tag.
+    """
+    values = list(pyamf.decode(data, encoding=pyamf.AMF0))
+
+    if len(values) < 2 or values[0] != 'onMetaData':
+        return None
+
+    return values[1]
+
+
+def iterTags(data, offset=None):
+    """
+    Iterates over the complete tags in C{data} (a C{str}, C{buffer} or
+    C{mmap}) from C{offset}, which defaults to the first tag.
+
+    @return: An iterator of C{(offset, tagType, size, timestamp)} tuples.
+        The tag data starts at C{offset + TAG_HEADER_SIZE}.
+    """
+    if offset is None:
+        offset = decodeHeader(data[:HEADER_SIZE + 4])
+
+    end = len(data)
+
+    while offset + TAG_HEADER_SIZE <= end:
+        tagType, size, timestamp = decodeTagHeader(data, offset)
+
+        if offset + TAG_HEADER_SIZE + size + 4 > end:
+            # truncated, e.g. still being written
+            break
+
+        yield offset, tagType, size, timestamp
+
+        offset += TAG_HEADER_SIZE + size + 4
+
+
+def readLastTimestamp(f):
+    """
+    Returns the timestamp of the last tag in the open file C{f} or C{None} if
+    there are no tags. Reads backwards, using the size after each tag.
+    """
+    f.seek(0, 2)
+    end = f.tell()
+
+    if end <= HEADER_SIZE + 4:
+        return None
+
+    f.seek(end - 4)
+    size = _tagSize.unpack(f.read(4))[0]
+
+    if size < TAG_HEADER_SIZE or size > end - HEADER_SIZE - 4:
+        raise FLVError('Bad tag size at the end of the file')
+
+    f.seek(end - 4 - size)
+
+    return decodeTagHeader(f.read(TAG_HEADER_SIZE))[2]
+
+
+def isSequenceHeader(tagType, data):
+    """
+    Whether C{data} is an AVC or AAC sequence header, the decoder
+    configuration that must precede the audio/video frames in a file.
+    """
+    if len(data) < 2 or data[1] != '\x00':
+        return False
+
+    if tagType == VIDEO:
+        return ord(data[0]) & 0x0f == CODEC_AVC
+
+    if tagType == AUDIO:
+        return ord(data[0]) >> 4 == SOUND_AAC
+
+    return False
@@ -17,8 +17,12 @@
 RTMP message implementations.
 """
 
+import re
+import struct
+
 from zope.interface import Interface, implements
 import pyamf
+from pyamf.util import BufferedByteStream
 
 from rtmpy.util import add_to_class
 
@@ -108,19 +112,23 @@ class IMessage(Interface):
     """
 
 
-    def encode(buffer):
+    def encode(buffer, codecs=None):
         """
         Encodes the event instance to C{stream}.
 
         @type buffer: L{pyamf.util.BufferedByteStream}
+        @param codecs: Supplies the AMF encoders, if any are needed.
+        @type codecs: L{Codecs}
         """
 
 
-    def decode(buffer):
+    def decode(buffer, codecs=None):
         """
         Decodes the event instance from C{stream}.
 
         @type buffer: L{pyamf.util.BufferedByteStream}
+        @param codecs: Supplies the AMF decoders, if any are needed.
+        @type codecs: L{Codecs}
         """
 
 
@@ -265,20 +273,22 @@ class Message(object):
     implements(IMessage)
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Called to encode the event to C{buf}.
 
         @type buf: L{pyamf.util.BufferedByteStream}
+        @type codecs: L{Codecs}
         """
         raise NotImplementedError
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Called to decode the event from C{buf}.
 
         @type buf: L{pyamf.util.BufferedByteStream}
+        @type codecs: L{Codecs}
         """
         raise NotImplementedError
 
@@ -324,14 +334,14 @@ class FrameSize(Message):
         self.size = size
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a frame size message.
         """
         self.size = buf.read_ulong()
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a frame size message.
         """
@@ -349,7 +359,7 @@ class FrameSize(Message):
         """
         Dispatches the message to the listener.
         """
-        listener.onFrameSize(self.size, timestamp)
+        return listener.onFrameSize(self.size, timestamp)
 
 
 
@@ -370,14 +380,14 @@ class BytesRead(Message):
         self.bytes = bytes
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a bytes read message.
         """
         self.bytes = buf.read_ulong()
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a bytes read message.
         """
@@ -395,7 +405,7 @@ class BytesRead(Message):
         """
         Dispatches the message to the listener.
         """
-        listener.onBytesRead(self.bytes, timestamp)
+        return listener.onBytesRead(self.bytes, timestamp)
 
 
 
@@ -418,7 +428,7 @@ class ControlMessage(Message):
         self.value3 = value3
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a control message.
         """
@@ -432,7 +442,7 @@ class ControlMessage(Message):
             pass
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a control message.
         """
@@ -486,14 +496,14 @@ class DownstreamBandwidth(Message):
         self.bandwidth = bandwidth
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a downstream bandwidth message.
         """
         self.bandwidth = buf.read_ulong()
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a downstream bandwidth message.
         """
@@ -532,7 +542,7 @@ class UpstreamBandwidth(Message):
         self.extra = extra
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode an upstream bandwidth message.
         """
@@ -540,7 +550,7 @@ class UpstreamBandwidth(Message):
         self.extra = buf.read_uchar()
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode an upstream bandwidth message.
         """
@@ -572,13 +582,282 @@ class UpstreamBandwidth(Message):
 
 
 
+def _reset_context(context):
+    """
+    Clears the references held by an AMF C{context}, keeping the class alias
+    lookups. The C extension contexts do not expose their alias lookups so
+    these are fully cleared.
+    """
+    aliases = getattr(context, '_class_aliases', None)
+
+    context.clear()
+
+    if aliases is not None:
+        context._class_aliases = aliases
+
+
+
+class Codecs(object):
+    """
+    Reusable AMF encoders and decoders, one set is kept per connection.
+
+    Getting an encoder or decoder from C{pyamf} builds a new context (and its
+    reference tables) every time. Instead, one is built for each AMF version
+    and reset between messages.
+
+    Decoders are held by L{Arguments} while the arguments are being decoded
+    so they are handed out by L{getDecoder} and given back by
+    L{releaseDecoder}. If a decoder is never given back, a new one is built.
+
+    @ivar encoders: Map of AMF version -> encoder.
+    @ivar decoders: Map of AMF version -> decoder that is not in use.
+    """
+
+    def __init__(self):
+        self.encoders = {}
+        self.decoders = {}
+
+
+    def getEncoder(self, encoding, stream):
+        """
+        Returns the encoder for C{encoding}, reset and writing to C{stream}.
+        """
+        encoder = self.encoders.get(encoding, None)
+
+        if encoder is None:
+            encoder = self.encoders[encoding] = pyamf.get_encoder(encoding)
+        else:
+            _reset_context(encoder.context)
+
+        encoder.stream = stream
+
+        return encoder
+
+
+    def getDecoder(self, encoding, stream):
+        """
+        Returns a decoder for C{encoding}, reset and reading from C{stream}.
+        """
+        decoder = self.decoders.pop(encoding, None)
+
+        if decoder is None:
+            return pyamf.get_decoder(encoding, stream=stream)
+
+        _reset_context(decoder.context)
+
+        decoder.stream = stream
+
+        return decoder
+
+
+    def releaseDecoder(self, encoding, decoder):
+        """
+        Hands back a decoder that was returned by L{getDecoder}.
+        """
+        decoder.stream = None
+
+        self.decoders[encoding] = decoder
+
+
+
+def _get_encoder(encoding, stream, codecs=None):
+    """
+    Returns an AMF encoder, from C{codecs} if supplied.
+    """
+    if codecs is None:
+        return pyamf.get_encoder(encoding, stream)
+
+    return codecs.getEncoder(encoding, stream)
+
+
+
+def _get_decoder(encoding, stream, codecs=None):
+    """
+    Returns an AMF decoder, from C{codecs} if supplied.
+    """
+    if codecs is None:
+        return pyamf.get_decoder(encoding, stream=stream)
+
+    return codecs.getDecoder(encoding, stream)
+
+
+
+class Arguments(object):
+    """
+    The arguments of a decoded L{Notify} or L{Invoke} message.
+
+    The arguments are decoded incrementally as they are accessed so that
+    a message that is routed nowhere, or only needs its first argument
+    inspecting, does not pay for decoding the rest. The AMF encoded bytes are
+    available through L{getRaw} so that the message can be relayed without
+    decoding it at all.
+
+    The decoder that read the message header is given back straight away, a
+    message whose arguments are never accessed does not keep hold of one.
+
+    @ivar decoder: The AMF decoder, positioned at the next argument. Only held
+        once the arguments are accessed and until they have all been decoded.
+    @ivar stream: The stream containing the encoded message.
+    @ivar start: The position in C{stream} where the message starts.
+    @ivar skip: The number of values (the name and id) in the message before
+        the arguments.
+    @ivar offset: The position in C{stream} where the arguments start.
+    @ivar items: The arguments decoded so far.
+    @type items: C{list}
+    @ivar complete: Whether all the arguments have been decoded.
+    @ivar codecs: The L{Codecs} that decoders are taken from and given back
+        to.
+    @ivar encoding: The AMF version of C{decoder}.
+    """
+
+    def __init__(self, decoder, codecs=None, encoding=None, start=0, skip=0):
+        self.decoder = decoder
+        self.stream = decoder.stream
+        self.start = start
+        self.skip = skip
+        self.offset = self.stream.tell()
+        self.codecs = codecs
+        self.encoding = encoding
+
+        self.items = []
+        self.complete = self.stream.at_eof()
+
+        self._release()
+
+
+    def _acquire(self):
+        self.stream.seek(self.start)
+
+        decoder = self.decoder = _get_decoder(self.encoding, self.stream,
+            self.codecs)
+
+        # decoding the header again restores the references the arguments
+        # may make to it
+        for i in xrange(self.skip):
+            decoder.next()
+
+
+    def _release(self):
+        decoder, self.decoder = self.decoder, None
+
+        if self.codecs is not None:
+            self.codecs.releaseDecoder(self.encoding, decoder)
+
+
+    def _decode(self, index=None):
+        """
+        Decodes the arguments up to and including C{index}, or all of them if
+        C{index} is C{None}.
+        """
+        items = self.items
+
+        while not self.complete:
+            if index is not None and len(items) > index:
+                break
+
+            if self.decoder is None:
+                self._acquire()
+
+            try:
+                items.append(self.decoder.next())
+            except StopIteration:
+                self.complete = True
+                self._release()
+
+        return items
+
+
+    def getRaw(self):
+        """
+        Returns the AMF encoded arguments.
+        """
+        return self.stream.getvalue()[self.offset:]
+
+
+    def isDecoded(self):
+        """
+        Whether any of the arguments have been decoded. Once they have there
+        is no telling whether they have been modified so L{getRaw} can no
+        longer be relied upon when encoding.
+        """
+        return bool(self.items)
+
+
+    def __len__(self):
+        return len(self._decode())
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is not None and index.stop >= 0 and (
+                    index.start is None or index.start >= 0):
+                return self._decode(index.stop - 1)[index]
+
+            return self._decode()[index]
+
+        if index >= 0:
+            return self._decode(index)[index]
+
+        return self._decode()[index]
+
+
+    def __iter__(self):
+        i = 0
+
+        while True:
+            items = self._decode(i)
+
+            if i >= len(items):
+                return
+
+            yield items[i]
+
+            i += 1
+
+
+    def __nonzero__(self):
+        return len(self._decode(0)) > 0
+
+
+    def __eq__(self, other):
+        if isinstance(other, Arguments):
+            other = other._decode()
+
+        return self._decode() == list(other)
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __repr__(self):
+        return repr(self._decode())
+
+
+
+def _encode_arguments(encoder, buf, args):
+    """
+    Encodes C{args} to C{buf}. If C{args} are L{Arguments} that have not been
+    touched then the original bytes are written out as is.
+    """
+    if isinstance(args, Arguments) and not args.isDecoded():
+        buf.write(args.getRaw())
+
+        return
+
+    for a in args:
+        encoder.writeElement(a)
+
+
+
 class Notify(Message):
     """
     A notification message.
 
     @param name: The method name to call.
     @type name: C{str}
-    @param args: A list of method arguments.
+    @param args: A list of method arguments. Once decoded, these are
+        L{Arguments}.
     """
 
     set_type(NOTIFY)
@@ -589,26 +868,25 @@ class Notify(Message):
         self.argv = list(args)
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a notification message.
         """
-        decoder = pyamf.get_decoder(pyamf.AMF0, stream=buf)
+        start = buf.tell()
+        decoder = _get_decoder(pyamf.AMF0, buf, codecs)
 
         self.name = decoder.next()
-        self.argv = [x for x in decoder]
+        self.argv = Arguments(decoder, codecs, pyamf.AMF0, start, 1)
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a notification message.
         """
-        args = [self.name] + self.argv
-
-        encoder = pyamf.get_encoder(pyamf.AMF0, buf)
+        encoder = _get_encoder(pyamf.AMF0, buf, codecs)
 
-        for a in args:
-            encoder.writeElement(a)
+        encoder.writeElement(self.name)
+        _encode_arguments(encoder, buf, self.argv)
 
 
     def dispatch(self, listener, timestamp):
@@ -635,34 +913,42 @@ class Invoke(Message):
         self.argv = list(args)
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a notification message.
         """
-        decoder = pyamf.get_decoder(self.encoding, stream=buf)
+        start = buf.tell()
+        decoder = _get_decoder(self.encoding, buf, codecs)
 
         self.name = decoder.next()
         self.id = decoder.next()
-        self.argv = list(decoder)
+        self.argv = Arguments(decoder, codecs, self.encoding, start, 2)
 
 
-    def encode(self, buf):
+    def encode(self, buf, codecs=None):
         """
         Encode a notification message.
+
+        AMF3 references may point back into the name so the arguments are
+        only written out as is for AMF0.
         """
-        args = [self.name, self.id] + self.argv
+        encoder = _get_encoder(self.encoding, buf, codecs)
 
-        encoder = pyamf.get_encoder(self.encoding, buf)
+        encoder.writeElement(self.name)
+        encoder.writeElement(self.id)
 
-        for a in args:
-            encoder.writeElement(a)
+        if self.encoding == pyamf.AMF0:
+            _encode_arguments(encoder, buf, self.argv)
+        else:
+            for a in self.argv:
+                encoder.writeElement(a)
 
 
     def dispatch(self, listener, timestamp):
         """
         Dispatches the message to the listener.
         """
-        listener.onInvoke(self.name, self.id, self.argv, timestamp)
+        return listener.onInvoke(self.name, self.id, self.argv, timestamp)
 
 
 
@@ -676,12 +962,12 @@ class FlexMessage(Invoke):
 
     encoding = pyamf.AMF3
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         if buf.peek(1) == '\x00':
             buf.seek(1, 1)
             self.encoding = pyamf.AMF0
 
-        return Invoke.decode(self, buf)
+        return Invoke.decode(self, buf, codecs)
 
 
 
@@ -698,7 +984,7 @@ class StreamingMessage(Message):
         self.data = data
 
 
-    def decode(self, buf):
+    def decode(self, buf, codecs=None):
         """
         Decode a streaming message.
         """
@@ -708,19 +994,26 @@ class StreamingMessage(Message):
             self.data = ''
 
 
-    def encode(self, buf):
+    def getData(self):
         """
-        Encode a streaming message.
+        Returns the data, which is sent as is.
         """
         if self.data is None:
             raise EncodeError('No data set')
 
-        try:
-            buf.write(self.data)
-        except TypeError:
+        if not isinstance(self.data, str):
             raise EncodeError('TypeError: data (expected str, got %r)' % (
                 type(self.data),))
 
+        return self.data
+
+
+    def encode(self, buf, codecs=None):
+        """
+        Encode a streaming message.
+        """
+        buf.write(self.getData())
+
 
 
 class AudioData(StreamingMessage):
@@ -735,7 +1028,7 @@ class AudioData(StreamingMessage):
         """
         Dispatches the message to the listener.
         """
-        listener.onAudioData(self.data, timestamp)
+        return listener.onAudioData(self.data, timestamp)
 
 
 
@@ -755,6 +1048,154 @@ class VideoData(StreamingMessage):
 
 
 
+def isKeyframe(data):
+    """
+    Whether the video data C{data} (the body of a L{VideoData} message) is a
+    keyframe, which a player can start decoding from.
+    """
+    return data[:1] != '' and ord(data[0]) >> 4 == 1
+
+
+
+class EncodedMessage(Message):
+    """
+    A message whose body has already been encoded. Useful for messages that
+    are sent over and over again with the same content.
+
+    @ivar body: The encoded message body.
+    @type body: C{str}
+    """
+
+
+    def __init__(self, datatype, body):
+        self.__data_type__ = datatype
+        self.body = body
+
+
+    def getData(self):
+        """
+        Returns the pre-encoded body.
+        """
+        return self.body
+
+
+    def encode(self, buf, codecs=None):
+        """
+        Writes the pre-encoded body.
+        """
+        buf.write(self.body)
+
+
+    def decode(self, buf, codecs=None):
+        raise DecodeError('Encoded messages cannot be decoded')
+
+
+    def getMessage(self):
+        """
+        Returns the message that this is the encoded form of.
+        """
+        msg = classByType(self.__data_type__)()
+
+        msg.decode(BufferedByteStream(self.body))
+
+        return msg
+
+
+
+def pre_encode(msg):
+    """
+    Encodes C{msg} once, returning an L{EncodedMessage} that can be sent any
+    number of times.
+    """
+    buf = BufferedByteStream()
+
+    msg.encode(buf)
+
+    return EncodedMessage(msg.__data_type__, buf.getvalue())
+
+
+
+_SLOT_MARKER = '\x00rtmpy.slot:%s\x00'
+
+#: Matches an AMF0 encoded slot marker, capturing the slot name.
+_SLOT_PATTERN = re.compile('\x02..\x00rtmpy\\.slot:([^\x00]*)\x00', re.S)
+
+
+def slot(name):
+    """
+    Marks a value in a message that is given to L{InvokeTemplate}, the value
+    is supplied when the template is filled.
+    """
+    return _SLOT_MARKER % (name,)
+
+
+
+class InvokeTemplate(object):
+    """
+    An AMF0 L{Invoke} (or L{Notify}) that is encoded once, with slots left
+    for the few values that change each time it is sent. Filling the
+    template only needs to encode the slot values.
+
+    For example::
+
+        t = InvokeTemplate(Invoke('onStatus', 0, None, status.status(
+            'NetStream.Play.Start', slot('description'))))
+
+        msg = t.fill(description='Started playing foo')
+
+    Slot values must be simple types (C{str}, C{unicode}, numbers, C{bool}
+    or C{None}), AMF references would point at the wrong objects otherwise.
+
+    @ivar datatype: The datatype of the templated message.
+    @ivar chunks: The encoded chunks of the message in between the slots.
+    @ivar slots: The slot names in the order that they appear.
+    """
+
+    simpleTypes = (str, unicode, int, long, float, bool, type(None))
+
+    #: Shared by all templates to encode the slot values.
+    codecs = Codecs()
+
+
+    def __init__(self, msg):
+        if getattr(msg, 'encoding', pyamf.AMF0) != pyamf.AMF0:
+            raise EncodeError('Only AMF0 messages can be templated')
+
+        buf = BufferedByteStream()
+        msg.encode(buf)
+
+        # [chunk, slot name, chunk, slot name, ..., chunk]
+        parts = _SLOT_PATTERN.split(buf.getvalue())
+
+        self.datatype = msg.__data_type__
+        self.chunks = parts[::2]
+        self.slots = parts[1::2]
+
+
+    def fill(self, **values):
+        """
+        Returns an L{EncodedMessage} with the slots filled by C{values}.
+        """
+        buf = BufferedByteStream()
+        encoder = self.codecs.getEncoder(pyamf.AMF0, buf)
+        chunks = self.chunks
+
+        buf.write(chunks[0])
+
+        for i, name in enumerate(self.slots):
+            value = values[name]
+
+            if not isinstance(value, self.simpleTypes):
+                raise EncodeError('Slot %r must be a simple type (got %r)' % (
+                    name, type(value)))
+
+            encoder.writeElement(value)
+            buf.write(chunks[i + 1])
+
+        return EncodedMessage(self.datatype, buf.getvalue())
+
+
+
 #: Map event types to event classes
 TYPE_MAP = {}
 
@@ -819,3 +1260,101 @@ def typeByClass(obj):
         pass
 
     return -1
+
+
+
+def dispatch_message(listener, datatype, timestamp, data, codecs=None):
+    """
+    Builds the message for C{datatype}, decodes C{data} into it and
+    dispatches it to C{listener}.
+
+    @return: Whatever the listener's method returns.
+    @raise UnknownType: Unknown message type for C{datatype}.
+    """
+    m = classByType(datatype)()
+
+    m.decode(BufferedByteStream(data), codecs)
+
+    return m.dispatch(listener, timestamp)
+
+
+
+# The functions below decode and dispatch a message without building the
+# message instance. They must behave the same as the C{decode}/C{dispatch}
+# methods of the corresponding message class.
+
+
+
+def _unpack(fmt, data):
+    """
+    Unpacks C{fmt} from the start of C{data}.
+
+    @raise IOError: C{data} is too short, as the message decoders do.
+    """
+    if len(data) < struct.calcsize(fmt):
+        raise IOError('Message body too short (%d bytes)' % (len(data),))
+
+    return struct.unpack_from(fmt, data)
+
+
+
+def _dispatch_frame_size(listener, datatype, timestamp, data, codecs):
+    return listener.onFrameSize(_unpack('!L', data)[0], timestamp)
+
+
+
+def _dispatch_bytes_read(listener, datatype, timestamp, data, codecs):
+    return listener.onBytesRead(_unpack('!L', data)[0], timestamp)
+
+
+
+def _dispatch_control(listener, datatype, timestamp, data, codecs):
+    n = len(data)
+
+    if n >= 14:
+        args = _unpack('!hlll', data)
+    elif n >= 10:
+        args = _unpack('!hll', data)
+    else:
+        args = _unpack('!hl', data)
+
+    return listener.onControlMessage(ControlMessage(*args), timestamp)
+
+
+
+def _dispatch_downstream_bandwidth(listener, datatype, timestamp, data, codecs):
+    return listener.onDownstreamBandwidth(
+        _unpack('!L', data)[0], timestamp)
+
+
+
+def _dispatch_upstream_bandwidth(listener, datatype, timestamp, data, codecs):
+    bandwidth, extra = _unpack('!LB', data)
+
+    return listener.onUpstreamBandwidth(bandwidth, extra, timestamp)
+
+
+
+def _dispatch_audio(listener, datatype, timestamp, data, codecs):
+    return listener.onAudioData(data, timestamp)
+
+
+
+def _dispatch_video(listener, datatype, timestamp, data, codecs):
+    return listener.onVideoData(data, timestamp)
+
+
+
+#: Map of datatype -> function that decodes and dispatches a message of that
+#: type without building a message instance. All functions have the same
+#: signature (and return value) as L{dispatch_message}, which handles any
+#: other type.
+DISPATCH_TABLE = {
+    FRAME_SIZE: _dispatch_frame_size,
+    BYTES_READ: _dispatch_bytes_read,
+    CONTROL: _dispatch_control,
+    DOWNSTREAM_BANDWIDTH: _dispatch_downstream_bandwidth,
+    UPSTREAM_BANDWIDTH: _dispatch_upstream_bandwidth,
+    AUDIO_DATA: _dispatch_audio,
+    VIDEO_DATA: _dispatch_video,
+}
@@ -24,8 +24,11 @@ generate/decode the packets) to determine if the packets are valid.
 @since: 0.1
 """
 
+import collections
+import struct
 
 from zope.interface import implements, Interface, Attribute
+from twisted.internet import task
 from pyamf.util import BufferedByteStream
 
 from rtmpy.protocol import version
@@ -157,6 +160,108 @@ class Packet(object):
 
 
 
+class PayloadPool(object):
+    """
+    A refillable pool of pre-generated random handshake payloads. Generating
+    the payloads is relatively expensive so L{refill} can be called when the
+    server is otherwise idle, taking the work out of the handshake itself.
+
+    @ivar size: The number of payloads to keep in reserve.
+    @type size: C{int}
+    @ivar length: The length of each payload.
+    @type length: C{int}
+    @ivar payloads: The available payloads.
+    @type payloads: C{collections.deque}
+    @ivar refillers: The number of users that want the pool refilled, see
+        L{startRefilling}.
+    """
+
+    def __init__(self, size=64, length=HANDSHAKE_LENGTH - 8):
+        self.size = size
+        self.length = length
+
+        self.payloads = collections.deque()
+
+        self.refillers = 0
+        self._loop = None
+
+
+    def __len__(self):
+        return len(self.payloads)
+
+
+    def get(self):
+        """
+        Returns a random payload. If the pool has been drained, one is
+        generated on demand.
+
+        @rtype: C{str}
+        """
+        try:
+            return self.payloads.popleft()
+        except IndexError:
+            return util.generateBytes(self.length)
+
+
+    def refill(self):
+        """
+        Tops the pool back up to C{size} payloads.
+
+        @return: The number of payloads that were generated.
+        @rtype: C{int}
+        """
+        needed = self.size - len(self.payloads)
+
+        if needed <= 0:
+            return 0
+
+        length = self.length
+        data = util.generateBytes(length * needed)
+
+        self.payloads.extend([data[i:i + length]
+            for i in xrange(0, len(data), length)])
+
+        return needed
+
+
+    def startRefilling(self, interval, clock=None):
+        """
+        Refills the pool every C{interval} seconds until every call has been
+        matched by a call to L{stopRefilling}. However many users the pool
+        has (e.g. one per listening factory), there is only ever one loop.
+        """
+        self.refillers += 1
+
+        if self._loop is not None:
+            return
+
+        self._loop = task.LoopingCall(self.refill)
+
+        if clock is not None:
+            self._loop.clock = clock
+
+        self._loop.start(interval, now=True)
+
+
+    def stopRefilling(self):
+        """
+        Stops refilling the pool, once there are no users left.
+        """
+        if self.refillers == 0:
+            return
+
+        self.refillers -= 1
+
+        if self.refillers or self._loop is None:
+            return
+
+        loop, self._loop = self._loop, None
+
+        if loop.running:
+            loop.stop()
+
+
+
 class BaseNegotiator(object):
     """
     Base functionality for negotiating an RTMP handshake.
@@ -206,7 +311,7 @@ class BaseNegotiator(object):
 
         self.buildSynPayload(self.my_syn)
 
-        self._writePacket(self.my_syn)
+        self.writeSyn()
 
 
     def getPeerPacket(self):
@@ -277,6 +382,13 @@ class BaseNegotiator(object):
         self.observer.handshakeSuccess(self.buffer.getvalue())
 
 
+    def writeSyn(self):
+        """
+        Writes L{self.my_syn} to the observer.
+        """
+        self._writePacket(self.my_syn)
+
+
     def writeAck(self):
         """
         Writes L{self.my_ack} to the observer.
@@ -355,35 +467,68 @@ class ClientNegotiator(BaseNegotiator):
 class ServerNegotiator(BaseNegotiator):
     """
     Negotiator for server handshakes.
+
+    Nothing is written until the peer syn has been received, the version
+    byte, syn and ack are then written together in one go. See
+    L{writeResponse}.
+
+    @cvar payloadPool: The L{PayloadPool} that random payloads are drawn from.
+    @cvar protocolVersion: The protocol version byte that is written ahead of
+        the syn packet.
     """
 
+    payloadPool = PayloadPool()
+    protocolVersion = version.RTMP
+
     def buildSynPayload(self, packet):
         """
         Called to build the syn packet, based on the state of the negotiations.
 
         C{RTMP} payloads are just random.
         """
-        packet.payload = _generate_payload()
+        packet.payload = self.payloadPool.get()
 
     def buildAckPayload(self, packet):
         """
         Called to build the ack packet, based on the state of the negotiations.
 
-        C{RTMP} payloads are just random.
+        The ack echoes the payload of the peer syn.
+        """
+        packet.payload = self.peer_syn.payload
+
+
+    def writeSyn(self):
+        """
+        The syn is held back until the peer syn has been received.
         """
-        packet.payload = _generate_payload()
 
 
     def synReceived(self):
         """
         Called when the client sends its syn packet.
 
-        Builds and writes the ack packet.
+        Builds the ack packet and writes the response.
         """
         self.my_ack = Packet(self.peer_syn.uptime, self.my_syn.uptime)
 
         self.buildAckPayload(self.my_ack)
-        self.writeAck()
+        self.writeResponse()
+
+
+    def writeResponse(self):
+        """
+        Writes the version byte, L{self.my_syn} and L{self.my_ack} to the
+        observer with a single call to C{write}.
+        """
+        syn, ack = self.my_syn, self.my_ack
+
+        self.transport.write(''.join([
+            chr(self.protocolVersion),
+            struct.pack('!LL', syn.uptime, syn.version),
+            syn.payload,
+            struct.pack('!LL', ack.uptime, ack.version),
+            ack.payload,
+        ]))
 
 
     def ackReceived(self):
@@ -416,7 +561,3 @@ def get_implementation(protocol):
 
     return mod
 
-
-
-def _generate_payload():
-    return util.generateBytes(HANDSHAKE_LENGTH - 8)
@@ -29,6 +29,8 @@ into fixed size body chunks.
 @see: U{RTMP<http://dev.rtmpy.org/wiki/RTMP>}
 """
 
+import struct
+
 from twisted.python import log, failure
 from twisted.internet import protocol, task
 from zope.interface import Interface, Attribute, implements
@@ -66,6 +68,8 @@ class MessageDispatcher(object):
     A proxy class that listens for events fired from the L{codec.Decoder}.
 
     @param streamer: The L{BaseStreamer} instance attached to the decoder.
+    @ivar codecs: The reusable AMF decoders for the connection.
+    @type codecs: L{message.Codecs}
     """
 
     implements(interfaces.IMessageDispatcher)
@@ -73,6 +77,7 @@ class MessageDispatcher(object):
 
     def __init__(self, streamer):
         self.streamer = streamer
+        self.codecs = message.Codecs()
 
 
     def dispatchMessage(self, stream, datatype, timestamp, data):
@@ -84,10 +89,9 @@ class MessageDispatcher(object):
         @param timestamp: The absolute timestamp this message was received.
         @param data: The raw data for the message.
         """
-        m = message.classByType(datatype)()
+        func = message.DISPATCH_TABLE.get(datatype, message.dispatch_message)
 
-        m.decode(BufferedByteStream(data))
-        m.dispatch(stream, timestamp)
+        func(stream, datatype, timestamp, data, self.codecs)
 
 
 
@@ -161,8 +165,13 @@ class BaseStreamer(object):
 
     def bytesInterval(self, bytes):
         """
+        Acknowledges the bytes read from the peer. The body is packed directly
+        rather than building and encoding a L{message.BytesRead}.
         """
-        self.sendMessage(message.BytesRead(bytes), self.controlStream)
+        body = struct.pack('!L', bytes % message.BytesRead.FOUR_GB_THRESHOLD)
+
+        self.sendMessage(message.EncodedMessage(message.BYTES_READ, body),
+            self.controlStream)
 
 
     def startStreaming(self):
@@ -174,6 +183,9 @@ class BaseStreamer(object):
 
         self._decodingBuffer = BufferedByteStream()
         self._encodingBuffer = BufferedByteStream()
+        self._messageBuffer = BufferedByteStream()
+
+        self.codecs = message.Codecs()
 
         self.decoder = codec.Decoder(self.getDispatcher(), self.streamManager,
             stream=self._decodingBuffer)
@@ -194,6 +206,8 @@ class BaseStreamer(object):
 
         del self._decodingBuffer
         del self._encodingBuffer
+        del self._messageBuffer
+        del self.codecs
 
         del self.decoder_task, self.decoder
         del self.encoder_task, self.encoder
@@ -260,16 +274,35 @@ class BaseStreamer(object):
         @param whenDone: A callback fired when the message has been written to
             the RTMP stream. See L{BaseStream.sendMessage}
         """
-        buf = BufferedByteStream()
-        e = self.encoder
+        if isinstance(msg, (message.StreamingMessage, message.EncodedMessage)):
+            # the body is already in its encoded form, skip the copies
+            self.sendRaw(msg.__data_type__, msg.getData(), stream)
+
+            return
+
+        buf = self._messageBuffer
+        buf.truncate()
 
         # this will probably need to be rethought as this could block for an
         # unacceptable amount of time. For most messages however it seems to be
         # fast enough and the penalty for setting up a new thread is too high.
-        msg.encode(buf)
+        msg.encode(buf, self.codecs)
+
+        self.sendRaw(msg.__data_type__, buf.getvalue(), stream)
+
+
+    def sendRaw(self, datatype, payload, stream):
+        """
+        Sends an already encoded message body to the peer.
+
+        @param datatype: The RTMP datatype of the message.
+        @param payload: The encoded message body.
+        @type payload: C{str}
+        @param stream: The stream instance that is sending the message.
+        """
+        e = self.encoder
 
-        e.send(buf.getvalue(), msg.__data_type__,
-            stream.streamId, stream.timestamp)
+        e.send(payload, datatype, stream.streamId, stream.timestamp)
 
         if e.active and not self.encoder_task:
             self.startEncoding()
@@ -53,6 +53,11 @@ MAX_CHANNELS = 0xffff + 64 - 2
 #  stream. It cannot be deleted and is integral to the RTMP protocol.
 COMMAND_CHANNEL_ID = 0
 
+#: The L{header.Header} attributes saved by L{Decoder.getState}, in the order
+#: that the constructor accepts them.
+_HEADER_FIELDS = ('channelId', 'timestamp', 'datatype', 'bodyLength',
+    'streamId', 'full', 'continuation')
+
 
 
 class BaseError(Exception):
@@ -552,6 +557,71 @@ class Decoder(ChannelDemuxer):
         self._nextInterval = self.bytes + self.bytesInterval
 
 
+    def getState(self):
+        """
+        Returns a snapshot of the decoding state, made up of simple types, so
+        that another decoder (possibly in another process) can carry on
+        decoding the stream. See L{setState}.
+
+        Any data that has been received but not yet decoded is included.
+
+        @raise DecodeError: Part way through reading a frame.
+        """
+        if self._currentChannel is not None:
+            raise DecodeError('Cannot snapshot the decoder mid frame')
+
+        channels = []
+
+        for c in self.channels.values():
+            h = c.header
+
+            if h is not None:
+                h = [getattr(h, k) for k in _HEADER_FIELDS]
+
+            channels.append([c.channelId, h, c.timestamp, c._lastDelta,
+                c.bytes, c.frameRemaining, c._bodyRemaining])
+
+        return {
+            'frameSize': self.frameSize,
+            'bytes': self.bytes,
+            'bytesInterval': self.bytesInterval,
+            'nextInterval': self._nextInterval,
+            'channels': channels,
+            'bucket': self.bucket.items(),
+            'buffer': self.stream.getvalue()[self.stream.tell():],
+        }
+
+
+    def setState(self, state):
+        """
+        Restores the decoding state from a snapshot returned by L{getState}.
+        """
+        self.setFrameSize(state['frameSize'])
+
+        self.bytes = state['bytes']
+        self.bytesInterval = state['bytesInterval']
+        self._nextInterval = state['nextInterval']
+
+        for channelId, h, timestamp, lastDelta, bytes, frameRemaining, \
+                bodyRemaining in state['channels']:
+            c = self.getChannel(channelId)
+
+            if h is not None:
+                h = header.Header(*h)
+
+            c.header = h
+            c.timestamp = timestamp
+            c._lastDelta = lastDelta
+            c.bytes = bytes
+            c.frameRemaining = frameRemaining
+            c._bodyRemaining = bodyRemaining
+
+        self.bucket = dict(state['bucket'])
+
+        if state['buffer']:
+            self.send(state['buffer'])
+
+
     def next(self):
         """
         Iterates over the RTMP stream and dispatches decoded messages to the
@@ -751,6 +821,18 @@ class ChannelMuxer(Codec):
         self.activeChannels[channel] = channel.channelId
 
 
+    def getActiveChannels(self):
+        """
+        Returns the active channels in channel id order. C{activeChannels} is
+        keyed on the channels themselves, so iterating over it directly would
+        interleave the frames in an order that depends on object addresses.
+        """
+        channels = self.activeChannels.keys()
+        channels.sort(key=lambda c: c.channelId)
+
+        return channels
+
+
     def next(self):
         """
         Encodes one RTMP frame from all the active channels.
@@ -763,7 +845,7 @@ class ChannelMuxer(Codec):
 
         to_release = []
 
-        for channel in self.activeChannels:
+        for channel in self.getActiveChannels():
             if self._encodeOneFrame(channel):
                 channel.reset()
                 to_release.append(channel)
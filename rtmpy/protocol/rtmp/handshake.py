@@ -15,8 +15,26 @@
 
 """
 Handshaking specific to C{RTMP}.
+
+Besides the plain handshake (where the peer simply echoes the random payloads)
+the digest handshake expected by Flash Player 9+ clients is supported. The
+peer advertises the digest scheme by sending a non-zero version in its syn. A
+HMAC-SHA256 digest of the packet is then embedded at an offset into the
+payload and the ack is signed with a key derived from the digest of the
+peer's syn.
+
+If the peer does not use digests (or C{hashlib} is unavailable) the
+negotiators fall back to the plain handshake.
 """
 
+import hmac
+import struct
+
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
+
 from rtmpy.protocol import handshake, version
 from rtmpy import util
 
@@ -26,6 +44,142 @@ __all__ = [
 ]
 
 
+#: Length of a HMAC-SHA256 digest.
+DIGEST_LENGTH = 32
+
+_KEY_TAIL = (
+    '\xf0\xee\xc2\x4a\x80\x68\xbe\xe8\x2e\x00\xd0\xd1\x02\x9e\x7e\x57'
+    '\x6e\xec\x5d\x2d\x29\x80\x6f\xab\x93\xb8\xe6\x36\xcf\xeb\x31\xae')
+
+GENUINE_FP_KEY = 'Genuine Adobe Flash Player 001' + _KEY_TAIL
+GENUINE_FMS_KEY = 'Genuine Adobe Flash Media Server 001' + _KEY_TAIL
+
+
+def _build_context(key):
+    if hashlib is None:
+        return None
+
+    return hmac.new(key, digestmod=hashlib.sha256)
+
+
+# The HMAC contexts for the fixed keys are built once and copied for each use,
+# which saves rehashing the key for every connection.
+
+#: Signs the client syn.
+_FP_SYN = _build_context(GENUINE_FP_KEY[:30])
+#: Signs the server syn.
+_FMS_SYN = _build_context(GENUINE_FMS_KEY[:36])
+#: Derives the key used to sign the client ack.
+_FP_ACK = _build_context(GENUINE_FP_KEY)
+#: Derives the key used to sign the server ack.
+_FMS_ACK = _build_context(GENUINE_FMS_KEY)
+
+
+def _hmac(context, *data):
+    """
+    Returns the digest of C{data} using a copy of C{context}.
+    """
+    h = context.copy()
+
+    for d in data:
+        h.update(d)
+
+    return h.digest()
+
+
+def _header(packet):
+    return struct.pack('!LL', packet.uptime, packet.version)
+
+
+def get_digest_offset(payload, scheme):
+    """
+    Returns the offset of the digest within C{payload}.
+
+    @param scheme: C{0} or C{1}. The offset is derived from the 4 bytes at
+        the start of the first or second half of the payload respectively.
+    """
+    base = scheme * 764
+
+    return sum(map(ord, payload[base:base + 4])) % 728 + base + 4
+
+
+def get_digest(packet, context, scheme):
+    """
+    Calculates the digest of C{packet} for C{scheme}, excluding the bytes
+    where the digest is embedded.
+    """
+    offset = get_digest_offset(packet.payload, scheme)
+
+    return _hmac(context, _header(packet), packet.payload[:offset],
+        packet.payload[offset + DIGEST_LENGTH:])
+
+
+def find_digest(packet, context):
+    """
+    Looks for a valid digest in C{packet}, trying each scheme in turn.
+
+    @return: A C{(scheme, digest)} tuple or C{None} if no valid digest was
+        found.
+    """
+    if context is None:
+        return None
+
+    for scheme in (0, 1):
+        offset = get_digest_offset(packet.payload, scheme)
+        digest = packet.payload[offset:offset + DIGEST_LENGTH]
+
+        if digest == get_digest(packet, context, scheme):
+            return scheme, digest
+
+    return None
+
+
+def sign_syn(packet, context, scheme):
+    """
+    Embeds the digest of C{packet} into its payload.
+
+    @return: The digest.
+    """
+    offset = get_digest_offset(packet.payload, scheme)
+    digest = get_digest(packet, context, scheme)
+
+    packet.payload = (packet.payload[:offset] + digest +
+        packet.payload[offset + DIGEST_LENGTH:])
+
+    return digest
+
+
+def get_ack_signature(packet, context, peer_digest):
+    """
+    Returns the signature for the ack C{packet}. The signing key is the
+    digest of C{peer_digest} using C{context}.
+    """
+    key = _hmac(context, peer_digest)
+
+    return hmac.new(key, _header(packet) + packet.payload[:-DIGEST_LENGTH],
+        hashlib.sha256).digest()
+
+
+def sign_ack(packet, context, peer_digest):
+    """
+    Replaces the last L{DIGEST_LENGTH} bytes of the payload of C{packet} with
+    its signature.
+    """
+    packet.payload = (packet.payload[:-DIGEST_LENGTH] +
+        get_ack_signature(packet, context, peer_digest))
+
+
+def verify_ack(packet, context, peer_digest):
+    """
+    Raises L{handshake.VerificationError} if the signature of the ack
+    C{packet} is invalid.
+    """
+    signature = get_ack_signature(packet, context, peer_digest)
+
+    if packet.payload[-DIGEST_LENGTH:] != signature:
+        raise handshake.VerificationError('Invalid ack signature')
+
+
 class RandomPayloadNegotiator(object):
     """
     Generate a random payload for the syn/ack packets.
@@ -54,14 +208,144 @@ class RandomPayloadNegotiator(object):
 class ClientNegotiator(RandomPayloadNegotiator, handshake.ClientNegotiator):
     """
     A client negotiator for RTMP specific handshaking.
+
+    A digest is embedded in the syn. If the server responds in kind then the
+    digest handshake is used, otherwise the plain handshake.
+
+    @cvar clientVersion: The version sent in the syn if none was supplied.
+    @ivar digest: The digest embedded in the syn.
+    @ivar peer_digest: The digest found in the peer syn or C{None} if the peer
+        does not use digests.
     """
 
+    clientVersion = 0x09007c02
+
+    digest = None
+    peer_digest = None
+
+    def buildSynPayload(self, packet):
+        """
+        Random payload with a digest embedded.
+        """
+        RandomPayloadNegotiator.buildSynPayload(self, packet)
+
+        if _FP_SYN is None:
+            return
+
+        if not packet.version:
+            packet.version = self.clientVersion
+
+        self.digest = sign_syn(packet, _FP_SYN, 0)
+
+    def buildAckPayload(self, packet):
+        """
+        Random payload signed if the peer uses digests, otherwise the ack
+        echoes the peer syn.
+        """
+        if self.peer_digest is None:
+            packet.payload = self.peer_syn.payload
+
+            return
+
+        RandomPayloadNegotiator.buildAckPayload(self, packet)
+
+        sign_ack(packet, _FP_ACK, self.peer_digest)
+
+    def ackReceived(self):
+        """
+        Verifies the signature of the peer ack, falling back to the plain
+        handshake if the peer syn does not contain a digest.
+        """
+        found = None
+
+        if self.digest is not None:
+            found = find_digest(self.peer_syn, _FMS_SYN)
+
+        if found is None:
+            handshake.ClientNegotiator.ackReceived(self)
+
+            return
+
+        if self.buffer.remaining():
+            raise handshake.HandshakeError(
+                'Unexpected trailing data after peer ack')
+
+        self.peer_digest = found[1]
 
-class ServerNegotiator(RandomPayloadNegotiator, handshake.ServerNegotiator):
+        verify_ack(self.peer_ack, _FMS_ACK, self.digest)
+
+        self.my_ack = handshake.Packet(self.peer_syn.uptime,
+            self.my_syn.version)
+
+        self.buildAckPayload(self.my_ack)
+
+        self.writeAck()
+
+
+class ServerNegotiator(handshake.ServerNegotiator):
     """
     A server negotiator for RTMP specific handshaking.
+
+    The random payloads are drawn from L{handshake.ServerNegotiator.payloadPool}.
+    If the client syn contains a valid digest then the syn and ack are signed
+    accordingly, otherwise the ack echoes the client syn.
+
+    @cvar serverVersion: The version sent in the syn when digests are used.
+    @ivar digest: The digest embedded in the syn.
+    @ivar peer_digest: The digest found in the peer syn or C{None} if the peer
+        does not use digests.
     """
 
+    protocolVersion = version.RTMP
+    serverVersion = 0x04050001
+
+    digest = None
+    peer_digest = None
+
+    def synReceived(self):
+        """
+        Looks for a digest in the client syn and signs the syn if one is
+        found.
+        """
+        if self.peer_syn.version:
+            found = find_digest(self.peer_syn, _FP_SYN)
+
+            if found is not None:
+                scheme, self.peer_digest = found
+
+                self.my_syn.version = self.serverVersion
+                self.digest = sign_syn(self.my_syn, _FMS_SYN, scheme)
+
+        handshake.ServerNegotiator.synReceived(self)
+
+    def buildAckPayload(self, packet):
+        """
+        Random payload signed with a key derived from the client digest.
+        """
+        if self.peer_digest is None:
+            handshake.ServerNegotiator.buildAckPayload(self, packet)
+
+            return
+
+        packet.payload = self.payloadPool.get()
+
+        sign_ack(packet, _FMS_ACK, self.peer_digest)
+
+    def ackReceived(self):
+        """
+        Some clients that use digests still echo the server syn rather than
+        signing the ack, so both are accepted.
+        """
+        if self.peer_digest is None:
+            handshake.ServerNegotiator.ackReceived(self)
+
+            return
+
+        if self.peer_ack.payload == self.my_syn.payload:
+            return
+
+        verify_ack(self.peer_ack, _FP_ACK, self.digest)
+
 
 def _generate_payload():
     return util.generateBytes(handshake.HANDSHAKE_LENGTH - 8)
@@ -0,0 +1,415 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Push relaying. Streams published to an application are forwarded to the same
+stream name on a number of downstream servers, one client connection per
+stream per downstream server.
+
+Example usage::
+
+    app = server.Application()
+    app.push = push.Pusher(['rtmp://edge1.example.com/live',
+        'rtmp://edge2.example.com/live'])
+
+@since: 0.2
+"""
+
+import collections
+
+from zope.interface import implements
+from twisted.internet import interfaces
+from twisted.python import log
+
+from rtmpy import server, client, message
+
+
+
+class PushClientFactory(client.ClientFactory):
+    """
+    Tells the L{PushTarget} when its connection has been lost.
+    """
+
+
+    def __init__(self, target, url):
+        client.ClientFactory.__init__(self, url)
+
+        self.target = target
+
+
+    def clientConnectionLost(self, connector, reason):
+        self.failed(reason)
+        self.target.connectionLost(self, reason)
+
+
+
+class PushTarget(object):
+    """
+    Forwards a published stream to the application at C{url}, reconnecting
+    (with an exponential backoff) whenever the connection is lost.
+
+    The audio/video is written straight to the connection while the
+    transport keeps up. Otherwise (and while reconnecting) it is queued. Once
+    the queue holds more than C{maxQueue} bytes, the oldest packets are dropped
+    up to the first video keyframe that brings it back under the limit (or
+    until the next keyframe arrives) so that the downstream server always
+    receives a stream that it can decode.
+
+    The packets are the same strings that were received from the publishing
+    peer, no copies are made for each downstream server.
+
+    @ivar url: The url of the application on the downstream server.
+    @ivar name: The name the stream is published as.
+    @ivar stream: The publishing L{client.NetStream} while connected.
+    @ivar queue: The C{(datatype, data, timestamp)} packets waiting to be
+        sent.
+    @ivar stats: Counters for the C{connects} and C{failures} of the
+        connection and the packets C{sent} and C{dropped}.
+    """
+
+    implements(server.IPublishingStream, interfaces.IPushProducer)
+
+    #: The number of bytes of audio/video that can be queued.
+    maxQueue = 1024 * 1024
+
+    #: The delay before the first reconnect, in seconds.
+    initialDelay = 1.0
+    #: The delay is multiplied by this after every failed attempt.
+    factor = 2.0
+    #: The longest delay between reconnects.
+    maxDelay = 60.0
+
+
+    def __init__(self, url, name, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.url = url
+        self.name = name
+        self.reactor = reactor
+        self.clock = reactor
+
+        self.factory = None
+        self.connector = None
+        self.stream = None
+        self.meta = {}
+
+        self.queue = collections.deque()
+        self.queued = 0
+        self.paused = False
+        self.waitingForKeyframe = True
+        self.hasVideo = False
+
+        self.closed = False
+        self.retries = 0
+        self.retryTimer = None
+
+        self.stats = {
+            'connects': 0,
+            'failures': 0,
+            'sent': 0,
+            'dropped': 0,
+        }
+
+
+    def start(self):
+        """
+        Connects to the downstream server and starts publishing.
+        """
+        self.closed = False
+
+        if self.factory is None:
+            self.connect()
+
+
+    def stop(self):
+        """
+        Stops forwarding the stream and closes the connection.
+        """
+        self.closed = True
+
+        timer, self.retryTimer = self.retryTimer, None
+
+        if timer is not None and timer.active():
+            timer.cancel()
+
+        stream, self.stream = self.stream, None
+
+        if stream is not None:
+            try:
+                stream.close()
+            except:
+                log.err()
+
+        connector, self.connector = self.connector, None
+        self.factory = None
+
+        if connector is not None:
+            connector.disconnect()
+
+        self.queue.clear()
+        self.queued = 0
+
+
+    def connect(self):
+        """
+        Makes a new connection to the downstream server.
+        """
+        self.retryTimer = None
+
+        f = self.factory = PushClientFactory(self, self.url)
+
+        def publish(nc):
+            d = nc.openStream()
+
+            d.addCallback(lambda stream: stream.publish(self.name))
+
+            return d
+
+        def failed(fail):
+            if self.factory is not f:
+                return
+
+            log.msg('Unable to push %r to %s: %s' % (
+                self.name, self.url, fail.getErrorMessage()))
+
+            connector.disconnect()
+            self.connectionLost(f, fail)
+
+        d = f.deferred
+
+        d.addCallback(publish)
+        d.addCallbacks(self.publishing, failed)
+
+        connector = self.connector = self.reactor.connectTCP(f.host, f.port, f)
+
+
+    def publishing(self, stream):
+        """
+        The downstream server has accepted the stream.
+        """
+        if self.closed:
+            return
+
+        self.stream = stream
+        self.retries = 0
+        self.paused = False
+        self.stats['connects'] += 1
+
+        stream.nc.protocol.transport.registerProducer(self, True)
+
+        if self.meta:
+            stream.sendMetaData(self.meta)
+
+        self.flush()
+
+
+    def connectionLost(self, factory, reason):
+        """
+        Called when the connection made by C{factory} has been lost (or could
+        not be made). A new connection is attempted after a delay.
+        """
+        if factory is not self.factory:
+            return
+
+        self.factory = self.connector = None
+        self.stream = None
+        self.stats['failures'] += 1
+
+        # the downstream server must start decoding from a keyframe again
+        self.waitingForKeyframe = not self.trimQueue()
+
+        if self.closed or self.retryTimer is not None:
+            return
+
+        delay = min(self.maxDelay,
+            self.initialDelay * (self.factor ** self.retries))
+
+        self.retries += 1
+        self.retryTimer = self.clock.callLater(delay, self.connect)
+
+
+    def isSyncPoint(self, datatype, data):
+        """
+        Whether the downstream server can start decoding at this packet.
+        """
+        if datatype == message.VIDEO_DATA:
+            return message.isKeyframe(data)
+
+        # audio only streams can start anywhere
+        return not self.hasVideo
+
+
+    def enqueue(self, datatype, data, timestamp):
+        """
+        Sends the packet straight away if possible, otherwise queues it.
+        """
+        if datatype == message.VIDEO_DATA:
+            self.hasVideo = True
+
+        if self.waitingForKeyframe:
+            if not self.isSyncPoint(datatype, data):
+                self.stats['dropped'] += 1
+
+                return
+
+            self.waitingForKeyframe = False
+
+        if self.stream is not None and not self.paused and not self.queue:
+            self.send(datatype, data, timestamp)
+
+            return
+
+        self.queue.append((datatype, data, timestamp))
+        self.queued += len(data)
+
+        if self.queued > self.maxQueue:
+            self.waitingForKeyframe = not self.trimQueue()
+
+
+    def trimQueue(self):
+        """
+        Drops the oldest queued packets until the queue fits in C{maxQueue}
+        bytes and starts at a keyframe. If there is no such keyframe, the
+        whole queue is dropped.
+
+        @return: Whether there is anything left in the queue.
+        """
+        queue = self.queue
+
+        while queue:
+            datatype, data, timestamp = queue[0]
+
+            if self.queued <= self.maxQueue and \
+                    self.isSyncPoint(datatype, data):
+                break
+
+            queue.popleft()
+
+            self.queued -= len(data)
+            self.stats['dropped'] += 1
+
+        return bool(queue)
+
+
+    def send(self, datatype, data, timestamp):
+        if datatype == message.VIDEO_DATA:
+            self.stream.sendVideo(data, timestamp)
+        else:
+            self.stream.sendAudio(data, timestamp)
+
+        self.stats['sent'] += 1
+
+
+    def flush(self):
+        """
+        Sends the queued packets until the transport asks us to pause.
+        """
+        queue = self.queue
+
+        while queue and self.stream is not None and not self.paused:
+            datatype, data, timestamp = queue.popleft()
+            self.queued -= len(data)
+
+            self.send(datatype, data, timestamp)
+
+
+    # IPushProducer
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+
+        self.flush()
+
+
+    def stopProducing(self):
+        self.paused = True
+
+
+    # IPublishingStream
+
+    def started(self):
+        pass
+
+
+    def stopped(self):
+        pass
+
+
+    def videoDataReceived(self, data, timestamp):
+        self.enqueue(message.VIDEO_DATA, data, timestamp)
+
+
+    def audioDataReceived(self, data, timestamp):
+        self.enqueue(message.AUDIO_DATA, data, timestamp)
+
+
+    def onMetaData(self, data):
+        self.meta.update(data)
+
+        if self.stream is not None:
+            self.stream.sendMetaData(data)
+
+
+    def unpublish(self):
+        """
+        The published stream has gone away.
+        """
+        self.stop()
+
+
+
+class Pusher(object):
+    """
+    Forwards the streams published to an L{server.Application} to the
+    applications at C{urls}, see L{server.Application.push}.
+
+    @ivar urls: The urls of the applications on the downstream servers, e.g.
+        C{rtmp://edge.example.com/live}.
+    @ivar maxQueue: The number of bytes that can be queued for each
+        downstream server, see L{PushTarget}.
+    """
+
+
+    def __init__(self, urls, maxQueue=PushTarget.maxQueue, reactor=None):
+        self.urls = list(urls)
+        self.maxQueue = maxQueue
+        self.reactor = reactor
+
+
+    def buildTarget(self, url, name):
+        """
+        Returns a L{PushTarget} that forwards the stream C{name} to C{url}.
+        """
+        # any parameters (e.g. credentials) are not passed on
+        target = PushTarget(url, unicode(name), self.reactor)
+        target.maxQueue = self.maxQueue
+
+        return target
+
+
+    def push(self, publisher, name):
+        """
+        Starts forwarding the newly published stream C{name} to every
+        downstream server.
+
+        @type publisher: L{server.StreamPublisher}
+        """
+        for url in self.urls:
+            publisher.addPushTarget(self.buildTarget(url, name))
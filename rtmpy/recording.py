@@ -0,0 +1,675 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Recording of published streams to FLV files.
+
+Streams published with the type C{'record'} are written to a new file,
+C{'append'} continues an existing one. The tags are batched in memory and
+written by a L{DiskWriter} thread so that the reactor never waits for the
+disk.
+
+Example usage::
+
+    app = server.Application()
+    app.recorder = recording.Recorder('/var/lib/rtmpy', maxDuration=3600)
+
+@since: 0.2
+"""
+
+import collections
+import os
+import threading
+import time
+import urllib
+
+from zope.interface import implements
+from twisted.python import log
+
+from rtmpy import server, message, flv
+
+
+
+class FLVFile(object):
+    """
+    A recording on disk, split into segments when C{maxSize} or
+    C{maxDuration} is set. Only used by the L{DiskWriter} thread.
+
+    Timestamps start from 0 in each file (or carry on from the last tag when
+    appending). Every segment starts with the meta data and the audio/video
+    sequence headers seen so far, and (unless the stream is audio only) with
+    a video keyframe, so that each can be played on its own.
+
+    @ivar path: The path of the file. Segments are numbered, e.g.
+        C{foo-0.flv}, C{foo-1.flv} for C{foo.flv}.
+    @ivar append: Whether to continue the existing file (or last segment).
+    @ivar maxSize: The size (in bytes) a segment is rotated at.
+    @ivar maxDuration: The duration (in seconds) a segment is rotated at.
+    @ivar index: The number of the current segment.
+    @ivar size: The number of bytes in the current segment.
+    """
+
+
+    def __init__(self, path, append=False, maxSize=None, maxDuration=None):
+        self.path = path
+        self.append = append
+        self.maxSize = maxSize
+        self.maxDuration = maxDuration
+
+        self.file = None
+        self.index = 0
+        self.size = 0
+        self.lastSync = 0
+
+        self.meta = None
+        self.sequenceHeaders = {}
+        self.hasVideo = False
+
+        self._base = 0
+        self._start = 0
+
+
+    def isSegmented(self):
+        return bool(self.maxSize or self.maxDuration)
+
+
+    def getSegmentPath(self, index):
+        if not self.isSegmented():
+            return self.path
+
+        base, ext = os.path.splitext(self.path)
+
+        return '%s-%d%s' % (base, index, ext)
+
+
+    def _findLastSegment(self):
+        index = 0
+
+        if not self.isSegmented():
+            return index
+
+        while os.path.exists(self.getSegmentPath(index + 1)):
+            index += 1
+
+        return index
+
+
+    def open(self, timestamp):
+        """
+        Opens the first file, the first tag has C{timestamp}.
+        """
+        offset = 0
+
+        if self.append:
+            self.index = self._findLastSegment()
+
+        path = self.getSegmentPath(self.index)
+
+        dirname = os.path.dirname(path)
+
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        if self.append and os.path.exists(path) and os.path.getsize(path):
+            self.file = open(path, 'r+b', 0)
+
+            last = flv.readLastTimestamp(self.file)
+
+            if last is not None:
+                offset = last + 1
+
+            self.file.seek(0, 2)
+            self.size = self.file.tell()
+        else:
+            self.file = open(path, 'wb', 0)
+            self.size = 0
+
+            self.file.write(flv.encodeHeader())
+            self.size += flv.HEADER_SIZE + 4
+
+        self._base = timestamp - offset
+        self._start = timestamp
+        self.lastSync = time.time()
+
+
+    def rotate(self, timestamp):
+        """
+        Closes the current segment and starts the next one with the tag at
+        C{timestamp}.
+        """
+        self.close()
+
+        self.index += 1
+        self.file = open(self.getSegmentPath(self.index), 'wb', 0)
+        self.file.write(flv.encodeHeader())
+
+        self.size = flv.HEADER_SIZE + 4
+        self._base = self._start = timestamp
+        self.lastSync = time.time()
+
+        chunks = []
+
+        if self.meta is not None:
+            self._addTag(chunks, flv.SCRIPT, self.meta, timestamp)
+
+        for tagType in (flv.VIDEO, flv.AUDIO):
+            data = self.sequenceHeaders.get(tagType, None)
+
+            if data is not None:
+                self._addTag(chunks, tagType, data, timestamp)
+
+        self.file.write(''.join(chunks))
+
+
+    def isSyncPoint(self, tagType, data):
+        if tagType == flv.VIDEO:
+            return message.isKeyframe(data) and \
+                not flv.isSequenceHeader(tagType, data)
+
+        return tagType == flv.AUDIO and not self.hasVideo
+
+
+    def shouldRotate(self, tagType, data, timestamp):
+        if not self.isSegmented() or not self.isSyncPoint(tagType, data):
+            return False
+
+        if self.maxSize and self.size >= self.maxSize:
+            return True
+
+        if self.maxDuration and \
+                timestamp - self._start >= self.maxDuration * 1000:
+            return True
+
+        return False
+
+
+    def _addTag(self, chunks, tagType, data, timestamp):
+        size = len(data)
+
+        chunks.append(flv.encodeTagHeader(tagType, size,
+            max(0, timestamp - self._base)))
+        chunks.append(data)
+        chunks.append(flv.encodeTagSize(size))
+
+        self.size += flv.TAG_HEADER_SIZE + size + 4
+
+
+    def write(self, tags):
+        """
+        Writes a batch of C{(tagType, data, timestamp)} tags, with one write
+        per file.
+
+        @return: The number of bytes written.
+        """
+        chunks = []
+        written = 0
+
+        for tagType, data, timestamp in tags:
+            if tagType == flv.VIDEO:
+                self.hasVideo = True
+
+            if self.file is None:
+                self.open(timestamp)
+            elif self.shouldRotate(tagType, data, timestamp):
+                pending = ''.join(chunks)
+                self.file.write(pending)
+
+                written += len(pending)
+                chunks = []
+
+                self.rotate(timestamp)
+
+            if tagType == flv.SCRIPT:
+                self.meta = data
+            elif flv.isSequenceHeader(tagType, data):
+                self.sequenceHeaders[tagType] = data
+
+            self._addTag(chunks, tagType, data, timestamp)
+
+        data = ''.join(chunks)
+        self.file.write(data)
+
+        return written + len(data)
+
+
+    def sync(self):
+        """
+        Makes sure that everything written has reached the disk.
+        """
+        if self.file is None:
+            return
+
+        os.fsync(self.file.fileno())
+
+        self.lastSync = time.time()
+
+
+    def close(self):
+        f, self.file = self.file, None
+
+        if f is None:
+            return
+
+        try:
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+
+
+class DiskWriter(object):
+    """
+    Writes the recordings to disk in one dedicated thread, so that slow disks
+    never block the reactor.
+
+    Recordings hand over their tags in batches, each written with one large
+    sequential write. Files are fsync'd every C{fsyncInterval} seconds and
+    when they are closed.
+
+    At most C{maxPending} bytes can be waiting to be written. Batches that
+    would take it over are dropped (and counted in C{stats}).
+
+    @ivar stats: Counters for the C{batches} and C{bytes} written, the
+        C{fsyncs}, the number of bytes C{pending} and the most ever pending
+        (C{peakPending}), the batches dropped because of C{overflows} and the
+        number of bytes C{dropped}, and the write C{errors}.
+    """
+
+    #: The number of bytes that can be waiting to be written.
+    maxPending = 64 * 1024 * 1024
+    #: The longest time (in seconds) written data may stay out of the disk.
+    fsyncInterval = 5.0
+
+
+    def __init__(self, maxPending=None, fsyncInterval=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if maxPending is not None:
+            self.maxPending = maxPending
+
+        if fsyncInterval is not None:
+            self.fsyncInterval = fsyncInterval
+
+        self.reactor = reactor
+        self.thread = None
+
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+
+        self.stats = {
+            'batches': 0,
+            'bytes': 0,
+            'fsyncs': 0,
+            'pending': 0,
+            'peakPending': 0,
+            'overflows': 0,
+            'dropped': 0,
+            'errors': 0,
+        }
+
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(target=self._run,
+            name='rtmpy-recording')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        # after the connections (and so the recordings) have been closed
+        self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+            'after', 'shutdown', self.stop)
+
+
+    def stop(self):
+        """
+        Writes everything that is pending and stops the thread.
+        """
+        if self.thread is None:
+            return
+
+        thread, self.thread = self.thread, None
+
+        self._put(None)
+        thread.join()
+
+        try:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+        except (KeyError, ValueError, TypeError):
+            pass
+
+
+    def _put(self, item):
+        self._wakeup.acquire()
+
+        try:
+            self._queue.append(item)
+            self._wakeup.notify()
+        finally:
+            self._wakeup.release()
+
+
+    def write(self, f, tags, size):
+        """
+        Queues a batch of tags (C{size} bytes of data) to be written to the
+        L{FLVFile} C{f}.
+
+        @return: Whether the batch was accepted. If not, it was dropped.
+        """
+        self.start()
+
+        stats = self.stats
+
+        self._lock.acquire()
+
+        try:
+            if stats['pending'] + size > self.maxPending:
+                stats['overflows'] += 1
+                stats['dropped'] += size
+
+                return False
+
+            stats['pending'] += size
+            stats['peakPending'] = max(stats['peakPending'], stats['pending'])
+        finally:
+            self._lock.release()
+
+        self._put((f, tags, size))
+
+        return True
+
+
+    def close(self, f):
+        """
+        Closes the L{FLVFile} C{f} once everything queued for it has been
+        written.
+        """
+        self.start()
+        self._put((f, None, 0))
+
+
+    def _run(self):
+        stats = self.stats
+
+        while True:
+            self._wakeup.acquire()
+
+            try:
+                while not self._queue:
+                    self._wakeup.wait()
+
+                item = self._queue.popleft()
+            finally:
+                self._wakeup.release()
+
+            if item is None:
+                break
+
+            f, tags, size = item
+            written = synced = 0
+
+            try:
+                if tags is None:
+                    f.close()
+                else:
+                    written = f.write(tags)
+
+                    if time.time() - f.lastSync >= self.fsyncInterval:
+                        f.sync()
+                        synced = 1
+            except:
+                log.err(None, 'Unable to write %r' % (getattr(f, 'path', f),))
+
+                self._lock.acquire()
+                stats['errors'] += 1
+                self._lock.release()
+
+            self._lock.acquire()
+
+            try:
+                stats['pending'] -= size
+                stats['bytes'] += written
+                stats['fsyncs'] += synced
+
+                if tags is not None:
+                    stats['batches'] += 1
+            finally:
+                self._lock.release()
+
+
+    def getStats(self):
+        self._lock.acquire()
+
+        try:
+            return self.stats.copy()
+        finally:
+            self._lock.release()
+
+
+
+#: The writer used by the L{Recorder}s unless they are given another, see
+#: L{getDiskWriter}.
+diskWriter = None
+
+
+
+def getDiskWriter():
+    """
+    Returns L{diskWriter}, creating it on first use so that importing this
+    module does not install the reactor.
+
+    @rtype: L{DiskWriter}
+    """
+    global diskWriter
+
+    if diskWriter is None:
+        diskWriter = DiskWriter()
+
+    return diskWriter
+
+
+
+class Recording(object):
+    """
+    Subscribes to a published stream and buffers its tags, handing them to
+    the C{writer} once C{batchSize} bytes have been buffered or after
+    C{flushInterval} seconds.
+
+    If the writer drops a batch, the tags are dropped up to the next
+    keyframe so that the file stays playable.
+
+    @ivar file: The L{FLVFile} being written.
+    @ivar stats: Counters for the C{tags} recorded and the tags C{dropped}.
+    """
+
+    implements(server.IPublishingStream)
+
+    #: The number of bytes that are buffered before they are written.
+    batchSize = 256 * 1024
+    #: The longest time (in seconds) tags are buffered for.
+    flushInterval = 1.0
+
+
+    def __init__(self, writer, file, clock):
+        self.writer = writer
+        self.file = file
+        self.clock = clock
+
+        self.tags = []
+        self.buffered = 0
+        self.timestamp = 0
+        self.meta = {}
+
+        self.flushTimer = None
+        self.waitingForKeyframe = False
+        self.hasVideo = False
+        self.closed = False
+
+        self.stats = {
+            'tags': 0,
+            'dropped': 0,
+        }
+
+
+    def add(self, tagType, data, timestamp):
+        """
+        Buffers a tag.
+        """
+        if self.closed:
+            return
+
+        if tagType == flv.VIDEO:
+            self.hasVideo = True
+
+        if self.waitingForKeyframe:
+            if tagType == flv.VIDEO and message.isKeyframe(data):
+                self.waitingForKeyframe = False
+            elif tagType == flv.AUDIO and not self.hasVideo:
+                self.waitingForKeyframe = False
+            elif tagType != flv.SCRIPT:
+                self.stats['dropped'] += 1
+
+                return
+
+        self.timestamp = timestamp
+        self.tags.append((tagType, data, timestamp))
+        self.buffered += len(data)
+        self.stats['tags'] += 1
+
+        if self.buffered >= self.batchSize:
+            self.flush()
+        elif self.flushTimer is None:
+            self.flushTimer = self.clock.callLater(self.flushInterval,
+                self.flush)
+
+
+    def flush(self):
+        """
+        Hands the buffered tags to the writer.
+        """
+        timer, self.flushTimer = self.flushTimer, None
+
+        if timer is not None and timer.active():
+            timer.cancel()
+
+        if not self.tags:
+            return
+
+        tags, self.tags = self.tags, []
+        size, self.buffered = self.buffered, 0
+
+        if not self.writer.write(self.file, tags, size):
+            self.stats['dropped'] += len(tags)
+            self.waitingForKeyframe = True
+
+
+    def close(self):
+        """
+        Writes what is left and closes the file.
+        """
+        if self.closed:
+            return
+
+        self.flush()
+        self.closed = True
+
+        self.writer.close(self.file)
+
+
+    # IPublishingStream
+
+    def started(self):
+        pass
+
+
+    def stopped(self):
+        pass
+
+
+    def videoDataReceived(self, data, timestamp):
+        self.add(flv.VIDEO, data, timestamp)
+
+
+    def audioDataReceived(self, data, timestamp):
+        self.add(flv.AUDIO, data, timestamp)
+
+
+    def onMetaData(self, data):
+        self.meta.update(data)
+
+        self.add(flv.SCRIPT, flv.encodeMetaData(self.meta), self.timestamp)
+
+
+    def unpublish(self):
+        self.close()
+
+
+
+class Recorder(object):
+    """
+    Records the streams published to an L{server.Application} with the type
+    C{'record'} or C{'append'}, see L{server.Application.recorder}.
+
+    @ivar path: The directory the recordings are written to, one file (or
+        set of segments) per stream name.
+    @ivar maxSize: Segments are rotated once they reach this many bytes.
+    @ivar maxDuration: Segments are rotated once they last this many seconds.
+    @ivar writer: The L{DiskWriter}, which may be shared with other
+        recorders.
+    """
+
+
+    def __init__(self, path, maxSize=None, maxDuration=None, writer=None,
+            reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if writer is None:
+            writer = getDiskWriter()
+
+        self.path = path
+        self.maxSize = maxSize
+        self.maxDuration = maxDuration
+        self.writer = writer
+        self.clock = reactor
+
+
+    def getPath(self, name):
+        """
+        Returns the path of the file the stream C{name} is recorded to.
+        """
+        return os.path.join(self.path, urllib.quote(
+            unicode(name).encode('utf-8'), safe='') + '.flv')
+
+
+    def record(self, publisher, name, type_):
+        """
+        Starts recording the newly published stream C{name}.
+
+        @type publisher: L{server.StreamPublisher}
+        @param type_: C{'record'} or C{'append'}.
+        @return: The L{Recording}.
+        """
+        f = FLVFile(self.getPath(name), append=(type_ == 'append'),
+            maxSize=self.maxSize, maxDuration=self.maxDuration)
+
+        recording = Recording(self.writer, f, self.clock)
+
+        publisher.record(recording)
+
+        return recording
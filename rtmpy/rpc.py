@@ -19,14 +19,16 @@ API for handling RTMP RPC calls.
 
 from zope.interface import implements
 from twisted.python import failure, log
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
 
-from rtmpy import message, exc, status
+from rtmpy import message, exc, status, util
 
 
 
 __all__ = [
     'expose',
+    'blocking',
     'CommandResult',
     'AbstractCallHandler',
 ]
@@ -40,6 +42,27 @@ RESPONSE_RESULT = '_result'
 #: The name of the response for an RPC call that did not succeed.
 RESPONSE_ERROR = '_error'
 
+#: The timer wheel that is shared by all call handlers to time out calls that
+#: the peer never responds to. See L{AbstractCallHandler.callTimeout} and
+#: L{getTimers}.
+timers = None
+
+
+
+def getTimers():
+    """
+    Returns L{timers}, creating it on first use so that importing this module
+    does not install the reactor.
+
+    @rtype: L{util.TimerWheel}
+    """
+    global timers
+
+    if timers is None:
+        timers = util.TimerWheel()
+
+    return timers
+
 
 
 class RemoteCallFailed(failure.Failure):
@@ -60,7 +83,159 @@ class CommandResult(object):
         self.command = command
 
 
-def expose(func):
+class BlockingCallPool(object):
+    """
+    Runs methods that have been marked as L{blocking} in a bounded pool of
+    threads, so that they do not stall the reactor.
+
+    The pool is started on first use and stopped when the reactor shuts down.
+
+    @ivar size: The maximum number of threads.
+    @ivar stats: Counters for the C{calls} made, those that C{failed}, the
+        number C{pending} (running or queued) and the most ever pending
+        (C{maxPending}).
+    """
+
+
+    def __init__(self, size=10, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.size = size
+        self.reactor = reactor
+        self.pool = None
+
+        self.stats = {
+            'calls': 0,
+            'failed': 0,
+            'pending': 0,
+            'maxPending': 0,
+        }
+
+
+    def setSize(self, size):
+        """
+        Changes the maximum number of threads in the pool.
+        """
+        self.size = size
+
+        if self.pool is not None:
+            self.pool.adjustPoolsize(0, size)
+
+
+    def start(self):
+        if self.pool is not None:
+            return
+
+        self.pool = ThreadPool(0, self.size, name='rtmpy-rpc')
+        self.pool.start()
+
+        self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.stop)
+
+
+    def stop(self):
+        if self.pool is None:
+            return
+
+        pool, self.pool = self.pool, None
+        pool.stop()
+
+        try:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+        except (KeyError, ValueError, TypeError):
+            pass
+
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls C{func} in the pool.
+
+        @return: A L{defer.Deferred} that fires with the result of the call.
+        """
+        self.start()
+
+        stats = self.stats
+
+        stats['calls'] += 1
+        stats['pending'] += 1
+        stats['maxPending'] = max(stats['maxPending'], stats['pending'])
+
+        def done(result):
+            stats['pending'] -= 1
+
+            if isinstance(result, failure.Failure):
+                stats['failed'] += 1
+
+            return result
+
+        d = threads.deferToThreadPool(self.reactor, self.pool, func,
+            *args, **kwargs)
+
+        return d.addBoth(done)
+
+
+    def getStats(self):
+        """
+        Returns a copy of C{stats} along with the pool C{size} and the number
+        of calls C{queued} waiting for a free thread.
+        """
+        ret = self.stats.copy()
+
+        ret['size'] = self.size
+        ret['queued'] = max(0, ret['pending'] - self.size)
+
+        return ret
+
+
+#: The pool that runs the L{blocking} methods, see L{getBlockingPool}.
+blockingPool = None
+
+
+
+def getBlockingPool():
+    """
+    Returns L{blockingPool}, creating it on first use so that importing this
+    module does not install the reactor.
+
+    @rtype: L{BlockingCallPool}
+    """
+    global blockingPool
+
+    if blockingPool is None:
+        blockingPool = BlockingCallPool()
+
+    return blockingPool
+
+
+
+def blocking(func):
+    """
+    A decorator that marks C{func} as blocking, when called by L{callMethod}
+    it will be run in L{blockingPool}. The result of the call is always a
+    L{defer.Deferred}.
+
+    This is useful for methods that are called by the server but not
+    exposed, e.g. C{Application.onConnect}.
+    """
+    func.__rpc_blocking__ = True
+
+    return func
+
+
+
+def callMethod(method, *args, **kwargs):
+    """
+    Calls C{method}, in L{blockingPool} if it has been marked as L{blocking}.
+    """
+    if getattr(method, '__rpc_blocking__', False):
+        return getBlockingPool().call(method, *args, **kwargs)
+
+    return method(*args, **kwargs)
+
+
+
+def expose(func=None, blocking=False):
     """
     A decorator that provides an easy way to expose methods that the peer can
     'call' via RTMP C{invoke} or C{notify} messages.
@@ -76,7 +251,12 @@ def expose(func):
             def anotherExposedMethod(self, *args):
                 pass
 
-    If expose is called with no args, the function name is used.
+            @expose(blocking=True)
+            def slowMethod(self):
+                pass
+
+    If expose is called with no args, the function name is used. Methods
+    exposed with C{blocking=True} are run in a thread, see L{blockingPool}.
     """
     import sys
 
@@ -95,7 +275,10 @@ def expose(func):
 
     def decorator(f):
         frame = sys._getframe(1)
-        add_meta(frame.f_locals, func, f.__name__)
+        add_meta(frame.f_locals, func or f.__name__, f.__name__)
+
+        if blocking:
+            f.__rpc_blocking__ = True
 
         return f
 
@@ -155,7 +338,7 @@ def callExposedMethod(obj, name, *args, **kwargs):
 
         raise exc.CallFailed("Method not found (%s)" % (name,))
 
-    return method(*args, **kwargs)
+    return callMethod(method, *args, **kwargs)
 
 
 
@@ -173,15 +356,26 @@ class BaseCallHandler(object):
     @type _lastCallId: C{int}
     @ivar _activeCalls: A C{dict} of callId -> context. An active call has been
         I{initiated} but not yet I{finished}.
+    @ivar _pendingCalls: A C{dict} of callId -> timer (or C{None}) for the
+        calls made to the peer that are waiting for a response.
+    @ivar callStats: Counters for the calls made to the peer that C{timedOut}
+        or were C{rejected}/C{dropped} because too many were in flight.
     """
 
 
     def __init__(self, strict=True):
         self._lastCallId = 1
         self._activeCalls = {}
+        self._pendingCalls = {}
 
         self.strict = strict
 
+        self.callStats = {
+            'timedOut': 0,
+            'rejected': 0,
+            'dropped': 0,
+        }
+
 
     def isCallActive(self, callId):
         """
@@ -257,6 +451,8 @@ class BaseCallHandler(object):
         @return: The context with which this call was initiated or C{None} if no
             active call could be found.
         """
+        self._cancelTimeout(callId)
+
         return self._activeCalls.pop(callId, None)
 
 
@@ -273,9 +469,21 @@ class BaseCallHandler(object):
         @return: The context with which this call was initiated or C{None} if no
             active call could be found.
         """
+        self._cancelTimeout(callId)
+
         return self._activeCalls.pop(callId, None)
 
 
+    def _cancelTimeout(self, callId):
+        """
+        Forgets about a pending call to the peer, stopping its timeout.
+        """
+        timer = self._pendingCalls.pop(callId, None)
+
+        if timer is not None:
+            timer.cancel()
+
+
 
 class AbstractCallHandler(BaseCallHandler):
     """
@@ -284,6 +492,20 @@ class AbstractCallHandler(BaseCallHandler):
 
     implements(message.IMessageSender)
 
+    #: The default number of seconds to wait for a response to a call before
+    #: failing it with L{exc.CallTimedOut}. C{None} waits forever.
+    callTimeout = None
+    #: The maximum number of calls that can be waiting for a response from
+    #: the peer. C{None} means no limit.
+    maxPendingCalls = None
+    #: What to do with a new call when C{maxPendingCalls} has been reached.
+    #: C{'reject'} fails the new call, C{'drop'} fails the oldest pending call
+    #: to make room.
+    pendingCallOverflow = 'reject'
+    #: The L{util.TimerWheel} used to time out calls. C{None} means the
+    #: shared L{rpc.timers}.
+    timers = None
+
 
     # IMessageSender
     def sendMessage(self, msg):
@@ -314,6 +536,9 @@ class AbstractCallHandler(BaseCallHandler):
             generally be left alone unless you know what you're doing.
         @param kwargs['notify']: Return a L{defer.Deferred} which will hold the
             result of the call.
+        @param kwargs['timeout']: The number of seconds to wait for the result
+            before failing with L{exc.CallTimedOut}. Defaults to
+            C{callTimeout}.
         @return: By default, C{None} but if C{notify=True} is supplied, a
             L{defer.Deferred} that will hold the result of the call.
         """
@@ -327,6 +552,10 @@ class AbstractCallHandler(BaseCallHandler):
 
             return
 
+        if not self._admitCall(name):
+            return defer.fail(exc.CallFailed(
+                'Too many pending calls (%s)' % (name,)))
+
         d = defer.Deferred()
         callId = self.initiateCall(d, name, args, command)
         m = message.Invoke(name, callId, command, *args)
@@ -338,9 +567,102 @@ class AbstractCallHandler(BaseCallHandler):
 
             raise
 
+        if callId not in self._activeCalls:
+            # the response has already been handled
+            return d
+
+        timeout = kwargs.get('timeout', self.callTimeout)
+        timer = None
+
+        if timeout is not None:
+            if self.timers is None:
+                self.timers = getTimers()
+
+            timer = self.timers.schedule(timeout, self._timeoutCall, callId)
+
+        self._pendingCalls[callId] = timer
+
         return d
 
 
+    def callMany(self, calls, **kwargs):
+        """
+        Makes a number of RPC calls in one go. The messages are sent
+        back-to-back so the encoder picks them all up in the same pass and
+        they reach the transport together rather than one write per call.
+
+        @param calls: A list of C{(name, args)} tuples.
+        @param kwargs: Applied to every call, see L{call}.
+        @return: By default, C{None} but if C{notify=True} is supplied, a
+            L{defer.DeferredList} that fires with a list of C{(success,
+            result)} tuples, one for each call, in order.
+        """
+        notify = kwargs.get('notify', False)
+        results = []
+
+        for name, args in calls:
+            try:
+                d = self.call(name, *args, **kwargs)
+            except:
+                if not notify:
+                    raise
+
+                d = defer.fail()
+
+            results.append(d)
+
+        if not notify:
+            return
+
+        return defer.DeferredList(results, consumeErrors=True)
+
+
+    def _admitCall(self, name):
+        """
+        Applies C{maxPendingCalls} to a new call.
+
+        @return: Whether the call can be made.
+        """
+        if self.maxPendingCalls is None:
+            return True
+
+        if len(self._pendingCalls) < self.maxPendingCalls:
+            return True
+
+        if self.pendingCallOverflow != 'drop':
+            self.callStats['rejected'] += 1
+
+            return False
+
+        oldest = min(self._pendingCalls.keys())
+        context = self.discardCall(oldest)
+
+        self.callStats['dropped'] += 1
+
+        if context is not None:
+            context[0].errback(exc.CallFailed('Call %r dropped to make room '
+                'for %r' % (context[1], name)))
+
+        return True
+
+
+    def _timeoutCall(self, callId):
+        """
+        Called by C{timers} when the peer has not responded to C{callId} in
+        time.
+        """
+        context = self.discardCall(callId)
+
+        if context is None:
+            return
+
+        self.callStats['timedOut'] += 1
+
+        d, name = context[0], context[1]
+
+        d.errback(exc.CallTimedOut('No response to %r' % (name,)))
+
+
     def handleResponse(self, name, callId, result, **kwargs):
         """
         Handles the response to a previously initiated RPC call.
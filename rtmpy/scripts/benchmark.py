@@ -0,0 +1,312 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro benchmarks for the hot paths in RTMPy. Everything runs in memory, no
+sockets or reactor are involved.
+
+@since: 0.2
+"""
+
+import time
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy.protocol import handshake
+from rtmpy.protocol.rtmp import handshake as rtmp_handshake
+from rtmpy import message, server
+
+
+__all__ = ['BENCHMARKS', 'run']
+
+
+
+class _Observer(object):
+    """
+    Collects the output of a negotiator and whether it succeeded.
+    """
+
+    succeeded = False
+
+    def __init__(self):
+        self.buffer = BufferedByteStream()
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    def handshakeSuccess(self, data):
+        self.succeeded = True
+
+
+
+def _timeit(func, count):
+    """
+    Calls C{func} C{count} times and returns the number of calls per second.
+    """
+    start = time.time()
+
+    for i in xrange(count):
+        func()
+
+    elapsed = time.time() - start
+
+    if not elapsed:
+        return float('inf')
+
+    return count / elapsed
+
+
+
+def bench_handshake(count):
+    """
+    Runs C{count} plain server side handshakes, using the negotiator that
+    L{server.ServerFactory} builds, with and without a filled payload pool.
+
+    @return: A list of C{(label, connections/sec)} tuples.
+    """
+    negotiator = server.ServerFactory.handshake
+    client_syn = '\x00' * handshake.HANDSHAKE_LENGTH
+
+    def one():
+        observer = _Observer()
+        n = negotiator(observer, observer)
+
+        n.start(0, 0)
+        n.dataReceived(client_syn)
+
+        # echo the server syn (after the version byte) back as the client ack
+        n.dataReceived(
+            observer.buffer.getvalue()[1:handshake.HANDSHAKE_LENGTH + 1])
+
+        assert observer.succeeded
+
+    pool = negotiator.payloadPool
+    results = []
+
+    try:
+        negotiator.payloadPool = handshake.PayloadPool(0)
+        results.append(('no payload pool', _timeit(one, count)))
+
+        negotiator.payloadPool = handshake.PayloadPool(count * 2)
+        negotiator.payloadPool.refill()
+        results.append(('filled payload pool', _timeit(one, count)))
+    finally:
+        negotiator.payloadPool = pool
+
+    return [(label, rate, 'connections/sec') for label, rate in results]
+
+
+
+def bench_digest_handshake(count):
+    """
+    Runs C{count} server side digest handshakes, using the negotiator that
+    L{server.ServerFactory} builds. The client syn is generated once up front
+    so only the server side work is measured.
+
+    @return: A list of C{(label, connections/sec)} tuples.
+    """
+    negotiator = server.ServerFactory.handshake
+
+    observer = _Observer()
+    client = rtmp_handshake.ClientNegotiator(observer, observer)
+    client.start(0, 0)
+
+    client_syn = observer.buffer.getvalue()
+
+    def one():
+        observer = _Observer()
+        n = negotiator(observer, observer)
+
+        n.start(0, 0)
+        n.dataReceived(client_syn)
+
+        assert n.peer_digest is not None
+
+        # a client may echo the server syn rather than sign the ack
+        n.dataReceived(
+            observer.buffer.getvalue()[1:handshake.HANDSHAKE_LENGTH + 1])
+
+        assert observer.succeeded
+
+    pool = negotiator.payloadPool
+
+    try:
+        negotiator.payloadPool = handshake.PayloadPool(count * 2)
+        negotiator.payloadPool.refill()
+
+        rate = _timeit(one, count)
+    finally:
+        negotiator.payloadPool = pool
+
+    return [('filled payload pool', rate, 'connections/sec')]
+
+
+
+def bench_rpc(count):
+    """
+    Encodes and decodes C{count} invoke messages (with their arguments), with
+    and without reusable per connection L{message.Codecs}.
+
+    Alongside the rate, the number of AMF encoders/decoders that had to be
+    built per message is reported.
+
+    @return: A list of C{(label, rate, unit)} tuples.
+    """
+    import pyamf
+
+    args = (None, {
+        'code': 'NetConnection.Call.Success',
+        'description': 'Connection succeeded.',
+        'level': 'status',
+        'objectEncoding': 0,
+    }, [1, 2, 3], 'foo')
+
+    built = [0]
+    get_encoder, get_decoder = pyamf.get_encoder, pyamf.get_decoder
+
+    def counted(func):
+        def wrapper(*args, **kwargs):
+            built[0] += 1
+
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def run(codecs):
+        buf = BufferedByteStream()
+
+        def one():
+            buf.truncate()
+
+            message.Invoke('_result', 1, *args).encode(buf, codecs)
+
+            buf.seek(0)
+
+            m = message.Invoke()
+            m.decode(buf, codecs)
+            list(m.argv)
+
+        built[0] = 0
+        rate = _timeit(one, count)
+
+        return rate, built[0] / float(count)
+
+    results = []
+
+    pyamf.get_encoder = counted(get_encoder)
+    pyamf.get_decoder = counted(get_decoder)
+
+    try:
+        for label, codecs in [('no codecs', None),
+                ('reused codecs', message.Codecs())]:
+            rate, per_msg = run(codecs)
+
+            results.append((label, rate, 'messages/sec'))
+            results.append((label, per_msg, 'codecs built/message'))
+    finally:
+        pyamf.get_encoder, pyamf.get_decoder = get_encoder, get_decoder
+
+    return results
+
+
+
+class _NullListener(object):
+    """
+    Accepts all message dispatches and does nothing with them.
+    """
+
+    def _ignore(self, *args):
+        pass
+
+    onFrameSize = onBytesRead = onControlMessage = _ignore
+    onDownstreamBandwidth = onUpstreamBandwidth = _ignore
+    onAudioData = onVideoData = onInvoke = onNotify = _ignore
+
+
+
+def bench_dispatch(count):
+    """
+    Routes C{count} messages of each common type to a listener, building a
+    message instance for each versus using L{message.DISPATCH_TABLE}.
+
+    @return: A list of C{(label, rate, unit)} tuples.
+    """
+    listener = _NullListener()
+    codecs = message.Codecs()
+    results = []
+
+    messages = [
+        message.BytesRead(1000),
+        message.ControlMessage(6, 1234),
+        message.AudioData('\x00' * 200),
+        message.VideoData('\x00' * 2000),
+    ]
+
+    for msg in messages:
+        buf = BufferedByteStream()
+        msg.encode(buf)
+
+        datatype = message.typeByClass(msg)
+        data = buf.getvalue()
+        func = message.DISPATCH_TABLE[datatype]
+
+        def generic():
+            message.dispatch_message(listener, datatype, 0, data, codecs)
+
+        def table():
+            func(listener, datatype, 0, data, codecs)
+
+        name = msg.__class__.__name__
+
+        results.append(('%s message instance' % (name,),
+            _timeit(generic, count), 'messages/sec'))
+        results.append(('%s dispatch table' % (name,),
+            _timeit(table, count), 'messages/sec'))
+
+    return results
+
+
+
+#: Map of benchmark name -> C{(function, default count)}.
+BENCHMARKS = {
+    'handshake': (bench_handshake, 5000),
+    'digest-handshake': (bench_digest_handshake, 5000),
+    'rpc': (bench_rpc, 20000),
+    'dispatch': (bench_dispatch, 100000),
+}
+
+
+
+def run():
+    import sys
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-n', '--count', dest='count', type='int', default=None,
+        help='Number of iterations for each benchmark')
+
+    options, args = parser.parse_args()
+
+    names = args or sorted(BENCHMARKS.keys())
+
+    for name in names:
+        try:
+            func, count = BENCHMARKS[name]
+        except KeyError:
+            parser.error('Unknown benchmark %r (choose from %s)' % (
+                name, ', '.join(sorted(BENCHMARKS.keys()))))
+
+        for label, rate, unit in func(options.count or count):
+            sys.stdout.write('%s: %s: %.1f %s\n' % (name, label, rate, unit))
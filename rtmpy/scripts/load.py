@@ -0,0 +1,584 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load generator. Opens a large number of RTMP client connections from one
+process that each play (or publish) a stream, and reports the rate the
+connections were made at, how long they took to join the stream and the
+audio/video bitrate that was delivered.
+
+@since: 0.2
+"""
+
+from twisted.internet import task
+from twisted.python import log
+
+from rtmpy import client
+
+
+__all__ = ['Swarm', 'SyntheticSource', 'run']
+
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Returns a C{dict} of the C{min}, C{max} and nearest rank percentiles
+    (e.g. C{p50}) of C{values}. Empty if there are no values.
+    """
+    if not values:
+        return {}
+
+    values = sorted(values)
+    n = len(values)
+
+    ret = {
+        'min': values[0],
+        'max': values[-1],
+    }
+
+    for p in points:
+        rank = (p * n + 99) // 100
+
+        ret['p%d' % (p,)] = values[min(n, max(1, rank)) - 1]
+
+    return ret
+
+
+
+class SyntheticSource(object):
+    """
+    Generates video packets at C{bitrate} and writes them to its sinks. Each
+    packet is built once and the same string is written to every sink.
+
+    @ivar bitrate: In kbit/s.
+    @ivar fps: The number of packets per second.
+    @ivar gop: Every C{gop}th packet is a keyframe.
+    @ivar sinks: Receive the packets through C{videoDataReceived}.
+    """
+
+
+    def __init__(self, bitrate=500, fps=25, gop=50, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.bitrate = bitrate
+        self.fps = fps
+        self.gop = gop
+        self.clock = clock
+
+        self.sinks = []
+        self.frames = 0
+        self.startTime = None
+        self.loop = None
+
+        size = max(1, bitrate * 1000 // 8 // fps)
+
+        self.keyframe = '\x17' + '\x00' * (size - 1)
+        self.interframe = '\x27' + '\x00' * (size - 1)
+
+
+    def start(self):
+        self.startTime = self.clock.seconds()
+
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.clock = self.clock
+        self.loop.start(1.0 / self.fps)
+
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+        self.loop = None
+
+
+    def tick(self):
+        """
+        Writes the next packet to all the sinks.
+        """
+        if self.frames % self.gop == 0:
+            data = self.keyframe
+        else:
+            data = self.interframe
+
+        timestamp = self.frames * 1000 // self.fps
+        self.frames += 1
+
+        for sink in self.sinks[:]:
+            try:
+                sink.videoDataReceived(data, timestamp)
+            except:
+                log.err()
+                self.sinks.remove(sink)
+
+
+
+class Session(object):
+    """
+    One client connection of a L{Swarm}.
+
+    @ivar started: When the connection was started.
+    @ivar connected: When the application accepted the connection.
+    @ivar joined: When the first audio/video packet was received (playing) or
+        the server accepted the stream (publishing).
+    @ivar sent: The number of bytes published.
+    """
+
+
+    def __init__(self, swarm, name):
+        self.swarm = swarm
+        self.name = name
+
+        self.counter = client.MediaCounter(swarm.clock)
+        self.nc = None
+        self.stream = None
+
+        self.started = self.connected = self._joined = None
+        self.failed = False
+        self.sent = 0
+
+
+    @property
+    def joined(self):
+        if self._joined is None:
+            return self.counter.firstPacket
+
+        return self._joined
+
+
+    @property
+    def bytes(self):
+        return self.counter.bytes + self.sent
+
+
+    def start(self):
+        swarm = self.swarm
+
+        self.started = swarm.clock.seconds()
+
+        d = client.connect(swarm.url, reactor=swarm.reactor)
+
+        d.addCallback(self.connectionMade)
+        d.addCallback(lambda nc: nc.openStream())
+        d.addCallback(self.streamCreated)
+        d.addErrback(self.connectionFailed)
+
+        return d
+
+
+    def stop(self):
+        if self in self.swarm.source.sinks:
+            self.swarm.source.sinks.remove(self)
+
+        if self.nc is not None:
+            self.nc.protocol.transport.loseConnection()
+
+
+    def connectionMade(self, nc):
+        self.nc = nc
+        self.connected = self.swarm.clock.seconds()
+
+        return nc
+
+
+    def streamCreated(self, stream):
+        self.stream = stream
+
+        if not self.swarm.publish:
+            return stream.play(self.name, self.counter)
+
+        d = stream.publish(self.name)
+
+        d.addCallback(self.publishing)
+
+        return d
+
+
+    def publishing(self, stream):
+        self._joined = self.swarm.clock.seconds()
+
+        self.swarm.source.sinks.append(self)
+
+
+    def connectionFailed(self, fail):
+        self.failed = True
+
+        log.msg('Connection %s failed: %s' % (self.name,
+            fail.getErrorMessage()))
+
+
+    def videoDataReceived(self, data, timestamp):
+        self.stream.sendVideo(data, timestamp)
+        self.sent += len(data)
+
+
+
+class Swarm(object):
+    """
+    Opens C{count} connections to C{url}, C{rate} per second, that each play
+    (or publish) a stream.
+
+    @ivar name: The stream name. May contain C{%d}, which is replaced by the
+        index of the connection. Publishers always get a name of their own,
+        the index is appended if C{name} does not contain C{%d}.
+    @ivar source: Generates the data that is published.
+    @type source: L{SyntheticSource}
+    @ivar sessions: The L{Session}s that have been started.
+    @ivar samples: C{(time, bytes)} pairs, see L{sample}.
+    """
+
+
+    def __init__(self, url, name, count, rate=100, publish=False,
+            bitrate=500, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.url = url
+        self.name = name
+        self.count = count
+        self.rate = rate
+        self.publish = publish
+        self.reactor = reactor
+        self.clock = reactor
+
+        self.source = SyntheticSource(bitrate, clock=reactor)
+
+        self.sessions = []
+        self.samples = []
+        self.startTime = None
+        self.loop = None
+
+
+    def getStreamName(self, index):
+        if '%d' in self.name:
+            return self.name % (index,)
+
+        if self.publish:
+            return '%s%d' % (self.name, index)
+
+        return self.name
+
+
+    def start(self):
+        """
+        Starts opening the connections.
+        """
+        self.startTime = self.clock.seconds()
+
+        if self.publish:
+            self.source.start()
+
+        self.loop = task.LoopingCall(self.connectMore)
+        self.loop.clock = self.clock
+        self.loop.start(min(0.1, 1.0 / self.rate))
+
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+        self.loop = None
+        self.source.stop()
+
+        for session in self.sessions:
+            session.stop()
+
+
+    def connectMore(self):
+        """
+        Starts as many connections as C{rate} allows for the time since
+        L{start}.
+        """
+        elapsed = self.clock.seconds() - self.startTime
+        due = min(self.count, int(elapsed * self.rate) + 1)
+
+        while len(self.sessions) < due:
+            session = Session(self, self.getStreamName(len(self.sessions)))
+
+            self.sessions.append(session)
+            session.start()
+
+        if len(self.sessions) >= self.count:
+            self.loop.stop()
+            self.loop = None
+
+
+    def sample(self):
+        """
+        Records the total number of bytes delivered so far.
+
+        @return: The bitrate since the previous sample in kbit/s or C{None}
+            for the first sample.
+        """
+        now = self.clock.seconds()
+        total = 0
+
+        for session in self.sessions:
+            total += session.bytes
+
+        self.samples.append((now, total))
+
+        if len(self.samples) < 2:
+            return None
+
+        (then, before) = self.samples[-2]
+
+        if now <= then:
+            return None
+
+        return (total - before) * 8 / 1000.0 / (now - then)
+
+
+    def getStats(self):
+        """
+        Returns a C{dict} with the number of C{connected} and C{failed}
+        sessions, the C{connectRate} (connections/sec), the C{joinTimes}
+        percentiles (in milliseconds), the number of sessions that C{joined}
+        and the C{bitrate} (kbit/s) delivered since all the connections were
+        started.
+        """
+        connected = [s for s in self.sessions if s.connected is not None]
+        joinTimes = [(s.joined - s.started) * 1000.0 for s in self.sessions
+            if s.joined is not None]
+
+        connectRate = None
+
+        if connected:
+            elapsed = max(s.connected for s in connected) - self.startTime
+
+            if elapsed > 0:
+                connectRate = len(connected) / elapsed
+
+        return {
+            'connected': len(connected),
+            'failed': len([s for s in self.sessions if s.failed]),
+            'connectRate': connectRate,
+            'joined': len(joinTimes),
+            'joinTimes': percentiles(joinTimes),
+            'bitrate': self.getSustainedBitrate(),
+        }
+
+
+    def getSustainedBitrate(self):
+        """
+        Returns the bitrate (kbit/s) over the samples taken once all the
+        connections had been started, C{None} if there are not enough.
+        """
+        if len(self.sessions) < self.count:
+            return None
+
+        lastStarted = max(s.started for s in self.sessions)
+        samples = [x for x in self.samples if x[0] >= lastStarted]
+
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return None
+
+        (start, before), (end, after) = samples[0], samples[-1]
+
+        return (after - before) * 8 / 1000.0 / (end - start)
+
+
+
+def listenLocal(name, bitrate, reactor, publish=False):
+    """
+    Starts a L{server.ServerFactory} on a free local port with a C{live}
+    application. Unless the connections C{publish}, the stream C{name} is
+    published to it by a L{SyntheticSource}.
+
+    @return: The url of the application.
+    """
+    from rtmpy import server
+
+    app = server.Application()
+
+    factory = server.ServerFactory()
+    factory.registerApplication('live', app)
+
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    if not publish and '%d' not in name:
+        source = SyntheticSource(bitrate, clock=reactor)
+        source.sinks.append(app.publishStream(
+            server.Client(None), None, name))
+        source.start()
+
+    return 'rtmp://127.0.0.1:%d/live' % (port.getHost().port,)
+
+
+
+#: Where Linux keeps the most files a process can be allowed to open.
+NR_OPEN_PATH = '/proc/sys/fs/nr_open'
+#: The limit asked for when the hard limit is unlimited and L{NR_OPEN_PATH}
+#: cannot be read.
+MAX_OPEN_FILES = 1024 * 1024
+
+
+
+def getMaxOpenFiles():
+    """
+    Returns the most files a process can be allowed to open.
+    """
+    try:
+        f = open(NR_OPEN_PATH, 'rb')
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        return int(data.strip())
+    except (IOError, ValueError):
+        return MAX_OPEN_FILES
+
+
+
+def raiseFileLimit():
+    """
+    Raises the limit on open files to the hard limit (or, if that is
+    unlimited, L{getMaxOpenFiles}) so that thousands of connections can be
+    made.
+
+    @return: The limit on open files or C{None} if it is not known.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard
+
+    if hard == resource.RLIM_INFINITY:
+        # unlimited is refused, the most that can be asked for is nr_open
+        target = getMaxOpenFiles()
+
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, resource.error), e:
+            log.msg('Unable to raise the open file limit from %d to %d: %s' % (
+                soft, target, e))
+        else:
+            soft = target
+
+    return soft
+
+
+
+def formatStats(stats):
+    """
+    Returns the summary lines for L{Swarm.getStats}.
+    """
+    def fmt(value, spec='%.1f'):
+        if value is None:
+            return '-'
+
+        return spec % (value,)
+
+    joinTimes = stats['joinTimes']
+
+    return [
+        'connects: %d ok, %d failed, %s/sec' % (stats['connected'],
+            stats['failed'], fmt(stats['connectRate'])),
+        'join time (ms, %d joined): %s' % (stats['joined'], ' '.join(
+            ['%s %s' % (k, fmt(joinTimes.get(k, None)))
+                for k in ('min', 'p50', 'p90', 'p99', 'max')])),
+        'delivered: %s kbit/s sustained' % (fmt(stats['bitrate']),),
+    ]
+
+
+
+def run():
+    import sys
+    from optparse import OptionParser
+
+    from twisted.internet import reactor
+
+    parser = OptionParser(usage='%prog [options] [url]')
+    parser.add_option('-n', '--count', dest='count', type='int', default=100,
+        help='Number of connections [default: %default]')
+    parser.add_option('-r', '--rate', dest='rate', type='float', default=100,
+        help='Connections started per second [default: %default]')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+        default=30, help='Seconds to run for [default: %default]')
+    parser.add_option('-s', '--stream', dest='name', default='livestream',
+        help='Stream name, %d is replaced by the connection number '
+            '[default: %default]')
+    parser.add_option('-p', '--publish', dest='publish', action='store_true',
+        default=False, help='Publish rather than play')
+    parser.add_option('-b', '--bitrate', dest='bitrate', type='int',
+        default=500, help='Bitrate published, in kbit/s [default: %default]')
+    parser.add_option('-i', '--interval', dest='interval', type='float',
+        default=1, help='Seconds between reports [default: %default]')
+    parser.add_option('-l', '--local', dest='local', action='store_true',
+        default=False, help='Run against a local server in this process')
+
+    options, args = parser.parse_args()
+
+    if options.local:
+        if args:
+            parser.error('No url expected with --local')
+
+        if '%d' in options.name and not options.publish:
+            parser.error('Nothing is published to a --local server for '
+                'stream names containing %d, use --publish')
+
+        url = listenLocal(options.name, options.bitrate, reactor,
+            options.publish)
+    elif len(args) == 1:
+        url = args[0]
+    else:
+        parser.error('Expected exactly one url')
+
+    limit = raiseFileLimit()
+
+    if limit is not None and limit < options.count:
+        sys.stderr.write('Warning: only %d files can be open, fewer than the '
+            '%d connections\n' % (limit, options.count))
+
+    swarm = Swarm(url, options.name, options.count, options.rate,
+        options.publish, options.bitrate, reactor)
+
+    def report():
+        bitrate = swarm.sample()
+        stats = swarm.getStats()
+
+        if bitrate is None:
+            bitrate = '-'
+        else:
+            bitrate = '%.1f' % (bitrate,)
+
+        sys.stdout.write('%6.1fs: %d connected, %d failed, %d joined, '
+            '%s kbit/s\n' % (reactor.seconds() - swarm.startTime,
+                stats['connected'], stats['failed'], stats['joined'], bitrate))
+        sys.stdout.flush()
+
+    def finish():
+        reporter.stop()
+        swarm.sample()
+
+        for line in formatStats(swarm.getStats()):
+            sys.stdout.write(line + '\n')
+
+        swarm.stop()
+        reactor.stop()
+
+    swarm.start()
+
+    reporter = task.LoopingCall(report)
+    reporter.start(options.interval, now=False)
+
+    reactor.callLater(options.duration, finish)
+    reactor.run()
@@ -19,12 +19,22 @@ Parses RTMP dumps from Wireshark - converted to c array format.
 @since: 0.1.1
 """
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 from pyamf.util import BufferedByteStream
 from rtmpy.protocol.rtmp import codec
 from rtmpy import message
 
 
-__all__ = ['parse_dump', 'XMLObserver']
+__all__ = ['parse_dump', 'XMLObserver', 'JSONObserver', 'SummaryObserver']
 
 
 
@@ -42,6 +52,9 @@ def parse_dump(f, observer):
 
     C{observer} must implement C{messageStart}, C{messageReceived} and
     C{messageComplete}. See L{XMLObserver} as an example.
+
+    Observers that also implement C{finish} will have it called once the whole
+    dump has been read.
     """
     recv = RTMPEndpoint('server', observer)
     send = RTMPEndpoint('client', observer)
@@ -64,6 +77,11 @@ def parse_dump(f, observer):
 
         [y for y in endpoint]
 
+    finish = getattr(observer, 'finish', None)
+
+    if finish:
+        finish()
+
 
 
 def read_dump(f):
@@ -165,11 +183,13 @@ class Stream(object):
 
     def onAudioData(self, data, timestamp):
         m = Message('audio', length=len(data), timestamp=timestamp)
+        m.payload = data
 
         self.observer.messageReceived(m)
 
     def onVideoData(self, data, timestamp):
         m = Message('video', length=len(data), timestamp=timestamp)
+        m.payload = data
 
         self.observer.messageReceived(m)
 
@@ -246,6 +266,7 @@ class StreamFactory(object):
     def dispatchMessage(self, stream, datatype, timestamp, data):
         p = Packet(self.type,
             streamId=stream.streamId, datatype=datatype, timestamp=timestamp)
+        p.length = len(data)
 
         self.observer.messageStart(p)
 
@@ -359,12 +380,164 @@ class XMLObserver(object):
         self.file.write('</message>\n')
 
 
+
+def _json_default(obj):
+    """
+    Lazily decoded call arguments are serialised as a list, anything else
+    that C{json} does not understand as its C{repr}.
+    """
+    if isinstance(obj, message.Arguments):
+        return list(obj)
+
+    return repr(obj)
+
+
+
+class JSONObserver(object):
+    """
+    An RTMP observer that writes one JSON object per line to a file object as
+    each message completes.
+
+    Audio/video payloads are never written out, they are replaced by their
+    length and a digest of the bytes.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+        self._messages = []
+
+    def _to_json(self, message):
+        d = message.context.copy()
+        d['type'] = message.type
+
+        payload = getattr(message, 'payload', None)
+
+        if payload is not None:
+            d['sha1'] = sha1(payload).hexdigest()
+
+        return d
+
+    def messageStart(self, packet):
+        self._messages = []
+
+    def messageReceived(self, message):
+        self._messages.append(self._to_json(message))
+
+    def messageComplete(self, packet):
+        d = packet.context.copy()
+
+        d['from'] = packet.type
+        d['messages'] = self._messages
+
+        self.file.write(json.dumps(d, default=_json_default) + '\n')
+
+        self._messages = []
+
+
+
+class SummaryObserver(object):
+    """
+    An RTMP observer that only keeps counters and a message size histogram
+    for each endpoint/message type. Nothing is written until L{finish} is
+    called.
+
+    @ivar counts: C{(endpoint, type)} -> number of messages.
+    @ivar bytes: C{(endpoint, type)} -> total number of body bytes.
+    @ivar sizes: C{(endpoint, type)} -> C{dict} of size bucket -> number of
+        messages. A bucket is the smallest power of 2 that is >= the body size.
+    @ivar calls: C{(endpoint, name)} -> number of invoke/notify calls.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+        self.counts = {}
+        self.bytes = {}
+        self.sizes = {}
+        self.calls = {}
+
+        self._length = 0
+
+    def messageStart(self, packet):
+        self._from = packet.type
+        self._length = getattr(packet, 'length', 0)
+
+    def messageReceived(self, message):
+        key = (self._from, message.type)
+        length = self._length
+
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.bytes[key] = self.bytes.get(key, 0) + length
+
+        bucket = 1
+
+        while bucket < length:
+            bucket <<= 1
+
+        sizes = self.sizes.setdefault(key, {})
+        sizes[bucket] = sizes.get(bucket, 0) + 1
+
+        if message.type in ('invoke', 'notify'):
+            key = (self._from, message.context['name'])
+
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def messageComplete(self, packet):
+        pass
+
+    def getSummary(self):
+        """
+        Returns a C{dict} representing everything that has been observed so far.
+        """
+        ret = {}
+
+        for (label, type_), count in self.counts.iteritems():
+            ret.setdefault(label, {})[type_] = {
+                'count': count,
+                'bytes': self.bytes[(label, type_)],
+                'sizes': self.sizes[(label, type_)],
+            }
+
+        for (label, name), count in self.calls.iteritems():
+            calls = ret.setdefault(label, {}).setdefault('calls', {})
+            calls[name] = count
+
+        return ret
+
+    def finish(self):
+        self.file.write(json.dumps(self.getSummary(), default=_json_default,
+            sort_keys=True, indent=2) + '\n')
+
+
+
+#: Map of output formats -> observer classes, see L{run}.
+OBSERVERS = {
+    'xml': XMLObserver,
+    'json': JSONObserver,
+    'summary': SummaryObserver,
+}
+
+
+
 def run():
     import sys
+    from optparse import OptionParser
+
+    parser = OptionParser(usage='%prog [options] dumpfile')
+    parser.add_option('-f', '--format', dest='format', default='xml',
+        choices=sorted(OBSERVERS.keys()),
+        help='Output format, one of %s [default: %%default]' % (
+            ', '.join(sorted(OBSERVERS.keys())),))
+
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error('Expected exactly one dump file')
 
-    observer = XMLObserver(sys.stdout)
+    observer = OBSERVERS[options.format](sys.stdout)
 
-    f = open(sys.argv[1], 'rb')
+    f = open(args[0], 'rb')
 
     try:
         parse_dump(f, observer)
@@ -16,19 +16,51 @@
 """
 Server implementation.
 """
+import time
 import urlparse
+import collections
 
 from zope.interface import Interface, Attribute, implements
-from twisted.internet import protocol, defer
+from twisted.internet import protocol, defer, task
 from twisted.python import failure, log
 import pyamf
 
 from rtmpy import util, exc, versions
 from rtmpy import message, rpc, status, core
 from rtmpy.protocol import rtmp, handshake, version
+from rtmpy.protocol.rtmp import handshake as rtmp_handshake
 from rtmpy.status import codes
 
 
+#: Control messages sent to the peer when a stream starts playing.
+PLAY_CONTROL_MESSAGES = [
+    message.pre_encode(message.ControlMessage(4, 1)),
+    message.pre_encode(message.ControlMessage(0, 1)),
+]
+
+#: Sent once a connection has been accepted.
+CONNECT_CONTROL_MESSAGE = message.pre_encode(message.ControlMessage(0, 0))
+
+
+def _status_template(code):
+    """
+    Returns an L{message.InvokeTemplate} of an C{onStatus} call for C{code},
+    with C{description} and C{clientid} slots.
+    """
+    s = status.status(code, message.slot('description'),
+        clientid=message.slot('clientid'))
+
+    return message.InvokeTemplate(
+        message.Invoke('onStatus', rpc.NO_RESULT, None, s))
+
+
+PLAY_RESET_STATUS = _status_template('NetStream.Play.Reset')
+PLAY_START_STATUS = _status_template('NetStream.Play.Start')
+
+DATA_START_STATUS = message.pre_encode(message.Invoke('onStatus',
+    rpc.NO_RESULT, None, {'code': 'NetStream.Data.Start'}))
+
+
 class IApplication(Interface):
     """
     An application provides business logic for connected clients and streams.
@@ -208,13 +240,15 @@ class NetStream(core.NetStream):
     defers all logic to the L{NetConnection<ServerProtocol>}.
 
     @param state: The state of the NetStream. Right now the only valid values
-        are C{None} and C{'publishing'}.
+        are C{None}, C{'publishing'} and C{'playing'}.
     @param name: The name of the published stream. Use this to look up the
         stream in the application.
     @param publisher: When published, this is set to the instance that will
         receive the audio/video/meta data events from the peer. See
         L{StreamPublisher} for now.
     @type publisher: L{IPublishingStream}
+    @param source: When playing, this is the publisher that this NetStream
+        has subscribed to.
     """
 
     def __init__(self, nc, streamId):
@@ -223,6 +257,7 @@ class NetStream(core.NetStream):
         self.state = None
         self.name = None
         self.publisher = None
+        self.source = None
 
     def publishingStarted(self, publisher, name):
         """
@@ -258,6 +293,12 @@ class NetStream(core.NetStream):
         def send_status(result):
             s = None
 
+            if isinstance(result, failure.Failure) and \
+                    result.check(exc.Redirect):
+                self.nc.redirect(result.value)
+
+                return result
+
             if isinstance(result, failure.Failure):
                 code = getattr(result.value, 'code', 'NetConnection.Call.Failed')
                 description = util.getFailureMessage(result) or 'Internal Server Error'
@@ -294,6 +335,13 @@ class NetStream(core.NetStream):
                 return res
 
             d.addBoth(send_status)
+        elif self.state == 'playing':
+            source, self.source = self.source, None
+
+            if source is not None and self in source.subscribers:
+                source.removeSubscriber(self)
+        else:
+            self.nc.stopWaiting(self)
 
         def clear_state(res):
             self.state = None
@@ -386,24 +434,32 @@ class NetStream(core.NetStream):
             self._videoChannel.setType(message.VIDEO_DATA)
 
             self.state = 'playing'
+            self.source = res
 
             # wtf
-            self.sendMessage(message.ControlMessage(4, 1))
-            self.sendMessage(message.ControlMessage(0, 1))
+            for msg in PLAY_CONTROL_MESSAGES:
+                self.sendMessage(msg)
+
+            clientId = self.nc.clientId
 
-            self.sendStatus('NetStream.Play.Reset',
+            self.sendMessage(PLAY_RESET_STATUS.fill(
                 description='Playing and resetting %s' % (name,),
-                clientid=self.nc.clientId)
+                clientid=clientId))
 
-            self.sendStatus('NetStream.Play.Start',
+            self.sendMessage(PLAY_START_STATUS.fill(
                 description='Started playing %s' % (name,),
-                clientid=self.nc.clientId)
+                clientid=clientId))
 
-            self.nc.call('onStatus', {'code': 'NetStream.Data.Start'})
+            self.nc.sendMessage(DATA_START_STATUS)
 
             return res
 
         def eb(fail):
+            if fail.check(exc.Redirect):
+                self.nc.redirect(fail.value)
+
+                return fail
+
             code = getattr(fail.value, 'code', 'NetStream.Play.Failed')
             description = util.getFailureMessage(fail) or 'Internal Server Error'
 
@@ -416,6 +472,39 @@ class NetStream(core.NetStream):
 
         return d
 
+
+    @rpc.expose
+    def seek(self, offset):
+        """
+        Called by the peer to move the playback of a file to C{offset}
+        milliseconds, see L{rtmpy.vod.VODPlayer.seek}.
+        """
+        seek = getattr(self.source, 'seek', None)
+
+        if self.state != 'playing' or seek is None:
+            self.sendStatus(status.error(codes.NS_SEEK_FAILED,
+                'Only files can be seeked'))
+
+            return
+
+        if isinstance(offset, bool) or \
+                not isinstance(offset, (int, long, float)):
+            self.sendStatus(status.error(codes.NS_SEEK_FAILED,
+                'Invalid seek offset %r' % (offset,)))
+
+            return
+
+        seek(offset)
+
+        clientId = self.nc.clientId
+
+        self.sendStatus(status.status(codes.NS_SEEK_NOTIFY,
+            'Seeking %d' % (offset,), clientid=clientId))
+        self.sendMessage(PLAY_START_STATUS.fill(
+            description='Started playing at %d' % (offset,),
+            clientid=clientId))
+
+
     def onMetaData(self, data):
         """
         """
@@ -443,6 +532,9 @@ class NetConnection(core.NetConnection):
         self.application = None
         self.clientId = None
 
+        # stream -> (name, cb), the plays waiting for a stream to be published
+        self._waiting = {}
+
 
     def buildStream(self, streamId):
         """
@@ -521,20 +613,62 @@ class NetConnection(core.NetConnection):
     def playStream(self, name, subscriber, *args):
         """
         """
+        redirect = self.application.getRedirect(name)
+
+        if redirect is not None:
+            raise redirect
+
+        d = self.application.playFile(name, subscriber, *args)
+
+        if d is not None:
+            return d
+
         d = defer.Deferred()
 
         def whenPublished(publisher):
+            self._waiting.pop(subscriber, None)
             publisher.addSubscriber(subscriber)
 
             return publisher
 
-        self.application.whenPublished(name, d.callback)
-
         d.addCallback(whenPublished)
 
+        self._waiting[subscriber] = (name, d.callback)
+        self.application.whenPublished(name, d.callback)
+
         return d
 
 
+    def stopWaiting(self, subscriber):
+        """
+        Called when C{subscriber} is closed before the stream it asked to
+        play has been published.
+        """
+        try:
+            name, cb = self._waiting.pop(subscriber)
+        except KeyError:
+            return
+
+        if self.application:
+            self.application.cancelWhenPublished(name, cb)
+
+
+    def redirect(self, error):
+        """
+        Tells the peer to connect to C{error.url} instead and drops the
+        connection.
+
+        @type error: L{exc.Redirect}
+        """
+        self.sendStatus(status.error(codes.NC_CONNECT_REJECTED, error.args[0],
+            ex={'code': 302, 'redirect': error.url}))
+
+        if self.application and getattr(self, 'client', None):
+            self.application.disconnect(self.client)
+        else:
+            self.protocol.transport.loseConnection()
+
+
     def callExposedMethod(self, name, *args):
         """
         Used to match a callable based on the supplied name when a notify or
@@ -546,8 +680,32 @@ class NetConnection(core.NetConnection):
         All methods on a client/application is considered B{public} and
         accessible by the peer.
 
+        Once connected, the call must be admitted by L{Application.admitCall}
+        and the (wall clock) time the reactor thread spends in the method is
+        recorded with L{Application.recordCall}. Methods that are run in the
+        thread pool (see L{rpc.blocking}) are not timed.
+
         @see: L{rtmp.RTMPProtocol.getInvokableTarget}
         """
+        app = self.application
+        client = getattr(self, 'client', None)
+
+        if app is None or client is None:
+            return self._callExposedMethod(name, *args)
+
+        if not app.admitCall(client, name):
+            return defer.fail(exc.CallRateLimited(
+                'Call rate limit exceeded (%s)' % (name,)))
+
+        start = time.time()
+
+        try:
+            return self._callExposedMethod(name, *args)
+        finally:
+            app.recordCall(name, time.time() - start)
+
+
+    def _callExposedMethod(self, name, *args):
         # all client methods are publicly accessible
         client = getattr(self, 'client', None)
 
@@ -555,7 +713,7 @@ class NetConnection(core.NetConnection):
             target = util.get_callable_target(client, name)
 
             if target:
-                return defer.maybeDeferred(target, *args)
+                return defer.maybeDeferred(rpc.callMethod, target, *args)
 
         return core.NetConnection.callExposedMethod(self, name, *args)
 
@@ -596,11 +754,13 @@ class NetConnection(core.NetConnection):
             self.connected = True
             del self._pendingConnection
 
+            self.protocol.connectSucceeded()
+
             result = status.status('NetConnection.Connect.Success',
                 description='Connection succeeded.',
                 objectEncoding=self.objectEncoding)
 
-            self.sendMessage(message.ControlMessage(0, 0))
+            self.sendMessage(CONNECT_CONTROL_MESSAGE)
 
             return rpc.CommandResult(result,
                 # what are these values?
@@ -629,7 +789,6 @@ class NetConnection(core.NetConnection):
         d.addCallback(connection_accepted)
         d.addErrback(chain_errback)
 
-        # todo: timeout for connection
         return self._pendingConnection
 
     def _onConnect(self, params, *args):
@@ -662,7 +821,8 @@ class NetConnection(core.NetConnection):
             self.application.acceptConnection(self.client)
             self.application.onConnectAccept(self.client, *args)
 
-        d = defer.maybeDeferred(self.application.onConnect, self.client, *args)
+        d = defer.maybeDeferred(rpc.callMethod, self.application.onConnect,
+            self.client, *args)
 
         d.addCallback(cb)
 
@@ -687,14 +847,181 @@ class ServerProtocol(rtmp.RTMPProtocol):
 
     netconnection = NetConnection
 
+    #: Whether this connection is waiting for a handshake slot. See
+    #: L{ServerFactory.admitHandshake}.
+    queued = False
+    handshakeTimer = None
+    connectTimer = None
+
+    #: The state of a connection that has been handed over from another
+    #: process, see L{resume}.
+    resumeState = None
+    #: Whether this connection was handed over from another process.
+    resumed = False
+
 
     def buildStreamManager(self):
         return self.nc
 
-    def versionSuccess(self):
-        self.transport.write('\x03')
 
-        rtmp.RTMPProtocol.versionSuccess(self)
+    def getDispatcher(self):
+        """
+        Lets the factory's C{handoff} (if any) see the connect request first.
+        """
+        handoff = getattr(self.factory, 'handoff', None)
+
+        if handoff is not None:
+            return handoff.buildDispatcher(self)
+
+        return rtmp.RTMPProtocol.getDispatcher(self)
+
+
+    def connectionMade(self):
+        """
+        Asks the factory for a handshake slot before version negotiations can
+        begin. The connection may be queued or rejected outright, see
+        L{ServerFactory.admitHandshake}.
+        """
+        if self.resumeState is not None:
+            self.resume(self.resumeState)
+
+            return
+
+        f = self.factory
+
+        if f.handshakeTimeout:
+            self.handshakeTimer = f.clock.callLater(f.handshakeTimeout,
+                self.handshakeTimedOut)
+
+        if f.admitHandshake(self):
+            rtmp.RTMPProtocol.connectionMade(self)
+
+
+    def handshakeAdmitted(self):
+        """
+        Called by the factory when a queued connection has been given a
+        handshake slot.
+        """
+        self.queued = False
+
+        rtmp.RTMPProtocol.connectionMade(self)
+
+        self.transport.resumeProducing()
+
+
+    def connectionLost(self, reason):
+        """
+        Cancels any pending timeouts and frees the handshake slot (if the
+        connection was still handshaking).
+        """
+        self._cancelTimer('handshakeTimer')
+        self._cancelTimer('connectTimer')
+
+        if self.state != self.STATE_STREAM:
+            self.factory.handshakeFinished(self)
+
+        rtmp.RTMPProtocol.connectionLost(self, reason)
+
+
+    def handshakeSuccess(self, data):
+        """
+        Frees the handshake slot and starts waiting for the peer to send its
+        connect request.
+        """
+        f = self.factory
+
+        self._cancelTimer('handshakeTimer')
+        f.handshakeFinished(self, True)
+
+        if f.connectTimeout:
+            self.connectTimer = f.clock.callLater(f.connectTimeout,
+                self.connectTimedOut)
+
+        rtmp.RTMPProtocol.handshakeSuccess(self, data)
+
+
+    def resume(self, state):
+        """
+        Carries on with a connection that completed the handshake (and sent
+        its connect request) in another process.
+
+        @param state: Contains the C{decoder} state (see
+            L{codec.Decoder.getState}) and the C{connect} request as a
+            C{(datatype, timestamp, data)} tuple.
+        """
+        self.resumeState = None
+        self.resumed = True
+
+        f = self.factory
+
+        if f.connectTimeout:
+            self.connectTimer = f.clock.callLater(f.connectTimeout,
+                self.connectTimedOut)
+
+        self.state = self.STATE_STREAM
+        self.startStreaming()
+
+        self.decoder.setState(state['decoder'])
+
+        datatype, timestamp, data = state['connect']
+
+        self.decoder.dispatcher.dispatchMessage(
+            self.streamManager.getStream(0), datatype, timestamp, data)
+
+        if state['decoder']['buffer']:
+            self.startDecoding()
+
+
+    def detach(self):
+        """
+        Drops the connection without shutting down the socket, which has been
+        passed to (and carries on in) another process.
+        """
+        # twisted only offers this through the transport's private state
+        self.transport._shouldShutdown = False
+        self.transport.loseConnection()
+
+
+    def connectSucceeded(self):
+        """
+        Called by the L{NetConnection} when the peer has successfully
+        connected to an application.
+        """
+        self._cancelTimer('connectTimer')
+
+
+    def handshakeTimedOut(self):
+        """
+        The peer did not complete the version/handshake negotiations in time.
+        """
+        self.handshakeTimer = None
+        self.factory.stats['handshakeTimeouts'] += 1
+
+        log.msg('Handshake timed out, dropping connection')
+        self.transport.loseConnection()
+
+
+    def connectTimedOut(self):
+        """
+        The peer did not successfully connect to an application in time.
+        """
+        self.connectTimer = None
+        self.factory.stats['connectTimeouts'] += 1
+
+        log.msg('Connect request timed out, dropping connection')
+        self.transport.loseConnection()
+
+
+    def _cancelTimer(self, name):
+        timer = getattr(self, name)
+
+        if timer is None:
+            return
+
+        setattr(self, name, None)
+
+        if timer.active():
+            timer.cancel()
 
     def startStreaming(self):
         """
@@ -756,7 +1083,10 @@ class StreamPublisher(object):
     @ivar stream: The publishing L{NetStream}
     @ivar client: The linked L{Client} object. Not used right now.
     @ivar subscribers: A list of subscribers that are listening to the stream.
-    @ivar
+    @ivar pushTargets: The downstream servers that the stream is forwarded to,
+        see L{rtmpy.push.PushTarget}.
+    @ivar recording: The L{rtmpy.recording.Recording} of the stream, if it is
+        being recorded.
     """
 
     implements(IPublishingStream)
@@ -766,6 +1096,8 @@ class StreamPublisher(object):
         self.client = client
 
         self.subscribers = {}
+        self.pushTargets = []
+        self.recording = None
         self.meta = {}
         self.timestamp = self.baseTimestamp = 0
 
@@ -798,6 +1130,29 @@ class StreamPublisher(object):
         """
         self.subscribers.pop(subscriber)
 
+    def addPushTarget(self, target):
+        """
+        Forwards this stream to a downstream server. The target receives the
+        same data as the other subscribers and is stopped when the stream is
+        unpublished.
+
+        @type target: L{rtmpy.push.PushTarget}
+        """
+        self.pushTargets.append(target)
+        self.addSubscriber(target)
+
+        target.start()
+
+    def record(self, recording):
+        """
+        Records this stream. The recording receives the same data as the
+        other subscribers and is closed when the stream is unpublished.
+
+        @type recording: L{rtmpy.recording.Recording}
+        """
+        self.recording = recording
+        self.addSubscriber(recording)
+
     # events called by the stream
 
     def videoDataReceived(self, data, timestamp):
@@ -866,7 +1221,17 @@ class StreamPublisher(object):
         for a in self.subscribers:
             a.unpublish()
 
+        for target in self.pushTargets:
+            if target not in self.subscribers:
+                # dropped after an error, make sure it is not left running
+                target.stop()
+
+        if self.recording is not None and \
+                self.recording not in self.subscribers:
+            self.recording.close()
+
         self.subscribers = {}
+        self.pushTargets = []
 
 
 class Application(object):
@@ -878,11 +1243,64 @@ class Application(object):
 
     client = Client
 
+    #: The maximum number of clients written to per reactor iteration when
+    #: broadcasting. See L{broadcast}.
+    broadcastBatchSize = 500
+
+    #: Provides C{callLater}, used to spread broadcasts over reactor
+    #: iterations, and C{seconds} for the call rate limits. Defaults to the
+    #: reactor.
+    clock = None
+
+    #: A C{(rate, burst)} tuple limiting the number of calls per second each
+    #: client can make, over all methods. C{None} means no limit.
+    callRateLimit = None
+    #: A C{dict} of method name -> C{(rate, burst)} limiting the calls per
+    #: second each client can make to that method.
+    methodRateLimits = {}
+
+    #: The id of this node (e.g. worker process) in the C{directory}.
+    nodeId = None
+    #: Records which node owns each published stream, see
+    #: L{rtmpy.cluster.directory}. C{None} when running as a single process.
+    directory = None
+    #: Fetches streams that are published on other nodes, see
+    #: L{rtmpy.cluster.relay.RelayClient}.
+    relay = None
+    #: Plays the streams that are not published here from an origin server,
+    #: making this an edge. See L{rtmpy.edge.Origin}.
+    origin = None
+    #: Forwards the streams published here to other servers. See
+    #: L{rtmpy.push.Pusher}.
+    push = None
+    #: Records the streams published with the type C{'record'} or
+    #: C{'append'} to FLV files. See L{rtmpy.recording.Recorder}.
+    recorder = None
+    #: Plays FLV files on demand, for the streams that are not published.
+    #: See L{rtmpy.vod.VODLibrary}.
+    vod = None
+    #: Decides which of a number of servers owns each stream, redirecting
+    #: (or proxying) publishes and plays that arrive at the wrong one. See
+    #: L{rtmpy.cluster.placement.Placement}.
+    placement = None
+
     def __init__(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+
+            self.clock = reactor
+
         self.clients = {}
         self.streams = {}
         self._streamingClients = {}
         self._pendingPublishedCallbacks = {}
+        self._callBuckets = {}
+        self._relayedStreams = {}
+        self._pendingRelays = {}
+        self._watching = {}
+        self._claiming = set()
+
+        self.callStats = {}
 
 
     def startup(self):
@@ -936,6 +1354,8 @@ class Application(object):
 
             self.streams.pop(name, None)
 
+        self._callBuckets.pop(client.id, None)
+
         c = self.clients.pop(client.id, None)
 
         if c is None:
@@ -983,6 +1403,164 @@ class Application(object):
         return c
 
 
+    def admitCall(self, client, name):
+        """
+        Checks a call from C{client} against C{methodRateLimits} and
+        C{callRateLimit}, before the method is dispatched.
+
+        A token is only taken from each bucket once all of them have admitted
+        the call, so a call rejected by one limit does not count against the
+        other.
+
+        @return: Whether the call can go ahead.
+        """
+        limits = [
+            (name, self.methodRateLimits.get(name, None)),
+            (None, self.callRateLimit),
+        ]
+
+        buckets = None
+        now = None
+        admitted = []
+
+        for key, limit in limits:
+            if limit is None:
+                continue
+
+            if buckets is None:
+                buckets = self._callBuckets.setdefault(client.id, {})
+                now = self.clock.seconds()
+
+            bucket = buckets.get(key, None)
+
+            if bucket is None:
+                rate, burst = limit
+                bucket = buckets[key] = util.TokenBucket(rate, burst, now)
+
+            if bucket.refill(now) < 1:
+                self._getCallStats(name)['rejected'] += 1
+
+                return False
+
+            admitted.append(bucket)
+
+        for bucket in admitted:
+            bucket.consume(now)
+
+        return True
+
+
+    def recordCall(self, name, elapsed):
+        """
+        Accounts for a call to the method C{name}.
+
+        @param elapsed: The (wall clock) time the reactor thread spent
+            dispatching the call, in seconds. This does not include any time
+            spent in the thread pool by a L{rpc.blocking} method.
+        """
+        stats = self._getCallStats(name)
+
+        stats['calls'] += 1
+        stats['time'] += elapsed
+
+
+    def _getCallStats(self, name):
+        try:
+            return self.callStats[name]
+        except KeyError:
+            stats = self.callStats[name] = {
+                'calls': 0,
+                'time': 0.0,
+                'rejected': 0,
+            }
+
+            return stats
+
+
+    def getStats(self):
+        """
+        Returns a C{dict} of the number of connected C{clients}, the published
+        C{streams} and a C{calls} C{dict} of method name -> C{calls},
+        C{rejected} and C{time} (reactor thread seconds, see
+        L{recordCall}) counters.
+        """
+        calls = {}
+
+        for name, stats in self.callStats.iteritems():
+            calls[name] = stats.copy()
+
+        return {
+            'clients': len(self.clients),
+            'streams': len(self.streams),
+            'calls': calls,
+        }
+
+
+    def broadcast(self, name, *args, **kwargs):
+        """
+        Calls C{name} on every connected client. This is a B{fire-and-forget}
+        call, no results are returned from the peers.
+
+        The invoke is encoded once and the same bytes are sent to each client.
+        Clients are written to in batches of C{broadcastBatchSize}, yielding to
+        the reactor in between, so that a large number of clients does not
+        block other connections.
+
+        @param name: The name of the method to call on the clients.
+        @param args: The arguments to the call.
+        @param kwargs['filter']: An optional callable that accepts a client
+            and returns whether that client should receive the call.
+        @return: A L{defer.Deferred} that fires with the number of clients
+            that the call was sent to.
+        """
+        filter_ = kwargs.pop('filter', None)
+
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments %r' % (
+                kwargs.keys(),))
+
+        msg = message.pre_encode(
+            message.Invoke(name, rpc.NO_RESULT, None, *args))
+
+        clients = collections.deque(self.clients.values())
+        d = defer.Deferred()
+        sent = [0]
+
+        def write_batch():
+            n = self.broadcastBatchSize
+
+            while clients and n > 0:
+                client = clients.popleft()
+                n -= 1
+
+                if self.clients.get(client.id, None) is not client:
+                    # disconnected since the broadcast started
+                    continue
+
+                try:
+                    if filter_ is not None and not filter_(client):
+                        continue
+
+                    client.nc.sendMessage(msg)
+                except:
+                    log.err()
+
+                    continue
+
+                sent[0] += 1
+
+            if clients:
+                self.clock.callLater(0, write_batch)
+
+                return
+
+            d.callback(sent[0])
+
+        write_batch()
+
+        return d
+
+
     def whenPublished(self, name, cb):
         """
         Will call C{cb} when a stream has been published under C{name}
@@ -992,12 +1570,14 @@ class Application(object):
         if not callable(cb):
             raise TypeError('cb must be callable for whenPublished')
 
-        try:
-            publisher = self.streams[name]
-        except KeyError:
-            cbs = self._pendingPublishedCallbacks.setdefault(name, [])
+        publisher = self.streams.get(name, None)
+
+        if publisher is None:
+            publisher = self._relayedStreams.get(name, None)
 
-            cbs.append(cb)
+        if publisher is None:
+            if not self._relayStream(name, cb):
+                self._waitForStream(name, [cb])
 
             return
 
@@ -1007,11 +1587,244 @@ class Application(object):
             log.err()
 
 
+    def _waitForStream(self, name, cbs):
+        """
+        Calls C{cbs} once the stream C{name} is published, here or on another
+        node (see L{_watchStream}).
+        """
+        publisher = self.streams.get(name, None)
+
+        if publisher is None:
+            self._pendingPublishedCallbacks.setdefault(name, []).extend(cbs)
+            self._watchStream(name)
+
+            return
+
+        # published while the stream was being looked for elsewhere
+        for cb in cbs:
+            try:
+                cb(publisher)
+            except:
+                log.err()
+
+
+    def cancelWhenPublished(self, name, cb):
+        """
+        Stops waiting to call C{cb} when the stream C{name} is published, see
+        L{whenPublished}. The C{directory} stops watching for the stream once
+        nothing is waiting for it.
+        """
+        waiting = self._pendingRelays.get(name, None)
+
+        if waiting is not None and cb in waiting:
+            waiting.remove(cb)
+
+        cbs = self._pendingPublishedCallbacks.get(name, None)
+
+        if cbs is None or cb not in cbs:
+            return
+
+        cbs.remove(cb)
+
+        if not cbs:
+            del self._pendingPublishedCallbacks[name]
+
+            self._unwatchStream(name)
+
+
+    def playFile(self, name, subscriber, start=-2, *args):
+        """
+        Plays the file for the stream C{name} to C{subscriber}, see L{vod}.
+
+        @param start: Where to start playing, in seconds. C{-2} (the
+            default) plays the live stream if it is published and the file
+            otherwise, C{-1} only plays the live stream.
+        @return: A L{defer.Deferred} that fires with the player, or C{None}
+            if the live stream should be played instead.
+        """
+        if self.vod is None or start == -1:
+            return None
+
+        if start < 0 and name in self.streams:
+            return None
+
+        if not self.vod.exists(name):
+            return None
+
+        return self.vod.play(name, subscriber, max(0, start) * 1000)
+
+
+    def getStreamKey(self, name):
+        """
+        Returns the key that identifies the stream C{name} in the
+        C{directory}.
+        """
+        return '%s/%s' % (getattr(self, 'name', None), name)
+
+
+    def getRedirect(self, name):
+        """
+        Returns an L{exc.Redirect} if peers asking for the stream C{name}
+        should go to another server, see L{placement}. Streams that are
+        published here are always served here.
+        """
+        if self.placement is None or name in self.streams:
+            return None
+
+        return self.placement.getRedirect(name)
+
+
+    def _relayStream(self, name, cb):
+        """
+        Fetches the stream C{name} from wherever it is published, if that is
+        not here (see L{_fetchStream}), and calls C{cb} with the relayed
+        publisher. All the callbacks waiting for the same stream share the
+        one relayed publisher. If the stream turns out not to be published
+        elsewhere, C{cb} waits for it to be published (see
+        L{_waitForStream}).
+
+        @return: Whether the stream is being looked for elsewhere.
+        """
+        waiting = self._pendingRelays.get(name, None)
+
+        if waiting is not None:
+            waiting.append(cb)
+
+            return True
+
+        waiting = self._pendingRelays[name] = [cb]
+
+        d = self._fetchStream(name)
+
+        if d is None:
+            del self._pendingRelays[name]
+
+            return False
+
+        def forget(result, publisher):
+            if self._relayedStreams.get(name, None) is publisher:
+                del self._relayedStreams[name]
+
+            return result
+
+        def relayed(publisher):
+            del self._pendingRelays[name]
+
+            if publisher is None:
+                # not published anywhere else (yet)
+                self._waitForStream(name, waiting)
+
+                return
+
+            self._relayedStreams[name] = publisher
+            publisher.finished.addCallback(forget, publisher)
+
+            for cb in waiting:
+                try:
+                    cb(publisher)
+                except:
+                    log.err()
+
+        def failed(fail):
+            del self._pendingRelays[name]
+
+            log.msg('Unable to relay %r: %s' % (name, fail.getErrorMessage()))
+
+            # wait for the stream to be published (again), here or elsewhere
+            self._waitForStream(name, waiting)
+
+        d.addCallbacks(relayed, failed)
+
+        return True
+
+
+    def _watchStream(self, name):
+        """
+        Asks the C{directory} to tell us when the stream C{name} is published
+        on another node, so that the callbacks waiting for it can be given the
+        relayed stream.
+        """
+        if self.directory is None or self.relay is None:
+            return
+
+        if name in self._watching:
+            return
+
+        def published(key, owner):
+            if self._watching.get(name, None) is not published:
+                return
+
+            del self._watching[name]
+
+            if owner == self.nodeId:
+                # publishStream runs the callbacks
+                return
+
+            cbs = self._pendingPublishedCallbacks.pop(name, [])
+
+            for cb in cbs:
+                self._relayStream(name, cb)
+
+        self._watching[name] = published
+        self.directory.watch(self.getStreamKey(name), published)
+
+
+    def _unwatchStream(self, name):
+        cb = self._watching.pop(name, None)
+
+        if cb is not None:
+            self.directory.unwatch(self.getStreamKey(name), cb)
+
+
+    def _fetchStream(self, name):
+        """
+        Plays the stream C{name} from the node in the C{directory} that owns
+        it or, failing that, from the C{origin}.
+
+        @return: A L{defer.Deferred} that fires with the relayed publisher
+            (which must provide a C{finished} deferred), or with C{None} if
+            the C{directory} does not know of the stream. C{None} if there is
+            nowhere else to fetch the stream from.
+        """
+        if self.directory is not None and self.relay is not None:
+            key = self.getStreamKey(name)
+
+            def found(owner):
+                if owner is not None and owner != self.nodeId:
+                    return self.relay.fetch(owner, key)
+
+                return self._fetchUpstream(name)
+
+            return self.directory.lookup(key).addCallback(found)
+
+        return self._fetchUpstream(name)
+
+
+    def _fetchUpstream(self, name):
+        """
+        Plays the stream C{name} from the owning server (see L{placement}) or
+        the C{origin}.
+
+        @return: A L{defer.Deferred} that fires with the relayed publisher or
+            C{None} if there is neither.
+        """
+        if self.placement is not None:
+            d = self.placement.fetch(name)
+
+            if d is not None:
+                return d
+
+        if self.origin is not None:
+            return self.origin.fetch(name)
+
+
     def _runCallbacksForPublishedStream(self, name, stream):
         """
         Iterates over the list of callables to be executed when a stream named
         C{name} is successfully published.
         """
+        self._unwatchStream(name)
+
         try:
             cbs = self._pendingPublishedCallbacks[name]
         except KeyError:
@@ -1034,15 +1847,79 @@ class Application(object):
         @param client: The L{Client} requesting the publishing the stream.
         @param stream: The L{NetStream} that will receive the a/v data.
         @param name: The name of the stream that will be published.
-        @param type_: Ignored for now.
+        @param type_: C{'live'}, or C{'record'} or C{'append'} to record the
+            stream (see L{recorder}).
+        @return: The L{StreamPublisher} or, with a C{directory}, a
+            L{defer.Deferred} that fires with it once the stream has been
+            claimed.
         """
         stream = self.streams.get(name, None)
 
         if stream is None:
-            # brand new publish
-            stream = self.streams[name] = StreamPublisher(requestor, client)
-            self._streamingClients[client] = stream
+            if name in self._claiming:
+                raise exc.BadNameError("'%s' is already used" % (name,))
+
+            redirect = self.getRedirect(name)
+
+            if redirect is not None:
+                raise redirect
+
+            if self.directory is not None:
+                return self._claimStream(client, requestor, name, type_)
+
+            stream = self._startPublishing(client, requestor, name, type_)
+
+        return self._publishTo(stream, client, name)
+
+
+    def _claimStream(self, client, requestor, name, type_):
+        """
+        Claims the stream C{name} in the C{directory} before publishing it.
+        The claim is atomic, so only one node wins a race to publish the same
+        name.
+        """
+        self._claiming.add(name)
+
+        def claimed(result):
+            self._claiming.discard(name)
+
+            if not result:
+                raise exc.BadNameError("'%s' is already used" % (name,))
 
+            stream = self._startPublishing(client, requestor, name, type_)
+
+            return self._publishTo(stream, client, name)
+
+        def failed(fail):
+            self._claiming.discard(name)
+
+            return fail
+
+        d = self.directory.register(self.getStreamKey(name), self.nodeId)
+
+        return d.addCallbacks(claimed, failed)
+
+
+    def _startPublishing(self, client, requestor, name, type_):
+        """
+        Builds the publisher for the brand new stream C{name}.
+        """
+        stream = self.streams[name] = StreamPublisher(requestor, client)
+        self._streamingClients[client] = stream
+
+        if self.push is not None:
+            self.push.push(stream, name)
+
+        if self.placement is not None:
+            self.placement.publish(stream, name)
+
+        if self.recorder is not None and type_ in ('record', 'append'):
+            self.recorder.record(stream, name, type_)
+
+        return stream
+
+
+    def _publishTo(self, stream, client, name):
         if client.id != stream.client.id:
             raise exc.BadNameError("'%s' is already used" % (name,))
 
@@ -1067,6 +1944,11 @@ class Application(object):
 
         del self.streams[name]
 
+        if self.directory is not None:
+            d = self.directory.unregister(self.getStreamKey(name),
+                self.nodeId)
+            d.addErrback(log.err)
+
 
     def addSubscriber(self, stream, subscriber):
         """
@@ -1100,6 +1982,9 @@ class Application(object):
         If C{False} is returned (or an exception raised) then the connection is
         rejected. The default is to accept the connection.
 
+        Decorate with L{rpc.blocking} if this method blocks (e.g. checks
+        credentials against a database) to run it in a thread.
+
         @param client: The client requesting the connection.
         @type client: An instance of L{client_class}.
         """
@@ -1152,24 +2037,175 @@ class ServerFactory(protocol.ServerFactory):
     @ivar _pendingApplications: A collection of applications that are pending
         activation.
     @type _pendingApplications: C{dict} of C{name} -> L{IApplication}
+    @ivar stats: Counters for handshakes and timeouts, see L{getStats}.
+    @ivar _handshakes: The protocols that are currently handshaking.
+    @ivar _handshakeQueue: The protocols waiting for a handshake slot.
     """
 
     protocol = ServerProtocol
-    handshake = handshake.ServerNegotiator
+    #: Speaks the digest handshake with Flash Player 9+ clients and the plain
+    #: handshake with everything else.
+    handshake = rtmp_handshake.ServerNegotiator
 
     upstreamBandwidth = 2500000L
     downstreamBandwidth = 2500000L
     fmsVer = versions.FMS_MIN_H264
 
+    #: The number of seconds between topping up the handshake payload pool.
+    #: See L{handshake.PayloadPool}. Set to C{None} to disable.
+    payloadRefillInterval = 1.0
+
+    #: The number of seconds a peer has to complete the version and handshake
+    #: negotiations (including any time spent queued). C{None} to disable.
+    handshakeTimeout = 30
+    #: The number of seconds a peer has to successfully connect to an
+    #: application once the handshake is complete. C{None} to disable.
+    connectTimeout = 30
+    #: The maximum number of concurrent in-progress handshakes. C{None} means
+    #: no limit.
+    maxHandshakes = None
+    #: What to do with a connection when C{maxHandshakes} has been reached.
+    #: C{'queue'} pauses reading from the connection until a slot frees up,
+    #: C{'reject'} drops the connection straight away.
+    handshakeOverflow = 'queue'
+
+    #: Provides C{callLater}, used for the timeouts. Defaults to the reactor.
+    clock = None
+
+    #: Hands connections for applications that are served by other processes
+    #: over to them, see L{rtmpy.cluster.handoff.Handoff}.
+    handoff = None
+
     def __init__(self, applications=None):
+        if self.clock is None:
+            from twisted.internet import reactor
+
+            self.clock = reactor
+
         self.applications = {}
         self._pendingApplications = {}
 
+        self._handshakes = set()
+        self._handshakeQueue = collections.deque()
+
+        self.stats = {
+            'handshakes': 0,
+            'handshakesQueued': 0,
+            'handshakesRejected': 0,
+            'handshakeTimeouts': 0,
+            'connectTimeouts': 0,
+        }
+
         if applications:
             for name, app in applications.items():
                 self.registerApplication(name, app)
 
 
+    def startFactory(self):
+        """
+        Starts refilling the handshake payload pool (if there is one) whilst
+        the factory is listening. The pool is shared, see
+        L{handshake.PayloadPool.startRefilling}.
+        """
+        pool = getattr(self.handshake, 'payloadPool', None)
+
+        if pool is None or not self.payloadRefillInterval:
+            return
+
+        self._payloadPool = pool
+        pool.startRefilling(self.payloadRefillInterval, self.clock)
+
+
+    def stopFactory(self):
+        """
+        Stops refilling the handshake payload pool.
+        """
+        pool = getattr(self, '_payloadPool', None)
+
+        if pool is None:
+            return
+
+        del self._payloadPool
+
+        pool.stopRefilling()
+
+
+    def getStats(self):
+        """
+        Returns a C{dict} of the handshake/timeout counters along with the
+        number of connections that are currently handshaking (C{active}) or
+        waiting for a handshake slot (C{queued}).
+        """
+        ret = self.stats.copy()
+
+        ret['active'] = len(self._handshakes)
+        ret['queued'] = len(self._handshakeQueue)
+
+        return ret
+
+
+    def admitHandshake(self, protocol):
+        """
+        Called when a new connection wants to start handshaking.
+
+        If there are fewer than C{maxHandshakes} in progress, the connection is
+        admitted straight away. Otherwise, depending on C{handshakeOverflow},
+        reading from the connection is paused and it waits its turn or the
+        connection is dropped.
+
+        @return: Whether handshaking can begin.
+        """
+        limit = self.maxHandshakes
+
+        if limit is None or len(self._handshakes) < limit:
+            self._handshakes.add(protocol)
+
+            return True
+
+        if self.handshakeOverflow == 'queue':
+            protocol.queued = True
+            protocol.transport.pauseProducing()
+
+            self._handshakeQueue.append(protocol)
+            self.stats['handshakesQueued'] += 1
+
+            return False
+
+        self.stats['handshakesRejected'] += 1
+        protocol.transport.loseConnection()
+
+        return False
+
+
+    def handshakeFinished(self, protocol, success=False):
+        """
+        Called when C{protocol} no longer needs its handshake slot, either
+        because the handshake completed or the connection went away. Admits
+        the next queued connection(s).
+        """
+        try:
+            self._handshakes.remove(protocol)
+        except KeyError:
+            try:
+                self._handshakeQueue.remove(protocol)
+            except ValueError:
+                pass
+
+            return
+
+        if success:
+            self.stats['handshakes'] += 1
+
+        limit = self.maxHandshakes
+
+        while self._handshakeQueue and (
+                limit is None or len(self._handshakes) < limit):
+            p = self._handshakeQueue.popleft()
+
+            self._handshakes.add(p)
+            p.handshakeAdmitted()
+
+
     def buildHandshakeNegotiator(self, observer, output):
         """
         Returns a negotiator capable of handling server side handshakes.
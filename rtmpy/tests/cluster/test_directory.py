@@ -0,0 +1,412 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.cluster.directory}.
+"""
+
+import os
+import fcntl
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from rtmpy.cluster import directory
+
+
+
+class DirectoryTests(object):
+    """
+    Tests that apply to every directory, see L{buildDirectory}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+
+        self.directory = self.buildDirectory(ttl=30)
+
+    def tearDown(self):
+        self.directory.close()
+
+    def buildDirectory(self, ttl=None):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Waits for the calls already made to the directory's thread.
+        """
+        return self.directory.run(lambda: None)
+
+    def test_interface(self):
+        self.assertTrue(directory.IStreamDirectory.providedBy(self.directory))
+
+    @defer.inlineCallbacks
+    def test_register(self):
+        yield self.directory.register('live/foo', 'node-1')
+
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-1')
+        self.assertEqual((yield self.directory.lookup('live/bar')), None)
+
+        yield self.directory.unregister('live/foo', 'node-2')
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-1')
+
+        yield self.directory.unregister('live/foo', 'node-1')
+        self.assertEqual((yield self.directory.lookup('live/foo')), None)
+
+    @defer.inlineCallbacks
+    def test_claim(self):
+        """
+        A stream can only be registered by one owner at a time.
+        """
+        self.assertTrue((yield self.directory.register('live/foo', 'node-1')))
+        self.assertFalse((yield self.directory.register('live/foo',
+            'node-2')))
+
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-1')
+        self.assertFalse('node-2' in self.directory.owned)
+
+        self.assertTrue((yield self.directory.register('live/foo', 'node-1')))
+
+    @defer.inlineCallbacks
+    def test_claim_expired(self):
+        yield self.directory.register('live/foo', 'node-1')
+        self.directory.stopHeartbeat('node-1')
+
+        self.clock.advance(30)
+
+        self.assertTrue((yield self.directory.register('live/foo', 'node-2')))
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-2')
+
+        # the old owner does not take it back with a heartbeat
+        yield self.directory.refresh('node-1')
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-2')
+
+    @defer.inlineCallbacks
+    def test_expire(self):
+        """
+        Entries whose owner stops sending heartbeats expire.
+        """
+        yield self.directory.register('live/foo', 'node-1')
+        self.directory.stopHeartbeat('node-1')
+
+        self.clock.advance(29)
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-1')
+
+        self.clock.advance(1)
+        self.assertEqual((yield self.directory.lookup('live/foo')), None)
+
+    @defer.inlineCallbacks
+    def test_heartbeat(self):
+        yield self.directory.register('live/foo', 'node-1')
+
+        for i in xrange(10):
+            self.clock.advance(10)
+
+            yield self.flush()
+
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-1')
+
+        yield self.directory.unregister('live/foo', 'node-1')
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_watch(self):
+        found = []
+
+        self.directory.watch('live/foo', lambda *args: found.append(args))
+        yield self.directory.register('live/foo', 'node-1')
+
+        self.assertEqual(found, [('live/foo', 'node-1')])
+
+        # watches only fire once
+        yield self.directory.register('live/foo', 'node-1')
+        self.assertEqual(len(found), 1)
+
+    @defer.inlineCallbacks
+    def test_unwatch(self):
+        found = []
+
+        self.directory.watch('live/foo', found.append)
+        self.directory.unwatch('live/foo', found.append)
+        yield self.directory.register('live/foo', 'node-1')
+
+        self.assertEqual(found, [])
+        self.assertEqual(self.directory.watchers, {})
+
+
+
+class MemoryDirectoryTestCase(DirectoryTests, unittest.TestCase):
+    """
+    Tests for L{directory.MemoryDirectory}.
+    """
+
+    def buildDirectory(self, ttl=None):
+        return directory.MemoryDirectory(ttl, clock=self.clock)
+
+    def test_no_poll(self):
+        self.directory.watch('live/foo', lambda *args: None)
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_synchronous(self):
+        """
+        The entries are in memory, so there is no thread.
+        """
+        d = self.directory.register('live/foo', 'node-1')
+
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.directory.pool, None)
+
+
+
+class SharedDirectoryTests(DirectoryTests):
+    """
+    Tests for directories shared between processes.
+    """
+
+    def buildOther(self):
+        other = self.buildDirectory(ttl=30)
+        self.addCleanup(other.close)
+
+        return other
+
+    @defer.inlineCallbacks
+    def test_thread(self):
+        """
+        The entries are stored in the directory's thread, not the reactor's.
+        """
+        thread = yield self.directory.run(threading.currentThread)
+
+        self.assertNotIdentical(thread, threading.currentThread())
+
+        # the thread goes away with the directory
+        self.directory.close()
+
+        self.assertEqual(self.directory.pool, None)
+        self.assertFalse(thread.isAlive())
+
+    @defer.inlineCallbacks
+    def test_poll(self):
+        """
+        Streams registered by another process are found by polling.
+        """
+        other = self.buildOther()
+        found = []
+
+        self.directory.watch('live/foo', lambda *args: found.append(args))
+        yield other.register('live/foo', 'node-2')
+        other.close()
+
+        self.assertEqual(found, [])
+
+        self.clock.advance(self.directory.pollInterval)
+        yield self.flush()
+
+        self.assertEqual(found, [('live/foo', 'node-2')])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_claim_shared(self):
+        """
+        A stream registered by another process cannot be claimed.
+        """
+        other = self.buildOther()
+
+        self.assertTrue((yield self.directory.register('live/foo', 'node-1')))
+        self.assertFalse((yield other.register('live/foo', 'node-2')))
+
+        self.assertEqual((yield other.lookup('live/foo')), 'node-1')
+
+    @defer.inlineCallbacks
+    def test_claim_race(self):
+        """
+        Only one of a number of simultaneous claims succeeds.
+        """
+        others = [self.buildOther() for i in xrange(4)]
+
+        results = yield defer.gatherResults([other.register('live/foo',
+            'node-%d' % (i,)) for i, other in enumerate(others)])
+
+        self.assertEqual(sorted(results), [False, False, False, True])
+
+    @defer.inlineCallbacks
+    def test_refresh_shared(self):
+        """
+        All the entries of an owner are refreshed, whichever process
+        registered them.
+        """
+        other = self.buildOther()
+
+        yield other.register('live/foo', 'node-1')
+        other.stopHeartbeat('node-1')
+
+        self.clock.advance(20)
+        yield self.directory.refresh('node-1')
+        self.clock.advance(20)
+
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-1')
+
+
+
+class SQLiteDirectoryTestCase(SharedDirectoryTests, unittest.TestCase):
+    """
+    Tests for L{directory.SQLiteDirectory}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+        SharedDirectoryTests.setUp(self)
+
+    def buildDirectory(self, ttl=None):
+        return directory.SQLiteDirectory(self.path, ttl, clock=self.clock)
+
+    @defer.inlineCallbacks
+    def test_purge(self):
+        yield self.directory.register('live/foo', 'node-1')
+        yield self.directory.register('live/bar', 'node-2')
+        self.directory.stopHeartbeat('node-2')
+
+        self.clock.advance(20)
+        yield self.directory.refresh('node-1')
+        self.clock.advance(10)
+
+        self.assertEqual((yield self.directory.purge()), 1)
+        self.assertEqual((yield self.directory.lookup('live/foo')), 'node-1')
+
+    @defer.inlineCallbacks
+    def test_close(self):
+        yield self.directory.lookup('live/foo')
+        self.assertNotEqual(self.directory.db, None)
+
+        self.directory.close()
+
+        self.assertEqual(self.directory.db, None)
+
+
+
+class FileDirectoryExpiryTestCase(SharedDirectoryTests, unittest.TestCase):
+    """
+    Tests for L{directory.FileDirectory} with expiring entries.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+        SharedDirectoryTests.setUp(self)
+
+    def buildDirectory(self, ttl=None):
+        return directory.FileDirectory(self.path, ttl, clock=self.clock)
+
+
+
+class FileDirectoryTestCase(unittest.TestCase):
+    """
+    Tests for L{directory.FileDirectory}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.directory = directory.FileDirectory(self.path)
+
+        self.addCleanup(self.directory.close)
+
+    def test_create(self):
+        self.assertTrue(os.path.isdir(self.path))
+
+    @defer.inlineCallbacks
+    def test_lookup(self):
+        self.assertEqual((yield self.directory.lookup('live/foo')), None)
+
+        yield self.directory.register('live/foo', 'worker-1')
+
+        self.assertEqual((yield self.directory.lookup('live/foo')),
+            'worker-1')
+        self.assertEqual(sorted(os.listdir(self.path)),
+            ['+lock', 'live%2Ffoo'])
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        """
+        All instances using the same path see the same entries.
+        """
+        other = directory.FileDirectory(self.path)
+        self.addCleanup(other.close)
+
+        yield self.directory.register('live/foo', 'worker-1')
+
+        self.assertEqual((yield other.lookup('live/foo')), 'worker-1')
+
+    @defer.inlineCallbacks
+    def test_unregister(self):
+        yield self.directory.register('live/foo', 'worker-1')
+        yield self.directory.unregister('live/foo', 'worker-1')
+
+        self.assertEqual((yield self.directory.lookup('live/foo')), None)
+
+        # nothing to unregister
+        yield self.directory.unregister('live/foo', 'worker-1')
+
+    def test_locked(self):
+        """
+        A claim waits (in the directory's thread) for another process to
+        release the lock.
+        """
+        fd = os.open(os.path.join(self.path, '+lock'),
+            os.O_WRONLY | os.O_CREAT, 0644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        released = []
+
+        def release():
+            released.append(True)
+            os.close(fd)
+
+        reactor.callLater(0.05, release)
+
+        d = self.directory.register('live/foo', 'worker-1')
+
+        def check(result):
+            self.assertTrue(result)
+            self.assertEqual(released, [True])
+
+        return d.addCallback(check)
+
+    @defer.inlineCallbacks
+    def test_left_lock(self):
+        """
+        A lock file left behind by a process that died does not stop the
+        stream being claimed.
+        """
+        open(os.path.join(self.path, '+lock'), 'wb').close()
+
+        self.assertTrue((yield self.directory.register('live/foo',
+            'worker-1')))
+        self.assertEqual(sorted(os.listdir(self.path)),
+            ['+lock', 'live%2Ffoo'])
+
+    @defer.inlineCallbacks
+    def test_unregister_owner(self):
+        """
+        Only the owner can remove an entry.
+        """
+        yield self.directory.register('live/foo', 'worker-1')
+        yield self.directory.unregister('live/foo', 'worker-2')
+
+        self.assertEqual((yield self.directory.lookup('live/foo')),
+            'worker-1')
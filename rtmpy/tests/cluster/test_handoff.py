@@ -0,0 +1,323 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.cluster.handoff}.
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, protocol, reactor
+from pyamf.util import BufferedByteStream
+
+from rtmpy import server, message
+from rtmpy.protocol.rtmp import codec
+from rtmpy.cluster import handoff
+
+
+
+class ConnectingClient(protocol.Protocol):
+    """
+    Performs a plain RTMP handshake, sends a connect request and waits for
+    the server to accept it.
+    """
+
+    handshakeLength = 1 + 1536 * 2
+
+    def __init__(self, app):
+        self.app = app
+        self.buffer = ''
+        self.negotiated = False
+        self.accepted = defer.Deferred()
+
+        self.output = BufferedByteStream()
+        self.encoder = codec.Encoder(self.output)
+
+    def encode(self, msg):
+        buf = BufferedByteStream()
+        msg.encode(buf)
+
+        self.encoder.send(buf.getvalue(), message.typeByClass(msg), 0, 0)
+
+        while self.encoder.active:
+            self.encoder.next()
+
+        s = self.output.getvalue()
+        self.output.truncate()
+
+        return s
+
+    def connectionMade(self):
+        self.transport.write('\x03' + '\x00' * 8 + 'x' * 1528)
+
+    def dataReceived(self, data):
+        sent = len(self.buffer) >= self.handshakeLength
+
+        self.buffer += data
+
+        if len(self.buffer) < self.handshakeLength:
+            return
+
+        if not sent:
+            # C2 echoes S1
+            self.transport.write(self.buffer[1:1537] +
+                self.encode(message.Invoke('connect', 2, {'app': self.app})))
+
+            return
+
+        if not self.negotiated:
+            # the server waits for this before accepting the connection
+            self.negotiated = True
+            self.transport.write(
+                self.encode(message.DownstreamBandwidth(2500000)))
+
+        if 'NetConnection.Connect.Success' in self.buffer:
+            d, self.accepted = self.accepted, None
+
+            if d is not None:
+                d.callback(None)
+
+
+
+class RecordingHandoff(handoff.Handoff):
+    """
+    Records the connections that would be handed off.
+    """
+
+    def handOff(self, protocol, owner, datatype, timestamp, data):
+        self.handedOff = (owner, handoff.getConnectApp(data))
+
+        return True
+
+
+
+class DispatcherTestCase(unittest.TestCase):
+    """
+    Tests for L{handoff.HandoffDispatcher}.
+    """
+
+    def setUp(self):
+        self.handoff = RecordingHandoff('a', ['a', 'b'], self.mktemp())
+        self.handoff.handedOff = None
+
+        self.apps = {}
+
+        for i in xrange(100):
+            name = 'app-%d' % (i,)
+            self.apps.setdefault(self.handoff.getOwner(name), name)
+
+    def dispatch(self, app, resumed=False):
+        p = server.ServerProtocol()
+        p.resumed = resumed
+
+        buf = BufferedByteStream()
+        message.Invoke('connect', 1, {'app': app}).encode(buf)
+
+        dispatcher = handoff.HandoffDispatcher(p, self.handoff)
+        self.dispatched = []
+
+        self.patch(handoff.rtmp.ProtocolMessageDispatcher, 'dispatchMessage',
+            lambda *args: self.dispatched.append(args))
+
+        dispatcher.dispatchMessage(None, message.INVOKE, 0, buf.getvalue())
+
+    def test_connect_app(self):
+        buf = BufferedByteStream()
+        message.Invoke('connect', 1, {'app': 'foo'}).encode(buf)
+
+        self.assertEqual(handoff.getConnectApp(buf.getvalue()), 'foo')
+
+        buf = BufferedByteStream()
+        message.Invoke('play', 1, None, 'foo').encode(buf)
+
+        self.assertEqual(handoff.getConnectApp(buf.getvalue()), None)
+
+    def test_local(self):
+        self.dispatch(self.apps['a'])
+
+        self.assertEqual(self.handoff.handedOff, None)
+        self.assertEqual(len(self.dispatched), 1)
+
+    def test_remote(self):
+        self.dispatch(self.apps['b'])
+
+        self.assertEqual(self.handoff.handedOff, ('b', self.apps['b']))
+        self.assertEqual(self.dispatched, [])
+
+    def test_resumed(self):
+        """
+        A connection that was handed over is never handed on again.
+        """
+        self.dispatch(self.apps['b'], resumed=True)
+
+        self.assertEqual(self.handoff.handedOff, None)
+        self.assertEqual(len(self.dispatched), 1)
+
+
+
+class StateTestCase(unittest.TestCase):
+    """
+    Tests for L{handoff.encodeState} and L{handoff.decodeState}.
+    """
+
+    def test_round_trip(self):
+        state = {
+            'family': 10,
+            'decoder': {
+                'frameSize': 4096,
+                'bytes': 3073,
+                'channels': [[3, [3, 0, 20, 200, 0, True, False], 0, 0, 200,
+                    0, 0]],
+                'bucket': [(4, '\x00\xff\x80')],
+                'buffer': '\xc3\x00',
+            },
+            'connect': (20, 0, '\x02\x00\x07connect\xff'),
+        }
+
+        frame = handoff.encodeState(state)
+
+        self.assertEqual(handoff.decodeState(frame), {
+            'family': 10,
+            'decoder': {
+                'frameSize': 4096,
+                'bytes': 3073,
+                'channels': [[3, [3, 0, 20, 200, 0, True, False], 0, 0, 200,
+                    0, 0]],
+                'bucket': [(4, '\x00\xff\x80')],
+                'buffer': '\xc3\x00',
+            },
+            'connect': (20, 0, '\x02\x00\x07connect\xff'),
+        })
+
+    def test_pickle(self):
+        """
+        A pickle is rejected rather than loaded.
+        """
+        import cPickle
+
+        frame = cPickle.dumps({'family': 2}, cPickle.HIGHEST_PROTOCOL)
+
+        self.assertRaises(ValueError, handoff.decodeState, frame)
+
+
+
+class HandoffTestCase(unittest.TestCase):
+    """
+    Hands a real connection from one L{handoff.Handoff} to another.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.makedirs(self.path)
+
+        nodes = ['a', 'b']
+
+        self.front = handoff.Handoff('a', nodes, self.path)
+        self.owner = handoff.Handoff('b', nodes, self.path)
+
+        self.appName = [name for name in ['app-%d' % (i,) for i in xrange(100)]
+            if self.front.getOwner(name) == 'b'][0]
+
+        self.frontFactory = server.ServerFactory()
+        self.frontFactory.applications[self.appName] = server.Application()
+
+        self.ownerApp = server.Application()
+        self.ownerFactory = server.ServerFactory()
+        self.ownerFactory.applications[self.appName] = self.ownerApp
+
+        self.ports = [self.owner.listen(self.ownerFactory),
+            self.front.listen(self.frontFactory),
+            reactor.listenTCP(0, self.frontFactory, interface='127.0.0.1')]
+
+    def tearDown(self):
+        return defer.DeferredList([p.stopListening() for p in self.ports])
+
+    def connect(self, host='127.0.0.1'):
+        client = ConnectingClient(self.appName)
+        port = self.ports[-1].getHost().port
+
+        d = protocol.ClientCreator(reactor, lambda: client).connectTCP(
+            host, port)
+
+        def cb(result):
+            self.addCleanup(client.transport.loseConnection)
+
+            return client.accepted
+
+        return d.addCallback(cb)
+
+    def test_handoff(self):
+        d = self.connect()
+
+        def connected(result):
+            self.assertEqual(self.front.stats['handedOff'], 1)
+            self.assertEqual(self.owner.stats['adopted'], 1)
+
+            self.assertEqual(len(self.ownerApp.clients), 1)
+            self.assertEqual(len(self.frontFactory.applications[
+                self.appName].clients), 0)
+
+        return d.addCallback(connected)
+
+    def test_ipv6(self):
+        """
+        The adopted socket keeps the address family of the listener.
+        """
+        try:
+            port = reactor.listenTCP(0, self.frontFactory, interface='::1')
+        except error.CannotListenError:
+            raise unittest.SkipTest('IPv6 is not available')
+
+        self.ports.append(port)
+
+        d = self.connect('::1')
+
+        def connected(result):
+            self.assertEqual(self.owner.stats['adopted'], 1)
+
+            client = self.ownerApp.clients.values()[0]
+            host = client.nc.protocol.transport.getHost()
+
+            self.assertEqual(host.type, 'TCP')
+            self.assertEqual(host.host, '::1')
+
+        return d.addCallback(connected)
+
+    def test_socket_mode(self):
+        """
+        Only the user the workers run as can connect to the handoff socket.
+        """
+        mode = os.stat(self.owner.getAddress('b')).st_mode & 0777
+
+        self.assertEqual(mode, handoff.SOCKET_MODE)
+
+    def test_owner_gone(self):
+        """
+        The connection is served locally if the owner cannot be reached.
+        """
+        self.ports.pop(0).stopListening()
+
+        d = self.connect()
+
+        def connected(result):
+            self.assertEqual(self.front.stats['failed'], 1)
+            self.assertEqual(len(self.frontFactory.applications[
+                self.appName].clients), 1)
+
+        d.addCallback(connected)
+        d.addCallback(lambda _: self.flushLoggedErrors())
+
+        return d
@@ -0,0 +1,81 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.cluster.hashring}.
+"""
+
+from twisted.trial import unittest
+
+from rtmpy.cluster import hashring
+
+
+
+class HashRingTestCase(unittest.TestCase):
+    """
+    Tests for L{hashring.HashRing}.
+    """
+
+    def setUp(self):
+        self.ring = hashring.HashRing(['a', 'b', 'c'])
+        self.keys = ['app-%d' % (i,) for i in xrange(1000)]
+
+    def test_empty(self):
+        self.assertEqual(hashring.HashRing().getNode('foo'), None)
+
+    def test_stable(self):
+        other = hashring.HashRing(['c', 'b', 'a'])
+
+        for key in self.keys:
+            self.assertEqual(self.ring.getNode(key), other.getNode(key))
+
+    def test_spread(self):
+        counts = {}
+
+        for key in self.keys:
+            node = self.ring.getNode(key)
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEqual(sorted(counts.keys()), ['a', 'b', 'c'])
+
+        for count in counts.values():
+            self.assertTrue(count > 150, counts)
+
+    def test_remove(self):
+        """
+        Only the keys owned by the removed node move.
+        """
+        before = dict([(key, self.ring.getNode(key)) for key in self.keys])
+
+        self.ring.removeNode('b')
+
+        self.assertEqual(len(self.ring), 2)
+
+        for key in self.keys:
+            node = self.ring.getNode(key)
+
+            if before[key] != 'b':
+                self.assertEqual(node, before[key])
+            else:
+                self.assertNotEqual(node, 'b')
+
+    def test_add(self):
+        self.ring.addNode('a')
+
+        self.assertEqual(len(self.ring), 3)
+
+    def test_unicode(self):
+        self.assertEqual(self.ring.getNode(u'app-1'),
+            self.ring.getNode('app-1'))
@@ -0,0 +1,306 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.cluster.placement}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+
+from rtmpy import server, client, exc
+from rtmpy.cluster import placement
+from rtmpy.tests.test_client import RecordingSubscriber, waitFor
+
+
+KEYFRAME = '\x17' + 'k' * 9
+
+URLS = {
+    'node-a': 'rtmp://a.example.com/live',
+    'node-b': 'rtmp://b.example.com/live',
+}
+
+
+
+def findName(p, owner):
+    """
+    Returns a stream name that C{p} places on C{owner}.
+    """
+    for i in xrange(1000):
+        name = 'stream%d' % (i,)
+
+        if p.getOwner(name) == owner:
+            return name
+
+
+
+class PlacementTestCase(unittest.TestCase):
+    """
+    Tests for L{placement.Placement}.
+    """
+
+    def test_mode(self):
+        self.assertRaises(ValueError, placement.Placement, 'node-a', URLS,
+            mode='foo')
+
+    def test_owner(self):
+        p = placement.Placement('node-a', URLS)
+        name = findName(p, 'node-b')
+
+        self.assertEqual(p.getOwner(name), 'node-b')
+        self.assertEqual(p.getOwner(findName(p, None)), None)
+
+        # parameters are ignored
+        for i in xrange(100):
+            name = 'stream%d' % (i,)
+
+            self.assertEqual(p.getOwner(name + '?token=x'), p.getOwner(name))
+
+        name = findName(p, 'node-b')
+
+        # every node agrees
+        other = placement.Placement('node-b', URLS)
+
+        self.assertEqual(other.getOwner(name), None)
+
+    def test_spread(self):
+        urls = dict(('node-%d' % (i,), 'rtmp://%d/live' % (i,))
+            for i in xrange(4))
+        p = placement.Placement('node-0', urls)
+
+        counts = dict.fromkeys(urls, 0)
+
+        for i in xrange(4000):
+            counts[p.ring.getNode('stream%d' % (i,))] += 1
+
+        for count in counts.values():
+            self.assertTrue(600 < count < 1400, counts)
+
+    def test_add_node(self):
+        """
+        A new node only takes streams, about its share, from the others.
+        """
+        p = placement.Placement('node-a', URLS)
+        names = ['stream%d' % (i,) for i in xrange(3000)]
+        before = dict((name, p.ring.getNode(name)) for name in names)
+
+        p.addNode('node-c', 'rtmp://c.example.com/live')
+
+        moved = [name for name in names if p.ring.getNode(name) != before[name]]
+
+        for name in moved:
+            self.assertEqual(p.ring.getNode(name), 'node-c')
+
+        self.assertTrue(600 < len(moved) < 1400, len(moved))
+
+    def test_remove_node(self):
+        p = placement.Placement('node-a', URLS)
+        p.addNode('node-c', 'rtmp://c.example.com/live')
+
+        names = ['stream%d' % (i,) for i in xrange(1000)]
+        before = dict((name, p.ring.getNode(name)) for name in names)
+
+        p.removeNode('node-c')
+
+        self.assertFalse('node-c' in p.urls)
+
+        for name in names:
+            if before[name] != 'node-c':
+                self.assertEqual(p.ring.getNode(name), before[name])
+
+    def test_redirect(self):
+        p = placement.Placement('node-a', URLS)
+        name = findName(p, 'node-b')
+
+        error = p.getRedirect(name)
+
+        self.assertTrue(isinstance(error, exc.Redirect))
+        self.assertEqual(error.url, 'rtmp://b.example.com/live')
+        self.assertEqual(p.getRedirect(findName(p, None)), None)
+        self.assertEqual(p.stats['redirected'], 1)
+
+        p.mode = placement.PROXY
+
+        self.assertEqual(p.getRedirect(name), None)
+
+
+
+class BaseServerTestCase(unittest.TestCase):
+    """
+    Runs two local servers, C{node-a} and C{node-b}.
+    """
+
+    mode = placement.REDIRECT
+
+    def setUp(self):
+        self.apps = {}
+        self.urls = {}
+
+        for nodeId in ('node-a', 'node-b'):
+            app = self.apps[nodeId] = server.Application()
+
+            factory = server.ServerFactory()
+            factory.applications['live'] = app
+
+            port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+            self.addCleanup(port.stopListening)
+
+            self.urls[nodeId] = 'rtmp://127.0.0.1:%d/live' % (
+                port.getHost().port,)
+
+        for nodeId, app in self.apps.items():
+            app.placement = placement.Placement(nodeId, self.urls, self.mode)
+
+        self.name = findName(self.apps['node-a'].placement, 'node-b')
+
+    def openStream(self, nodeId):
+        d = client.connect(self.urls[nodeId])
+
+        def cb(nc):
+            self.addCleanup(nc.protocol.transport.loseConnection)
+
+            return nc.openStream()
+
+        return d.addCallback(cb)
+
+
+
+class RedirectTestCase(BaseServerTestCase):
+    """
+    Tests for L{server.Application.placement} in redirect mode.
+    """
+
+    def test_play(self):
+        d = self.openStream('node-a')
+
+        d.addCallback(lambda stream: stream.play(self.name,
+            RecordingSubscriber()))
+
+        self.assertFailure(d, exc.Redirect)
+
+        def check(error):
+            self.assertEqual(error.url, self.urls['node-b'])
+            self.assertEqual(self.apps['node-a'].clients, {})
+
+            self.flushLoggedErrors(exc.Redirect)
+
+        return d.addCallback(check)
+
+    def test_publish(self):
+        d = self.openStream('node-a')
+
+        d.addCallback(lambda stream: stream.publish(self.name))
+
+        self.assertFailure(d, exc.Redirect)
+
+        def check(error):
+            self.assertEqual(error.url, self.urls['node-b'])
+            self.assertEqual(self.apps['node-a'].streams, {})
+
+            self.flushLoggedErrors(exc.Redirect)
+
+        return d.addCallback(check)
+
+    def test_owner(self):
+        d = self.openStream('node-b')
+
+        d.addCallback(lambda stream: stream.publish(self.name))
+
+        def check(stream):
+            self.assertTrue(self.name in self.apps['node-b'].streams)
+
+        return d.addCallback(check)
+
+
+
+class ProxyTestCase(BaseServerTestCase):
+    """
+    Tests for L{server.Application.placement} in proxy mode.
+    """
+
+    mode = placement.PROXY
+
+    def test_publish(self):
+        """
+        Streams published on the wrong node are pushed to the owner.
+        """
+        subscriber = RecordingSubscriber()
+        owner = self.apps['node-b']
+
+        d = self.openStream('node-a')
+
+        d.addCallback(lambda stream: stream.publish(self.name))
+
+        def published(stream):
+            self.stream = stream
+
+            [target] = self.apps['node-a'].streams[self.name].pushTargets
+            self.addCleanup(target.stop)
+
+            return waitFor(lambda: self.name in owner.streams)
+
+        def cb(result):
+            owner.streams[self.name].addSubscriber(subscriber)
+
+            self.stream.sendVideo(KEYFRAME, 0)
+
+            return waitFor(lambda: subscriber.video)
+
+        def check(result):
+            self.assertEqual(subscriber.video, [(KEYFRAME, 0)])
+            self.assertEqual(self.apps['node-a'].placement.stats['pushed'], 1)
+
+        d.addCallback(published)
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_play(self):
+        """
+        Streams played on the wrong node are pulled from the owner.
+        """
+        subscriber = RecordingSubscriber()
+
+        d = self.openStream('node-b')
+
+        d.addCallback(lambda stream: stream.publish(self.name))
+
+        def published(stream):
+            self.stream = stream
+
+            d = self.openStream('node-a')
+
+            d.addCallback(lambda stream: stream.play(self.name, subscriber))
+
+            return d
+
+        def playing(result):
+            self.addCleanup(
+                self.apps['node-a']._relayedStreams[self.name].stop)
+
+            self.stream.sendVideo(KEYFRAME, 0)
+
+            return waitFor(lambda: subscriber.video)
+
+        def check(result):
+            self.assertEqual(subscriber.video, [(KEYFRAME, 0)])
+            self.assertEqual(self.apps['node-a'].placement.stats['pulled'], 1)
+
+        d.addCallback(published)
+        d.addCallback(playing)
+        d.addCallback(check)
+
+        return d
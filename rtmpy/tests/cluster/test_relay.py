@@ -0,0 +1,484 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.cluster.relay}.
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from rtmpy import server, exc
+from rtmpy.cluster import relay, directory
+
+
+
+class RecordingSubscriber(object):
+    """
+    Records the events from a publisher.
+    """
+
+    def __init__(self, expected=None):
+        self.events = []
+        self.expected = expected
+        self.done = defer.Deferred()
+
+    def _add(self, *event):
+        self.events.append(event)
+
+        if len(self.events) == self.expected:
+            self.done.callback(self.events)
+
+    def videoDataReceived(self, data, timestamp):
+        self._add('video', data, timestamp)
+
+    def audioDataReceived(self, data, timestamp):
+        self._add('audio', data, timestamp)
+
+    def onMetaData(self, data):
+        self._add('meta', data)
+
+    def unpublish(self):
+        self._add('unpublish')
+
+
+
+class RelayTestCase(unittest.TestCase):
+    """
+    Relays a stream between two L{relay.RelayClient}s over a real UNIX
+    socket.
+    """
+
+    rings = False
+    #: The subscribers added to the origin stream for a relay.
+    originSubscribers = 1
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.makedirs(self.path)
+
+        self.factory = server.ServerFactory()
+        self.app = server.Application()
+
+        self.publisher = server.StreamPublisher(None, None)
+        self.app.streams['foo'] = self.publisher
+
+        self.factory.applications['live'] = self.app
+
+        self.relay = relay.RelayClient(self.path, rings=self.rings)
+        self.port = self.relay.listen('worker-0', self.factory)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def fetch(self, key='live/foo'):
+        d = self.relay.fetch('worker-0', key)
+
+        def cb(publisher):
+            self.addCleanup(publisher.stop)
+
+            return publisher
+
+        return d.addCallback(cb)
+
+    def test_not_found(self):
+        d = self.fetch('live/bar')
+
+        return self.assertFailure(d, exc.StreamNotFound)
+
+    def test_no_worker(self):
+        d = self.relay.fetch('worker-1', 'live/foo')
+
+        return self.assertFailure(d, Exception)
+
+    def test_relay(self):
+        self.publisher.onMetaData({'width': 320})
+
+        d = self.fetch()
+
+        def fetched(publisher):
+            self.assertTrue(isinstance(publisher, relay.RelayedPublisher))
+            self.assertEqual(len(self.publisher.subscribers),
+                self.originSubscribers)
+
+            subscriber = RecordingSubscriber(expected=3)
+            publisher.addSubscriber(subscriber)
+
+            self.publisher.videoDataReceived('video', 0)
+            self.publisher.audioDataReceived('audio', 40)
+
+            return subscriber.done
+
+        def check(events):
+            self.assertEqual(events, [
+                ('meta', {'width': 320}),
+                ('video', 'video', 0),
+                ('audio', 'audio', 40),
+            ])
+
+        d.addCallback(fetched)
+        d.addCallback(check)
+
+        return d
+
+    def test_unpublish(self):
+        """
+        Unpublishing the origin stream unpublishes the relayed stream.
+        """
+        d = self.fetch()
+
+        def fetched(publisher):
+            subscriber = RecordingSubscriber(expected=1)
+            publisher.addSubscriber(subscriber)
+
+            self.publisher.unpublish()
+
+            return defer.gatherResults([subscriber.done, publisher.finished])
+
+        def check(result):
+            events, publisher = result
+
+            self.assertEqual(events, [('unpublish',)])
+            self.assertEqual(publisher.subscribers, {})
+
+        return d.addCallback(fetched).addCallback(check)
+
+    def test_stop(self):
+        """
+        Stopping the relayed stream removes the subscriber from the origin.
+        """
+        d = self.fetch()
+
+        def fetched(publisher):
+            publisher.stop()
+
+            return publisher.finished
+
+        def check(publisher):
+            # let the origin notice the connection went away
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+
+            return d.addCallback(lambda _: self.assertEqual(
+                self.publisher.subscribers, {}))
+
+        return d.addCallback(fetched).addCallback(check)
+
+
+
+class RingRelayTestCase(RelayTestCase):
+    """
+    Relays the audio/video through a shared memory ring.
+    """
+
+    rings = True
+    # the ring and the control connection
+    originSubscribers = 2
+
+    def test_ring(self):
+        d = self.fetch()
+
+        def fetched(publisher):
+            self.assertNotEqual(publisher.feeder, None)
+
+            path = publisher.feeder.reader.path
+
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(os.path.dirname(path),
+                os.path.join(self.path, 'rings'))
+
+            # a second relay shares the ring
+            return self.fetch().addCallback(lambda other: self.assertEqual(
+                other.feeder.reader.path, path))
+
+        return d.addCallback(fetched)
+
+
+
+class FakeRelay(object):
+    """
+    Records the streams fetched by an application.
+    """
+
+    def __init__(self):
+        self.fetched = []
+
+    def fetch(self, owner, key):
+        d = defer.Deferred()
+
+        self.fetched.append((owner, key, d))
+
+        return d
+
+
+
+class ApplicationRelayTestCase(unittest.TestCase):
+    """
+    Tests for L{server.Application} using a stream directory and relay.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.directory = directory.FileDirectory(self.mktemp(),
+            clock=self.clock)
+        self.addCleanup(self.directory.close)
+
+        self.relay = FakeRelay()
+
+        self.app = server.Application()
+        self.app.name = 'live'
+        self.app.nodeId = 'worker-0'
+        self.app.directory = self.directory
+        self.app.relay = self.relay
+
+        self.client = server.Client(None)
+        self.client.id = 'client'
+
+    def flush(self):
+        """
+        Waits for the calls already made to the directory's thread.
+        """
+        return self.directory.run(lambda: None)
+
+    def publishElsewhere(self, name, owner='worker-1'):
+        other = directory.FileDirectory(self.directory.path)
+        self.addCleanup(other.close)
+
+        return other.register('live/' + name, owner)
+
+    @defer.inlineCallbacks
+    def test_publish(self):
+        """
+        Publishing a stream registers it in the directory, unpublishing
+        removes it.
+        """
+        publisher = yield self.app.publishStream(self.client, None, 'foo')
+
+        self.assertEqual((yield self.directory.lookup('live/foo')),
+            'worker-0')
+
+        self.app.unpublishStream('foo', publisher)
+        yield self.flush()
+
+        self.assertEqual((yield self.directory.lookup('live/foo')), None)
+
+    @defer.inlineCallbacks
+    def test_publish_elsewhere(self):
+        yield self.publishElsewhere('foo')
+
+        d = self.app.publishStream(self.client, None, 'foo')
+
+        yield self.assertFailure(d, exc.BadNameError)
+
+        self.assertEqual(self.app.streams, {})
+
+    @defer.inlineCallbacks
+    def test_publish_claiming(self):
+        """
+        A stream cannot be published again while it is being claimed.
+        """
+        d = self.app.publishStream(self.client, None, 'foo')
+
+        self.assertRaises(exc.BadNameError, self.app.publishStream,
+            self.client, None, 'foo')
+
+        publisher = yield d
+
+        self.assertIdentical(self.app.streams['foo'], publisher)
+        self.assertEqual(self.app._claiming, set())
+
+    @defer.inlineCallbacks
+    def test_local(self):
+        """
+        Streams not in the directory wait for a local publish.
+        """
+        found = []
+
+        self.app.whenPublished('foo', found.append)
+        yield self.flush()
+
+        self.assertEqual(self.relay.fetched, [])
+        self.assertEqual(found, [])
+
+        publisher = yield self.app.publishStream(self.client, None, 'foo')
+
+        self.assertEqual(found, [publisher])
+
+    @defer.inlineCallbacks
+    def test_local_looking(self):
+        """
+        A stream published while it is being looked up in the directory is
+        given to the callbacks.
+        """
+        found = []
+
+        self.app.whenPublished('foo', found.append)
+
+        publisher = yield self.app.publishStream(self.client, None, 'foo')
+        yield self.flush()
+
+        self.assertEqual(found, [publisher])
+        self.assertEqual(self.app._pendingPublishedCallbacks, {})
+
+    @defer.inlineCallbacks
+    def test_relayed(self):
+        yield self.publishElsewhere('foo')
+
+        found = []
+
+        self.app.whenPublished('foo', found.append)
+        self.app.whenPublished('foo', found.append)
+        yield self.flush()
+
+        # only one relay connection per stream
+        (owner, key, d), = self.relay.fetched
+
+        self.assertEqual((owner, key), ('worker-1', 'live/foo'))
+
+        publisher = relay.RelayedPublisher(key)
+        d.callback(publisher)
+
+        self.assertEqual(found, [publisher, publisher])
+
+        self.app.whenPublished('foo', found.append)
+        self.assertEqual(len(self.relay.fetched), 1)
+        self.assertEqual(len(found), 3)
+
+        publisher.unpublish()
+
+        self.assertEqual(self.app._relayedStreams, {})
+
+    @defer.inlineCallbacks
+    def test_relay_failed(self):
+        """
+        If the stream cannot be relayed, wait for a local publish instead.
+        """
+        yield self.publishElsewhere('foo')
+
+        found = []
+        self.app.whenPublished('foo', found.append)
+        yield self.flush()
+
+        (owner, key, d), = self.relay.fetched
+        d.errback(exc.StreamNotFound())
+
+        self.assertEqual(self.app._pendingPublishedCallbacks,
+            {'foo': [found.append]})
+
+    @defer.inlineCallbacks
+    def test_relay_failed_elsewhere(self):
+        """
+        After a failed relay, the stream is relayed once it is published on
+        another node.
+        """
+        other = directory.FileDirectory(self.directory.path)
+        self.addCleanup(other.close)
+
+        yield other.register('live/foo', 'worker-1')
+
+        found = []
+        self.app.whenPublished('foo', found.append)
+        yield self.flush()
+
+        (owner, key, d), = self.relay.fetched
+        d.errback(exc.StreamNotFound())
+
+        # the owner goes away and another node publishes the stream
+        yield other.unregister('live/foo', 'worker-1')
+        yield other.register('live/foo', 'worker-2')
+
+        self.clock.advance(self.directory.pollInterval)
+        yield self.flush()
+        yield self.flush()
+
+        (owner, key, d) = self.relay.fetched[-1]
+        self.assertEqual(owner, 'worker-2')
+
+        publisher = relay.RelayedPublisher(key)
+        d.callback(publisher)
+
+        self.assertEqual(found, [publisher])
+        self.assertEqual(self.app._pendingPublishedCallbacks, {})
+
+    @defer.inlineCallbacks
+    def test_published_elsewhere(self):
+        """
+        Callbacks waiting for a stream are given the relayed stream once it is
+        published on another node.
+        """
+        found = []
+
+        self.app.whenPublished('foo', found.append)
+        yield self.flush()
+
+        self.assertEqual(self.relay.fetched, [])
+
+        yield self.publishElsewhere('foo')
+
+        self.clock.advance(self.directory.pollInterval)
+        yield self.flush()
+        yield self.flush()
+
+        (owner, key, d), = self.relay.fetched
+        self.assertEqual(owner, 'worker-1')
+        self.assertEqual(self.app._pendingPublishedCallbacks, {})
+
+        publisher = relay.RelayedPublisher(key)
+        d.callback(publisher)
+
+        self.assertEqual(found, [publisher])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_unwatch(self):
+        """
+        A local publish stops watching the directory.
+        """
+        self.app.whenPublished('foo', lambda stream: None)
+        yield self.flush()
+
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        yield self.app.publishStream(self.client, None, 'foo')
+
+        self.assertEqual(self.app._watching, {})
+        self.assertEqual(self.directory.watchers, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        """
+        The directory stops being watched once nothing is waiting for the
+        stream.
+        """
+        a, b = lambda stream: None, lambda stream: None
+
+        self.app.whenPublished('foo', a)
+        self.app.whenPublished('foo', b)
+        yield self.flush()
+
+        self.app.cancelWhenPublished('foo', a)
+
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(self.app._pendingPublishedCallbacks, {'foo': [b]})
+
+        self.app.cancelWhenPublished('foo', b)
+
+        self.assertEqual(self.app._pendingPublishedCallbacks, {})
+        self.assertEqual(self.app._watching, {})
+        self.assertEqual(self.directory.watchers, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
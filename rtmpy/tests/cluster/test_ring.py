@@ -0,0 +1,255 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.cluster.ring}.
+"""
+
+import os
+import time
+import multiprocessing
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from rtmpy import server
+from rtmpy.cluster import ring
+
+
+
+def readRecords(path, count, ready, results):
+    """
+    Reads the records from the ring at C{path} in a child process until the
+    record with the sequence C{count - 1} is seen.
+    """
+    reader = ring.RingReader(path)
+    ready.set()
+
+    records = []
+
+    while reader.seq != count:
+        records.extend(reader.read())
+
+    results.send((records, reader.lost))
+    results.close()
+
+
+
+def receive(connection, timeout):
+    """
+    Receives from C{connection}, polling because C{SIGCHLD} (the reactor
+    handles it) interrupts the wait.
+    """
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            if connection.poll(0.05):
+                return connection.recv()
+        except IOError:
+            pass
+
+    raise AssertionError('Nothing received')
+
+
+
+class RingTestCase(unittest.TestCase):
+    """
+    Tests for L{ring.RingWriter} and L{ring.RingReader}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.writer = ring.RingWriter(self.path, capacity=1024)
+        self.addCleanup(self.writer.close)
+
+    def test_read(self):
+        reader = ring.RingReader(self.path)
+
+        self.assertEqual(reader.read(), [])
+
+        self.assertEqual(self.writer.write('V', 10, 'foo'), 0)
+        self.assertEqual(self.writer.write('A', 20, 'bar'), 1)
+
+        self.assertEqual(reader.read(), [
+            (0, 'V', 10, 'foo'),
+            (1, 'A', 20, 'bar'),
+        ])
+        self.assertEqual(reader.read(), [])
+
+    def test_live(self):
+        """
+        A reader starts with the records written after it was opened.
+        """
+        self.writer.write('V', 0, 'foo')
+
+        reader = ring.RingReader(self.path)
+        self.writer.write('V', 0, 'bar')
+
+        self.assertEqual(reader.read(), [(1, 'V', 0, 'bar')])
+
+    def test_limit(self):
+        reader = ring.RingReader(self.path)
+
+        for i in xrange(3):
+            self.writer.write('V', i, 'x')
+
+        self.assertEqual(len(reader.read(limit=2)), 2)
+        self.assertEqual(len(reader.read()), 1)
+
+    def test_wrap(self):
+        reader = ring.RingReader(self.path)
+        data = 'x' * 100
+        records = []
+
+        for i in xrange(50):
+            self.writer.write('V', i, data)
+            records.extend(reader.read())
+
+        self.assertEqual([r[2] for r in records], range(50))
+        self.assertEqual(set([r[3] for r in records]), set([data]))
+        self.assertEqual(reader.lost, 0)
+
+    def test_overrun(self):
+        reader = ring.RingReader(self.path)
+
+        for i in xrange(50):
+            self.writer.write('V', i, 'x' * 100)
+
+        records = reader.read()
+
+        # skipped to the most recent record
+        self.assertEqual(records, [(49, 'V', 49, 'x' * 100)])
+        self.assertEqual(reader.overruns, 1)
+        self.assertEqual(reader.lost, 49)
+
+    def test_too_large(self):
+        self.assertRaises(ValueError, self.writer.write, 'V', 0, 'x' * 1024)
+
+    def test_close(self):
+        reader = ring.RingReader(self.path)
+        self.writer.write('V', 0, 'foo')
+        self.writer.close()
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(reader.closed)
+
+        self.assertEqual(len(reader.read()), 1)
+        self.assertTrue(reader.closed)
+
+    def test_not_a_ring(self):
+        path = self.mktemp()
+        open(path, 'wb').write('\x00' * 128)
+
+        self.assertRaises(IOError, ring.RingReader, path)
+
+    def test_processes(self):
+        """
+        Readers in other processes see the records written by this one.
+        """
+        count = 1000
+        ready = multiprocessing.Event()
+        readers = []
+
+        # a pipe rather than a queue, which needs a thread in the child
+        for i in xrange(2):
+            output, input = multiprocessing.Pipe(False)
+            p = multiprocessing.Process(target=readRecords,
+                args=(self.path, count, ready, input))
+
+            ready.clear()
+            p.start()
+            ready.wait(5)
+
+            readers.append((p, output))
+
+        for i in xrange(count):
+            self.writer.write('V', i, str(i))
+
+        for p, output in readers:
+            records, lost = receive(output, 10)
+
+            # the ring is small, the reader may well be overrun
+            seen = [r[0] for r in records]
+
+            self.assertEqual(len(seen) + lost, count)
+            self.assertEqual(seen, sorted(seen))
+
+            for seq, kind, timestamp, data in records:
+                self.assertEqual(str(seq), data)
+                self.assertEqual(seq, timestamp)
+
+        for p, output in readers:
+            p.join(5)
+            self.assertEqual(p.exitcode, 0)
+
+
+
+class RecordingPublisher(server.StreamPublisher):
+    def __init__(self):
+        server.StreamPublisher.__init__(self, None, None)
+
+        self.events = []
+
+    def videoDataReceived(self, data, timestamp):
+        self.events.append(('video', data, timestamp))
+
+    def audioDataReceived(self, data, timestamp):
+        self.events.append(('audio', data, timestamp))
+
+    def unpublish(self):
+        self.events.append(('unpublish',))
+
+
+
+class RingFeederTestCase(unittest.TestCase):
+    """
+    Tests for L{ring.RingSubscriber} and L{ring.RingFeeder}.
+    """
+
+    def setUp(self):
+        path = self.mktemp()
+
+        self.source = server.StreamPublisher(None, None)
+        self.source.addSubscriber(ring.RingSubscriber(ring.RingWriter(path)))
+
+        self.clock = task.Clock()
+        self.publisher = RecordingPublisher()
+        self.feeder = ring.RingFeeder(ring.RingReader(path), self.publisher,
+            clock=self.clock)
+
+        self.feeder.start()
+
+    def test_feed(self):
+        self.source.videoDataReceived('video', 10)
+        self.source.audioDataReceived('audio', 20)
+        self.source.onMetaData({'foo': 'bar'})
+
+        self.assertEqual(self.publisher.events, [])
+
+        self.clock.advance(self.feeder.interval)
+
+        self.assertEqual(self.publisher.events, [
+            ('video', 'video', 10),
+            ('audio', 'audio', 20),
+        ])
+
+    def test_unpublish(self):
+        self.source.unpublish()
+        self.clock.advance(self.feeder.interval)
+
+        self.assertEqual(self.publisher.events, [('unpublish',)])
+        self.assertEqual(self.feeder.reader, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
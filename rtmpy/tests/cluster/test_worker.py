@@ -0,0 +1,131 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.cluster.worker}.
+"""
+
+import os
+import signal
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import protocol, reactor
+
+from rtmpy import server, util
+from rtmpy.cluster import worker, relay
+
+
+
+class ListenReusePortTestCase(unittest.TestCase):
+    """
+    Tests for L{worker.listenReusePort}.
+    """
+
+    def test_shared(self):
+        """
+        Two factories can listen on the same port.
+        """
+        factory = protocol.ServerFactory()
+
+        a = worker.listenReusePort(0, factory, '127.0.0.1')
+        self.addCleanup(a.stopListening)
+
+        port = a.getHost().port
+
+        b = worker.listenReusePort(port, factory, '127.0.0.1')
+        self.addCleanup(b.stopListening)
+
+        self.assertEqual(b.getHost().port, port)
+
+
+
+class WorkerTestCase(unittest.TestCase):
+    """
+    Tests for L{worker.Worker}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.makedirs(self.path)
+
+        self.worker = worker.Worker('worker-0', self.path)
+
+    def test_attach(self):
+        app = server.Application()
+        factory = server.ServerFactory()
+        factory.applications['live'] = app
+
+        self.worker.attach(factory)
+
+        self.assertEqual(app.nodeId, 'worker-0')
+        self.assertTrue(app.directory is self.worker.directory)
+        self.assertTrue(app.relay is self.worker.relay)
+
+    def test_listen(self):
+        ports = self.worker.listen(server.ServerFactory(), 0, '127.0.0.1')
+
+        for port in ports:
+            self.addCleanup(port.stopListening)
+
+        self.assertTrue(os.path.exists(
+            self.worker.relay.getAddress('worker-0')))
+
+    def test_handoff(self):
+        w = worker.Worker('worker-0', self.path, nodes=['worker-0', 'worker-1'])
+        factory = server.ServerFactory()
+
+        ports = w.listen(factory, 0, '127.0.0.1')
+
+        for port in ports:
+            self.addCleanup(port.stopListening)
+
+        self.assertEqual(len(ports), 3)
+        self.assertTrue(factory.handoff is w.handoff)
+        self.assertTrue(os.path.exists(w.handoff.getAddress('worker-0')))
+
+    def test_cpu_count(self):
+        self.assertTrue(worker.getCPUCount() >= 1)
+
+
+
+class RunTestCase(unittest.TestCase):
+    """
+    Tests for L{worker.run}.
+    """
+
+    def test_random(self):
+        """
+        Each worker gets its own random numbers.
+        """
+        path = self.mktemp()
+        os.makedirs(path)
+
+        def runWorker(nodeId, path, *args):
+            f = open(os.path.join(path, nodeId), 'wb')
+            f.write(util.generateBytes(16))
+            f.close()
+
+        self.patch(worker, '_runWorker', runWorker)
+        self.patch(signal, 'signal', lambda *args: None)
+        self.patch(worker.sys, 'stderr', StringIO())
+
+        worker.run(None, 0, workers=2, path=path)
+
+        a, b = [open(os.path.join(path, nodeId), 'rb').read()
+            for nodeId in ('worker-0', 'worker-1')]
+
+        self.assertEqual(len(a), 16)
+        self.assertNotEqual(a, b)
@@ -395,3 +395,100 @@ class BytesIntervalTestCase(unittest.TestCase):
         self.assertEqual(self.decoder.bytes, 12)
         self.assertEqual(self.dispatcher.intervals, [12])
 
+
+
+class DecoderStateTestCase(unittest.TestCase):
+    """
+    Tests for L{codec.Decoder.getState} and L{codec.Decoder.setState}.
+    """
+
+    def setUp(self):
+        self.output = BufferedByteStream()
+        self.encoder = codec.Encoder(self.output)
+
+    def getStream(self, streamId):
+        return MockStream()
+
+    def buildDecoder(self):
+        return codec.Decoder(DispatchTester(self), MockStreamFactory(self))
+
+    def encode(self, data, timestamp):
+        self.encoder.send(data, 0x14, 0, timestamp)
+
+        while self.encoder.active:
+            self.encoder.next()
+
+        s = self.output.getvalue()
+        self.output.truncate()
+
+        return s
+
+    def test_resume(self):
+        a = self.buildDecoder()
+        a.setFrameSize(256)
+
+        first = self.encode('foo', 10)
+        second = self.encode('bar', 30)
+
+        # what an uninterrupted decoder makes of the stream
+        expected = self.buildDecoder()
+        expected.send(first + second)
+        expected.next()
+        expected.next()
+
+        a.send(first + second[:2])
+        a.next()
+
+        self.assertEqual(len(a.dispatcher.messages), 1)
+
+        state = a.getState()
+
+        self.assertEqual(state['buffer'], second[:2])
+        self.assertEqual(state['bytes'], len(first))
+
+        b = self.buildDecoder()
+        b.setState(state)
+
+        self.assertEqual(b.frameSize, 256)
+        self.assertEqual(b.bytes, len(first))
+
+        b.send(second[2:])
+        b.next()
+
+        self.assertEqual(len(b.dispatcher.messages), 1)
+
+        self.assertEqual(b.dispatcher.messages[0][1:],
+            expected.dispatcher.messages[1][1:])
+        self.assertEqual(b.bytes, expected.bytes)
+
+    def test_resume_mid_message(self):
+        """
+        The message is split over two frames, the first frame is decoded
+        before the snapshot.
+        """
+        a = self.buildDecoder()
+
+        data = self.encode('x' * 200, 0)
+
+        a.send(data)
+        a.next()
+
+        self.assertEqual(a.dispatcher.messages, [])
+
+        b = self.buildDecoder()
+        b.setState(a.getState())
+
+        b.next()
+
+        self.assertEqual(len(b.dispatcher.messages), 1)
+        self.assertEqual(b.dispatcher.messages[0][3], 'x' * 200)
+
+    def test_mid_frame(self):
+        a = self.buildDecoder()
+
+        a.send(self.encode('foo' * 100, 0)[:20])
+        self.assertRaises(StopIteration, a.next)
+
+        a._currentChannel = a.getChannel(3)
+
+        self.assertRaises(codec.DecodeError, a.getState)
@@ -188,6 +188,18 @@ class WritingTestCase(BaseTestCase):
         self.assertEqual(self.output.read(50), 'b' * 50)
         self.assertTrue(self.output.at_eof())
 
+    def test_interleave_order(self):
+        """
+        Frames are interleaved in channel id order, whatever order the
+        channels were acquired in.
+        """
+        channels = [self.encoder.acquireChannel() for i in xrange(5)]
+
+        for channel in reversed(channels):
+            self.encoder.activeChannels[channel] = channel.channelId
+
+        self.assertEqual(self.encoder.getActiveChannels(), channels)
+
     def test_reappropriate_channel(self):
         self.encoder.send('a' * 2, 8, 5, 0)
 
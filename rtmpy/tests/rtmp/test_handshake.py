@@ -19,7 +19,10 @@ Tests for L{rtmpy.protocol.handshake}.
 
 import unittest
 
+from twisted.internet import task
+
 from rtmpy.protocol import handshake
+from rtmpy.protocol.rtmp import handshake as rtmp_handshake
 from rtmpy.util import BufferedByteStream
 
 
@@ -258,13 +261,13 @@ class ServerStartTestCase(ServerNegotiatorTestCase):
         self.version = 5678
 
         self.negotiator.start(self.uptime, self.version)
-        self.buffer.seek(0)
 
-        self.assertEqual(self.buffer.remaining(), 1536)
+        # nothing is written until the client syn is received
+        self.assertEqual(self.buffer.getvalue(), '')
 
-        self.assertEqual(self.buffer.read_ulong(), self.uptime)
-        self.assertEqual(self.buffer.read_ulong(), self.version)
-        self.assertEqual(self.buffer.read(), 's' * (1536 - 8))
+        self.assertEqual(self.negotiator.my_syn.uptime, self.uptime)
+        self.assertEqual(self.negotiator.my_syn.version, self.version)
+        self.assertEqual(self.negotiator.my_syn.payload, 's' * (1536 - 8))
 
 
 class ServerSynTestCase(ServerNegotiatorTestCase):
@@ -284,10 +287,17 @@ class ServerSynTestCase(ServerNegotiatorTestCase):
 
         self.receive_client_syn()
 
-        self.assertEqual(len(self.buffer), 1536)
+        # version + syn + ack
+        self.assertEqual(len(self.buffer), 1 + 1536 * 2)
 
         self.buffer.seek(0)
 
+        self.assertEqual(self.buffer.read_uchar(), 3)
+
+        self.assertEqual(self.buffer.read_ulong(), self.uptime)
+        self.assertEqual(self.buffer.read_ulong(), self.version)
+        self.assertEqual(self.buffer.read(1536 - 8), 's' * (1536 - 8))
+
         self.assertEqual(
             self.buffer.read_ulong(), self.negotiator.peer_syn.uptime)
         self.assertEqual(
@@ -296,6 +306,15 @@ class ServerSynTestCase(ServerNegotiatorTestCase):
         self.assertEqual(self.buffer.read(), self.negotiator.my_ack.payload)
         self.assertFalse(self.succeeded)
 
+    def test_single_write(self):
+        writes = []
+        self.negotiator.transport = type('Transport', (object,), {
+            'write': lambda _, data: writes.append(data)})()
+
+        self.receive_client_syn()
+
+        self.assertEqual([len(x) for x in writes], [1 + 1536 * 2])
+
 
 class ServerClientAckTestCase(ServerNegotiatorTestCase):
     """
@@ -357,3 +376,251 @@ class ServerClientAckTestCase(ServerNegotiatorTestCase):
 
         self.negotiator.dataReceived(payload)
         self.assertTrue(self.succeeded)
+
+
+
+class PayloadPoolTestCase(unittest.TestCase):
+    """
+    Tests for L{handshake.PayloadPool}
+    """
+
+    def setUp(self):
+        self.pool = handshake.PayloadPool(4)
+
+    def test_empty(self):
+        self.assertEqual(len(self.pool), 0)
+
+        payload = self.pool.get()
+
+        self.assertEqual(len(payload), 1536 - 8)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_refill(self):
+        self.assertEqual(self.pool.refill(), 4)
+        self.assertEqual(len(self.pool), 4)
+
+        payloads = list(self.pool.payloads)
+
+        for p in payloads:
+            self.assertEqual(len(p), 1536 - 8)
+
+        self.assertEqual(self.pool.get(), payloads[0])
+        self.assertEqual(len(self.pool), 3)
+
+        self.assertEqual(self.pool.refill(), 1)
+        self.assertEqual(self.pool.refill(), 0)
+        self.assertEqual(len(self.pool), 4)
+
+    def test_refilling(self):
+        """
+        There is one refill loop, however many users start it.
+        """
+        clock = task.Clock()
+
+        self.pool.startRefilling(1, clock)
+        self.pool.startRefilling(1, clock)
+
+        self.assertEqual(len(self.pool), 4)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        self.pool.get()
+        clock.advance(1)
+        self.assertEqual(len(self.pool), 4)
+
+        self.pool.stopRefilling()
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        self.pool.stopRefilling()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+        # unmatched calls are ignored
+        self.pool.stopRefilling()
+        self.assertEqual(self.pool.refillers, 0)
+
+    def test_negotiator(self):
+        """
+        L{handshake.ServerNegotiator} draws its payloads from the pool.
+        """
+        self.pool.refill()
+        payloads = list(self.pool.payloads)
+
+        observer = HandshakeObserver(self)
+        negotiator = handshake.ServerNegotiator(observer, observer.buffer)
+        negotiator.payloadPool = self.pool
+
+        negotiator.start(0, 0)
+        negotiator.dataReceived('\x00' * 1536)
+
+        self.assertEqual(negotiator.my_syn.payload, payloads[0])
+        self.assertEqual(len(self.pool), 3)
+
+
+class ServerEchoAckTestCase(unittest.TestCase):
+    """
+    The ack sent by L{handshake.ServerNegotiator} echoes the peer syn.
+    """
+
+    def test_echo(self):
+        observer = HandshakeObserver(self)
+        negotiator = handshake.ServerNegotiator(observer, observer.buffer)
+
+        negotiator.start(0, 0)
+        negotiator.dataReceived('\x00\x00\x00\x01' + '\x00' * 4 +
+            'c' * (1536 - 8))
+
+        self.assertEqual(negotiator.my_ack.uptime, 1)
+        self.assertEqual(negotiator.my_ack.payload, 'c' * (1536 - 8))
+
+    def test_client(self):
+        """
+        A L{handshake.ClientNegotiator} can handshake with the server.
+        """
+        class Client(handshake.ClientNegotiator):
+            def buildSynPayload(self, packet):
+                packet.payload = 'c' * (1536 - 8)
+
+            def buildAckPayload(self, packet):
+                packet.payload = self.peer_syn.payload
+
+        client_observer = HandshakeObserver(self)
+        client = Client(client_observer, client_observer.buffer)
+
+        server_observer = HandshakeObserver(self)
+        server = handshake.ServerNegotiator(server_observer,
+            server_observer.buffer)
+
+        client.start(0, 0)
+        server.start(0, 0)
+
+        server.dataReceived(client_observer.buffer.getvalue())
+        client_observer.buffer.truncate()
+
+        # strip the version byte
+        client.dataReceived(server_observer.buffer.getvalue()[1:])
+        self.assertTrue(self.succeeded)
+
+        self.succeeded = False
+        server.dataReceived(client_observer.buffer.getvalue())
+
+        self.assertTrue(self.succeeded)
+
+
+class DigestHandshakeTestCase(unittest.TestCase):
+    """
+    Tests for the digest handshake in L{rtmp_handshake}.
+    """
+
+    def setUp(self):
+        self.client_observer = HandshakeObserver(self)
+        self.client = rtmp_handshake.ClientNegotiator(self.client_observer,
+            self.client_observer.buffer)
+
+        self.server_observer = HandshakeObserver(self)
+        self.server = rtmp_handshake.ServerNegotiator(self.server_observer,
+            self.server_observer.buffer)
+
+        self.client.start(0, 0)
+        self.server.start(0, 0)
+
+    def test_implementation(self):
+        from rtmpy.protocol import version
+
+        imp = handshake.get_implementation(version.RTMP)
+
+        self.assertTrue(
+            imp.ServerNegotiator is rtmp_handshake.ServerNegotiator)
+
+    def test_client_syn(self):
+        syn = self.client.my_syn
+
+        self.assertEqual(syn.version,
+            rtmp_handshake.ClientNegotiator.clientVersion)
+        self.assertEqual(
+            rtmp_handshake.find_digest(syn, rtmp_handshake._FP_SYN),
+            (0, self.client.digest))
+
+    def test_handshake(self):
+        self.server.dataReceived(self.client_observer.buffer.getvalue())
+
+        self.assertEqual(self.server.peer_digest, self.client.digest)
+        self.assertEqual(self.server.my_syn.version,
+            rtmp_handshake.ServerNegotiator.serverVersion)
+
+        self.client_observer.buffer.truncate()
+        self.client.dataReceived(self.server_observer.buffer.getvalue()[1:])
+
+        self.assertTrue(self.succeeded)
+        self.assertEqual(self.client.peer_digest, self.server.digest)
+
+        self.succeeded = False
+        self.server.dataReceived(self.client_observer.buffer.getvalue())
+
+        self.assertTrue(self.succeeded)
+
+    def test_scheme(self):
+        """
+        The server signs its syn with the scheme that the client used.
+        """
+        syn = self.client.my_syn
+        syn.payload = rtmp_handshake._generate_payload()
+
+        digest = rtmp_handshake.sign_syn(syn, rtmp_handshake._FP_SYN, 1)
+
+        buf = BufferedByteStream()
+        syn.encode(buf)
+
+        self.server.dataReceived(buf.getvalue())
+
+        self.assertEqual(self.server.peer_digest, digest)
+        self.assertEqual(rtmp_handshake.find_digest(self.server.my_syn,
+            rtmp_handshake._FMS_SYN), (1, self.server.digest))
+
+    def test_bad_ack_signature(self):
+        self.server.dataReceived(self.client_observer.buffer.getvalue())
+
+        self.assertRaises(handshake.VerificationError,
+            self.server.dataReceived, '\x00' * 1536)
+
+    def test_echoed_ack(self):
+        """
+        A client that echoes the server syn is accepted.
+        """
+        self.server.dataReceived(self.client_observer.buffer.getvalue())
+        self.server.dataReceived(
+            self.server_observer.buffer.getvalue()[1:1537])
+
+        self.assertTrue(self.succeeded)
+
+    def test_invalid_digest(self):
+        """
+        A client syn with a version but no valid digest falls back to the
+        plain handshake.
+        """
+        self.server.dataReceived('\x00\x00\x00\x00\x01\x02\x03\x04' +
+            '\x00' * 1528)
+
+        self.assertEqual(self.server.peer_digest, None)
+        self.assertEqual(self.server.my_ack.payload, '\x00' * 1528)
+
+    def test_plain_server(self):
+        """
+        The client falls back to the plain handshake if the server does not
+        use digests.
+        """
+        server = handshake.ServerNegotiator(self.server_observer,
+            self.server_observer.buffer)
+        server.start(0, 0)
+
+        server.dataReceived(self.client_observer.buffer.getvalue())
+
+        self.client_observer.buffer.truncate()
+        self.client.dataReceived(self.server_observer.buffer.getvalue()[1:])
+
+        self.assertTrue(self.succeeded)
+        self.assertEqual(self.client.peer_digest, None)
+
+        # the ack echoes the server syn
+        self.succeeded = False
+        server.dataReceived(self.client_observer.buffer.getvalue())
+
+        self.assertTrue(self.succeeded)
@@ -329,6 +329,10 @@ class BasicResponseTestCase(ProtocolTestCase):
         msg, stream, = self.messages[0]
 
         self.assertIdentical(stream, self.protocol)
+        self.assertIsInstance(msg, message.EncodedMessage)
+
+        msg = msg.getMessage()
+
         self.assertIsInstance(msg, message.BytesRead)
         self.assertEqual(msg.bytes, 16)
 
@@ -705,3 +709,82 @@ class InvokingTestCase(ProtocolTestCase):
         self.assertIsInstance(d, defer.Deferred)
 
         return wait_ok
+
+
+class SendRawTestCase(ProtocolTestCase):
+    """
+    Tests for L{rtmp.BaseStreamer.sendRaw}
+    """
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+
+        self.sent = []
+        self.stream = self.protocol.controlStream
+
+        def send(*args):
+            self.sent.append(args)
+
+        self.patch(self.protocol.encoder, 'send', send)
+
+    def test_raw(self):
+        self.protocol.sendRaw(message.VIDEO_DATA, 'foo', self.stream)
+
+        self.assertEqual(self.sent, [('foo', message.VIDEO_DATA, 0, 0)])
+
+    def test_streaming_message(self):
+        """
+        The data of streaming messages is handed to the encoder as is.
+        """
+        data = 'x' * 1000
+
+        self.protocol.sendMessage(message.AudioData(data), self.stream)
+
+        (payload, datatype, _, _), = self.sent
+
+        self.assertTrue(payload is data)
+        self.assertEqual(datatype, message.AUDIO_DATA)
+
+    def test_no_data(self):
+        self.assertRaises(message.EncodeError, self.protocol.sendMessage,
+            message.VideoData(), self.stream)
+
+        self.assertEqual(self.sent, [])
+
+    def test_encoded(self):
+        self.protocol.sendMessage(message.BytesRead(5), self.stream)
+
+        self.assertEqual(self.sent,
+            [('\x00\x00\x00\x05', message.BYTES_READ, 0, 0)])
+
+
+class CallBatchingTestCase(ProtocolTestCase):
+    """
+    Calls made in the same reactor turn are written to the transport
+    together.
+    """
+
+    def setUp(self):
+        ProtocolTestCase.setUp(self)
+
+        self.connect()
+        self.protocol.handshakeSuccess('')
+
+        self.writes = []
+        self.patch(self.protocol, 'startEncoding', lambda: None)
+        self.patch(self.transport, 'write', self.writes.append)
+
+    def test_call_many(self):
+        stream = self.protocol.buildStream(1)
+
+        stream.callMany([('foo', (1,)), ('bar', (2,)), ('baz', (3,))])
+
+        self.assertEqual(self.writes, [])
+
+        self.protocol.encoder.next()
+
+        self.assertEqual(len(self.writes), 1)
+        self.assertFalse(self.protocol.encoder.active)
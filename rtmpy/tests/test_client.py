@@ -0,0 +1,338 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.client}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from rtmpy import client, server, exc
+
+
+
+def waitFor(predicate, interval=0.01):
+    """
+    Returns a L{defer.Deferred} that fires once C{predicate} returns C{True}.
+    """
+    if predicate():
+        return defer.succeed(None)
+
+    d = task.deferLater(reactor, interval, lambda: None)
+
+    return d.addCallback(lambda _: waitFor(predicate, interval))
+
+
+
+class RecordingSubscriber(object):
+    """
+    Records the data played to it.
+    """
+
+    def __init__(self):
+        self.video = []
+        self.audio = []
+        self.meta = []
+        self.unpublished = False
+
+    def videoDataReceived(self, data, timestamp):
+        self.video.append((data, timestamp))
+
+    def audioDataReceived(self, data, timestamp):
+        self.audio.append((data, timestamp))
+
+    def onMetaData(self, data):
+        self.meta.append(data)
+
+    def unpublish(self):
+        self.unpublished = True
+
+
+
+class BaseClientTestCase(unittest.TestCase):
+    """
+    Runs a local L{server.ServerFactory} for the client to connect to.
+    """
+
+    def setUp(self):
+        self.app = server.Application()
+
+        self.factory = server.ServerFactory()
+        self.factory.applications['live'] = self.app
+
+        self.port = reactor.listenTCP(0, self.factory, interface='127.0.0.1')
+        self.url = 'rtmp://127.0.0.1:%d/live' % (self.port.getHost().port,)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def connect(self, url=None):
+        d = client.connect(url or self.url)
+
+        def cb(nc):
+            self.addCleanup(nc.protocol.transport.loseConnection)
+
+            return nc
+
+        return d.addCallback(cb)
+
+
+
+class ConnectTestCase(BaseClientTestCase):
+    """
+    Tests for connecting to an application.
+    """
+
+    def test_url(self):
+        f = client.ClientFactory('rtmp://example.com/live')
+
+        self.assertEqual((f.host, f.port), ('example.com', 1935))
+        self.assertEqual(f.params['app'], 'live')
+        self.assertEqual(f.params['tcUrl'], 'rtmp://example.com/live')
+
+        f = client.ClientFactory('rtmp://example.com:1936/live/')
+
+        self.assertEqual((f.host, f.port), ('example.com', 1936))
+        self.assertEqual(f.params['app'], 'live')
+
+        self.assertRaises(ValueError, client.ClientFactory,
+            'http://example.com/live')
+
+    def test_connect(self):
+        d = self.connect()
+
+        def cb(nc):
+            self.assertTrue(nc.connected)
+            self.assertEqual(client.getStatusCode(nc.info),
+                'NetConnection.Connect.Success')
+            self.assertEqual(len(self.app.clients), 1)
+
+        return d.addCallback(cb)
+
+    def test_rejected(self):
+        self.app.onConnect = lambda client, *args: False
+
+        d = self.connect()
+
+        return self.assertFailure(d, exc.ConnectRejected)
+
+    def test_invalid_application(self):
+        d = self.connect(self.url + 'foo')
+
+        return self.assertFailure(d, exc.InvalidApplication)
+
+    def test_refused(self):
+        d = self.port.stopListening()
+
+        d.addCallback(lambda _: self.connect())
+
+        return self.assertFailure(d, Exception)
+
+    def test_open_stream(self):
+        d = self.connect()
+
+        d.addCallback(lambda nc: nc.openStream())
+
+        def cb(stream):
+            self.assertEqual(stream.streamId, 1)
+            self.assertIdentical(stream.nc.getStream(1), stream)
+
+        return d.addCallback(cb)
+
+
+
+class PlayTestCase(BaseClientTestCase):
+    """
+    Tests for playing a stream.
+    """
+
+    def setUp(self):
+        BaseClientTestCase.setUp(self)
+
+        self.publisher = self.app.streams['foo'] = server.StreamPublisher(
+            None, None)
+        self.subscriber = RecordingSubscriber()
+
+    def play(self, name='foo'):
+        d = self.connect()
+
+        d.addCallback(lambda nc: nc.openStream())
+        d.addCallback(lambda stream: stream.play(name, self.subscriber))
+
+        return d
+
+    def test_play(self):
+        d = self.play()
+
+        def cb(stream):
+            self.assertEqual(stream.state, 'playing')
+            self.assertEqual(len(self.publisher.subscribers), 1)
+
+            self.publisher.onMetaData({'width': 320})
+            self.publisher.videoDataReceived('video', 0)
+            self.publisher.audioDataReceived('audio', 10)
+
+            return waitFor(lambda: self.subscriber.audio)
+
+        def check(result):
+            self.assertEqual(self.subscriber.meta, [{'width': 320}])
+            self.assertEqual(self.subscriber.video, [('video', 0)])
+            self.assertEqual(self.subscriber.audio, [('audio', 10)])
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_close(self):
+        """
+        Closing the stream unsubscribes it on the server.
+        """
+        d = self.play()
+
+        def cb(stream):
+            stream.close()
+
+            self.assertEqual(stream.state, None)
+            self.assertTrue(self.subscriber.unpublished)
+
+            return waitFor(lambda: not self.publisher.subscribers)
+
+        return d.addCallback(cb)
+
+    def test_unpublish(self):
+        d = self.play()
+
+        def cb(stream):
+            self.publisher.unpublish()
+
+            return waitFor(lambda: self.subscriber.unpublished)
+
+        return d.addCallback(cb)
+
+    def test_connection_lost(self):
+        d = self.play()
+
+        def cb(stream):
+            stream.nc.protocol.transport.loseConnection()
+
+            return waitFor(lambda: self.subscriber.unpublished)
+
+        def check(result):
+            return waitFor(lambda: not self.publisher.subscribers)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+
+
+class PublishTestCase(BaseClientTestCase):
+    """
+    Tests for publishing a stream.
+    """
+
+    def publish(self, name='foo'):
+        d = self.connect()
+
+        d.addCallback(lambda nc: nc.openStream())
+        d.addCallback(lambda stream: stream.publish(name))
+
+        return d
+
+    def test_publish(self):
+        subscriber = RecordingSubscriber()
+
+        d = self.publish()
+
+        def cb(stream):
+            self.assertEqual(stream.state, 'publishing')
+
+            publisher = self.app.streams['foo']
+            publisher.addSubscriber(subscriber)
+
+            stream.sendMetaData({'width': 320})
+            stream.sendVideo('video', 0)
+            stream.sendAudio('audio', 10)
+
+            return waitFor(lambda: subscriber.audio)
+
+        def check(result):
+            self.assertEqual(subscriber.meta, [{'width': 320}])
+            self.assertEqual(subscriber.video, [('video', 0)])
+            self.assertEqual(subscriber.audio, [('audio', 10)])
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_bad_name(self):
+        self.app.streams['foo'] = server.StreamPublisher(None, None)
+        self.app.streams['foo'].client = server.Client(None)
+        self.app.streams['foo'].client.id = 'other'
+
+        d = self.publish()
+
+        self.assertFailure(d, exc.CallFailed)
+
+        def cb(result):
+            self.flushLoggedErrors(exc.BadNameError)
+
+        return d.addCallback(cb)
+
+    def test_close(self):
+        d = self.publish()
+
+        def cb(stream):
+            stream.close()
+
+            self.assertEqual(stream.state, 'closing')
+
+            return waitFor(lambda: stream.state is None)
+
+        def check(result):
+            self.assertFalse('foo' in self.app.streams)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+
+
+class MediaCounterTestCase(unittest.TestCase):
+    """
+    Tests for L{client.MediaCounter}.
+    """
+
+    def test_count(self):
+        clock = task.Clock()
+        counter = client.MediaCounter(clock)
+
+        clock.advance(5)
+
+        counter.videoDataReceived('video', 0)
+        counter.audioDataReceived('audio!', 10)
+
+        self.assertEqual(counter.bytes, 11)
+        self.assertEqual(counter.packets, 2)
+        self.assertEqual(counter.firstPacket, 5)
+
+        counter.unpublish()
+
+        self.assertTrue(counter.unpublished)
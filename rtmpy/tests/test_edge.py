@@ -0,0 +1,253 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.edge}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from rtmpy import server, edge
+from rtmpy.tests.test_client import RecordingSubscriber, waitFor
+
+
+
+class FakeTransport(object):
+    disconnecting = False
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+
+class FakeNetConnection(object):
+    def __init__(self):
+        self.protocol = self
+        self.transport = FakeTransport()
+
+
+
+class OriginPublisherTestCase(unittest.TestCase):
+    """
+    Tests for L{edge.OriginPublisher}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.publisher = edge.OriginPublisher('foo', 10, self.clock)
+        self.publisher.nc = self.nc = FakeNetConnection()
+
+    def test_grace_period(self):
+        subscriber = RecordingSubscriber()
+
+        self.publisher.checkSubscribers()
+        self.publisher.addSubscriber(subscriber)
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.publisher.removeSubscriber(subscriber)
+        self.clock.advance(9)
+
+        self.assertFalse(self.nc.transport.disconnecting)
+
+        # someone turns up in time
+        self.publisher.addSubscriber(subscriber)
+        self.clock.advance(10)
+
+        self.assertFalse(self.nc.transport.disconnecting)
+
+        self.publisher.removeSubscriber(subscriber)
+        self.clock.advance(10)
+
+        self.assertTrue(self.nc.transport.disconnecting)
+
+    def test_unpublish(self):
+        subscriber = RecordingSubscriber()
+
+        self.publisher.addSubscriber(subscriber)
+        self.publisher.unpublish()
+
+        self.assertTrue(subscriber.unpublished)
+        self.assertTrue(self.nc.transport.disconnecting)
+        self.assertTrue(self.publisher.finished.called)
+
+        self.publisher.checkSubscribers()
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class EdgeTestCase(unittest.TestCase):
+    """
+    Plays streams from a local origin L{server.ServerFactory}.
+    """
+
+    def setUp(self):
+        self.originApp = server.Application()
+
+        factory = server.ServerFactory()
+        factory.applications['live'] = self.originApp
+
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+        self.origin = edge.Origin('rtmp://127.0.0.1:%d/live' % (
+            self.port.getHost().port,), gracePeriod=5)
+        self.origin.clock = self.clock = task.Clock()
+
+        self.app = server.Application()
+        self.app.origin = self.origin
+
+        self.source = self.originApp.streams['foo'] = server.StreamPublisher(
+            None, None)
+
+    def tearDown(self):
+        for publisher in self.app._relayedStreams.values():
+            publisher.stop()
+
+        return self.port.stopListening()
+
+    def whenPublished(self, name='foo'):
+        d = defer.Deferred()
+
+        self.app.whenPublished(name, d.callback)
+
+        return d
+
+    def test_shared(self):
+        """
+        The subscribers of a stream share one origin connection.
+        """
+        d = defer.gatherResults([self.whenPublished(), self.whenPublished()])
+
+        def cb(publishers):
+            a, b = publishers
+
+            self.assertIdentical(a, b)
+            self.assertIsInstance(a, edge.OriginPublisher)
+            self.assertIdentical(self.app._relayedStreams['foo'], a)
+
+            self.assertEqual(len(self.originApp.clients), 1)
+            self.assertEqual(len(self.source.subscribers), 1)
+            self.assertEqual(self.origin.stats['fetched'], 1)
+
+        return d.addCallback(cb)
+
+    def test_republish(self):
+        subscriber = RecordingSubscriber()
+
+        d = self.whenPublished()
+
+        def cb(publisher):
+            publisher.addSubscriber(subscriber)
+
+            self.source.onMetaData({'width': 320})
+            self.source.videoDataReceived('video', 0)
+            self.source.audioDataReceived('audio', 10)
+
+            return waitFor(lambda: subscriber.audio)
+
+        def check(result):
+            self.assertEqual(subscriber.meta, [{'width': 320}])
+            self.assertEqual(subscriber.video, [('video', 0)])
+            self.assertEqual(subscriber.audio, [('audio', 10)])
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_teardown(self):
+        """
+        The origin connection is closed once the last subscriber has been gone
+        for the grace period.
+        """
+        subscriber = RecordingSubscriber()
+
+        d = self.whenPublished()
+
+        def cb(publisher):
+            publisher.addSubscriber(subscriber)
+            publisher.removeSubscriber(subscriber)
+
+            self.clock.advance(5)
+
+            return publisher.finished
+
+        def check(publisher):
+            self.assertFalse('foo' in self.app._relayedStreams)
+
+            return waitFor(lambda: not self.source.subscribers)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_unsubscribed(self):
+        """
+        A stream that no one subscribes to is not played for longer than the
+        grace period.
+        """
+        d = self.origin.fetch('foo')
+
+        def cb(publisher):
+            self.clock.advance(5)
+
+            return publisher.finished
+
+        return d.addCallback(cb)
+
+    def test_origin_unpublish(self):
+        subscriber = RecordingSubscriber()
+
+        d = self.whenPublished()
+
+        def cb(publisher):
+            publisher.addSubscriber(subscriber)
+
+            self.source.unpublish()
+
+            return publisher.finished
+
+        def check(publisher):
+            self.assertTrue(subscriber.unpublished)
+            self.assertFalse('foo' in self.app._relayedStreams)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_origin_down(self):
+        """
+        The stream is waited for locally if the origin cannot be reached.
+        """
+        seen = []
+
+        d = self.port.stopListening()
+
+        d.addCallback(lambda _: self.app.whenPublished('foo', seen.append))
+        d.addCallback(lambda _: waitFor(
+            lambda: 'foo' in self.app._pendingPublishedCallbacks))
+
+        def check(result):
+            self.assertEqual(self.origin.stats['failed'], 1)
+            self.assertFalse('foo' in self.app._pendingRelays)
+            self.assertEqual(seen, [])
+
+        d.addCallback(check)
+
+        return d
@@ -0,0 +1,91 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.flv}.
+"""
+
+import StringIO
+
+from twisted.trial import unittest
+
+from rtmpy import flv
+
+
+
+class HeaderTestCase(unittest.TestCase):
+    """
+    Tests for the file header.
+    """
+
+    def test_encode(self):
+        self.assertEqual(flv.encodeHeader(),
+            'FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00')
+        self.assertEqual(flv.encodeHeader(video=False)[4], '\x04')
+
+    def test_decode(self):
+        self.assertEqual(flv.decodeHeader(flv.encodeHeader()), 13)
+        self.assertRaises(flv.FLVError, flv.decodeHeader, 'foo')
+
+
+
+class TagTestCase(unittest.TestCase):
+    """
+    Tests for encoding and reading tags.
+    """
+
+    def test_encode(self):
+        self.assertEqual(flv.encodeTag(flv.VIDEO, 'abc', 0x12345678),
+            '\x09\x00\x00\x03\x34\x56\x78\x12\x00\x00\x00abc\x00\x00\x00\x0e')
+
+    def test_decode(self):
+        header = flv.encodeTagHeader(flv.AUDIO, 300, 0x87654321)
+
+        self.assertEqual(flv.decodeTagHeader(header),
+            (flv.AUDIO, 300, 0x87654321))
+
+    def test_iter(self):
+        data = flv.encodeHeader() + flv.encodeTag(flv.VIDEO, 'abc', 0) + \
+            flv.encodeTag(flv.AUDIO, 'de', 10)
+
+        self.assertEqual(list(flv.iterTags(data)), [
+            (13, flv.VIDEO, 3, 0), (31, flv.AUDIO, 2, 10)])
+
+        # truncated tags are ignored
+        self.assertEqual(list(flv.iterTags(data[:-1])), [
+            (13, flv.VIDEO, 3, 0)])
+
+    def test_last_timestamp(self):
+        f = StringIO.StringIO(flv.encodeHeader())
+
+        self.assertEqual(flv.readLastTimestamp(f), None)
+
+        f.write(flv.encodeTag(flv.VIDEO, 'abc', 20))
+        f.write(flv.encodeTag(flv.AUDIO, 'de', 30))
+
+        self.assertEqual(flv.readLastTimestamp(f), 30)
+
+    def test_meta(self):
+        data = flv.encodeMetaData({'width': 320})
+
+        self.assertEqual(flv.decodeMetaData(data), {'width': 320})
+
+    def test_sequence_header(self):
+        self.assertTrue(flv.isSequenceHeader(flv.VIDEO, '\x17\x00abc'))
+        self.assertFalse(flv.isSequenceHeader(flv.VIDEO, '\x17\x01abc'))
+        self.assertFalse(flv.isSequenceHeader(flv.VIDEO, '\x12\x00abc'))
+        self.assertTrue(flv.isSequenceHeader(flv.AUDIO, '\xaf\x00abc'))
+        self.assertFalse(flv.isSequenceHeader(flv.AUDIO, '\xaf\x01abc'))
+        self.assertFalse(flv.isSequenceHeader(flv.AUDIO, '\xaf'))
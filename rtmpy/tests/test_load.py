@@ -0,0 +1,365 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.scripts.load}.
+"""
+
+import sys
+import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+
+from rtmpy import server
+from rtmpy.scripts import load
+from rtmpy.tests.test_client import RecordingSubscriber, waitFor
+
+
+
+class PercentilesTestCase(unittest.TestCase):
+    """
+    Tests for L{load.percentiles}.
+    """
+
+    def test_empty(self):
+        self.assertEqual(load.percentiles([]), {})
+
+    def test_values(self):
+        p = load.percentiles(range(100, 0, -1))
+
+        self.assertEqual(p, {'min': 1, 'p50': 50, 'p90': 90, 'p99': 99,
+            'max': 100})
+
+    def test_single(self):
+        p = load.percentiles([7])
+
+        self.assertEqual(p['p50'], 7)
+        self.assertEqual(p['p99'], 7)
+
+
+
+class SyntheticSourceTestCase(unittest.TestCase):
+    """
+    Tests for L{load.SyntheticSource}.
+    """
+
+    def test_tick(self):
+        clock = task.Clock()
+        source = load.SyntheticSource(bitrate=80, fps=10, gop=2, clock=clock)
+        sink = RecordingSubscriber()
+
+        source.sinks.append(sink)
+        source.start()
+        clock.pump([0.1, 0.1])
+        source.stop()
+
+        self.assertEqual([t for data, t in sink.video], [0, 100, 200])
+        self.assertEqual([len(data) for data, t in sink.video], [1000] * 3)
+        self.assertEqual([data[0] for data, t in sink.video],
+            ['\x17', '\x27', '\x17'])
+
+        # the packets are shared
+        self.assertIdentical(sink.video[0][0], sink.video[2][0])
+
+
+
+class SwarmTestCase(unittest.TestCase):
+    """
+    Runs a L{load.Swarm} against a local L{server.ServerFactory}.
+    """
+
+    def setUp(self):
+        self.app = server.Application()
+
+        factory = server.ServerFactory()
+        factory.registerApplication('live', self.app)
+
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.url = 'rtmp://127.0.0.1:%d/live' % (self.port.getHost().port,)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def buildSwarm(self, name, count, **kwargs):
+        swarm = load.Swarm(self.url, name, count, rate=1000, **kwargs)
+
+        self.addCleanup(swarm.stop)
+
+        return swarm
+
+    def test_play(self):
+        publisher = self.app.publishStream(server.Client(None), None, 'foo')
+        swarm = self.buildSwarm('foo', 5)
+
+        swarm.start()
+
+        d = waitFor(lambda: len(publisher.subscribers) == 5)
+
+        def cb(result):
+            swarm.sample()
+
+            publisher.videoDataReceived('\x17' + 'x' * 99, 0)
+
+            return waitFor(lambda: swarm.getStats()['joined'] == 5)
+
+        def check(result):
+            swarm.sample()
+
+            stats = swarm.getStats()
+
+            self.assertEqual(stats['connected'], 5)
+            self.assertEqual(stats['failed'], 0)
+            self.assertTrue(stats['connectRate'] > 0)
+            self.assertEqual(sorted(stats['joinTimes'].keys()),
+                ['max', 'min', 'p50', 'p90', 'p99'])
+            self.assertEqual(sum(s.bytes for s in swarm.sessions), 500)
+            self.assertTrue(stats['bitrate'] > 0)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_publish(self):
+        swarm = self.buildSwarm('foo%d', 3, publish=True, bitrate=80)
+        subscriber = RecordingSubscriber()
+
+        swarm.start()
+
+        d = waitFor(lambda: len(swarm.source.sinks) == 3)
+
+        def cb(result):
+            self.assertEqual(sorted(self.app.streams.keys()),
+                ['foo0', 'foo1', 'foo2'])
+
+            self.app.streams['foo1'].addSubscriber(subscriber)
+
+            return waitFor(lambda: subscriber.video)
+
+        def check(result):
+            self.assertEqual(swarm.getStats()['joined'], 3)
+            self.assertEqual(len(subscriber.video[0][0]), 400)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_publish_names(self):
+        """
+        Publishers get a stream name of their own.
+        """
+        swarm = self.buildSwarm('foo', 3, publish=True)
+
+        swarm.start()
+
+        d = waitFor(lambda: len(swarm.source.sinks) == 3)
+
+        def check(result):
+            self.assertEqual(sorted(self.app.streams.keys()),
+                ['foo0', 'foo1', 'foo2'])
+            self.assertEqual(swarm.getStats()['failed'], 0)
+
+        return d.addCallback(check)
+
+    def test_refused(self):
+        swarm = self.buildSwarm('foo', 2)
+
+        d = self.port.stopListening()
+
+        d.addCallback(lambda _: swarm.start())
+        d.addCallback(lambda _: waitFor(
+            lambda: swarm.getStats()['failed'] == 2))
+
+        def check(result):
+            stats = swarm.getStats()
+
+            self.assertEqual(stats['connected'], 0)
+            self.assertEqual(stats['connectRate'], None)
+            self.assertEqual(stats['joinTimes'], {})
+
+            self.flushLoggedErrors()
+
+        return d.addCallback(check)
+
+
+
+class FormatStatsTestCase(unittest.TestCase):
+    """
+    Tests for L{load.formatStats}.
+    """
+
+    def test_format(self):
+        lines = load.formatStats({
+            'connected': 10,
+            'failed': 1,
+            'connectRate': 100.0,
+            'joined': 10,
+            'joinTimes': {'min': 1.0, 'p50': 2.0, 'p90': 3.0, 'p99': 4.0,
+                'max': 5.0},
+            'bitrate': None,
+        })
+
+        self.assertEqual(lines, [
+            'connects: 10 ok, 1 failed, 100.0/sec',
+            'join time (ms, 10 joined): min 1.0 p50 2.0 p90 3.0 p99 4.0 '
+                'max 5.0',
+            'delivered: - kbit/s sustained',
+        ])
+
+
+
+class ListenLocalTestCase(unittest.TestCase):
+    """
+    Tests for L{load.listenLocal}.
+    """
+
+    def listen(self, name, publish=False):
+        ports = []
+
+        def listenTCP(*args, **kwargs):
+            port = reactor.listenTCP(*args, **kwargs)
+            ports.append(port)
+
+            return port
+
+        clock = task.Clock()
+        clock.listenTCP = listenTCP
+
+        url = load.listenLocal(name, 80, clock, publish)
+
+        self.addCleanup(lambda: ports[0].stopListening())
+
+        return url, ports[0].factory
+
+    def test_registered(self):
+        url, factory = self.listen('foo')
+
+        app = factory.applications['live']
+
+        self.assertIdentical(app.factory, factory)
+        self.assertEqual(app.name, 'live')
+        self.assertEqual(app.streams.keys(), ['foo'])
+        self.assertTrue(url.startswith('rtmp://127.0.0.1:'))
+
+    def test_publish(self):
+        """
+        No local source is published when the connections publish.
+        """
+        url, factory = self.listen('foo', publish=True)
+
+        self.assertEqual(factory.applications['live'].streams, {})
+
+
+
+class FileLimitTestCase(unittest.TestCase):
+    """
+    Tests for L{load.raiseFileLimit}.
+    """
+
+    def setUp(self):
+        try:
+            import resource
+        except ImportError:
+            raise unittest.SkipTest('resource is not available')
+
+        self.resource = resource
+        self.limits = []
+
+        self.patch(resource, 'setrlimit',
+            lambda which, limits: self.limits.append(limits))
+
+    def setLimits(self, soft, hard):
+        self.patch(self.resource, 'getrlimit', lambda which: (soft, hard))
+
+    def test_hard(self):
+        self.setLimits(1024, 4096)
+
+        self.assertEqual(load.raiseFileLimit(), 4096)
+        self.assertEqual(self.limits, [(4096, 4096)])
+
+    def test_unlimited(self):
+        """
+        An unlimited hard limit cannot be asked for, the soft limit is raised
+        to nr_open instead.
+        """
+        path = self.mktemp()
+
+        f = open(path, 'wb')
+        f.write('1048576\n')
+        f.close()
+
+        self.patch(load, 'NR_OPEN_PATH', path)
+        self.setLimits(1024, self.resource.RLIM_INFINITY)
+
+        self.assertEqual(load.raiseFileLimit(), 1048576)
+        self.assertEqual(self.limits,
+            [(1048576, self.resource.RLIM_INFINITY)])
+
+    def test_no_nr_open(self):
+        self.patch(load, 'NR_OPEN_PATH', self.mktemp())
+        self.setLimits(1024, self.resource.RLIM_INFINITY)
+
+        self.assertEqual(load.raiseFileLimit(), load.MAX_OPEN_FILES)
+
+    def test_refused(self):
+        """
+        A limit that cannot be raised is logged.
+        """
+        def setrlimit(which, limits):
+            raise ValueError('not allowed')
+
+        self.patch(self.resource, 'setrlimit', setrlimit)
+        self.setLimits(1024, 4096)
+
+        messages = []
+        self.patch(load.log, 'msg', messages.append)
+
+        self.assertEqual(load.raiseFileLimit(), 1024)
+        self.assertEqual(len(messages), 1)
+        self.assertIn('not allowed', messages[0])
+
+    def test_raised(self):
+        self.setLimits(4096, 4096)
+
+        self.assertEqual(load.raiseFileLimit(), 4096)
+        self.assertEqual(self.limits, [])
+
+
+
+class RunTestCase(unittest.TestCase):
+    """
+    Tests for the options of L{load.run}.
+    """
+
+    def parse(self, *args):
+        self.patch(sys, 'argv', ['rtmpy-load'] + list(args))
+        self.patch(sys, 'stderr', StringIO.StringIO())
+
+        e = self.assertRaises(SystemExit, load.run)
+
+        self.assertEqual(e.code, 2)
+
+        return sys.stderr.getvalue()
+
+    def test_local_numbered(self):
+        """
+        Nothing would be published for numbered stream names to play.
+        """
+        self.assertIn('--publish', self.parse('--local', '-s', 'foo%d'))
+
+    def test_local_url(self):
+        self.assertIn('No url expected', self.parse('--local', 'rtmp://foo'))
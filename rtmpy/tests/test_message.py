@@ -18,9 +18,12 @@ Tests for L{rtmpy.protocol.rtmp.message}.
 """
 
 import unittest
+
+import pyamf
 from pyamf.util import BufferedByteStream
 
 from rtmpy.protocol.rtmp import message
+from rtmpy import status
 
 
 class MockMessageListener(object):
@@ -33,30 +36,48 @@ class MockMessageListener(object):
     def onInvoke(self, *args, **kwargs):
         self.calls.append(('invoke', args, kwargs))
 
+        return 'invoke'
+
     def onNotify(self, *args, **kwargs):
         self.calls.append(('notify', args, kwargs))
 
+        return 'notify'
+
     def onFrameSize(self, *args, **kwargs):
         self.calls.append(('frame-size', args, kwargs))
 
+        return 'frame-size'
+
     def onBytesRead(self, *args, **kwargs):
         self.calls.append(('bytes-read', args, kwargs))
 
+        return 'bytes-read'
+
     def onControlMessage(self, *args, **kwargs):
         self.calls.append(('control', args, kwargs))
 
+        return 'control'
+
     def onDownstreamBandwidth(self, *args, **kwargs):
         self.calls.append(('bw-down', args, kwargs))
 
+        return 'bw-down'
+
     def onUpstreamBandwidth(self, *args, **kwargs):
         self.calls.append(('bw-up', args, kwargs))
 
+        return 'bw-up'
+
     def onAudioData(self, *args, **kwargs):
         self.calls.append(('audio', args, kwargs))
 
+        return 'audio'
+
     def onVideoData(self, *args, **kwargs):
         self.calls.append(('video', args, kwargs))
 
+        return 'video'
+
 
 class BaseTestCase(unittest.TestCase):
     """
@@ -291,6 +312,198 @@ class NotifyTestCase(BaseTestCase):
         self.assertEquals(self.listener.calls, [('notify', ('foo', [], 54), {})])
 
 
+class ArgumentsTestCase(BaseTestCase):
+    """
+    Tests for L{message.Arguments}
+    """
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+
+        message.Invoke('foo', 2, None, 'bar', {'spam': 'eggs'}).encode(
+            self.buffer)
+
+        self.encoded = self.buffer.getvalue()
+        self.buffer.seek(0)
+
+        self.message = message.Invoke()
+        self.message.decode(self.buffer)
+
+        self.args = self.message.argv
+
+    def test_lazy(self):
+        self.assertEqual(self.message.name, 'foo')
+        self.assertEqual(self.message.id, 2)
+        self.assertEqual(self.args.items, [])
+
+    def test_incremental(self):
+        self.assertEqual(self.args[0], None)
+        self.assertEqual(self.args.items, [None])
+
+        self.assertEqual(self.args[:2], [None, 'bar'])
+        self.assertEqual(self.args.items, [None, 'bar'])
+
+        self.assertEqual(self.args[-1], {'spam': 'eggs'})
+        self.assertEqual(len(self.args), 3)
+
+    def test_sequence(self):
+        self.assertTrue(self.args)
+        self.assertEqual(list(self.args), [None, 'bar', {'spam': 'eggs'}])
+        self.assertEqual(self.args[1:], ['bar', {'spam': 'eggs'}])
+        self.assertEqual(self.args, [None, 'bar', {'spam': 'eggs'}])
+        self.assertNotEqual(self.args, [None])
+
+    def test_empty(self):
+        self.buffer.truncate()
+        message.Notify('foo').encode(self.buffer)
+        self.buffer.seek(0)
+
+        m = message.Notify()
+        m.decode(self.buffer)
+
+        self.assertFalse(m.argv)
+        self.assertEqual(len(m.argv), 0)
+
+    def test_relay(self):
+        """
+        Untouched arguments are written out as is.
+        """
+        self.args.stream = BufferedByteStream(
+            self.encoded.replace('bar', 'baz'))
+
+        buf = BufferedByteStream()
+        self.message.encode(buf)
+
+        self.assertEqual(buf.getvalue(), self.encoded.replace('bar', 'baz'))
+
+    def test_relay_decoded(self):
+        """
+        Decoded arguments are re-encoded.
+        """
+        self.args[-1]['spam'] = 'hams'
+
+        buf = BufferedByteStream()
+        self.message.encode(buf)
+
+        self.assertEqual(buf.getvalue(), self.encoded.replace('eggs', 'hams'))
+
+    def test_relay_renamed(self):
+        self.message.id = 3
+
+        buf = BufferedByteStream()
+        self.message.encode(buf)
+
+        buf.seek(0)
+
+        m = message.Invoke()
+        m.decode(buf)
+
+        self.assertEqual(m.id, 3)
+        self.assertEqual(m.argv, [None, 'bar', {'spam': 'eggs'}])
+
+
+class CodecsTestCase(BaseTestCase):
+    """
+    Tests for L{message.Codecs}
+    """
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+
+        self.codecs = message.Codecs()
+
+    def test_encoder(self):
+        obj = {'foo': 'bar'}
+
+        message.Invoke('foo', 1, obj).encode(self.buffer)
+        expected = self.buffer.getvalue()
+
+        encoder = None
+
+        for i in range(2):
+            buf = BufferedByteStream()
+
+            message.Invoke('foo', 1, obj).encode(buf, self.codecs)
+
+            # the references from the previous message are gone
+            self.assertEqual(buf.getvalue(), expected)
+
+            if encoder is not None:
+                self.assertTrue(self.codecs.encoders[pyamf.AMF0] is encoder)
+
+            encoder = self.codecs.encoders[pyamf.AMF0]
+
+    def test_decoder(self):
+        message.Invoke('foo', 1, {'foo': 'bar'}).encode(self.buffer)
+        data = self.buffer.getvalue()
+
+        m1 = message.Invoke()
+        m1.decode(BufferedByteStream(data), self.codecs)
+
+        # untouched arguments do not hold on to the decoder
+        decoder = self.codecs.decoders[pyamf.AMF0]
+
+        self.assertEqual(m1.argv.decoder, None)
+
+        m2 = message.Invoke()
+        m2.decode(BufferedByteStream(data), self.codecs)
+
+        self.assertTrue(self.codecs.decoders[pyamf.AMF0] is decoder)
+
+        self.assertEqual(m2.argv, [{'foo': 'bar'}])
+        self.assertEqual(m1.argv, [{'foo': 'bar'}])
+
+        self.assertTrue(self.codecs.decoders[pyamf.AMF0] is decoder)
+        self.assertEqual(m1.argv.decoder, None)
+
+    def test_decoder_held(self):
+        """
+        The decoder is held while the arguments are partly decoded.
+        """
+        message.Invoke('foo', 1, 'bar', 'baz').encode(self.buffer)
+        self.buffer.seek(0)
+
+        m = message.Invoke()
+        m.decode(self.buffer, self.codecs)
+
+        self.assertEqual(m.argv[0], 'bar')
+        self.assertEqual(self.codecs.decoders, {})
+
+        self.assertEqual(m.argv[1], 'baz')
+        self.assertEqual(len(m.argv), 2)
+        self.assertTrue(pyamf.AMF0 in self.codecs.decoders)
+
+    def test_references(self):
+        """
+        Arguments that reference the values before them are decoded once the
+        decoder has been given back.
+        """
+        obj = {'spam': 'eggs'}
+
+        message.Invoke('foo', 1, obj, obj).encode(self.buffer)
+        self.buffer.seek(0)
+
+        m = message.Invoke()
+        m.decode(self.buffer, self.codecs)
+
+        # another message takes (and resets) the decoder
+        other = message.Notify()
+        other.decode(BufferedByteStream(self.buffer.getvalue()), self.codecs)
+        self.assertEqual(other.argv[0], 1)
+
+        self.assertEqual(m.argv, [obj, obj])
+        self.assertTrue(m.argv[0] is m.argv[1])
+
+    def test_no_arguments(self):
+        message.Notify('foo').encode(self.buffer)
+        self.buffer.seek(0)
+
+        m = message.Notify()
+        m.decode(self.buffer, self.codecs)
+
+        self.assertTrue(pyamf.AMF0 in self.codecs.decoders)
+
+
 class InvokeTestCase(BaseTestCase):
     """
     Tests for L{message.Invoke}
@@ -635,6 +848,11 @@ class VideoDataTestCase(BaseTestCase):
 
         self.assertEquals(self.listener.calls, [('video', ('foo', 54), {})])
 
+    def test_keyframe(self):
+        self.assertTrue(message.isKeyframe('\x17\x01'))
+        self.assertFalse(message.isKeyframe('\x27\x01'))
+        self.assertFalse(message.isKeyframe(''))
+
 
 class HelperTestCase(unittest.TestCase):
     def test_type_class(self):
@@ -643,3 +861,143 @@ class HelperTestCase(unittest.TestCase):
 
         self.assertFalse('foo' in message.TYPE_MAP.keys())
         self.assertRaises(message.UnknownType, message.classByType, 'foo')
+
+
+class EncodedMessageTestCase(BaseTestCase):
+    """
+    Tests for L{message.EncodedMessage} and L{message.pre_encode}
+    """
+
+    def test_pre_encode(self):
+        x = message.pre_encode(message.ControlMessage(0, 1))
+
+        self.assertEqual(message.typeByClass(x), -1)
+        self.assertEqual(x.__data_type__, message.CONTROL)
+
+        x.encode(self.buffer)
+        x.encode(self.buffer)
+
+        self.assertEqual(self.buffer.getvalue(),
+            '\x00\x00\x00\x00\x00\x01' * 2)
+
+    def test_get_message(self):
+        x = message.pre_encode(message.ControlMessage(0, 1)).getMessage()
+
+        self.assertIsInstance(x, message.ControlMessage)
+        self.assertEqual((x.type, x.value1), (0, 1))
+
+
+class InvokeTemplateTestCase(BaseTestCase):
+    """
+    Tests for L{message.InvokeTemplate}
+    """
+
+    def test_fill(self):
+        t = message.InvokeTemplate(message.Invoke('onStatus', 0, None,
+            status.status('NetStream.Play.Start', message.slot('description'),
+                clientid=message.slot('clientid'))))
+
+        self.assertEqual(t.slots, ['description', 'clientid'])
+
+        for description, clientid in [('foo', 1), (u'\u1234', None)]:
+            buf = BufferedByteStream()
+
+            message.Invoke('onStatus', 0, None, status.status(
+                'NetStream.Play.Start', description,
+                clientid=clientid)).encode(buf)
+
+            x = t.fill(description=description, clientid=clientid)
+
+            self.assertEqual(x.__data_type__, message.INVOKE)
+            self.assertEqual(x.body, buf.getvalue())
+
+    def test_complex_value(self):
+        t = message.InvokeTemplate(message.Notify('foo', message.slot('bar')))
+
+        self.assertRaises(message.EncodeError, t.fill, bar={})
+
+    def test_amf3(self):
+        self.assertRaises(message.EncodeError, message.InvokeTemplate,
+            message.FlexMessage('foo', 0))
+
+
+class DispatchTableTestCase(BaseTestCase):
+    """
+    The functions in L{message.DISPATCH_TABLE} must dispatch the same as the
+    message classes.
+    """
+
+    def assertDispatch(self, msg):
+        msg.encode(self.buffer)
+        datatype = message.typeByClass(msg)
+
+        expected = MockMessageListener()
+        result = message.dispatch_message(expected, datatype, 10,
+            self.buffer.getvalue())
+
+        # both return what the listener returns
+        self.assertEqual(result, expected.calls[0][0])
+        self.assertEqual(message.DISPATCH_TABLE[datatype](self.listener,
+            datatype, 10, self.buffer.getvalue(), None), result)
+
+        def normalise(calls):
+            # control messages are dispatched as instances
+            return [(name, tuple([getattr(a, '__dict__', a) for a in args]),
+                kwargs) for name, args, kwargs in calls]
+
+        self.assertEqual(normalise(self.listener.calls),
+            normalise(expected.calls))
+        self.assertEqual(len(self.listener.calls), 1)
+
+    def test_frame_size(self):
+        self.assertDispatch(message.FrameSize(1000))
+
+    def test_bytes_read(self):
+        self.assertDispatch(message.BytesRead(0xffffff))
+
+    def test_control(self):
+        self.assertDispatch(message.ControlMessage(0, 1))
+        self.listener.calls = []
+        self.buffer.truncate()
+
+        self.assertDispatch(message.ControlMessage(3, 1, -2))
+        self.listener.calls = []
+        self.buffer.truncate()
+
+        self.assertDispatch(message.ControlMessage(3, 1, 2, 3))
+
+    def test_bandwidth(self):
+        self.assertDispatch(message.DownstreamBandwidth(2500000))
+        self.listener.calls = []
+        self.buffer.truncate()
+
+        self.assertDispatch(message.UpstreamBandwidth(2500000, 2))
+
+    def test_streaming(self):
+        self.assertDispatch(message.AudioData('foo'))
+        self.listener.calls = []
+        self.buffer.truncate()
+
+        self.assertDispatch(message.VideoData('bar'))
+
+    def test_unknown(self):
+        self.assertRaises(message.UnknownType, message.dispatch_message,
+            self.listener, 0x7f, 0, '')
+
+    def test_short(self):
+        """
+        A body that is too short raises C{IOError}, like the message classes.
+        """
+        for cls, data in [(message.FrameSize, '\x00\x01'),
+                (message.BytesRead, '\x00\x01\x02'),
+                (message.ControlMessage, '\x00\x01\x02'),
+                (message.DownstreamBandwidth, ''),
+                (message.UpstreamBandwidth, '\x00\x00\x00\x01')]:
+            datatype = message.typeByClass(cls)
+
+            self.assertRaises(IOError, message.dispatch_message,
+                self.listener, datatype, 0, data)
+            self.assertRaises(IOError, message.DISPATCH_TABLE[datatype],
+                self.listener, datatype, 0, data, None)
+
+        self.assertEqual(self.listener.calls, [])
@@ -0,0 +1,142 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.scripts.parse_dump}.
+"""
+
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from pyamf.util import BufferedByteStream
+
+from rtmpy import message
+from rtmpy.scripts import parse_dump
+
+
+class BaseObserverTestCase(unittest.TestCase):
+    """
+    Feeds decoded messages through a L{parse_dump.StreamFactory} into the
+    observer under test.
+    """
+
+    observer_class = None
+
+    def setUp(self):
+        self.output = BufferedByteStream()
+        self.observer = self.observer_class(self.output)
+
+        self.factory = parse_dump.StreamFactory('client', self.observer)
+        self.factory.decoder = None
+
+    def dispatch(self, msg, streamId=1, timestamp=0):
+        buf = BufferedByteStream()
+        msg.encode(buf)
+
+        self.factory.dispatchMessage(self.factory.getStream(streamId),
+            message.typeByClass(msg), timestamp, buf.getvalue())
+
+
+class JSONObserverTestCase(BaseObserverTestCase):
+    """
+    Tests for L{parse_dump.JSONObserver}.
+    """
+
+    observer_class = parse_dump.JSONObserver
+
+    def test_video(self):
+        self.dispatch(message.VideoData('\x00' * 1000), timestamp=10)
+
+        lines = self.output.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+
+        d = json.loads(lines[0])
+
+        self.assertEqual(d['from'], 'client')
+        self.assertEqual(d['datatype'], message.VIDEO_DATA)
+        self.assertEqual(d['streamId'], 1)
+        self.assertEqual(d['timestamp'], 10)
+
+        self.assertEqual(d['messages'], [{
+            'type': 'video',
+            'length': 1000,
+            'timestamp': 10,
+            'sha1': 'c577f7a37657053275f3e3ecc06ec22e6b909366',
+        }])
+
+    def test_invoke(self):
+        self.dispatch(message.Invoke('foo', 2, None, 'bar'))
+        self.dispatch(message.Notify('spam', 'eggs'))
+
+        lines = self.output.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+
+        d = json.loads(lines[0])
+        self.assertEqual(d['messages'], [{
+            'type': 'invoke',
+            'name': 'foo',
+            'id': 2,
+            'args': [None, 'bar'],
+        }])
+
+        d = json.loads(lines[1])
+        self.assertEqual(d['messages'], [{
+            'type': 'notify',
+            'name': 'spam',
+            'args': ['eggs'],
+        }])
+
+
+class SummaryObserverTestCase(BaseObserverTestCase):
+    """
+    Tests for L{parse_dump.SummaryObserver}.
+    """
+
+    observer_class = parse_dump.SummaryObserver
+
+    def test_nothing_written(self):
+        self.dispatch(message.AudioData('\x00' * 10))
+
+        self.assertEqual(self.output.getvalue(), '')
+
+    def test_summary(self):
+        self.dispatch(message.AudioData('\x00' * 10))
+        self.dispatch(message.AudioData('\x00' * 16))
+        self.dispatch(message.AudioData('\x00' * 100))
+        self.dispatch(message.Notify('spam', 'eggs'))
+        self.dispatch(message.Notify('spam', 'eggs'))
+
+        summary = self.observer.getSummary()['client']
+
+        self.assertEqual(summary['audio'], {
+            'count': 3,
+            'bytes': 126,
+            'sizes': {16: 2, 128: 1},
+        })
+
+        self.assertEqual(summary['notify']['count'], 2)
+        self.assertEqual(summary['calls'], {'spam': 2})
+
+    def test_finish(self):
+        self.dispatch(message.AudioData('\x00' * 10))
+        self.observer.finish()
+
+        d = json.loads(self.output.getvalue())
+
+        self.assertEqual(d['client']['audio']['count'], 1)
@@ -0,0 +1,325 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.push}.
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+
+from rtmpy import server, push, util
+from rtmpy.tests.test_client import RecordingSubscriber, waitFor
+
+
+KEYFRAME = '\x17' + 'k' * 9
+INTERFRAME = '\x27' + 'i' * 9
+
+
+
+class FakeTransport(object):
+    producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+
+class RecordingStream(object):
+    """
+    Stands in for a publishing L{rtmpy.client.NetStream}.
+    """
+
+    def __init__(self):
+        self.nc = self
+        self.protocol = self
+        self.transport = FakeTransport()
+
+        self.video = []
+        self.audio = []
+
+    def sendVideo(self, data, timestamp):
+        self.video.append((data, timestamp))
+
+    def sendAudio(self, data, timestamp):
+        self.audio.append((data, timestamp))
+
+
+
+class QueueTestCase(unittest.TestCase):
+    """
+    Tests for the L{push.PushTarget} queue.
+    """
+
+    def setUp(self):
+        self.target = push.PushTarget('rtmp://localhost/live', 'foo',
+            reactor=task.Clock())
+        self.target.maxQueue = 35
+
+    def test_wait_for_keyframe(self):
+        """
+        Nothing is sent before the first keyframe.
+        """
+        self.target.videoDataReceived(INTERFRAME, 0)
+        self.target.audioDataReceived('audio', 0)
+        self.target.videoDataReceived(KEYFRAME, 10)
+        self.target.audioDataReceived('audio', 10)
+
+        self.assertEqual(list(self.target.queue), [
+            (9, KEYFRAME, 10), (8, 'audio', 10)])
+        self.assertEqual(self.target.stats['dropped'], 2)
+
+    def test_audio_only(self):
+        self.target.audioDataReceived('audio', 0)
+
+        self.assertEqual(list(self.target.queue), [(8, 'audio', 0)])
+
+    def test_send(self):
+        stream = RecordingStream()
+
+        self.target.videoDataReceived(KEYFRAME, 0)
+        self.target.publishing(stream)
+        self.target.videoDataReceived(INTERFRAME, 10)
+
+        self.assertIdentical(stream.transport.producer, self.target)
+        self.assertEqual(stream.video, [(KEYFRAME, 0), (INTERFRAME, 10)])
+        self.assertEqual(self.target.queued, 0)
+        self.assertEqual(self.target.stats['sent'], 2)
+
+    def test_paused(self):
+        stream = RecordingStream()
+
+        self.target.stream = stream
+        self.target.pauseProducing()
+
+        self.target.videoDataReceived(KEYFRAME, 0)
+
+        self.assertEqual(stream.video, [])
+        self.assertEqual(self.target.queued, 10)
+
+        self.target.resumeProducing()
+
+        self.assertEqual(stream.video, [(KEYFRAME, 0)])
+        self.assertEqual(self.target.queued, 0)
+
+    def test_overflow(self):
+        """
+        The queue is cut back to the first keyframe that fits.
+        """
+        for i in xrange(3):
+            self.target.videoDataReceived(KEYFRAME, i * 20)
+            self.target.videoDataReceived(INTERFRAME, i * 20 + 10)
+
+        self.assertEqual(list(self.target.queue), [
+            (9, KEYFRAME, 40), (9, INTERFRAME, 50)])
+        self.assertEqual(self.target.stats['dropped'], 4)
+        self.assertFalse(self.target.waitingForKeyframe)
+
+    def test_overflow_no_keyframe(self):
+        self.target.videoDataReceived(KEYFRAME, 0)
+
+        for i in xrange(4):
+            self.target.videoDataReceived(INTERFRAME, i)
+
+        self.assertEqual(list(self.target.queue), [])
+        self.assertTrue(self.target.waitingForKeyframe)
+
+        self.target.videoDataReceived(INTERFRAME, 5)
+        self.target.videoDataReceived(KEYFRAME, 6)
+
+        self.assertEqual(list(self.target.queue), [(9, KEYFRAME, 6)])
+        self.assertEqual(self.target.stats['dropped'], 6)
+
+
+
+class BaseServerTestCase(unittest.TestCase):
+    """
+    Runs a local downstream L{server.ServerFactory}.
+    """
+
+    def setUp(self):
+        self.app = server.Application()
+
+        factory = server.ServerFactory()
+        factory.applications['live'] = self.app
+
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.url = 'rtmp://127.0.0.1:%d/live' % (self.port.getHost().port,)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def buildTarget(self, name='foo'):
+        target = push.PushTarget(self.url, name)
+        target.clock = self.clock = task.Clock()
+
+        self.addCleanup(target.stop)
+
+        return target
+
+
+
+class PushTargetTestCase(BaseServerTestCase):
+    """
+    Tests for L{push.PushTarget}.
+    """
+
+    def test_push(self):
+        subscriber = RecordingSubscriber()
+        target = self.buildTarget()
+
+        target.onMetaData({'width': 320})
+        target.videoDataReceived(KEYFRAME, 0)
+        target.start()
+
+        d = waitFor(lambda: target.stream is not None)
+
+        def cb(result):
+            self.app.streams['foo'].addSubscriber(subscriber)
+
+            target.audioDataReceived('audio', 10)
+
+            return waitFor(lambda: subscriber.audio)
+
+        def check(result):
+            self.assertEqual(subscriber.meta, [{'width': 320}])
+            self.assertEqual(subscriber.audio, [('audio', 10)])
+            self.assertEqual(target.stats['connects'], 1)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+    def test_reconnect(self):
+        """
+        Lost connections are retried with an increasing delay.
+        """
+        target = self.buildTarget()
+
+        portNumber = self.port.getHost().port
+
+        target.start()
+
+        d = waitFor(lambda: target.stream is not None)
+
+        def cb(result):
+            d = self.port.stopListening()
+
+            target.stream.nc.protocol.transport.loseConnection()
+
+            d.addCallback(lambda _: waitFor(
+                lambda: target.retryTimer is not None))
+
+            return d
+
+        def lost(result):
+            self.assertEqual(target.stream, None)
+            self.assertEqual(target.retryTimer.getTime(), 1)
+
+            self.clock.advance(1)
+
+            return waitFor(lambda: target.retryTimer is not None)
+
+        def failed(result):
+            self.assertEqual(target.stats['failures'], 2)
+            self.assertEqual(target.retryTimer.getTime(), 3)
+
+            self.port = reactor.listenTCP(portNumber, self.port.factory,
+                interface='127.0.0.1')
+            self.clock.advance(2)
+
+            return waitFor(lambda: target.stream is not None)
+
+        def reconnected(result):
+            self.assertEqual(target.stats['connects'], 2)
+            self.assertEqual(target.retries, 0)
+
+        d.addCallback(cb)
+        d.addCallback(lost)
+        d.addCallback(failed)
+        d.addCallback(reconnected)
+
+        return d
+
+    def test_stop(self):
+        target = self.buildTarget()
+
+        target.start()
+
+        d = waitFor(lambda: 'foo' in self.app.streams)
+
+        def cb(result):
+            target.stop()
+
+            return waitFor(lambda: 'foo' not in self.app.streams)
+
+        def check(result):
+            self.assertEqual(target.retryTimer, None)
+            self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
+
+
+
+class ApplicationTestCase(BaseServerTestCase):
+    """
+    Tests for L{server.Application.push}.
+    """
+
+    def setUp(self):
+        BaseServerTestCase.setUp(self)
+
+        self.ingest = server.Application()
+        self.ingest.push = push.Pusher([self.url])
+
+        self.client = server.Client(None)
+        self.client.id = 'client'
+
+    def test_publish(self):
+        subscriber = RecordingSubscriber()
+        publisher = self.ingest.publishStream(self.client, None,
+            util.ParamedString('foo?key=x'))
+
+        [target] = publisher.pushTargets
+
+        self.assertEqual(target.name, u'foo')
+        self.assertTrue(target in publisher.subscribers)
+
+        d = waitFor(lambda: target.stream is not None)
+
+        def cb(result):
+            self.app.streams['foo'].addSubscriber(subscriber)
+
+            publisher.videoDataReceived(KEYFRAME, 0)
+
+            return waitFor(lambda: subscriber.video)
+
+        def check(result):
+            self.assertEqual(subscriber.video, [(KEYFRAME, 0)])
+
+            publisher.unpublish()
+
+            self.assertEqual(publisher.pushTargets, [])
+
+            return waitFor(lambda: 'foo' not in self.app.streams)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
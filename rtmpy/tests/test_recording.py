@@ -0,0 +1,389 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.recording}.
+"""
+
+import os
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from rtmpy import recording, flv, server
+from rtmpy.tests.util import importsReactor
+
+
+AVC_HEADER = '\x17\x00config'
+KEYFRAME = '\x17\x01' + 'k' * 8
+INTERFRAME = '\x27\x01' + 'i' * 8
+AUDIO = '\xaf\x01' + 'a' * 8
+
+
+
+def readTags(path):
+    """
+    Returns the C{(tagType, data, timestamp)} tags in the FLV file at C{path}.
+    """
+    data = open(path, 'rb').read()
+
+    return [(tagType, data[offset + 11:offset + 11 + size], timestamp)
+        for offset, tagType, size, timestamp in flv.iterTags(data)]
+
+
+
+class FLVFileTestCase(unittest.TestCase):
+    """
+    Tests for L{recording.FLVFile}.
+    """
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'foo.flv')
+
+    def test_write(self):
+        f = recording.FLVFile(self.path)
+
+        f.write([(flv.VIDEO, KEYFRAME, 1000), (flv.AUDIO, AUDIO, 1010)])
+        f.write([(flv.VIDEO, INTERFRAME, 1040)])
+        f.close()
+
+        self.assertEqual(readTags(self.path), [
+            (flv.VIDEO, KEYFRAME, 0), (flv.AUDIO, AUDIO, 10),
+            (flv.VIDEO, INTERFRAME, 40)])
+        self.assertEqual(f.size, os.path.getsize(self.path))
+
+    def test_record(self):
+        """
+        Recording replaces an existing file.
+        """
+        for i in xrange(2):
+            f = recording.FLVFile(self.path)
+            f.write([(flv.VIDEO, KEYFRAME, 0)])
+            f.close()
+
+        self.assertEqual(readTags(self.path), [(flv.VIDEO, KEYFRAME, 0)])
+
+    def test_append(self):
+        f = recording.FLVFile(self.path)
+        f.write([(flv.VIDEO, KEYFRAME, 0), (flv.VIDEO, INTERFRAME, 40)])
+        f.close()
+
+        f = recording.FLVFile(self.path, append=True)
+        f.write([(flv.VIDEO, KEYFRAME, 500)])
+        f.close()
+
+        self.assertEqual(readTags(self.path), [
+            (flv.VIDEO, KEYFRAME, 0), (flv.VIDEO, INTERFRAME, 40),
+            (flv.VIDEO, KEYFRAME, 41)])
+
+    def test_append_new(self):
+        f = recording.FLVFile(self.path, append=True)
+        f.write([(flv.VIDEO, KEYFRAME, 500)])
+        f.close()
+
+        self.assertEqual(readTags(self.path), [(flv.VIDEO, KEYFRAME, 0)])
+
+    def test_rotate_duration(self):
+        """
+        Segments are rotated at the first keyframe after C{maxDuration}, and
+        start with the meta data and sequence headers.
+        """
+        meta = flv.encodeMetaData({'width': 320})
+
+        f = recording.FLVFile(self.path, maxDuration=1)
+        f.write([(flv.SCRIPT, meta, 0), (flv.VIDEO, AVC_HEADER, 0),
+            (flv.VIDEO, KEYFRAME, 0), (flv.VIDEO, INTERFRAME, 1000),
+            (flv.VIDEO, KEYFRAME, 1200), (flv.VIDEO, INTERFRAME, 1240)])
+        f.close()
+
+        dirname = os.path.dirname(self.path)
+
+        self.assertEqual(sorted(os.listdir(dirname)),
+            ['foo-0.flv', 'foo-1.flv'])
+
+        self.assertEqual(readTags(os.path.join(dirname, 'foo-0.flv')), [
+            (flv.SCRIPT, meta, 0), (flv.VIDEO, AVC_HEADER, 0),
+            (flv.VIDEO, KEYFRAME, 0), (flv.VIDEO, INTERFRAME, 1000)])
+        self.assertEqual(readTags(os.path.join(dirname, 'foo-1.flv')), [
+            (flv.SCRIPT, meta, 0), (flv.VIDEO, AVC_HEADER, 0),
+            (flv.VIDEO, KEYFRAME, 0), (flv.VIDEO, INTERFRAME, 40)])
+
+    def test_rotate_size(self):
+        f = recording.FLVFile(self.path, maxSize=60)
+
+        for i in xrange(3):
+            f.write([(flv.AUDIO, AUDIO, i * 10)])
+
+        f.close()
+
+        dirname = os.path.dirname(self.path)
+
+        # 13 byte header and 25 byte tags
+        self.assertEqual(sorted(os.listdir(dirname)),
+            ['foo-0.flv', 'foo-1.flv'])
+        self.assertEqual(len(readTags(os.path.join(dirname, 'foo-0.flv'))), 2)
+
+        # appending continues the last segment
+        f = recording.FLVFile(self.path, append=True, maxSize=60)
+        f.write([(flv.AUDIO, AUDIO, 0)])
+        f.close()
+
+        self.assertEqual(readTags(os.path.join(dirname, 'foo-1.flv')), [
+            (flv.AUDIO, AUDIO, 0), (flv.AUDIO, AUDIO, 1)])
+
+
+
+class BlockingFile(object):
+    """
+    An L{recording.FLVFile} that waits for C{event} before each write.
+    """
+
+    path = 'blocking'
+    lastSync = 0
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.written = []
+        self.closed = False
+
+    def write(self, tags):
+        self.event.wait()
+        self.written.extend(tags)
+
+        return len(tags)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+
+class DiskWriterTestCase(unittest.TestCase):
+    """
+    Tests for L{recording.DiskWriter}.
+    """
+
+    def setUp(self):
+        self.writer = recording.DiskWriter(maxPending=25, fsyncInterval=0)
+        self.addCleanup(self.writer.stop)
+
+    def test_write(self):
+        path = os.path.join(self.mktemp(), 'foo.flv')
+        f = recording.FLVFile(path)
+
+        self.assertTrue(self.writer.write(f, [(flv.VIDEO, KEYFRAME, 0)], 10))
+        self.writer.close(f)
+        self.writer.stop()
+
+        self.assertEqual(readTags(path), [(flv.VIDEO, KEYFRAME, 0)])
+
+        stats = self.writer.getStats()
+
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['bytes'], 25)
+        self.assertEqual(stats['fsyncs'], 1)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_overflow(self):
+        """
+        Batches are dropped while too much is waiting to be written.
+        """
+        f = BlockingFile()
+
+        self.assertTrue(self.writer.write(f, ['a'], 10))
+        self.assertTrue(self.writer.write(f, ['b'], 10))
+        self.assertFalse(self.writer.write(f, ['c'], 10))
+
+        f.event.set()
+        self.writer.close(f)
+        self.writer.stop()
+
+        self.assertEqual(f.written, ['a', 'b'])
+        self.assertTrue(f.closed)
+
+        stats = self.writer.getStats()
+
+        self.assertEqual(stats['overflows'], 1)
+        self.assertEqual(stats['dropped'], 10)
+        self.assertEqual(stats['peakPending'], 20)
+
+    def test_error(self):
+        f = BlockingFile()
+        f.write = lambda tags: 1 / 0
+
+        self.writer.write(f, ['a'], 10)
+        self.writer.stop()
+
+        self.assertEqual(self.writer.stats['errors'], 1)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.batches = []
+        self.closed = []
+        self.full = False
+
+    def write(self, f, tags, size):
+        if self.full:
+            return False
+
+        self.batches.append(tags)
+
+        return True
+
+    def close(self, f):
+        self.closed.append(f)
+
+
+
+class RecordingTestCase(unittest.TestCase):
+    """
+    Tests for L{recording.Recording}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.writer = FakeWriter()
+        self.recording = recording.Recording(self.writer, 'file', self.clock)
+        self.recording.batchSize = 25
+
+    def test_batch(self):
+        self.recording.videoDataReceived(KEYFRAME, 0)
+        self.recording.audioDataReceived(AUDIO, 10)
+
+        self.assertEqual(self.writer.batches, [])
+
+        self.recording.videoDataReceived(INTERFRAME, 20)
+
+        self.assertEqual(self.writer.batches, [[(flv.VIDEO, KEYFRAME, 0),
+            (flv.AUDIO, AUDIO, 10), (flv.VIDEO, INTERFRAME, 20)]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_interval(self):
+        self.recording.audioDataReceived(AUDIO, 0)
+
+        self.clock.advance(self.recording.flushInterval)
+
+        self.assertEqual(self.writer.batches, [[(flv.AUDIO, AUDIO, 0)]])
+
+    def test_meta(self):
+        self.recording.batchSize = 1000
+
+        self.recording.videoDataReceived(KEYFRAME, 10)
+        self.recording.onMetaData({'width': 320})
+
+        self.assertEqual(self.recording.tags[-1],
+            (flv.SCRIPT, flv.encodeMetaData({'width': 320}), 10))
+
+    def test_dropped(self):
+        """
+        Once a batch has been dropped, tags are dropped up to the next
+        keyframe.
+        """
+        self.writer.full = True
+
+        self.recording.videoDataReceived(KEYFRAME, 0)
+        self.recording.flush()
+
+        self.writer.full = False
+
+        self.recording.videoDataReceived(INTERFRAME, 10)
+        self.recording.audioDataReceived(AUDIO, 10)
+        self.recording.videoDataReceived(KEYFRAME, 20)
+        self.recording.flush()
+
+        self.assertEqual(self.writer.batches, [[(flv.VIDEO, KEYFRAME, 20)]])
+        self.assertEqual(self.recording.stats['dropped'], 3)
+
+    def test_unpublish(self):
+        self.recording.audioDataReceived(AUDIO, 0)
+        self.recording.unpublish()
+
+        self.assertEqual(self.writer.batches, [[(flv.AUDIO, AUDIO, 0)]])
+        self.assertEqual(self.writer.closed, ['file'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.recording.audioDataReceived(AUDIO, 10)
+        self.assertEqual(self.recording.tags, [])
+
+
+
+class RecorderTestCase(unittest.TestCase):
+    """
+    Tests for L{recording.Recorder}.
+    """
+
+    def test_default_writer(self):
+        """
+        The shared writer is created by the first recorder that needs it,
+        not when L{recording} is imported.
+        """
+        self.assertFalse(importsReactor('rtmpy.recording'))
+
+        self.patch(recording, 'diskWriter', None)
+
+        recorder = recording.Recorder(self.mktemp(), reactor=task.Clock())
+
+        self.assertTrue(isinstance(recorder.writer, recording.DiskWriter))
+        self.assertIdentical(recorder.writer, recording.diskWriter)
+        self.assertIdentical(recording.getDiskWriter(), recorder.writer)
+
+
+
+class ApplicationTestCase(unittest.TestCase):
+    """
+    Tests for L{server.Application.recorder}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.writer = recording.DiskWriter()
+        self.addCleanup(self.writer.stop)
+
+        self.app = server.Application()
+        self.app.recorder = recording.Recorder(self.path, writer=self.writer,
+            reactor=task.Clock())
+
+        self.client = server.Client(None)
+        self.client.id = 'client'
+
+    def test_live(self):
+        publisher = self.app.publishStream(self.client, None, 'foo', 'live')
+
+        self.assertEqual(publisher.recording, None)
+
+    def test_record(self):
+        publisher = self.app.publishStream(self.client, None, 'foo/bar',
+            'record')
+
+        self.assertTrue(publisher.recording in publisher.subscribers)
+
+        publisher.videoDataReceived(KEYFRAME, 0)
+        publisher.unpublish()
+
+        self.writer.stop()
+
+        self.assertEqual(readTags(os.path.join(self.path, 'foo%2Fbar.flv')),
+            [(flv.VIDEO, KEYFRAME, 0)])
+
+    def test_append(self):
+        publisher = self.app.publishStream(self.client, None, 'foo', 'append')
+
+        self.assertTrue(publisher.recording.file.append)
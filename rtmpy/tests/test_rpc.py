@@ -19,9 +19,10 @@ Tests for L{rtmpy.rpc}.
 
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 
-from rtmpy import rpc, message, exc
+from rtmpy import rpc, message, exc, util
+from rtmpy.tests.util import importsReactor
 
 
 
@@ -121,6 +122,138 @@ class ExposingTestCase(unittest.TestCase):
         self.assertExposedAs(B.named, 'bar')
 
 
+class BlockingTestCase(unittest.TestCase):
+    """
+    Tests for methods exposed with C{blocking=True}.
+    """
+
+
+    def setUp(self):
+        self.pool = rpc.BlockingCallPool(size=2)
+        self.patch(rpc, 'blockingPool', self.pool)
+
+
+    def tearDown(self):
+        self.pool.stop()
+
+
+    def test_lazy(self):
+        """
+        The pool is created on first use, not when L{rpc} is imported.
+        """
+        self.assertFalse(importsReactor('rtmpy.rpc'))
+
+        self.patch(rpc, 'blockingPool', None)
+
+        pool = rpc.getBlockingPool()
+
+        self.assertTrue(isinstance(pool, rpc.BlockingCallPool))
+        self.assertIdentical(rpc.getBlockingPool(), pool)
+        self.assertEqual(pool.pool, None)
+
+
+    def test_expose(self):
+        class SomeClass(object):
+            @rpc.expose(blocking=True)
+            def foo(self):
+                pass
+
+            @rpc.expose('baz', blocking=True)
+            def bar(self):
+                pass
+
+        self.assertEqual(rpc.getExposedMethods(SomeClass),
+            {'foo': 'foo', 'baz': 'bar'})
+        self.assertTrue(SomeClass.foo.__rpc_blocking__)
+        self.assertTrue(SomeClass.bar.__rpc_blocking__)
+
+
+    def test_thread(self):
+        """
+        Blocking methods are not run on the reactor thread.
+        """
+        import thread
+
+        class SomeClass(object):
+            @rpc.expose(blocking=True)
+            def foo(self, x):
+                return thread.get_ident(), x
+
+            @rpc.expose
+            def bar(self, x):
+                return thread.get_ident(), x
+
+        obj = SomeClass()
+        main = thread.get_ident()
+
+        self.assertEqual(rpc.callExposedMethod(obj, 'bar', 1), (main, 1))
+
+        d = rpc.callExposedMethod(obj, 'foo', 2)
+
+        self.assertTrue(isinstance(d, defer.Deferred))
+        self.assertEqual(self.pool.getStats()['pending'], 1)
+
+        def cb(res):
+            ident, x = res
+
+            self.assertNotEqual(ident, main)
+            self.assertEqual(x, 2)
+
+            stats = self.pool.getStats()
+
+            self.assertEqual(stats['calls'], 1)
+            self.assertEqual(stats['pending'], 0)
+            self.assertEqual(stats['size'], 2)
+
+        return d.addCallback(cb)
+
+
+    def test_failure(self):
+        class SomeClass(object):
+            @rpc.expose(blocking=True)
+            def foo(self):
+                raise exc.CallFailed('foo')
+
+        d = rpc.callExposedMethod(SomeClass(), 'foo')
+
+        def check(res):
+            self.assertEqual(self.pool.getStats()['failed'], 1)
+
+            return res
+
+        d.addBoth(check)
+
+        return self.assertFailure(d, exc.CallFailed)
+
+
+    def test_blocking(self):
+        """
+        L{rpc.blocking} marks methods that are not exposed.
+        """
+        def foo():
+            return 'bar'
+
+        self.assertTrue(rpc.blocking(foo) is foo)
+
+        d = rpc.callMethod(foo)
+
+        return d.addCallback(self.assertEqual, 'bar')
+
+
+    def test_queued(self):
+        self.pool.stats['pending'] = 5
+
+        self.assertEqual(self.pool.getStats()['queued'], 3)
+
+
+    def test_set_size(self):
+        self.pool.start()
+        self.pool.setSize(4)
+
+        self.assertEqual(self.pool.pool.max, 4)
+
+
+
 class CallHandlerTestCase(unittest.TestCase):
     """
     Tests for L{rpc.BaseCallHandler}.
@@ -427,6 +560,237 @@ class CallWithNotifTestCase(unittest.TestCase):
 
 
 
+class CallManyTestCase(unittest.TestCase):
+    """
+    Tests for L{rpc.AbstractCallHandler.callMany}.
+    """
+
+
+    def setUp(self):
+        self.invoker = SimpleInitiator()
+        self.messages = self.invoker.messages
+
+
+    def test_fire_and_forget(self):
+        ret = self.invoker.callMany([('foo', (1,)), ('bar', ())])
+
+        self.assertEqual(ret, None)
+        self.assertEqual([(m.name, m.id, m.argv) for m in self.messages], [
+            ('foo', 0, [None, 1]),
+            ('bar', 0, [None]),
+        ])
+
+
+    def test_notify(self):
+        i = self.invoker
+
+        d = i.callMany([('foo', (1,)), ('bar', ()), ('baz', ())],
+            notify=True)
+
+        self.assertEqual([m.id for m in self.messages], [2, 3, 4])
+
+        i.handleResponse('_result', 4, 'c')
+        i.handleResponse('_error', 3, ('b',))
+        i.handleResponse('_result', 2, 'a')
+
+        def cb(results):
+            self.assertEqual(results[0], (True, 'a'))
+            self.assertEqual(results[2], (True, 'c'))
+
+            success, fail = results[1]
+
+            self.assertFalse(success)
+            self.assertTrue(isinstance(fail, rpc.RemoteCallFailed))
+
+        d.addCallback(cb)
+
+        return d
+
+
+    def test_send_failure(self):
+        """
+        A call that blows up fails its slot in the result, the other calls
+        are still made.
+        """
+        class TestRuntimeError(RuntimeError):
+            """
+            """
+
+        i = self.invoker
+        send = i.sendMessage
+
+        def sendMessage(msg):
+            if msg.name == 'bad':
+                raise TestRuntimeError()
+
+            send(msg)
+
+        self.patch(i, 'sendMessage', sendMessage)
+
+        d = i.callMany([('bad', ()), ('good', ())], notify=True)
+
+        self.assertEqual([m.name for m in self.messages], ['good'])
+
+        i.handleResponse('_result', self.messages[0].id, 'ok')
+
+        def cb(results):
+            self.assertFalse(results[0][0])
+            self.assertTrue(results[0][1].check(TestRuntimeError))
+            self.assertEqual(results[1], (True, 'ok'))
+
+        d.addCallback(cb)
+
+        return d
+
+
+
+class CallTimeoutTestCase(unittest.TestCase):
+    """
+    Tests for timing out calls that the peer does not respond to.
+    """
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+        self.invoker = SimpleInitiator()
+        self.invoker.timers = util.TimerWheel(clock=self.clock)
+        self.invoker.callTimeout = 5
+
+
+    def test_timeout(self):
+        i = self.invoker
+
+        d = i.call('foo', notify=True)
+        callId = i.messages[0].id
+
+        self.clock.pump([1] * 4)
+        self.assertTrue(i.isCallActive(callId))
+
+        self.clock.advance(1)
+
+        self.assertFalse(i.isCallActive(callId))
+        self.assertEqual(i._pendingCalls, {})
+        self.assertEqual(i.callStats['timedOut'], 1)
+
+        return self.assertFailure(d, exc.CallTimedOut)
+
+
+    def test_per_call(self):
+        """
+        A C{timeout} kwarg overrides C{callTimeout}.
+        """
+        i = self.invoker
+
+        d = i.call('foo', notify=True, timeout=1)
+        self.clock.advance(1)
+
+        return self.assertFailure(d, exc.CallTimedOut)
+
+
+    def test_no_timeout(self):
+        i = self.invoker
+        i.callTimeout = None
+
+        i.call('foo', notify=True)
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(i._pendingCalls, {2: None})
+
+
+    def test_shared(self):
+        """
+        Handlers share L{rpc.timers}, which is created on first use.
+        """
+        self.patch(rpc, 'timers', None)
+
+        i = SimpleInitiator()
+        i.callTimeout = 5
+        i.call('foo', notify=True)
+
+        self.assertTrue(isinstance(rpc.timers, util.TimerWheel))
+        self.assertIdentical(i.timers, rpc.timers)
+        self.assertIdentical(rpc.getTimers(), rpc.timers)
+
+        i.discardCall(i.messages[0].id)
+
+
+    def test_response(self):
+        """
+        A response to the call stops the timeout.
+        """
+        i = self.invoker
+
+        d = i.call('foo', notify=True)
+        i.handleResponse('_result', i.messages[0].id, 'bar')
+
+        self.assertEqual(i._pendingCalls, {})
+        self.assertEqual(len(i.timers), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        d.addCallback(self.assertEqual, 'bar')
+
+        return d
+
+
+
+class PendingCallLimitTestCase(unittest.TestCase):
+    """
+    Tests for L{rpc.AbstractCallHandler.maxPendingCalls}.
+    """
+
+
+    def setUp(self):
+        self.invoker = SimpleInitiator()
+        self.invoker.maxPendingCalls = 2
+
+
+    def test_reject(self):
+        i = self.invoker
+
+        i.call('foo', notify=True)
+        i.call('foo', notify=True)
+
+        d = i.call('foo', notify=True)
+
+        self.assertEqual(len(i.messages), 2)
+        self.assertEqual(i.callStats['rejected'], 1)
+
+        return self.assertFailure(d, exc.CallFailed)
+
+
+    def test_drop(self):
+        """
+        The oldest pending call is failed to make room for the new one.
+        """
+        i = self.invoker
+        i.pendingCallOverflow = 'drop'
+
+        oldest = i.call('foo', notify=True)
+        i.call('bar', notify=True)
+        i.call('baz', notify=True)
+
+        self.assertEqual(len(i.messages), 3)
+        self.assertEqual(sorted(i._pendingCalls.keys()), [3, 4])
+        self.assertFalse(i.isCallActive(2))
+        self.assertEqual(i.callStats['dropped'], 1)
+
+        return self.assertFailure(oldest, exc.CallFailed)
+
+
+    def test_not_notify(self):
+        """
+        Fire-and-forget calls are not limited.
+        """
+        i = self.invoker
+
+        for x in range(5):
+            i.call('foo')
+
+        self.assertEqual(len(i.messages), 5)
+
+
+
 class CallResponseTestCase(unittest.TestCase):
     """
     Tests the response to an RPC call.
@@ -19,11 +19,17 @@
 """
 
 from twisted.trial import unittest
-from twisted.internet import defer, reactor, protocol
+from twisted.internet import defer, reactor, protocol, task
 from twisted.test.proto_helpers import StringTransportWithDisconnection, StringIOWithoutClosing
+from twisted.test import proto_helpers
+
+from pyamf.util import BufferedByteStream
 
 from rtmpy import server, exc, rpc, util
+from rtmpy.protocol import handshake
 from rtmpy.protocol.rtmp import message
+from rtmpy.protocol.rtmp import handshake as rtmp_handshake
+from rtmpy.tests.util import importsReactor
 
 
 
@@ -351,6 +357,7 @@ class ServerFactoryTestCase(unittest.TestCase):
 
     def setUp(self):
         self.factory = server.ServerFactory()
+        self.factory.clock = task.Clock()
         self.protocol = self.factory.buildProtocol(None)
         self.transport = StringTransportWithDisconnection()
         self.nc = server.NetConnection(self.protocol)
@@ -380,12 +387,317 @@ class ServerFactoryTestCase(unittest.TestCase):
         return manager.getStream(manager.createStream())
 
 
+class ClockTestCase(unittest.TestCase):
+    """
+    Tests for the default C{clock} of L{server.ServerFactory} and
+    L{server.Application}.
+    """
+
+    def test_import(self):
+        """
+        Importing L{server} does not install the reactor.
+        """
+        self.assertFalse(importsReactor('rtmpy.server'))
+
+    def test_default(self):
+        self.assertIdentical(server.ServerFactory().clock, reactor)
+        self.assertIdentical(server.Application().clock, reactor)
+
+    def test_class(self):
+        """
+        A C{clock} set on a subclass is kept.
+        """
+        clock = task.Clock()
+
+        class Application(server.Application):
+            pass
+
+        Application.clock = clock
+
+        self.assertIdentical(Application().clock, clock)
+
+
+
+class PayloadRefillTestCase(unittest.TestCase):
+    """
+    Tests for refilling the handshake payload pool when the factory starts.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = self.buildFactory()
+        self.pool = self.factory.handshake.payloadPool
+        self.pool.payloads.clear()
+
+    def tearDown(self):
+        self.factory.stopFactory()
+
+    def buildFactory(self):
+        factory = server.ServerFactory()
+        factory.clock = self.clock
+
+        return factory
+
+    def test_start(self):
+        self.factory.startFactory()
+
+        self.assertTrue(self.pool._loop.running)
+        self.assertEqual(len(self.pool), self.pool.size)
+
+    def test_stop(self):
+        self.factory.startFactory()
+        loop = self.pool._loop
+
+        self.factory.stopFactory()
+
+        self.assertFalse(loop.running)
+        self.assertEqual(self.pool._loop, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_shared(self):
+        """
+        Factories sharing a pool share one refill loop.
+        """
+        other = self.buildFactory()
+
+        self.factory.startFactory()
+        other.startFactory()
+
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        other.stopFactory()
+        self.assertTrue(self.pool._loop.running)
+
+        self.factory.stopFactory()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_disabled(self):
+        self.factory.payloadRefillInterval = None
+        self.factory.startFactory()
+
+        self.assertEqual(self.pool._loop, None)
+        self.assertEqual(len(self.pool), 0)
+
+
+class FactoryHandshakeTestCase(unittest.TestCase):
+    """
+    Tests for the handshake spoken by the negotiators that
+    L{server.ServerFactory} builds.
+    """
+
+    def setUp(self):
+        self.factory = server.ServerFactory()
+        self.factory.clock = task.Clock()
+
+        self.protocol = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+        self.succeeded = False
+        self.buffer = []
+
+        self.client = rtmp_handshake.ClientNegotiator(self, self)
+        self.client.start(0, 0)
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def handshakeSuccess(self, data):
+        self.succeeded = True
+
+    def test_digest(self):
+        """
+        A digest client syn is answered with a signed syn.
+        """
+        self.protocol.dataReceived('\x03' + ''.join(self.buffer))
+
+        response = self.transport.value()
+        s1 = handshake.Packet()
+        s1.decode(BufferedByteStream(response[1:1537]))
+
+        self.assertEqual(response[0], '\x03')
+        self.assertEqual(s1.version,
+            rtmp_handshake.ServerNegotiator.serverVersion)
+        self.assertNotEqual(rtmp_handshake.find_digest(s1,
+            rtmp_handshake._FMS_SYN), None)
+
+        del self.buffer[:]
+        self.client.dataReceived(response[1:])
+
+        self.assertTrue(self.succeeded)
+        self.assertEqual(self.client.peer_digest,
+            self.protocol.handshaker.digest)
+
+        self.protocol.dataReceived(''.join(self.buffer))
+
+        self.assertEqual(self.protocol.state, self.protocol.STATE_STREAM)
+
+    def test_plain(self):
+        """
+        A client syn without a digest gets the plain handshake.
+        """
+        self.protocol.dataReceived('\x03' + '\x00' * 1536)
+
+        response = self.transport.value()
+
+        self.assertEqual(response[5:9], '\x00' * 4)
+        self.assertEqual(response[1537 + 8:], '\x00' * 1528)
+
+        self.protocol.dataReceived(response[1:1537])
+
+        self.assertEqual(self.protocol.state, self.protocol.STATE_STREAM)
+
+
+
+class HandshakeAdmissionTestCase(unittest.TestCase):
+    """
+    Tests for capping the number of concurrent handshakes and the
+    handshake/connect timeouts.
+    """
+
+    def setUp(self):
+        self.factory = server.ServerFactory()
+        self.factory.clock = task.Clock()
+        self.factory.maxHandshakes = 2
+
+    def connect(self):
+        p = self.factory.buildProtocol(None)
+        t = StringTransportWithDisconnection()
+        t.protocol = p
+
+        p.makeConnection(t)
+
+        return p
+
+    def test_admit(self):
+        p1 = self.connect()
+        p2 = self.connect()
+
+        self.assertEqual(p1.state, 'version')
+        self.assertEqual(p2.state, 'version')
+
+        stats = self.factory.getStats()
+
+        self.assertEqual(stats['active'], 2)
+        self.assertEqual(stats['queued'], 0)
+
+    def test_queue(self):
+        p1 = self.connect()
+        self.connect()
+        p3 = self.connect()
+
+        self.assertTrue(p3.queued)
+        self.assertEqual(p3.state, None)
+        self.assertEqual(p3.transport.producerState, 'paused')
+
+        stats = self.factory.getStats()
+
+        self.assertEqual(stats['active'], 2)
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['handshakesQueued'], 1)
+
+        p1.versionReceived(3)
+        p1.handshakeSuccess('')
+
+        self.assertFalse(p3.queued)
+        self.assertEqual(p3.state, 'version')
+        self.assertEqual(p3.transport.producerState, 'producing')
+
+        stats = self.factory.getStats()
+
+        self.assertEqual(stats['active'], 2)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['handshakes'], 1)
+
+    def test_queued_disconnect(self):
+        self.connect()
+        self.connect()
+        p3 = self.connect()
+
+        p3.transport.loseConnection()
+
+        self.assertEqual(self.factory.getStats()['queued'], 0)
+
+    def test_disconnect_frees_slot(self):
+        p1 = self.connect()
+        self.connect()
+        p3 = self.connect()
+
+        p1.transport.loseConnection()
+
+        self.assertFalse(p3.queued)
+        self.assertEqual(self.factory.getStats()['active'], 2)
+        self.assertEqual(self.factory.getStats()['handshakes'], 0)
+
+    def test_reject(self):
+        self.factory.handshakeOverflow = 'reject'
+
+        self.connect()
+        self.connect()
+        p3 = self.connect()
+
+        self.assertFalse(p3.transport.connected)
+        self.assertEqual(p3.handshakeTimer, None)
+
+        stats = self.factory.getStats()
+
+        self.assertEqual(stats['active'], 2)
+        self.assertEqual(stats['handshakesRejected'], 1)
+
+    def test_handshake_timeout(self):
+        p = self.connect()
+
+        self.factory.clock.advance(self.factory.handshakeTimeout)
+
+        self.assertFalse(p.transport.connected)
+
+        stats = self.factory.getStats()
+
+        self.assertEqual(stats['handshakeTimeouts'], 1)
+        self.assertEqual(stats['active'], 0)
+
+    def test_connect_timeout(self):
+        p = self.connect()
+        p.versionReceived(3)
+        p.handshakeSuccess('')
+
+        self.assertEqual(p.handshakeTimer, None)
+        self.assertTrue(p.connectTimer.active())
+
+        self.factory.clock.advance(self.factory.connectTimeout)
+
+        self.assertFalse(p.transport.connected)
+        self.assertEqual(self.factory.getStats()['connectTimeouts'], 1)
+
+    def test_connect_succeeded(self):
+        p = self.connect()
+        p.versionReceived(3)
+        p.handshakeSuccess('')
+
+        timer = p.connectTimer
+        p.connectSucceeded()
+
+        self.assertFalse(timer.active())
+        self.assertEqual(p.connectTimer, None)
+
+    def test_disabled(self):
+        self.factory.handshakeTimeout = None
+        self.factory.connectTimeout = None
+
+        p = self.connect()
+        p.versionReceived(3)
+        p.handshakeSuccess('')
+
+        self.assertEqual(self.factory.clock.getDelayedCalls(), [])
+
+
 class ServerFactoryDisconnectedTestCase(unittest.TestCase):
     """
     """
 
     def setUp(self):
         self.factory = server.ServerFactory()
+        self.factory.clock = task.Clock()
         self.protocol = self.factory.buildProtocol(None)
         self.transport = StringTransportWithDisconnection()
         self.nc = server.NetConnection(self.protocol)
@@ -426,6 +738,7 @@ class ConnectingTestCase(unittest.TestCase):
         self.transport = protocol.FileWrapper(self.file)
 
         self.factory = server.ServerFactory()
+        self.factory.clock = task.Clock()
         self.protocol = self.factory.buildProtocol(None)
 
         self.protocol.factory = self.factory
@@ -488,6 +801,9 @@ class ConnectingTestCase(unittest.TestCase):
         """
         Ensure that the msg is of a particular type and state
         """
+        if isinstance(msg, message.EncodedMessage):
+            msg = msg.getMessage()
+
         self.assertEqual(message.typeByClass(msg), type_)
 
         d = msg.__dict__
@@ -946,6 +1262,280 @@ class ClientInterfaceTestCase(unittest.TestCase):
         self.assertEqual(kwargs, {'kw': 'Hello'})
 
 
+class RecordingNetConnection(object):
+    """
+    Collects the messages sent to a client.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def sendMessage(self, msg, stream=None):
+        self.messages.append(msg)
+
+
+class BroadcastTestCase(unittest.TestCase):
+    """
+    Tests for L{server.Application.broadcast}.
+    """
+
+    def setUp(self):
+        self.app = server.Application()
+        self.app.clock = task.Clock()
+
+    def addClient(self, id):
+        client = server.Client(RecordingNetConnection())
+        client.id = id
+
+        self.app.acceptConnection(client)
+
+        return client
+
+    def test_encoded_once(self):
+        """
+        Every client must be sent the same encoded message.
+        """
+        a = self.addClient('a')
+        b = self.addClient('b')
+
+        d = self.app.broadcast('foo', 'bar', 1)
+
+        self.assertEqual(len(a.nc.messages), 1)
+        self.assertTrue(a.nc.messages[0] is b.nc.messages[0])
+
+        msg = a.nc.messages[0]
+
+        self.assertTrue(isinstance(msg, message.EncodedMessage))
+        self.assertEqual(msg.__data_type__, message.INVOKE)
+
+        invoke = msg.getMessage()
+
+        self.assertEqual(invoke.name, 'foo')
+        self.assertEqual(invoke.id, rpc.NO_RESULT)
+        self.assertEqual(list(invoke.argv), [None, 'bar', 1])
+
+        d.addCallback(self.assertEqual, 2)
+
+        return d
+
+    def test_filter(self):
+        """
+        Only the clients accepted by C{filter} receive the call.
+        """
+        a = self.addClient('a')
+        b = self.addClient('b')
+
+        d = self.app.broadcast('foo', filter=lambda c: c.id == 'b')
+
+        self.assertEqual(a.nc.messages, [])
+        self.assertEqual(len(b.nc.messages), 1)
+
+        d.addCallback(self.assertEqual, 1)
+
+        return d
+
+    def test_bad_kwargs(self):
+        self.assertRaises(TypeError, self.app.broadcast, 'foo', spam='eggs')
+
+    def test_batches(self):
+        """
+        Clients are written to C{broadcastBatchSize} at a time, one batch per
+        reactor iteration.
+        """
+        self.app.broadcastBatchSize = 2
+
+        clients = [self.addClient(str(i)) for i in range(5)]
+        result = []
+
+        self.app.broadcast('foo').addCallback(result.append)
+
+        def received():
+            return len([c for c in clients if c.nc.messages])
+
+        self.assertEqual(received(), 2)
+        self.assertEqual(result, [])
+        self.assertEqual(len(self.app.clock.getDelayedCalls()), 1)
+
+        self.app.clock.advance(0)
+
+        self.assertEqual(received(), 5)
+        self.assertEqual(result, [5])
+        self.assertEqual(self.app.clock.getDelayedCalls(), [])
+
+    def test_disconnected(self):
+        """
+        Clients that disconnect during the broadcast are skipped.
+        """
+        self.app.broadcastBatchSize = 1
+
+        a = self.addClient('a')
+        b = self.addClient('b')
+
+        result = []
+        self.app.broadcast('foo').addCallback(result.append)
+
+        late = [c for c in (a, b) if not c.nc.messages][0]
+        self.app._disconnect(late)
+
+        self.app.clock.advance(0)
+
+        self.assertEqual(late.nc.messages, [])
+        self.assertEqual(result, [1])
+
+    def test_error(self):
+        """
+        An error sending to one client does not stop the broadcast.
+        """
+        a = self.addClient('a')
+        b = self.addClient('b')
+
+        def boom(msg, stream=None):
+            raise TestRuntimeError('Die!!')
+
+        a.nc.sendMessage = boom
+
+        d = self.app.broadcast('foo')
+
+        self.assertEqual(len(b.nc.messages), 1)
+        self.flushLoggedErrors(TestRuntimeError)
+
+        d.addCallback(self.assertEqual, 1)
+
+        return d
+
+
+class CallRateLimitTestCase(ServerFactoryTestCase):
+    """
+    Tests for the per client/method call rate limits and call accounting.
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.app = server.Application()
+        self.app.clock = task.Clock()
+
+        self.client = self.connect(self.app, self.protocol)
+        self.client.ping = lambda: 'pong'
+        self.client.echo = lambda x: x
+
+    def call(self, name, *args):
+        return self.protocol.nc.callExposedMethod(name, *args)
+
+    def test_unlimited(self):
+        for i in range(10):
+            self.assertEqual(self.successResultOf(self.call('ping')), 'pong')
+
+        stats = self.app.getStats()['calls']
+
+        self.assertEqual(stats['ping']['calls'], 10)
+        self.assertEqual(stats['ping']['rejected'], 0)
+        self.assertTrue(stats['ping']['time'] >= 0)
+
+    def test_client_limit(self):
+        self.app.callRateLimit = (1, 2)
+
+        self.successResultOf(self.call('ping'))
+        self.successResultOf(self.call('echo', 1))
+
+        f = self.failureResultOf(self.call('ping'))
+        f.trap(exc.CallRateLimited)
+
+        self.app.clock.advance(1)
+        self.successResultOf(self.call('echo', 1))
+
+        stats = self.app.getStats()['calls']
+
+        self.assertEqual(stats['ping'], {'calls': 1, 'rejected': 1,
+            'time': stats['ping']['time']})
+        self.assertEqual(stats['echo']['calls'], 2)
+
+    def test_method_limit(self):
+        self.app.methodRateLimits = {'ping': (1, 1)}
+
+        self.successResultOf(self.call('ping'))
+        self.failureResultOf(self.call('ping')).trap(exc.CallRateLimited)
+
+        # other methods are not affected
+        self.successResultOf(self.call('echo', 1))
+        self.successResultOf(self.call('echo', 1))
+
+    def test_rejected_keeps_tokens(self):
+        """
+        A call rejected by the client limit does not use up its method token.
+        """
+        self.app.callRateLimit = (1, 1)
+        self.app.methodRateLimits = {'ping': (0.5, 1)}
+
+        self.successResultOf(self.call('echo', 1))
+        self.failureResultOf(self.call('ping')).trap(exc.CallRateLimited)
+
+        self.app.clock.advance(1)
+        self.successResultOf(self.call('ping'))
+
+    def test_wall_time(self):
+        """
+        Calls are accounted using wall clock time.
+        """
+        self.patch(server.time, 'time', iter([10.0, 12.5]).next)
+
+        self.successResultOf(self.call('ping'))
+
+        self.assertEqual(self.app.getStats()['calls']['ping']['time'], 2.5)
+
+    def test_blocking_time(self):
+        """
+        The time a blocking method spends in the thread pool is not recorded.
+        """
+        self.client.slow = rpc.blocking(lambda: None)
+
+        pool = rpc.BlockingCallPool()
+        pool.call = lambda *args, **kwargs: defer.Deferred()
+
+        self.patch(rpc, 'blockingPool', pool)
+        self.patch(server.time, 'time', iter([10.0, 10.5]).next)
+
+        d = self.call('slow')
+
+        self.assertNoResult(d)
+        self.assertEqual(self.app.getStats()['calls']['slow']['time'], 0.5)
+
+    def test_error_status(self):
+        """
+        A rejected call is answered with a C{NetConnection.Call.Failed}
+        error.
+        """
+        self.app.callRateLimit = (1, 1)
+
+        nc = self.protocol.nc
+        sent = []
+        self.patch(nc, 'sendMessage', sent.append)
+
+        nc.callReceived('ping', 5)
+        d = nc.callReceived('ping', 6)
+
+        self.failureResultOf(d).trap(exc.CallRateLimited)
+
+        msg = sent[-1]
+
+        self.assertEqual(msg.name, '_error')
+        self.assertEqual(msg.id, 6)
+        self.assertEqual(msg.argv[1].code, 'NetConnection.Call.Failed')
+
+    def test_disconnect(self):
+        """
+        The buckets for a client are discarded when it disconnects.
+        """
+        self.app.callRateLimit = (1, 1)
+        self.call('ping')
+
+        self.assertTrue(self.client.id in self.app._callBuckets)
+
+        self.app._disconnect(self.client)
+
+        self.assertEqual(self.app._callBuckets, {})
+
+
 class PublishingTestCase(ServerFactoryTestCase):
     """
     Tests for all facets of publishing a stream
@@ -1137,6 +1727,24 @@ class PlayTestCase(ServerFactoryTestCase):
         self.assertTrue(s in res.subscribers)
 
 
+    def test_closed(self):
+        """
+        A stream that is closed whilst waiting for the stream it asked to play
+        stops waiting.
+        """
+        self.connect(self.app, self.protocol)
+
+        s = self.createStream(self.protocol.streamManager)
+        s.play('foo')
+
+        self.assertEqual(len(self.app._pendingPublishedCallbacks['foo']), 1)
+
+        s.closeStream()
+
+        self.assertEqual(self.app._pendingPublishedCallbacks, {})
+        self.assertEqual(self.protocol.nc._waiting, {})
+
+
     def test_existing(self):
         """
         Test if the stream does already exist, the play command is immediately
@@ -1163,6 +1771,57 @@ class PlayTestCase(ServerFactoryTestCase):
 
 
 
+class SeekTestCase(ServerFactoryTestCase):
+    """
+    Tests for L{server.NetStream.seek}
+    """
+
+    def setUp(self):
+        ServerFactoryTestCase.setUp(self)
+
+        self.app = server.Application()
+        self.connect(self.app, self.protocol)
+
+        self.stream = self.createStream(self.protocol.streamManager)
+        self.stream.state = 'playing'
+        self.stream.source = self
+
+        self.seeks = []
+        self.statuses = []
+
+        self.patch(self.stream, 'sendStatus', self.statuses.append)
+        self.patch(self.stream, 'sendMessage', lambda *args: None)
+
+    def seek(self, offset):
+        self.seeks.append(offset)
+
+    def test_seek(self):
+        self.stream.seek(1500)
+
+        self.assertEqual(self.seeks, [1500])
+        self.assertEqual([s.code for s in self.statuses],
+            ['NetStream.Seek.Notify'])
+
+    def test_invalid(self):
+        """
+        Offsets that are not numbers are rejected with a status.
+        """
+        for offset in [None, 'foo', {}, True]:
+            self.stream.seek(offset)
+
+        self.assertEqual(self.seeks, [])
+        self.assertEqual([s.code for s in self.statuses],
+            ['NetStream.Seek.Failed'] * 4)
+
+    def test_live(self):
+        self.stream.source = None
+        self.stream.seek(1500)
+
+        self.assertEqual([s.code for s in self.statuses],
+            ['NetStream.Seek.Failed'])
+
+
+
 class Publisher(object):
     """
     A value object that acts like a publisher.
@@ -22,6 +22,7 @@ import sys
 import warnings
 
 from twisted.trial import unittest
+from twisted.internet import task
 
 from rtmpy import util
 
@@ -119,6 +120,32 @@ class ParamedStringTestCase(unittest.TestCase):
 
 
 
+class GenerateBytesTestCase(unittest.TestCase):
+    """
+    Tests for L{util.generateBytes}
+    """
+
+    def test_type(self):
+        self.assertRaises(TypeError, util.generateBytes, '1')
+
+    def test_length(self):
+        self.assertEqual(util.generateBytes(0), '')
+        self.assertEqual(len(util.generateBytes(1)), 1)
+        self.assertEqual(len(util.generateBytes(1528)), 1528)
+
+    def test_random(self):
+        self.assertNotEqual(util.generateBytes(32), util.generateBytes(32))
+
+    def test_readable(self):
+        bytes = util.generateBytes(1000, readable=True)
+
+        self.assertEqual(len(bytes), 1000)
+
+        for b in bytes:
+            self.assertTrue(0x41 <= ord(b) <= 0x7a)
+
+
+
 class GetCallableTargetTestCase(unittest.TestCase):
     """
     Tests for L{util.get_callable_target}
@@ -166,6 +193,156 @@ class GetCallableTargetTestCase(unittest.TestCase):
         self.assertTrue(c, '__call__')
 
 
+
+class TimerWheelTestCase(unittest.TestCase):
+    """
+    Tests for L{util.TimerWheel}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = util.TimerWheel(resolution=1, size=4, clock=self.clock)
+        self.fired = []
+
+    def schedule(self, delay, name):
+        return self.wheel.schedule(delay, self.fired.append, name)
+
+    def test_idle(self):
+        """
+        An empty wheel does not tick.
+        """
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.schedule(1, 'a')
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(1)
+
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_expire(self):
+        self.schedule(2, 'b')
+        self.schedule(0.5, 'a')
+        self.schedule(3, 'c')
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a'])
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a', 'b'])
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+
+        self.assertEqual(self.wheel.stats['expired'], 3)
+
+    def test_rounds(self):
+        """
+        Delays longer than one turn of the wheel wait for the extra rounds.
+        """
+        self.schedule(10, 'a')
+
+        self.clock.pump([1] * 9)
+        self.assertEqual(self.fired, [])
+
+        self.clock.advance(1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_partial_tick(self):
+        """
+        A timer scheduled part way through a tick does not expire early.
+        """
+        self.schedule(5, 'a')
+
+        self.clock.advance(0.75)
+        self.schedule(1, 'b')
+
+        self.clock.advance(0.25)
+        self.assertEqual(self.fired, [])
+
+        self.clock.advance(0.75)
+        self.assertEqual(self.fired, [])
+
+        self.clock.advance(0.25)
+        self.assertEqual(self.fired, ['b'])
+
+    def test_cancel(self):
+        timer = self.schedule(1, 'a')
+
+        self.assertTrue(timer.active())
+        timer.cancel()
+        self.assertFalse(timer.active())
+
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.wheel.stats['cancelled'], 1)
+
+        timer.cancel()
+        self.assertEqual(self.wheel.stats['cancelled'], 1)
+
+    def test_error(self):
+        """
+        An error in one timer does not stop the others from firing.
+        """
+        def boom():
+            raise RuntimeError('Die!!')
+
+        self.wheel.schedule(1, boom)
+        self.schedule(1, 'a')
+
+        self.clock.advance(1)
+
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Tests for L{util.TokenBucket}.
+    """
+
+    def test_burst(self):
+        bucket = util.TokenBucket(1, 3, 0)
+
+        self.assertTrue(bucket.consume(0))
+        self.assertTrue(bucket.consume(0))
+        self.assertTrue(bucket.consume(0))
+        self.assertFalse(bucket.consume(0))
+
+    def test_refill(self):
+        bucket = util.TokenBucket(2, 2, 0)
+
+        bucket.consume(0)
+        bucket.consume(0)
+
+        self.assertFalse(bucket.consume(0.25))
+        self.assertTrue(bucket.consume(0.5))
+        self.assertFalse(bucket.consume(0.5))
+
+    def test_cap(self):
+        """
+        An idle bucket never holds more than C{burst} tokens.
+        """
+        bucket = util.TokenBucket(10, 2, 0)
+
+        self.assertTrue(bucket.consume(100))
+        self.assertEqual(bucket.tokens, 1)
+
+    def test_refill_only(self):
+        """
+        L{util.TokenBucket.refill} tops up the bucket without taking a token.
+        """
+        bucket = util.TokenBucket(1, 2, 0)
+
+        bucket.consume(0)
+        bucket.consume(0)
+
+        self.assertEqual(bucket.refill(1), 1)
+        self.assertEqual(bucket.refill(1), 1)
+        self.assertTrue(bucket.consume(1))
+        self.assertFalse(bucket.consume(1))
+
 if not sys.platform.startswith('linux'):
     LinuxUptimeTestCase.skip = 'Tested platform is not linux'
 
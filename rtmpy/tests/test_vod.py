@@ -0,0 +1,383 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for L{rtmpy.vod}.
+"""
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+
+from rtmpy import vod, flv, server, client
+from rtmpy.tests.test_client import RecordingSubscriber, waitFor
+
+
+AVC_HEADER = '\x17\x00config'
+KEYFRAME = '\x17\x01' + 'k' * 8
+INTERFRAME = '\x27\x01' + 'i' * 8
+AUDIO = '\x2f' + 'a' * 9
+
+
+
+def writeFLV(path, tags, meta=None):
+    """
+    Writes an FLV file holding C{(tagType, data, timestamp)} C{tags}.
+    """
+    dirname = os.path.dirname(path)
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    f = open(path, 'wb')
+
+    f.write(flv.encodeHeader())
+
+    if meta is not None:
+        f.write(flv.encodeTag(flv.SCRIPT, flv.encodeMetaData(meta), 0))
+
+    for tagType, data, timestamp in tags:
+        f.write(flv.encodeTag(tagType, data, timestamp))
+
+    f.close()
+
+
+def buildTags(seconds):
+    """
+    Returns the tags of a video that has a keyframe every second and
+    an interframe half way between.
+    """
+    tags = [(flv.VIDEO, AVC_HEADER, 0)]
+
+    for i in xrange(seconds):
+        tags.append((flv.VIDEO, KEYFRAME, i * 1000))
+        tags.append((flv.VIDEO, INTERFRAME, i * 1000 + 500))
+
+    return tags
+
+
+
+class KeyframeIndexTestCase(unittest.TestCase):
+    """
+    Tests for L{vod.KeyframeIndex}.
+    """
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'foo.flv')
+
+        writeFLV(self.path, buildTags(3), meta={'duration': 3})
+
+        self.data = open(self.path, 'rb').read()
+
+    def test_build(self):
+        index = vod.KeyframeIndex.build(self.data)
+
+        self.assertEqual(index.timestamps, [0, 1000, 2000])
+        self.assertEqual(index.metaOffset, 13)
+        self.assertEqual(index.end, len(self.data))
+        self.assertEqual(index.duration, 2500)
+
+        tagType, size, timestamp = flv.decodeTagHeader(self.data,
+            index.videoConfigOffset)
+
+        self.assertEqual(self.data[index.videoConfigOffset + 11:][:size],
+            AVC_HEADER)
+        self.assertEqual(index.audioConfigOffset, 0)
+
+        for timestamp, offset in zip(index.timestamps, index.offsets):
+            self.assertEqual(flv.decodeTagHeader(self.data, offset),
+                (flv.VIDEO, len(KEYFRAME), timestamp))
+
+    def test_audio_only(self):
+        writeFLV(self.path, [(flv.AUDIO, AUDIO, i * 400) for i in xrange(8)])
+
+        index = vod.KeyframeIndex.build(open(self.path, 'rb').read())
+
+        self.assertEqual(index.timestamps, [0, 1200, 2400])
+
+    def test_find(self):
+        index = vod.KeyframeIndex.build(self.data)
+
+        self.assertEqual(index.find(0), (0, index.offsets[0]))
+        self.assertEqual(index.find(1999), (1000, index.offsets[1]))
+        self.assertEqual(index.find(2000), (2000, index.offsets[2]))
+        self.assertEqual(index.find(10000), (2000, index.offsets[2]))
+
+    def test_save(self):
+        index = vod.KeyframeIndex.build(self.data, 100, 1.5)
+        index.save(self.path + '.idx')
+
+        loaded = vod.KeyframeIndex.load(self.path + '.idx', 100, 1.5)
+
+        self.assertEqual(loaded.timestamps, index.timestamps)
+        self.assertEqual(loaded.offsets, index.offsets)
+        self.assertEqual((loaded.end, loaded.metaOffset,
+            loaded.videoConfigOffset, loaded.duration), (index.end,
+            index.metaOffset, index.videoConfigOffset, index.duration))
+
+    def test_stale(self):
+        vod.KeyframeIndex.build(self.data, 100, 1.5).save(self.path + '.idx')
+
+        self.assertEqual(vod.KeyframeIndex.load(self.path + '.idx', 101, 1.5),
+            None)
+        self.assertEqual(vod.KeyframeIndex.load(self.path + '.idx', 100, 2),
+            None)
+
+    def test_corrupt(self):
+        self.assertEqual(vod.KeyframeIndex.load(self.path + '.idx'), None)
+
+        open(self.path + '.idx', 'wb').write('RTMPYIDX\x00')
+
+        self.assertEqual(vod.KeyframeIndex.load(self.path + '.idx'), None)
+
+
+
+class VODFileTestCase(unittest.TestCase):
+    """
+    Tests for L{vod.VODFile}.
+    """
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'foo.flv')
+
+        writeFLV(self.path, buildTags(3), meta={'duration': 3})
+
+    def test_index(self):
+        """
+        The index is built once and kept next to the file.
+        """
+        f = vod.VODFile(self.path)
+        f.close()
+
+        self.assertTrue(f.indexBuilt)
+        self.assertTrue(os.path.exists(self.path + '.idx'))
+
+        f = vod.VODFile(self.path)
+        f.close()
+
+        self.assertFalse(f.indexBuilt)
+        self.assertEqual(f.index.timestamps, [0, 1000, 2000])
+
+    def test_meta(self):
+        f = vod.VODFile(self.path)
+        self.addCleanup(f.close)
+
+        self.assertEqual(f.meta, {'duration': 3})
+
+    def test_read(self):
+        f = vod.VODFile(self.path)
+        self.addCleanup(f.close)
+
+        tagType, data, timestamp, offset = f.readTag(f.index.offsets[1])
+
+        self.assertEqual((tagType, data, timestamp), (flv.VIDEO, KEYFRAME,
+            1000))
+        self.assertEqual(f.readTag(offset)[:3], (flv.VIDEO, INTERFRAME, 1500))
+
+    def test_not_flv(self):
+        open(self.path, 'wb').write('foo')
+
+        self.assertRaises(flv.FLVError, vod.VODFile, self.path)
+
+
+
+class VODPlayerTestCase(unittest.TestCase):
+    """
+    Tests for L{vod.VODPlayer}.
+    """
+
+    def setUp(self):
+        path = os.path.join(self.mktemp(), 'foo.flv')
+
+        writeFLV(path, buildTags(10), meta={'duration': 10})
+
+        self.file = vod.VODFile(path)
+        self.addCleanup(self.file.close)
+
+        self.clock = task.Clock()
+        self.subscriber = RecordingSubscriber()
+        self.player = vod.VODPlayer(self.file, self.subscriber, self.clock,
+            sendAhead=2000)
+
+    def getTimestamps(self):
+        return [timestamp for data, timestamp in self.subscriber.video]
+
+    def test_send_ahead(self):
+        """
+        Tags are sent up to C{sendAhead} ms ahead of the playback position,
+        with one timer for each C{interval}.
+        """
+        self.player.start()
+
+        self.assertEqual(self.subscriber.video, [])
+
+        self.clock.advance(0)
+
+        self.assertEqual(self.subscriber.meta, [{'duration': 10}])
+        self.assertEqual(self.getTimestamps(), [0, 0, 500, 1000, 1500, 2000])
+        self.assertEqual(self.subscriber.video[0], (AVC_HEADER, 0))
+
+        self.clock.advance(self.player.interval)
+
+        self.assertEqual(self.getTimestamps()[-2:], [2500, 3000])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_complete(self):
+        self.player.start()
+        self.clock.pump([1] * 10)
+
+        self.assertEqual(len(self.subscriber.video), 21)
+        self.assertTrue(self.subscriber.unpublished)
+        self.assertTrue(self.player.finished.called)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_start(self):
+        """
+        Playback starts from the keyframe before the requested position,
+        after the sequence header.
+        """
+        self.player.start(4700)
+        self.clock.advance(0)
+
+        self.assertEqual(self.subscriber.video[:2], [(AVC_HEADER, 4000),
+            (KEYFRAME, 4000)])
+        self.assertEqual(self.getTimestamps()[-1], 6000)
+
+    def test_seek(self):
+        self.player.start()
+        self.clock.advance(0)
+
+        del self.subscriber.video[:]
+
+        self.player.seek(8000)
+        self.clock.advance(0)
+
+        self.assertEqual(self.getTimestamps(), [8000, 8000, 8500, 9000, 9500])
+
+    def test_remove_subscriber(self):
+        self.player.start()
+        self.clock.advance(0)
+
+        self.player.removeSubscriber(self.subscriber)
+
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.player.subscribers, {})
+        self.assertFalse(self.subscriber.unpublished)
+
+
+
+class ApplicationTestCase(unittest.TestCase):
+    """
+    Tests for L{server.Application.vod}.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+        writeFLV(os.path.join(self.path, 'foo.flv'), buildTags(2),
+            meta={'duration': 2})
+
+        self.app = server.Application()
+        self.app.vod = vod.VODLibrary(self.path)
+
+        factory = server.ServerFactory()
+        factory.applications['live'] = self.app
+
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.url = 'rtmp://127.0.0.1:%d/live' % (self.port.getHost().port,)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def openStream(self):
+        d = client.connect(self.url)
+
+        def cb(nc):
+            self.addCleanup(nc.protocol.transport.loseConnection)
+
+            return nc.openStream()
+
+        return d.addCallback(cb)
+
+    def test_path(self):
+        self.assertEqual(self.app.vod.getPath('foo'),
+            os.path.join(self.path, 'foo.flv'))
+        self.assertEqual(self.app.vod.getPath('flv:foo.flv'),
+            os.path.join(self.path, 'foo.flv'))
+        self.assertEqual(self.app.vod.getPath('../foo'),
+            os.path.join(self.path, '..%2Ffoo.flv'))
+
+    def test_live(self):
+        """
+        Live streams are played in preference to files, unless a start
+        position is given.
+        """
+        self.app.streams['foo'] = server.StreamPublisher(None, None)
+
+        self.assertEqual(self.app.playFile('foo', None), None)
+        self.assertEqual(self.app.playFile('foo', None, -1), None)
+        self.assertEqual(self.app.playFile('bar', None, 0), None)
+
+    def test_play(self):
+        subscriber = RecordingSubscriber()
+
+        d = self.openStream()
+
+        d.addCallback(lambda stream: stream.play('foo', subscriber, 1))
+
+        def cb(stream):
+            return waitFor(lambda: subscriber.unpublished)
+
+        def check(result):
+            self.assertEqual(subscriber.meta, [{'duration': 2}])
+            self.assertEqual(subscriber.video, [(AVC_HEADER, 1000),
+                (KEYFRAME, 1000), (INTERFRAME, 1500)])
+
+            stats = self.app.vod.stats
+
+            self.assertEqual((stats['opened'], stats['indexed']), (1, 1))
+
+            return waitFor(lambda: self.app.vod.stats['players'] == 0)
+
+        def closed(result):
+            self.assertEqual(self.app.vod.files, {})
+
+        d.addCallback(cb)
+        d.addCallback(check)
+        d.addCallback(closed)
+
+        return d
+
+    def test_seek(self):
+        subscriber = RecordingSubscriber()
+        self.app.vod.sendAhead = 0
+
+        d = self.openStream()
+
+        d.addCallback(lambda stream: stream.play('foo', subscriber))
+
+        def cb(stream):
+            stream.seek(1000)
+
+            return waitFor(lambda: subscriber.unpublished)
+
+        def check(result):
+            self.assertTrue((KEYFRAME, 1000) in subscriber.video)
+
+        d.addCallback(cb)
+        d.addCallback(check)
+
+        return d
@@ -22,9 +22,19 @@ try:
 except ImportError:
     from StringIO import StringIO
 
+import os
+import sys
+import subprocess
+
 from twisted.internet import error
 
 
+#: The directory that holds the C{rtmpy} package. Trial changes the working
+#: directory, so it is worked out at import time.
+_root = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
 class StringTransport:
     disconnecting = 0
 
@@ -79,4 +89,18 @@ class DummyDelayedCall:
 
     def cancel(self):
         self.cancelled = True
-    
\ No newline at end of file
+    
+
+
+def importsReactor(module):
+    """
+    Whether importing C{module} (in a fresh interpreter) imports, and so
+    installs, the default reactor.
+    """
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join([_root] + sys.path)
+
+    return subprocess.call([sys.executable, '-c',
+        'import sys, %s\n'
+        'sys.exit("twisted.internet.reactor" in sys.modules)' % (module,)],
+        env=env) != 0
@@ -25,6 +25,7 @@ import os.path
 import sys
 import time
 import random
+import binascii
 from urlparse import urlparse
 
 try:
@@ -234,32 +235,37 @@ def uptime():
     return now - boottime
 
 
+#: Maps every byte value onto the readable range 0x41 - 0x7a, see
+#: L{generateBytes}.
+_READABLE_BYTES = ''.join([chr(0x41 + (i % 58)) for i in xrange(256)])
+
+
 def generateBytes(length, readable=False):
     """
     Generates a string of C{length} bytes of pseudo-random data. Used for
     filling in the gaps in unknown sections of the handshake.
 
-    This function is going to to called a lot and is ripe for moving into C.
+    The bytes are generated in one go from C{random.getrandbits} rather than
+    one at a time.
 
     @param length: The number of bytes to generate.
     @type length: C{int}
+    @param readable: Whether to limit the bytes to the range 0x41 - 0x7a.
     @return: A random string of bytes, length C{length}.
     @rtype: C{str}
     @raise TypeError: C{int} expected for C{length}.
     """
-    # FIXME: sloooow
     if not isinstance(length, (int, long)):
         raise TypeError('int expected for length (got:%s)' % (type(length),))
 
-    bytes = ''
+    if length <= 0:
+        return ''
 
-    i, j = 0, 0xff
+    bytes = binascii.unhexlify(
+        '%0*x' % (length * 2, random.getrandbits(length * 8)))
 
     if readable:
-        i, j = 0x41, 0x7a
-
-    for x in xrange(0, length):
-        bytes += chr(random.randint(i, j))
+        bytes = bytes.translate(_READABLE_BYTES)
 
     return bytes
 
@@ -326,4 +332,212 @@ def getFailureMessage(failure):
         except IndexError:
             value = ""
 
-    return value
\ No newline at end of file
+    return value
+
+
+class Timer(object):
+    """
+    A call scheduled on a L{TimerWheel}.
+
+    @ivar rounds: The number of complete turns of the wheel still to go
+        before the timer expires.
+    @ivar slot: The wheel slot that contains this timer.
+    """
+
+    __slots__ = ('wheel', 'slot', 'rounds', 'func', 'args')
+
+
+    def __init__(self, wheel, slot, rounds, func, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.func = func
+        self.args = args
+
+
+    def active(self):
+        """
+        Whether this timer is still waiting to expire.
+        """
+        return self.wheel is not None
+
+
+    def cancel(self):
+        """
+        Stops this timer from expiring. Cancelling an inactive timer does
+        nothing.
+        """
+        if self.wheel is None:
+            return
+
+        self.wheel._remove(self)
+
+
+
+class TimerWheel(object):
+    """
+    Schedules a large number of coarse timeouts with one delayed call.
+
+    Timers are hashed into C{size} slots, each covering C{resolution}
+    seconds. The wheel only ticks when there are timers waiting, so an idle
+    wheel costs nothing. A timer expires between C{delay} and C{delay +
+    resolution} seconds after it was scheduled.
+
+    @ivar resolution: The number of seconds between ticks.
+    @ivar clock: Provides C{callLater} and C{seconds}. Defaults to the
+        reactor.
+    @ivar stats: Counters for the C{scheduled}, C{cancelled} and C{expired}
+        timers.
+    """
+
+
+    def __init__(self, resolution=1.0, size=64, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.resolution = resolution
+        self.clock = clock
+
+        self.slots = [set() for i in xrange(size)]
+        self.current = 0
+        self.count = 0
+
+        self.stats = {
+            'scheduled': 0,
+            'cancelled': 0,
+            'expired': 0,
+        }
+
+        self._tick = None
+
+
+    def __len__(self):
+        return self.count
+
+
+    def schedule(self, delay, func, *args):
+        """
+        Calls C{func(*args)} in (roughly) C{delay} seconds.
+
+        @return: The L{Timer}, call C{cancel} on it to stop it from expiring.
+        """
+        resolution = self.resolution
+
+        if self._tick is None:
+            ticks = max(1, int(-(-delay // resolution)))
+        else:
+            # part of the current tick has already gone by, so count from
+            # when the next one is due
+            remaining = self._tick.getTime() - self.clock.seconds()
+            ticks = max(1, int(-(-(delay - remaining) // resolution)) + 1)
+
+        size = len(self.slots)
+
+        rounds, offset = divmod(ticks - 1, size)
+        slot = (self.current + offset + 1) % size
+
+        timer = Timer(self, slot, rounds, func, args)
+
+        self.slots[slot].add(timer)
+        self.count += 1
+        self.stats['scheduled'] += 1
+
+        if self._tick is None:
+            self._tick = self.clock.callLater(self.resolution, self.tick)
+
+        return timer
+
+
+    def _remove(self, timer):
+        self.slots[timer.slot].discard(timer)
+        self.count -= 1
+        self.stats['cancelled'] += 1
+
+        timer.wheel = None
+
+        if self.count == 0 and self._tick is not None:
+            self._tick.cancel()
+            self._tick = None
+
+
+    def tick(self):
+        """
+        Advances the wheel by one slot, calling any expired timers.
+        """
+        self._tick = None
+        self.current = (self.current + 1) % len(self.slots)
+
+        slot = self.slots[self.current]
+        expired = [t for t in slot if t.rounds == 0]
+
+        for timer in slot:
+            timer.rounds -= 1
+
+        for timer in expired:
+            slot.discard(timer)
+            timer.wheel = None
+
+        self.count -= len(expired)
+        self.stats['expired'] += len(expired)
+
+        if self.count and self._tick is None:
+            self._tick = self.clock.callLater(self.resolution, self.tick)
+
+        for timer in expired:
+            try:
+                timer.func(*timer.args)
+            except:
+                from twisted.python import log
+
+                log.err()
+
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter. Tokens are added at C{rate} per second up to
+    a maximum of C{burst}, each admitted event takes one.
+
+    @ivar tokens: The number of tokens currently available.
+    @ivar last: The time the bucket was last topped up.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+
+    def refill(self, now):
+        """
+        Tops up the bucket for the time elapsed since it was last refilled.
+
+        @param now: The current time, in seconds.
+        @return: The number of tokens available.
+        """
+        elapsed = now - self.last
+
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last = now
+
+        return self.tokens
+
+
+    def consume(self, now, amount=1):
+        """
+        Takes C{amount} tokens from the bucket.
+
+        @param now: The current time, in seconds.
+        @return: Whether there were enough tokens.
+        """
+        if self.refill(now) < amount:
+            return False
+
+        self.tokens -= amount
+
+        return True
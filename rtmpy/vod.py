@@ -0,0 +1,628 @@
+# Copyright the RTMPy Project
+#
+# RTMPy is free software: you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# RTMPy is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with RTMPy.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Video on demand. FLV files (e.g. those written by L{rtmpy.recording}) are
+played from memory maps shared by all the viewers of a file.
+
+Each file has a keyframe index, built the first time it is played and kept
+next to it (C{foo.flv.idx}), so that starting at an offset or seeking is a
+binary search rather than a scan of the file.
+
+Example usage::
+
+    app = server.Application()
+    app.vod = vod.VODLibrary('/var/lib/rtmpy')
+
+@since: 0.2
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import urllib
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from rtmpy import message, flv
+
+
+
+class KeyframeIndex(object):
+    """
+    The points of an FLV file that playback can start from: the video
+    keyframes or, for audio only files, an audio tag every C{audioInterval}
+    milliseconds.
+
+    @ivar timestamps: The (sorted) timestamps of the points.
+    @ivar offsets: The file offsets of the tags at C{timestamps}.
+    @ivar end: The offset just past the last complete tag.
+    @ivar metaOffset: The offset of the C{onMetaData} tag, 0 if there is
+        none. Likewise C{videoConfigOffset} and C{audioConfigOffset} for the
+        AVC and AAC sequence headers.
+    @ivar duration: The timestamp of the last tag.
+    @ivar size: The size of the file the index was built from.
+    @ivar mtime: The modification time of that file.
+    """
+
+    magic = 'RTMPYIDX'
+    version = 1
+
+    #: The spacing of the points in an audio only file.
+    audioInterval = 1000
+
+    _header = struct.Struct('>8sHQdQQQQII')
+
+
+    def __init__(self):
+        self.timestamps = []
+        self.offsets = []
+
+        self.end = 0
+        self.metaOffset = 0
+        self.videoConfigOffset = 0
+        self.audioConfigOffset = 0
+        self.duration = 0
+
+        self.size = 0
+        self.mtime = 0
+
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+    def find(self, timestamp):
+        """
+        Returns the C{(timestamp, offset)} of the last point at or before
+        C{timestamp}, or of the first point if there is none before it.
+        """
+        i = bisect.bisect_right(self.timestamps, timestamp) - 1
+
+        return self.timestamps[max(i, 0)], self.offsets[max(i, 0)]
+
+
+    @classmethod
+    def build(cls, data, size=0, mtime=0):
+        """
+        Scans the FLV file in C{data} (e.g. an C{mmap}).
+        """
+        index = cls()
+        index.size = size
+        index.mtime = mtime
+
+        audio = ([], [])
+        lastAudio = None
+
+        end = flv.decodeHeader(data[:flv.HEADER_SIZE + 4])
+
+        for offset, tagType, length, timestamp in flv.iterTags(data, end):
+            end = offset + flv.TAG_HEADER_SIZE + length + 4
+            start = offset + flv.TAG_HEADER_SIZE
+            head = data[start:start + 2]
+
+            index.duration = timestamp
+
+            if tagType == flv.SCRIPT:
+                if not index.metaOffset:
+                    index.metaOffset = offset
+            elif flv.isSequenceHeader(tagType, head):
+                if tagType == flv.VIDEO:
+                    index.videoConfigOffset = offset
+                else:
+                    index.audioConfigOffset = offset
+            elif tagType == flv.VIDEO:
+                if message.isKeyframe(head):
+                    index.timestamps.append(timestamp)
+                    index.offsets.append(offset)
+            elif tagType == flv.AUDIO:
+                if lastAudio is None or \
+                        timestamp - lastAudio >= cls.audioInterval:
+                    audio[0].append(timestamp)
+                    audio[1].append(offset)
+
+                    lastAudio = timestamp
+
+        index.end = end
+
+        if not index.timestamps:
+            index.timestamps, index.offsets = audio
+
+        return index
+
+
+    def save(self, path):
+        """
+        Writes the index to C{path}. The file is replaced atomically.
+        """
+        count = len(self.timestamps)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+
+        f = open(tmp, 'wb')
+
+        try:
+            f.write(self._header.pack(self.magic, self.version, self.size,
+                self.mtime, self.end, self.metaOffset, self.videoConfigOffset,
+                self.audioConfigOffset, self.duration, count))
+            f.write(struct.pack('>%dI' % (count,), *self.timestamps))
+            f.write(struct.pack('>%dQ' % (count,), *self.offsets))
+        finally:
+            f.close()
+
+        os.rename(tmp, path)
+
+
+    @classmethod
+    def load(cls, path, size=None, mtime=None):
+        """
+        Reads the index at C{path}.
+
+        @return: The index or C{None} if it does not exist, is corrupt or
+            was not built from a file of C{size} bytes modified at C{mtime}.
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        header = cls._header
+
+        if len(data) < header.size:
+            return None
+
+        fields = header.unpack_from(data)
+
+        if fields[:2] != (cls.magic, cls.version):
+            return None
+
+        index = cls()
+
+        (index.size, index.mtime, index.end, index.metaOffset,
+            index.videoConfigOffset, index.audioConfigOffset, index.duration,
+            count) = fields[2:]
+
+        if size is not None and index.size != size:
+            return None
+
+        if mtime is not None and index.mtime != mtime:
+            return None
+
+        if len(data) != header.size + count * 12:
+            return None
+
+        offset = header.size
+
+        index.timestamps = list(struct.unpack_from('>%dI' % (count,), data,
+            offset))
+        index.offsets = list(struct.unpack_from('>%dQ' % (count,), data,
+            offset + count * 4))
+
+        return index
+
+
+
+class VODFile(object):
+    """
+    An FLV file mapped into memory, shared by all of its players.
+
+    @ivar path: The path of the file.
+    @ivar data: The C{mmap} of the file.
+    @ivar index: The L{KeyframeIndex} of the file.
+    @ivar meta: The meta data of the file, if it has any.
+    @ivar indexBuilt: Whether the index had to be built (rather than being
+        loaded from disk).
+    """
+
+
+    def __init__(self, path):
+        self.path = path
+
+        f = open(path, 'rb')
+
+        try:
+            st = os.fstat(f.fileno())
+
+            if st.st_size < flv.HEADER_SIZE + 4:
+                raise flv.FLVError('%r is not an FLV file' % (path,))
+
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        self.indexBuilt = False
+        self.index = KeyframeIndex.load(self.getIndexPath(), st.st_size,
+            st.st_mtime)
+
+        if self.index is None:
+            self.index = KeyframeIndex.build(self.data, st.st_size,
+                st.st_mtime)
+            self.indexBuilt = True
+
+            try:
+                self.index.save(self.getIndexPath())
+            except (IOError, OSError):
+                log.err(None, 'Unable to save the index of %r' % (path,))
+
+        self.meta = None
+
+        if self.index.metaOffset:
+            tagType, data, timestamp, _ = self.readTag(self.index.metaOffset)
+
+            try:
+                self.meta = flv.decodeMetaData(data)
+            except:
+                log.err(None, 'Bad meta data in %r' % (path,))
+
+
+    def getIndexPath(self):
+        return self.path + '.idx'
+
+
+    def readTag(self, offset):
+        """
+        Reads the tag at C{offset}.
+
+        @return: A C{(tagType, data, timestamp, nextOffset)} tuple.
+        """
+        tagType, size, timestamp = flv.decodeTagHeader(self.data, offset)
+        start = offset + flv.TAG_HEADER_SIZE
+
+        return tagType, self.data[start:start + size], timestamp, \
+            start + size + 4
+
+
+    def close(self):
+        self.data.close()
+
+
+
+class VODPlayer(object):
+    """
+    Plays a L{VODFile} to one subscriber (e.g. a server side
+    L{rtmpy.server.NetStream}).
+
+    Rather than a timer per tag, the player wakes every C{interval} seconds
+    and sends every tag that is due within the next C{sendAhead}
+    milliseconds, so the peer's buffer is kept full while no more than
+    C{sendAhead} milliseconds of data are ever queued for a connection.
+
+    Stands in for the L{rtmpy.server.StreamPublisher} the subscriber would
+    play from, see L{removeSubscriber}.
+
+    @ivar offset: The offset of the next tag to send.
+    @ivar position: The timestamp playback (re)started from.
+    @ivar started: When playback (re)started, in C{clock} seconds.
+    """
+
+    #: How far ahead of the playback position tags are sent, in ms.
+    sendAhead = 2000
+
+
+    def __init__(self, file, subscriber, clock, sendAhead=None):
+        self.file = file
+        self.subscriber = subscriber
+        self.subscribers = {subscriber: {}}
+        self.clock = clock
+
+        if sendAhead is not None:
+            self.sendAhead = sendAhead
+
+        self.interval = self.sendAhead / 2000.0
+
+        self.offset = file.index.end
+        self.position = 0
+        self.started = None
+        self.timer = None
+        self.stopped = False
+
+        #: Called once playback has stopped.
+        self.finished = defer.Deferred()
+
+
+    def start(self, position=0):
+        """
+        Starts playing from the last point at or before C{position} (in ms).
+        """
+        self.seek(position)
+
+
+    def seek(self, position):
+        """
+        Moves playback to the last point at or before C{position} (in ms).
+        Nothing is sent until the reactor has had the chance to send any
+        status messages.
+        """
+        index = self.file.index
+
+        if len(index):
+            self.position, self.offset = index.find(max(0, int(position)))
+        else:
+            self.position, self.offset = 0, index.end
+
+        self.started = self.clock.seconds()
+
+        self._sendConfig = True
+        self._schedule(0)
+
+
+    def _schedule(self, delay):
+        self._cancelTimer()
+
+        if not self.stopped:
+            self.timer = self.clock.callLater(delay, self.pump)
+
+
+    def _cancelTimer(self):
+        timer, self.timer = self.timer, None
+
+        if timer is not None and timer.active():
+            timer.cancel()
+
+
+    def sendConfig(self):
+        """
+        Sends the meta data and any sequence headers that are before the
+        playback position, they must precede the first frame that is played.
+        """
+        f = self.file
+        index = f.index
+
+        if f.meta is not None:
+            self.subscriber.onMetaData(f.meta)
+
+        for offset in (index.videoConfigOffset, index.audioConfigOffset):
+            if offset and offset < self.offset:
+                tagType, data, _, _ = f.readTag(offset)
+
+                self.send(tagType, data, self.position)
+
+
+    def send(self, tagType, data, timestamp):
+        if tagType == flv.VIDEO:
+            self.subscriber.videoDataReceived(data, timestamp)
+        elif tagType == flv.AUDIO:
+            self.subscriber.audioDataReceived(data, timestamp)
+
+
+    def pump(self):
+        """
+        Sends the tags that are due within C{sendAhead} milliseconds.
+        """
+        self.timer = None
+
+        if self.stopped:
+            return
+
+        f = self.file
+        index = f.index
+        elapsed = (self.clock.seconds() - self.started) * 1000
+        limit = self.position + elapsed + self.sendAhead
+
+        try:
+            if self._sendConfig:
+                self._sendConfig = False
+                self.sendConfig()
+
+            while self.offset < index.end:
+                tagType, size, timestamp = flv.decodeTagHeader(f.data,
+                    self.offset)
+
+                if timestamp > limit:
+                    break
+
+                tagType, data, timestamp, self.offset = f.readTag(self.offset)
+
+                self.send(tagType, data, timestamp)
+        except:
+            log.err(None, 'Unable to play %r' % (f.path,))
+
+            self.stop()
+
+            return
+
+        if self.offset >= index.end:
+            self.complete()
+
+            return
+
+        self._schedule(self.interval)
+
+
+    def complete(self):
+        """
+        Everything has been sent.
+        """
+        subscriber = self.subscriber
+
+        self.stop()
+
+        try:
+            subscriber.unpublish()
+        except:
+            log.err()
+
+
+    def stop(self):
+        """
+        Stops playing.
+        """
+        if self.stopped:
+            return
+
+        self.stopped = True
+        self._cancelTimer()
+
+        self.subscribers = {}
+
+        self.finished.callback(self)
+
+
+    def removeSubscriber(self, subscriber):
+        """
+        The subscriber has stopped playing.
+        """
+        self.stop()
+
+
+
+class VODLibrary(object):
+    """
+    Plays the FLV files in the directory C{path} for an
+    L{rtmpy.server.Application}, see L{rtmpy.server.Application.vod}.
+
+    Files are opened (and indexed, if need be) in a thread. Each stays
+    mapped while it has players.
+
+    @ivar path: The directory holding the files, named as the
+        L{rtmpy.recording.Recorder} names them.
+    @ivar sendAhead: See L{VODPlayer.sendAhead}.
+    @ivar files: A C{dict} of path -> open L{VODFile}.
+    @ivar stats: Counters for the files C{opened} and C{indexed}, and the
+        number of C{players}.
+    """
+
+
+    def __init__(self, path, sendAhead=VODPlayer.sendAhead, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.path = path
+        self.sendAhead = sendAhead
+        self.reactor = reactor
+        self.clock = reactor
+
+        self.files = {}
+
+        self._players = {}
+        self._opening = {}
+
+        self.stats = {
+            'opened': 0,
+            'indexed': 0,
+            'players': 0,
+        }
+
+
+    def getPath(self, name):
+        """
+        Returns the path of the file for the stream C{name}.
+        """
+        name = unicode(name)
+
+        if name.startswith('flv:'):
+            name = name[4:]
+
+        if name.endswith('.flv'):
+            name = name[:-4]
+
+        return os.path.join(self.path, urllib.quote(name.encode('utf-8'),
+            safe='') + '.flv')
+
+
+    def exists(self, name):
+        return os.path.isfile(self.getPath(name))
+
+
+    def open(self, path):
+        """
+        Returns a L{defer.Deferred} that fires with the L{VODFile} at
+        C{path}.
+        """
+        f = self.files.get(path, None)
+
+        if f is not None:
+            return defer.succeed(f)
+
+        waiting = self._opening.get(path, None)
+
+        if waiting is None:
+            waiting = self._opening[path] = []
+
+            d = threads.deferToThreadPool(self.reactor,
+                self.reactor.getThreadPool(), VODFile, path)
+
+            d.addBoth(self._opened, path)
+
+        d = defer.Deferred()
+        waiting.append(d)
+
+        return d
+
+
+    def _opened(self, result, path):
+        waiting = self._opening.pop(path)
+
+        if not isinstance(result, VODFile):
+            for d in waiting:
+                d.errback(result)
+
+            return
+
+        self.stats['opened'] += 1
+
+        if result.indexBuilt:
+            self.stats['indexed'] += 1
+
+        self.files[path] = result
+        self._players.setdefault(path, 0)
+
+        for d in waiting:
+            d.callback(result)
+
+
+    def play(self, name, subscriber, position=0):
+        """
+        Plays the file for the stream C{name} to C{subscriber} from
+        C{position} (in ms).
+
+        @return: A L{defer.Deferred} that fires with the started
+            L{VODPlayer}.
+        """
+        path = self.getPath(name)
+
+        def cb(f):
+            player = VODPlayer(f, subscriber, self.clock, self.sendAhead)
+
+            self._players[path] += 1
+            self.stats['players'] += 1
+
+            player.finished.addCallback(self._finished, path)
+            player.start(position)
+
+            return player
+
+        return self.open(path).addCallback(cb)
+
+
+    def _finished(self, player, path):
+        self.stats['players'] -= 1
+        self._players[path] -= 1
+
+        if self._players[path]:
+            return
+
+        del self._players[path]
+
+        f = self.files.pop(path, None)
+
+        if f is not None:
+            f.close()